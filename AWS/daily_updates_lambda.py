@@ -1,48 +1,59 @@
-import json
 import time
-import pyarrow
-import pandas as pd
+_MODULE_START = time.perf_counter()
+
+import os
+import sys
+import gzip
+import json
+import logging
+import tempfile
 import boto3
-from io import StringIO
 from sodapy import Socrata
 from datetime import datetime
 
+# Shared pipeline modules are copied next to this file in the Docker image.
+# When running from the repository they live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data pipelines'))
+
+from nyc_collisions.cache import CachedSocrataClient, format_cache_stats
+from nyc_collisions.metrics import MetricsRecorder, format_metrics_summary, measure
+from nyc_collisions.profiling import profiled_run
+
+# The other nyc_collisions modules pull in pandas and pyarrow, so they are imported inside the
+# functions that use them: loading this module stays cheap and a path that does not need
+# them never pays for them. Python caches the modules after the first import.
+
+# ------------------------------------------ CONFIGURATION ------------------------------------------
+SECRET_NAME = os.environ.get('SECRET_NAME')  # name of the secret holding {"app_token": ...} in AWS SecretsManager
+REGION_NAME = os.environ.get('AWS_REGION', 'us-east-1')  # set by the Lambda runtime
+SECRET_TTL_SECONDS = int(os.environ.get('SECRET_TTL_SECONDS', 15 * 60))
+SOCRATA_DOMAIN = 'data.cityofnewyork.us'
+
+# Full results requested with {"result": "ndjson"} or {"result": "parquet"} are written here
+RESULTS_KEY_NAME = 'daily_update_results'
+RESULT_FORMATS = ('ndjson', 'parquet')
+NDJSON_CHUNK_ROWS = 10000
+
+# Catch-up runs work through windows of this many days and checkpoint after each one
+CATCH_UP_WINDOW_DAYS = int(os.environ.get('CATCH_UP_WINDOW_DAYS', 7))
+# Seconds kept back from the Lambda timeout to save the checkpoint and answer
+TIME_RESERVE_SECONDS = float(os.environ.get('TIME_RESERVE_SECONDS', 20))
+# SELF_REINVOKE=1 makes an unfinished run invoke the function again (needs lambda:InvokeFunction)
+SELF_REINVOKE = os.environ.get('SELF_REINVOKE', '0') == '1'
+MAX_REINVOCATIONS = int(os.environ.get('MAX_REINVOCATIONS', 50))
+
+# Clients and secrets kept between invocations while the execution environment stays warm
+_clients = {}
+_secret = {'app_token': None, 'expires': 0.0}
+_cold_start = True
+
 # ------------------------------------------ TOOLS TO INTERACT WITH S3 ------------------------------------------
 def get_latest_date_in_S3(aws_client, bucket_name, key_name):
     """
     Get the latest date available in the specified dataset inside S3 bucket.
 
-    Args:
-    aws_client: Boto3 client for AWS services.
-    dataset_name (str): Name of the dataset.
-    bucket_name (str): Name of the S3 bucket.
-    key_name (str): Key prefix where the dataset is stored.
-
-    Returns:
-    str: The latest date available in the dataset.
-    """
-    all_dates = []
-
-    # List objects in the base prefix
-    response = aws_client.list_objects_v2(Bucket=bucket_name, Prefix=key_name)
-    
-    # Extract dates from object keys for all years and months
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        # Split the object key to extract year and month
-        parts = key.split('/')
-        if len(parts) >= 5: # Assuming a minimum key structure depth
-            # Extract date and add to all_dates list
-            day = parts[3]
-            date_string  = str(datetime.strptime(day, '%Y-%m-%d'))
-            all_dates.append(date_string)
-
-    sorted_dates = sorted(all_dates, reverse=True)
-    return sorted_dates[0]
-
-def get_date_list_in_S3(aws_client, bucket_name, key_name):
-    """
-    Get a list of unique dates available in the specified location inside S3 bucket.
+    The date comes from the partition manifest, which is rebuilt from a full listing
+    of key_name the first time it is needed.
 
     Args:
     aws_client: Boto3 client for AWS services.
@@ -50,27 +61,18 @@ def get_date_list_in_S3(aws_client, bucket_name, key_name):
     key_name (str): Key prefix where the dataset is stored.
 
     Returns:
-    list: A sorted list of unique dates available in the specified location.
+    str: The latest date available in the dataset, i.e. '2024-01-31 00:00:00'.
     """
-    all_dates =[]
+    from nyc_collisions.manifest import latest_date, load_or_rebuild_manifest
 
-    # List objects in the base prefix
-    response = aws_client.list_objects_v2(Bucket=bucket_name, Prefix=key_name)
-    
-    # Extract dates from object keys for all years and months
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        # Split the object key to extract year and month
-        parts = key.split('/')
-        if len(parts) >= 5:
-            # Extract year, month and day from the day object and append to the corresponsding lists
-            all_dates.append(str(datetime.strptime(parts[3], '%Y-%m-%d')))
-           
-    sorted_dates = sorted(set(all_dates), reverse=True)
-    return sorted_dates
+    manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name)
+    date = latest_date(manifest)
+    if date is None:
+        raise ValueError(f"No partitions found under '{bucket_name}/{key_name}'")
+    return str(datetime.strptime(date, '%Y-%m-%d'))
 
 # ------------------------------------------ TOOLS TO EXTRACT DATA FROM SOCRATA API ------------------------------------------
-def fetch_total_records_count(socrata_client, dataset_name, starting_date, current_date):
+def fetch_total_records_count(socrata_client, dataset_name, starting_date, current_date, include_end=True):
     """
     Fetches the total count of records from a Socrata dataset within a specified date range.
 
@@ -79,11 +81,12 @@ def fetch_total_records_count(socrata_client, dataset_name, starting_date, curre
     dataset_name (str): Name of the dataset to query.
     starting_date (str): Start date of the date range in 'YYYY-MM-DD' format.
     current_date (str): End date of the date range in 'YYYY-MM-DD' format.
+    include_end (bool): Count records on current_date itself, False for a half-open window.
 
     Returns:
     int: Total count of records within the specified date range. Returns 0 if there are no records or an error occurs.
     """
-    count_query = f"SELECT COUNT(*) WHERE crash_date BETWEEN '{starting_date}' AND '{current_date}'"
+    count_query = f"SELECT COUNT(*) WHERE {crash_date_filter(starting_date, current_date, include_end)}"
     response = socrata_client.get(dataset_name, query=count_query)
     
     if response:
@@ -92,7 +95,32 @@ def fetch_total_records_count(socrata_client, dataset_name, starting_date, curre
     else:
         return 0
 
-def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
+def fetch_first_crash_date(socrata_client, dataset_name, start_date, end_date):
+    """
+    Find the first day with crashes in [start_date, end_date).
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to query.
+    start_date (datetime): Start of the range (included).
+    end_date (datetime): End of the range (excluded).
+
+    Returns:
+    datetime: Midnight of the first day with crashes, None if there are none.
+    """
+    where = crash_date_filter(f"{start_date:%Y-%m-%dT%H:%M:%S}", f"{end_date:%Y-%m-%dT%H:%M:%S}", include_end=False)
+    response = socrata_client.get(dataset_name, query=f"SELECT min(crash_date) AS first_date WHERE {where}")
+    if not response or not response[0].get('first_date'):
+        return None
+    return datetime.strptime(response[0]['first_date'][:10], '%Y-%m-%d')
+
+def crash_date_filter(starting_date, current_date, include_end=True):
+    """Return the SoQL filter of a crash_date range, closed or half-open ([start, end))."""
+    if include_end:
+        return f"crash_date BETWEEN '{starting_date}' AND '{current_date}'"
+    return f"crash_date >= '{starting_date}' AND crash_date < '{current_date}'"
+
+def fetch_data_from_socrata(socrata_client, dataset_name, start_date, end_date=None, budget=None, metrics=None):
     """
     Fetches data from a Socrata dataset starting from a specified date.
 
@@ -100,210 +128,513 @@ def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
     socrata_client: Socrata client for interacting with the Socrata API.
     dataset_name (str): Name of the dataset to fetch data from.
     start_date (str): Start date for fetching data in 'YYYY-MM-DD HH:MM:SS' format.
+    end_date (datetime): End of a catch-up window (excluded). Defaults to now (included).
+    budget (TimeBudget): Checked after every page, so a window can be abandoned before the
+    invocation times out.
+    metrics (MetricsRecorder): Records the 'fetch' stage (rows and requests) if given.
 
     Returns:
     pandas.DataFrame: DataFrame containing the fetched data.
+
+    Raises:
+    TimeBudgetExceeded: If the budget runs out before the last page.
     """
+    from nyc_collisions.paging import iter_keyset_pages
+    from nyc_collisions.schema import concat_frames, format_memory_report, memory_report, records_to_frame
  
     chunk_size = 3000
-    results = []
-    start = 0
+    frames = []
     number_of_requests_sent = 0
     
     # Rewrite the date strings so we can call the Socrata API -> i.e. '2020-01-01T00:00:00'
     date_format = "%Y-%m-%d %H:%M:%S"
     date_object = datetime.strptime(start_date, date_format)
     starting_date = str(date_object).replace(" ", "T")
-    current_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-
-    # Get the total number of records between the start and current dates
-    total_records =  fetch_total_records_count(socrata_client, dataset_name, starting_date, current_date)
+    current_date = (end_date or datetime.now()).strftime("%Y-%m-%dT%H:%M:%S")
+    include_end = end_date is None
 
-    # Calling the Socrata API. Extracting data in chunks of 3,000 records
-    while True:
+    with measure(metrics, 'fetch', start_date=starting_date) as stage:
+        # Get the total number of records between the start and current dates
+        total_records =  fetch_total_records_count(socrata_client, dataset_name, starting_date, current_date, include_end)
 
-        data_chunk  = socrata_client.get(
+        # Calling the Socrata API. Extracting data in chunks of 3,000 records, paging on collision_id.
+        # Each chunk is cast to the compact crash schema as soon as it arrives.
+        for data_chunk in iter_keyset_pages(
+            socrata_client,
             dataset_name,
-            where=f"crash_date BETWEEN '{starting_date}' AND '{current_date}'",
-            offset=start, 
-            limit=chunk_size, 
-            order='collision_id'
-            )
-        if not data_chunk:
-            # If the current data chunk is empty, we have fetched all available records
-            break
-
-        results.extend(data_chunk)
-        start += chunk_size
-        number_of_requests_sent += 1
-
-    data = pd.DataFrame.from_records(results)
-    rec_tot = data.shape[0]
+            chunk_size=chunk_size,
+            where=crash_date_filter(starting_date, current_date, include_end)
+            ):
+            frames.append(records_to_frame(data_chunk))
+            number_of_requests_sent += 1
+            stage.add(requests=1)
+            if budget is not None:
+                budget.check()
+
+        data = concat_frames(frames)
+        rec_tot = data.shape[0]
+        # The count query is a request too
+        stage.add(rows=rec_tot, requests=1)
 
     print()
-    print(f"Brute Force Approach for Daily Upload!")
+    print("Brute Force Approach for Daily Upload!")
     print(f"Socrata API is returning: {total_records} records")
     print(f'This dataset has {rec_tot} records')
+    print(f"Memory: {format_memory_report(memory_report(data))}")
     print(f"Latest record available in S3 is for date: {starting_date}")
     print(f"current date is {current_date}")
     print(f"Number of requests sent: {number_of_requests_sent}")
-    print(f"")
+    print("")
 
     return data
 
-# ------------------------------------------ TRANSFORMING DATA FOR S3 UPLOAD ------------------------------------------
-def transform_data(socrata_dataset, date_column_name, time_column_name):
+# ------------------------------------------ UPLOADING DATA TO S3 ------------------------------------------
+def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format='csv', compression='snappy',
+                           max_workers=None, folder_markers=False, content_encoding=None):
     """
-    Transforms the given Socrata dataset by converting date and time columns to datetime objects,
-    extracting year, month, day, hour, and minute, and dropping the original time column.
+    Uploads a DataFrame to S3 bucket, partitioned by date.
+
+    The DataFrame is split into days in a single pass and the days are uploaded concurrently,
+    sharing aws_client.
 
     Args:
-    socrata_dataset (pandas.DataFrame): The Socrata dataset to transform.
-    date_column_name (str): The name of the column containing the date information.
-    time_column_name (str): The name of the column containing the time information.
+    aws_client: Boto3 client for AWS services.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name under which data will be stored in S3.
+    DataFrame (pandas.DataFrame): DataFrame to upload.
+    date_column_name (str): Name of the column containing the date information.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Number of partitions uploaded at the same time, DEFAULT_UPLOAD_WORKERS if None.
+    folder_markers (bool): Also create the empty year/month/day '.../' objects for new days.
+    Off by default: S3 needs nothing but the data objects.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet.
 
     Returns:
-    None. The transformation is applied directly to the input DataFrame.
+    dict: The write_partitions report, with the bytes and latency of every partition.
+    The partitions are also recorded in the manifest.
     """
-    # Convert date column to a pandas datetime object
-    socrata_dataset[date_column_name] = pd.to_datetime(socrata_dataset[date_column_name])
-
-    # Convert time column to pandas datetime object with custom format
-    try:
-        socrata_dataset[time_column_name] = pd.to_datetime(socrata_dataset[time_column_name], format='%H:%M')
-    except ValueError as e:
-        print("Error occurred while parsing time column:")
-        for value in socrata_dataset[time_column_name]:
-            try:
-                pd.to_datetime(value, format='%H:%M')
-            except ValueError:
-                print(f"Invalid value: {value}")
-
-    # Extract year, month, day, hour, and minute from the date and time columns
-    socrata_dataset['crash_year'] = socrata_dataset[date_column_name].dt.year
-    socrata_dataset['crash_month'] = socrata_dataset[date_column_name].dt.month
-    socrata_dataset['crash_day'] = socrata_dataset[date_column_name].dt.day
-    socrata_dataset['crash_hour'] = socrata_dataset[time_column_name].dt.hour
-    socrata_dataset['crash_minute'] = socrata_dataset[time_column_name].dt.minute
-
-    # Drop the original time column
-    socrata_dataset.drop([time_column_name], axis=1, inplace=True)
+    from nyc_collisions.manifest import load_or_rebuild_manifest, partition_exists, update_manifest
+    from nyc_collisions.partitions import DEFAULT_UPLOAD_WORKERS, print_partition_report, write_partitions
+
+    max_workers = max_workers or DEFAULT_UPLOAD_WORKERS
+
+    # Existing days are looked up in the manifest instead of listing S3 for every date
+    manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name) if folder_markers else None
+
+    def create_day_subfolders(date):
+        year = date.year 
+        month = date.month 
+        day = date.day 
+        date_string = f"{year}-{month:02d}-{day:02d}" # Construct date_string in the desired format
+
+        # Create the year, month and day subfolders for a day we have not stored yet
+        if folder_markers and not partition_exists(manifest, date_string):
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/")
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/")
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/{date_string}/")
+                
+        # Log the upload process
+        logging.info(f"Uploading file to S3 for: {date_string}")
+
+    report = write_partitions(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format=output_format,
+                              compression=compression, max_workers=max_workers, before_upload=create_day_subfolders,
+                              content_encoding=content_encoding)
+    print_partition_report(report)
+
+    # Record the new partitions so the next run finds them without listing the bucket
+    update_manifest(aws_client, bucket_name, key_name, report['partitions'])
+    return report
+
+# ------------------------------------------ TOOLS TO RETURN THE RESULT ------------------------------------------
+def write_result_to_s3(aws_client, bucket_name, DataFrame, result_format='ndjson', run_time=None, name=None):
+    """
+    Write the full result of a run to S3, instead of returning it in the Lambda response.
 
-# ------------------------------------------ UPLOADING DATA TO S3 ------------------------------------------
-def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name):
+    NDJSON is written a chunk of rows at a time through gzip into a temporary file, which is
+    streamed to S3, so the whole result never exists as one JSON string in memory.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    DataFrame (pandas.DataFrame): The rows uploaded by the run.
+    result_format (str): 'ndjson' (gzip-compressed, one record per line) or 'parquet' (snappy).
+    run_time (datetime): Time of the run, used in the key. Defaults to now.
+    name (str): Name of the object under RESULTS_KEY_NAME instead of the run time, without extension.
+
+    Returns:
+    dict: key and bytes of the stored object.
     """
-    Uploads a DataFrame to S3 bucket, partitioned by date.
+    from nyc_collisions.formats import serialize_dataframe
+
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format '{result_format}', expected one of {RESULT_FORMATS}")
+    run_time = run_time or datetime.now()
+    key = f"{RESULTS_KEY_NAME}/{name or f'{run_time:%Y-%m-%dT%H-%M-%S}'}"
+
+    if result_format == 'parquet':
+        key += '.parquet'
+        body = serialize_dataframe(DataFrame, 'parquet')
+        aws_client.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType='application/vnd.apache.parquet')
+        return {'key': key, 'bytes': len(body)}
+
+    key += '.ndjson.gz'
+    with tempfile.TemporaryFile() as result_file:
+        with gzip.GzipFile(fileobj=result_file, mode='wb', compresslevel=6) as gzip_file:
+            for start in range(0, len(DataFrame), NDJSON_CHUNK_ROWS):
+                chunk = DataFrame.iloc[start:start + NDJSON_CHUNK_ROWS]
+                lines = chunk.to_json(orient='records', lines=True, date_format='iso')
+                gzip_file.write(lines.encode('utf-8'))
+                if not lines.endswith('\n'):
+                    gzip_file.write(b'\n')
+        size = result_file.tell()
+        result_file.seek(0)
+        aws_client.upload_fileobj(result_file, bucket_name, key, ExtraArgs={
+            'ContentType': 'application/x-ndjson',
+            'ContentEncoding': 'gzip',
+            })
+    return {'key': key, 'bytes': size}
+
+def build_run_summary(start_date, DataFrame, transform_report, upload_report, rollup_report=None):
+    """
+    Build the compact response of a daily run: counts, keys and bytes, never the rows themselves.
 
     Args:
-    aws_client: Boto3 client for AWS services.
+    start_date (str): Date the run fetched from.
+    DataFrame (pandas.DataFrame): The rows uploaded by the run.
+    transform_report (dict): Report returned by transform_data.
+    upload_report (dict): Report returned by upload_dataframe_to_s3.
+    rollup_report (dict): Report returned by update_rollups, if the rollups were updated.
+
+    Returns:
+    dict: JSON-serializable run summary.
+    """
+    partitions = upload_report['partitions']
+    return {
+        'mode': 'daily',
+        'start_date': start_date,
+        'rows_fetched': len(DataFrame),
+        'invalid_dates': int(transform_report['invalid_dates']),
+        'invalid_times': int(transform_report['invalid_times']),
+        'boroughs_filled': (transform_report.get('boroughs') or {}).get('filled', 0),
+        'partitions_written': len(partitions),
+        'partition_keys': [partition['key'] for partition in partitions],
+        'rows_written': upload_report['rows'],
+        'bytes_written': upload_report['bytes'],
+        'upload_seconds': upload_report['seconds'],
+        'rollup_slices_written': len(rollup_report['slices']) if rollup_report else 0,
+        'rollup_errors': rollup_report['errors'] if rollup_report else [],
+        'errors': upload_report['errors'],
+    }
+
+def combine_run_summaries(start_date, summaries):
+    """
+    Add up the build_run_summary of every window written by one invocation.
+
+    Returns:
+    dict: A run summary over all the windows, with the keys of their full results (if any)
+    in result_keys.
+    """
+    combined = build_run_summary(start_date, [], {'invalid_dates': 0, 'invalid_times': 0},
+                                 {'partitions': [], 'rows': 0, 'bytes': 0, 'seconds': 0, 'errors': []})
+    combined.update(result_keys=[], result_bytes=0)
+    for summary in summaries:
+        for field in ('rows_fetched', 'invalid_dates', 'invalid_times', 'boroughs_filled', 'partitions_written',
+                      'rollup_slices_written', 'rows_written', 'bytes_written', 'upload_seconds', 'partition_keys',
+                      'rollup_errors', 'errors'):
+            combined[field] += summary[field]
+        if 'result_key' in summary:
+            combined['result_keys'].append(summary['result_key'])
+            combined['result_bytes'] += summary['result_bytes']
+    combined['upload_seconds'] = round(combined['upload_seconds'], 3)
+    return combined
+
+# ------------------------------------------ CATCH-UP WITH CHECKPOINTS ------------------------------------------
+def run_daily_update(socrata_client, aws_client, bucket_name, key_name, dataset_name, output_format='csv',
+                     result_format=None, budget=None, window_days=CATCH_UP_WINDOW_DAYS, metrics=None):
+    """
+    Bring the partitions up to date, in windows of whole days that fit in the time budget.
+
+    The run resumes from the checkpoint left by an earlier invocation, or starts at the latest
+    day in S3 (fetched again in full). Every window starts on the next day that has crashes,
+    so days without any are skipped for one query. After each window is written the
+    checkpoint moves past it; a window that would not finish in time is left for the next
+    invocation. The checkpoint is deleted once the run reaches now.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    aws_client: Boto3 client for AWS S3.
     bucket_name (str): Name of the S3 bucket.
-    key_name (str): Base key name under which data will be stored in S3.
-    DataFrame (pandas.DataFrame): DataFrame to upload.
-    date_column_name (str): Name of the column containing the date information.
+    key_name (str): Base key name of the partitioned data.
+    dataset_name (str): Name of the dataset to fetch data from.
+    output_format (str): 'csv' or 'parquet'.
+    result_format (str): Also write every window's rows to S3, 'ndjson' or 'parquet'.
+    budget (TimeBudget): Time left in the invocation; unlimited if None.
+    window_days (int): Days fetched and written per window.
+    metrics (MetricsRecorder): Records the fetch, transform, upload, result and checkpoint
+    stages of every window if given.
 
     Returns:
-    None
+    dict: The combined run summary, plus complete, cursor, windows (in this invocation)
+    and invocations (of the whole run).
     """
-    date_list = list(set(DataFrame[date_column_name]))
+    from nyc_collisions.checkpoint import (TimeBudget, TimeBudgetExceeded, clear_checkpoint, iter_date_windows,
+                                           load_checkpoint, new_checkpoint, save_checkpoint)
+    from nyc_collisions.partitions import add_partition_metrics
+    from nyc_collisions.rollups import add_rollup_metrics, format_rollup_report, update_rollups
+    from nyc_collisions.transform import print_transform_report, transform_data
+
+    budget = budget or TimeBudget()
+    run_time = datetime.now()
+    checkpoint = load_checkpoint(aws_client, bucket_name, key_name)
+    if checkpoint is None:
+        checkpoint = new_checkpoint(get_latest_date_in_S3(aws_client, bucket_name, key_name)[:10])
+    else:
+        print(f"Resuming the catch-up started at {checkpoint['started_at']} from {checkpoint['cursor']}")
+    checkpoint['invocations'] += 1
+    start_date = checkpoint['cursor']
+
+    summaries = []
+    windows = 0
+    slowest_window = 0.0
+    complete = True
+
+    def first_day(window_start, end_date):
+        with measure(metrics, 'find_next_day') as stage:
+            stage.add(requests=1)
+            return fetch_first_crash_date(socrata_client, dataset_name, window_start, end_date)
+
+    for window_start, window_end in iter_date_windows(checkpoint['cursor'], run_time, window_days, first_day):
+        # Only start a window that should finish before the deadline, judging by the slowest one so far
+        if not budget.allows(slowest_window):
+            complete = False
+            break
 
-    for date in date_list:
+        window_started = time.perf_counter()
         try:
-            year = date.year 
-            month = date.month 
-            day = date.day 
-            date_string = f"{year}-{month:02d}-{day:02d}" # Construct date_string in the desired format
-            day_subfolder_key = f"{key_name}/{year}/{month:02d}/{date_string}/" # Construct the key path for the day subfolder
-            
-            year_exists = get_date_list_in_S3(aws_client, bucket_name, key_name) # Collect list of available dates in S3
-
-            # Create the year subfolder if it doesn't exist
-            if year not in year_exists:
-                aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/")
-
-                # Check if the month subfolder exists within the year subfolder
-                month_exists = get_date_list_in_S3(aws_client, bucket_name, f"{key_name}/{year}/")
-                if month not in month_exists:    
-                    aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/")
-
-                    # Check if the day subfolder exists within the month subfolder
-                    day_exists = get_date_list_in_S3(aws_client, bucket_name, f"{key_name}/{year}/{month:02d}/{date_string}/")
-                    if day not in day_exists:
-                        aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/{date_string}/")
-                    
-            # Log the upload process
-            #logging.info(f"Uploading file to S3 for: {date_string}")
-            print(f'Uploaded file for {date_string}')
-
-            # Filter DataFrame for records corresponding to the current date
-            subset_df = DataFrame[DataFrame[date_column_name].dt.date == date.date()]
-
-            # Save the subset DataFrame as a CSV file in memory
-            csv_buffer = StringIO()
-            subset_df.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
-
-            # Upload the CSV file to S3 under the day subfolder
-            aws_client.put_object(Bucket=bucket_name, Key=f"{day_subfolder_key}{date_string}.csv", Body=csv_buffer.getvalue())
-        
-        except Exception as e:
-            print(f"Error occurred while processing date {date}: {e}")
-
-# Initialize Socrata client
+            api_data = fetch_data_from_socrata(socrata_client, dataset_name, str(window_start), window_end, budget,
+                                               metrics)
+        except TimeBudgetExceeded as e:
+            # Nothing of this window has been written yet, the next invocation fetches it again
+            print(f"Stopping before {window_start:%Y-%m-%d}: {e}")
+            complete = False
+            break
+
+        if len(api_data):
+            with measure(metrics, 'transform') as stage:
+                api_data, transform_report = transform_data(api_data, 'crash_date', 'crash_time')
+                stage.add(rows=transform_report['rows'],
+                          errors=int(transform_report['invalid_dates']) + int(transform_report['invalid_times']))
+            print_transform_report(transform_report)
+            with measure(metrics, 'upload', output_format=output_format) as stage:
+                upload_report = upload_dataframe_to_s3(aws_client, bucket_name, key_name, api_data, 'crash_date',
+                                                       output_format=output_format)
+                add_partition_metrics(stage, upload_report)
+            # Dashboard rollups of the days just written, before the checkpoint moves past them
+            with measure(metrics, 'rollups') as stage:
+                rollup_report = update_rollups(aws_client, bucket_name, key_name, api_data,
+                                               days=[partition['date'] for partition in upload_report['partitions']])
+                add_rollup_metrics(stage, rollup_report)
+            print(format_rollup_report(rollup_report))
+            summary = build_run_summary(str(window_start), api_data, transform_report, upload_report, rollup_report)
+            if result_format:
+                with measure(metrics, 'result', result_format=result_format) as stage:
+                    result = write_result_to_s3(aws_client, bucket_name, api_data, result_format,
+                                                name=f"{run_time:%Y-%m-%dT%H-%M-%S}/{window_start:%Y-%m-%d}")
+                    stage.add(rows=len(api_data), bytes=result['bytes'], requests=1)
+                summary.update(result_key=result['key'], result_bytes=result['bytes'])
+            summaries.append(summary)
+            if upload_report['errors']:
+                # Keep the cursor on this window so the failed days are written again
+                complete = False
+                break
+            checkpoint['rows_written'] += upload_report['rows']
+            checkpoint['days_written'] += [partition['date'] for partition in upload_report['partitions']]
+
+        checkpoint['cursor'] = f"{window_end:%Y-%m-%d}"
+        checkpoint['windows'] += 1
+        windows += 1
+        with measure(metrics, 'checkpoint') as stage:
+            save_checkpoint(aws_client, bucket_name, key_name, checkpoint)
+            stage.add(requests=1)
+        slowest_window = max(slowest_window, time.perf_counter() - window_started)
+
+    if complete:
+        checkpoint['cursor'] = f"{run_time:%Y-%m-%d}"
+        clear_checkpoint(aws_client, bucket_name, key_name)
+    else:
+        save_checkpoint(aws_client, bucket_name, key_name, checkpoint)
+        print(f"Checkpoint saved: {checkpoint['cursor']} is the next day to fetch")
+
+    summary = combine_run_summaries(start_date, summaries)
+    summary.update(complete=complete, cursor=checkpoint['cursor'], windows=windows,
+                   invocations=checkpoint['invocations'])
+    return summary
+
+def reinvoke(context, event):
+    """
+    Invoke this function again, asynchronously, to continue an unfinished catch-up.
+
+    Args:
+    context: Lambda context of the current invocation.
+    event (dict): Event of the current invocation, passed on with its reinvocation count.
+
+    Returns:
+    bool: True if the function was invoked, False once MAX_REINVOCATIONS is reached.
+    """
+    reinvocations = (event or {}).get('reinvocations', 0) + 1
+    if reinvocations > MAX_REINVOCATIONS:
+        print(f"Not invoking again: {MAX_REINVOCATIONS} reinvocations reached")
+        return False
+    get_aws_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(dict(event or {}, reinvocations=reinvocations)).encode('utf-8'),
+        )
+    return True
+
+# ------------------------------------------ CLIENTS AND SECRETS ------------------------------------------
+def get_aws_client(service_name):
+    """
+    Return a boto3 client for service_name, created once per execution environment.
+
+    boto3 clients are thread safe and keep their connection pool, so warm invocations
+    reuse both instead of paying for client creation and new TLS handshakes.
+    """
+    if service_name not in _clients:
+        _clients[service_name] = boto3.client(service_name=service_name, region_name=REGION_NAME)
+    return _clients[service_name]
+
+def get_app_token():
+    """
+    Return the Socrata app token from AWS SecretsManager.
+
+    The token is cached for SECRET_TTL_SECONDS, so a rotated secret is picked up within
+    that time without calling SecretsManager on every invocation.
+
+    Returns:
+    str: The app token.
+    """
+    if _secret['app_token'] is None or time.time() >= _secret['expires']:
+        if not SECRET_NAME:
+            raise ValueError("Set the SECRET_NAME environment variable to the SecretsManager secret with the app token")
+        get_secret_value_response = get_aws_client('secretsmanager').get_secret_value(SecretId=SECRET_NAME)
+        secret_dict = json.loads(get_secret_value_response['SecretString'])
+        _secret.update(app_token=secret_dict['app_token'], expires=time.time() + SECRET_TTL_SECONDS)
+    return _secret['app_token']
+
 def initialize_socrata_client():
-    # Set up AWS client for SecretsManager
-    secret_name = <name_of_secret> # name of secret stored in AWS SecretsManager
-    region_name = <region> # AWS region name from user account
-    session = boto3.session.Session()
-    client = session.client(service_name='secretsmanager', region_name=region_name)
-
-    # Extract app token from SecretsManager
-    get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    secret_string = get_secret_value_response['SecretString']
-    secret_dict = json.loads(secret_string)
-    app_token = secret_dict['app_token']
-
-    # Set up Socrata client
-    data_url = 'data.cityofnewyork.us'
-    return Socrata(data_url, app_token)
-            
+    """
+    Return the Socrata client, reused across warm invocations.
+
+    The client, and its requests.Session, is rebuilt only when the app token changes.
+    With SOCRATA_CACHE_DIR (i.e. '/tmp/socrata') set it is wrapped in CachedSocrataClient,
+    whose index of the local cache is then built once per execution environment too.
+    """
+    app_token = get_app_token()
+    if _clients.get('socrata_app_token') != app_token:
+        socrata_client = Socrata(SOCRATA_DOMAIN, app_token)
+        cache_dir = os.environ.get('SOCRATA_CACHE_DIR')
+        if cache_dir:
+            socrata_client = CachedSocrataClient(socrata_client, cache_dir, max_bytes=256 * 1024 ** 2)
+        if 'socrata' in _clients:
+            _clients['socrata'].close()
+        _clients.update(socrata=socrata_client, socrata_app_token=app_token)
+    return _clients['socrata']
+
+# Time spent importing and configuring this module, reported by the first (cold) invocation
+_MODULE_INIT_SECONDS = time.perf_counter() - _MODULE_START
+
 # Lambda handler function
+# {"profile": true} (or "cpu") in the event, or PROFILE=1/cpu, writes cProfile and tracemalloc reports to /tmp/profiles and the log
+@profiled_run('daily_updates_lambda', enabled_by=lambda event, context: (event or {}).get('profile'))
 def lambda_handler(event, context):
-    # Initialize Socrata client
-    socrata_client = initialize_socrata_client()
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+
+    # One EMF line per stage (init, fetch, transform, upload, ...), turned into CloudWatch metrics
+    metrics = MetricsRecorder('daily_updates_lambda')
+
+    # Clients and secrets are only created on a cold start (or when the secret's TTL runs out)
+    init_start = time.perf_counter()
+    with metrics.stage('init', cold_start=cold_start):
+        socrata_client = initialize_socrata_client()
+        aws_client = get_aws_client('s3')
+    init_seconds = time.perf_counter() - init_start + (_MODULE_INIT_SECONDS if cold_start else 0)
 
-    # Set up AWS client for S3
-    aws_client = boto3.client(service_name='s3', region_name=<region>)
-    
     # S3 bucket and key 
     bucket_name = 'nyc-application-collisions'
     key_name = 'collisions_processed_data'
     crash_data_set = 'h9gi-nx95'
-    
-    start_time = time.time()
 
-    # Get the latest date available from S3
-    start_date = get_latest_date_in_S3(aws_client, bucket_name, key_name)
+    # Partitions are written as CSV unless the event asks for i.e. {"output_format": "parquet"}
+    output_format = (event or {}).get('output_format', 'csv')
 
-    # Make a call to Socrata API using the date range
-    api_data = fetch_data_from_socrata(socrata_client, crash_data_set, start_date)
-
-    # Transform api_data prior to uploading to S3
-    transform_data(api_data, 'crash_date', 'crash_time')
-    print(f"The Socrata data has been transformed!")
-
-    # Upload data to S3
-    upload_dataframe_to_s3(aws_client, bucket_name, key_name, api_data, 'crash_date')
-    print(f"Daily Upload has been completed!")
+    # The response is a run summary. {"result": "ndjson"} or {"result": "parquet"} also stores
+    # every uploaded row in S3 and adds the keys to the summary.
+    result_format = (event or {}).get('result')
+    
+    start_time = time.time()
+    work_start = time.perf_counter()
+
+    def log_timing():
+        # One JSON line per invocation, so cold and warm starts can be compared in CloudWatch Logs Insights
+        timing = {
+            'cold_start': cold_start,
+            'init_seconds': round(init_seconds, 4),
+            'work_seconds': round(time.perf_counter() - work_start, 4),
+        }
+        print(json.dumps(timing))
+        return timing
+
+    # {"mode": "incremental"} fetches only the records created or edited since the last run
+    if (event or {}).get('mode') == 'incremental':
+        from nyc_collisions.incremental import print_incremental_report, run_incremental_update
+
+        with metrics.stage('incremental', output_format=output_format) as stage:
+            summary = run_incremental_update(socrata_client, aws_client, crash_data_set, bucket_name, key_name,
+                                             output_format=output_format)
+            stage.add(rows=summary['changed'], requests=summary['pages'], partitions=summary['partitions_written'],
+                      errors=len(summary['errors']))
+        print_incremental_report(summary)
+        print(f"Execution time: {time.time() - start_time} seconds\n")
+        summary['timing'] = log_timing()
+        summary['stages'] = metrics.summary()
+        return {
+            'statusCode': 200,
+            'body': json.dumps(summary)
+        }
+
+    from nyc_collisions.checkpoint import TimeBudget
+
+    # Fetch, transform and upload everything since the latest day in S3 (or the checkpoint),
+    # a window of days at a time, stopping before the invocation runs out of time
+    budget = TimeBudget(context, reserve_seconds=TIME_RESERVE_SECONDS)
+    summary = run_daily_update(socrata_client, aws_client, bucket_name, key_name, crash_data_set,
+                               output_format=output_format, result_format=result_format, budget=budget,
+                               window_days=int((event or {}).get('window_days', CATCH_UP_WINDOW_DAYS)), metrics=metrics)
+    if summary['complete']:
+        print("Daily Upload has been completed!")
+    else:
+        print(f"Daily Upload will continue from {summary['cursor']}")
+        if SELF_REINVOKE and context is not None:
+            summary['reinvoked'] = reinvoke(context, event)
+    if isinstance(socrata_client, CachedSocrataClient):
+        print(format_cache_stats(socrata_client.stats))
+    for result_key in summary['result_keys']:
+        print(f"Full result written to s3://{bucket_name}/{result_key}")
 
     execution_time = time.time() - start_time
     print(f"Execution time: {execution_time} seconds\n")
+    print(format_metrics_summary(metrics.summary()))
+    summary['timing'] = log_timing()
+    summary['stages'] = metrics.summary()
 
-    # Convert Timestamp objects to strings
-    api_data['crash_date'] = api_data['crash_date'].astype(str)
-
+    # A summary instead of the rows: a catch-up run would exceed the 6 MB response limit
     return {
         'statusCode': 200,
-        'body': json.dumps(api_data.to_dict(orient='records'))  # Return the DataFrame as JSON
+        'body': json.dumps(summary)
     }
 
 if __name__ == "__main__":
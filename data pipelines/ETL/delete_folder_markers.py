@@ -0,0 +1,34 @@
+import os
+import sys
+import argparse
+import boto3
+
+# Shared pipeline modules live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.partitions import delete_folder_markers
+
+###########################################################################################
+############################## One-off cleanup of folder markers ##########################
+#
+# The writers no longer create the empty 'YYYY/', 'YYYY/MM/' and 'YYYY/MM/YYYY-MM-DD/'
+# placeholder objects. This removes the ones earlier runs left behind, up to 1000 per
+# delete_objects request. Run it with --dry-run first to see how many there are.
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete zero-byte folder placeholder objects from the collisions bucket.')
+    parser.add_argument('--bucket', default='nyc-application-collisions', help='S3 bucket name')
+    parser.add_argument('--prefix', default='collisions_processed_data/', help='only clean up keys under this prefix')
+    parser.add_argument('--dry-run', action='store_true', help='count the markers without deleting them')
+    args = parser.parse_args()
+
+    aws_client = boto3.client(service_name='s3', region_name='us-east-1')
+    summary = delete_folder_markers(aws_client, args.bucket, args.prefix, dry_run=args.dry_run)
+
+    print(f"Folder markers found under '{args.bucket}/{args.prefix}': {summary['markers']}")
+    if not args.dry_run:
+        print(f"Deleted {summary['deleted']} in {summary['delete_requests']} delete_objects requests")
+    for error in summary['errors']:
+        print(f"Could not delete '{error['key']}': {error['error']}")
+
+if __name__ == "__main__":
+    main()
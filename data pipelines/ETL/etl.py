@@ -1,84 +1,23 @@
+import os
+import sys
 import time
-import pyarrow
-import pandas as pd
 import boto3
-from io import StringIO, BytesIO
 
-###########################################################################################
-################################### Extraction Function ###################################
-
-def extract_csv_from_s3(aws_client, bucket_name, file_name):
-    try:
-        # Get the object from S3
-        response = aws_client.get_object(Bucket=bucket_name, Key=file_name)
-
-        # Read the CSV file content from the response
-        csv_content = response['Body'].read()
-
-        # Load the CSV content into a DataFrame
-        df = pd.read_csv(BytesIO(csv_content))
-
-        return df
-
-    except Exception as e:
-        print(f"Error occurred during extraction: {e}")
-        return None
-
-    
-###########################################################################################
-##################################### Transformations #####################################
-
-def transform_data(dataset, date_column_name, time_column_name):
-    """
-    Transforms a given dataset by converting date and time columns to datetime objects,
-    extracting year, month, day, hour, and minute, and replacing the original date and time columns 
-    with a concatenated new column called date_time.
-
-    Args:
-    dataset (pandas.DataFrame): The dataset to transform.
-    date_column_name (str): The name of the column containing the date information.
-    time_column_name (str): The name of the column containing the time information.
-
-    Returns:
-    None. The transformation is applied directly to the input DataFrame.
-    """
-    
-    # Convert date column to a pandas datetime object
-
-    dataset[date_column_name] = pd.to_datetime(dataset[date_column_name])
-
-    # Convert time column to pandas datetime object with custom format
-    try:
-        dataset[time_column_name] = pd.to_datetime(dataset[time_column_name], format='%H:%M')
-    except ValueError as e:
-        print("Error occurred while parsing time column:")
-        for value in dataset[time_column_name]:
-            try:
-                pd.to_datetime(value, format='%H:%M')
-            except ValueError:
-                print(f"Invalid value: {value}")
-
-    # Concatenate date and time columns into a new column 'datetime'
-    dataset['date_time'] = dataset[date_column_name].dt.strftime('%Y-%m-%dT') + dataset[time_column_name].dt.strftime('%H:%M')
-
-    # Extract year, month, day, hour, and minute from the date and time columns
-    dataset['crash_year'] = dataset[date_column_name].dt.year
-    dataset['crash_month'] = dataset[date_column_name].dt.month
-    dataset['crash_day'] = dataset[date_column_name].dt.day
-    dataset['crash_hour'] = dataset[time_column_name].dt.hour
-    dataset['crash_minute'] = dataset[time_column_name].dt.minute
-
-    # Drop the original date and time columns
-    # dataset.drop([date_column_name, time_column_name], axis=1, inplace=True)
-    
-    # Reorder columns so the new ones are at the beginning
-    new_column_order = [
-        'date_time', 'crash_year', 'crash_month', 'crash_day', 'crash_hour', 'crash_minute',
-    ] + [col for col in dataset.columns if col not in ['datetime', 'crash_year', 'crash_month', 'crash_day', 'crash_hour', 'crash_minute']]
-    
-    dataset = dataset[new_column_order]
-
-    print(f'Data has been transformed!')
+# Shared pipeline modules live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.compression import resolve_content_encoding
+from nyc_collisions.datasets import DATASETS, RAW_DATA_KEY, find_raw_file, get_dataset
+from nyc_collisions.extract import format_extract_report, stream_transform_from_s3
+from nyc_collisions.formats import format_from_key
+from nyc_collisions.grid import FINEST_GRID_COLUMN, GRID_LEVELS
+from nyc_collisions.joins import format_index_report, update_collision_index
+from nyc_collisions.metrics import MetricsRecorder, format_metrics_summary
+from nyc_collisions.parallel_etl import DEFAULT_ETL_WORKERS, format_parallel_report, parallel_etl
+from nyc_collisions.profiling import profiled_run
+from nyc_collisions.manifest import load_or_rebuild_manifest, partition_exists, update_manifest
+from nyc_collisions.partitions import DEFAULT_UPLOAD_WORKERS, add_partition_metrics, print_partition_report, write_partitions
+from nyc_collisions.rollups import add_rollup_metrics, format_rollup_report, update_rollups
+from nyc_collisions.transform import print_transform_report
 
 ###############################################################################################
 ####################################### Upload Functions ######################################
@@ -86,10 +25,6 @@ def transform_data(dataset, date_column_name, time_column_name):
 def create_folder(aws_client, bucket_name, prefix):
     aws_client.put_object(Bucket=bucket_name, Key=prefix)
 
-def folder_exists(aws_client, bucket_name, prefix):
-    response = aws_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
-    return 'CommonPrefixes' in response
-
 def create_missing_folders(aws_client, bucket_name, key_name, date_list):
     for date in date_list:
         year = date.year
@@ -100,17 +35,20 @@ def create_missing_folders(aws_client, bucket_name, key_name, date_list):
         month_prefix = f"{year_prefix}{month:02d}/"
         day_prefix = f"{month_prefix}{date_string}/"
 
-        # Check if day subfolder exists
-        if not folder_exists(aws_client, bucket_name, day_prefix):
-            # Day subfolder doesn't exist, create it along with its parent folders
-            create_folder(aws_client, bucket_name, year_prefix)
-            create_folder(aws_client, bucket_name, month_prefix)
-            create_folder(aws_client, bucket_name, day_prefix)
+        # Create the day subfolder along with its parent folders
+        create_folder(aws_client, bucket_name, year_prefix)
+        create_folder(aws_client, bucket_name, month_prefix)
+        create_folder(aws_client, bucket_name, day_prefix)
 
 
-def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name):
+def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format='csv', compression='snappy',
+                           max_workers=DEFAULT_UPLOAD_WORKERS, folder_markers=False, sort_column=FINEST_GRID_COLUMN,
+                           content_encoding=None):
     """
-    Uploads a csv DataFrame to S3 bucket, partitioned by date: YYYY-MM-DD.
+    Uploads a DataFrame to S3 bucket as CSV or Parquet files, partitioned by date: YYYY-MM-DD.
+
+    The DataFrame is split into days in a single pass and the days are uploaded concurrently,
+    sharing aws_client. Days without records are skipped.
 
     Args:
     aws_client: Boto3 client for AWS services.
@@ -118,91 +56,258 @@ def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_co
     key_name (str): Base key name under which data will be stored in S3.
     DataFrame (pandas.DataFrame): DataFrame to upload.
     date_column_name (str): Name of the column containing the date information.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Number of partitions uploaded at the same time.
+    folder_markers (bool): Also create the empty year/month/day '.../' objects for new days.
+    Off by default: S3 needs nothing but the data objects.
+    sort_column (str): Column every day is sorted by, the dataset's 'sort_column' in DATASETS.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet.
 
     Returns:
-    None
+    dict: The write_partitions report, with the bytes and latency of every partition.
+    The partitions are also recorded in the manifest.
     """
 
-    file_count = 0 
+    def create_day_folders(date):
+        # Check if day subfolder exists
+        if not partition_exists(manifest, date):
+            # Day subfolder doesn't exist, create it along with its parent folders
+            create_missing_folders(aws_client, bucket_name, key_name, [date])
 
-    try:
-        # Set the datetime column as the index
-        DataFrame[date_column_name] = pd.to_datetime(DataFrame[date_column_name])
-        DataFrame.set_index(date_column_name, inplace=True)
+    if folder_markers:
+        # Existing days are looked up in the manifest instead of listing S3 for every date
+        manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name)
 
-        # Group DataFrame by date column
-        grouped_data = DataFrame.groupby(pd.Grouper(freq='D'))
+    report = write_partitions(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format=output_format,
+                              compression=compression, max_workers=max_workers,
+                              before_upload=create_day_folders if folder_markers else None,
+                              sort_column=sort_column, content_encoding=content_encoding)
+    
+    # Print the total number of files uploaded
+    print("ETL Completed.")
+    print(f"Total files uploaded to {key_name} bucket: {len(report['partitions'])}")
+    print_partition_report(report)
 
-        for date, subset_df in grouped_data:
-            year = date.year 
-            month = date.month 
-            day = date.day 
-            date_string = f"{year}-{month:02d}-{day:02d}" # Construct date_string in the desired format
-            day_subfolder_key = f"{key_name}/{year}/{month:02d}/{date_string}/" # Construct the key path for the day subfolder
+    # Record the new partitions so the next run finds them without listing the bucket
+    update_manifest(aws_client, bucket_name, key_name, report['partitions'])
+    return report
 
-            # Check if day subfolder exists
-            if not folder_exists(aws_client, bucket_name, day_subfolder_key):
-                # Day subfolder doesn't exist, create it along with its parent folders
-                create_missing_folders(aws_client, bucket_name, key_name, [date])
 
-            # Save the subset DataFrame as a CSV file in memory
-            csv_buffer = StringIO()
-            subset_df.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
+#################################################################################################################################
 
-            # Upload the CSV file to S3 under the day subfolder
-            aws_client.put_object(Bucket=bucket_name, Key=f"{day_subfolder_key}{date_string}.csv", Body=csv_buffer.getvalue())
+def process_dataset(aws_client, bucket, name, metrics, output_format='csv', content_encoding=None, file_name=None):
+    """
+    Extract, transform and upload one dataset of the registry as day partitions.
 
-            # Increment the file count
-            file_count += 1
+    Crashes also get their dashboard rollups and their collision_id index updated, for the
+    days just written. Persons and vehicles are written sorted by collision_id, so they
+    merge join with the crashes of the same day (see joins.py).
 
-    except Exception as e:
-        print(f"Error occurred during upload: {e}")
-    
-    # Print the total number of files uploaded
-    print(f"ETL Completed.")
-    print(f"Total files uploaded to {key_name} bucket: {file_count}")
+    Args:
+    aws_client: Boto3 client for AWS services.
+    bucket (str): Name of the S3 bucket.
+    name (str): Key of the dataset in DATASETS.
+    metrics (MetricsRecorder): Recorder of the run, every stage is labelled with the dataset.
+    output_format (str): 'csv' or 'parquet'.
+    content_encoding (str): Codec of the raw CSV and of the CSV partitions, None to follow
+    the S3_CONTENT_ENCODING environment variable the mass upload ran with.
+    file_name (str): Key of the raw file, looked up with find_raw_file if not given.
 
+    Returns:
+    dict: The write_partitions report, None if the raw file is missing or could not be extracted.
+    """
+    dataset = get_dataset(name)
+    content_encoding = resolve_content_encoding(content_encoding)
+    file_name = file_name or find_raw_file(aws_client, bucket, name, content_encoding)
+    if file_name is None:
+        print_missing_raw_file(bucket, name)
+        return None
 
-#################################################################################################################################
+    ######################## EXTRACT AND TRANSFORM DATA FROM S3, BATCH BY BATCH ####################
+    ###############################################################################################
 
-def main():
+    # The raw CSV or Parquet file is streamed with ranged GETs and transformed as it is parsed,
+    # so neither the raw bytes nor the untyped frame of the whole file are ever in memory.
+    # Boroughs and grid cells only apply to crashes, the other datasets have no location
+    is_crashes = name == 'crashes'
+    with metrics.stage('extract_transform', input_format=format_from_key(file_name), dataset=name) as stage:
+        try:
+            processed_data_df, extract_report = stream_transform_from_s3(aws_client, bucket, file_name,
+                                                                         fill_boroughs=is_crashes,
+                                                                         grid_levels=GRID_LEVELS if is_crashes else ())
+        except Exception as e:
+            print(f"Error occurred during extraction: {e}")
+            stage.add(errors=1)
+            processed_data_df = None
+        if processed_data_df is not None:
+            transform_report = extract_report['transform']
+            stage.add(rows=extract_report['rows'], bytes=extract_report['bytes_fetched'],
+                      requests=extract_report['requests'], batches=extract_report['batches'],
+                      errors=int(transform_report['invalid_dates']) + int(transform_report['invalid_times']))
+
+    if processed_data_df is not None:
+        print(f"Raw {name} file extracted successfully.")
+    else:
+        print(f"Extraction of the {name} file failed.")
+        return None
+    print(format_extract_report(extract_report))
+    print_transform_report(transform_report)
 
-    ############################### EXTRACT DATA FROM S3 ##########################################
+    ############################## UPLOAD PROCESSED DATA  #########################################
     ###############################################################################################
 
-    start_time = time.time()
+    key_name = dataset['processed_key']
 
-    # Set up AWS client and S3 resources
-    aws_client = boto3.client(service_name='s3', region_name='us-east-1')
-    bucket = 'nyc-application-collisions'
-    file_name = "collisions_raw_data/'crash_data_set_par.csv'"
+    with metrics.stage('upload', output_format=output_format, content_encoding=content_encoding, dataset=name) as stage:
+        report = upload_dataframe_to_s3(aws_client, bucket, key_name, processed_data_df, 'crash_date', output_format=output_format,
+                                        sort_column=dataset['sort_column'], content_encoding=content_encoding)
+        add_partition_metrics(stage, report)
+    if is_crashes:
+        update_crash_tables(aws_client, bucket, key_name, processed_data_df, report, metrics,
+                            sort_column=dataset['sort_column'])
+    return report
 
-    # Extract CSV file from S3 bucket
-    raw_data_df = extract_csv_from_s3(aws_client, bucket, file_name)
+def process_dataset_in_parallel(aws_client, bucket, name, metrics, output_format='csv', workers=DEFAULT_ETL_WORKERS,
+                                content_encoding=None, file_name=None):
+    """
+    Same as process_dataset, with the raw file split into units transformed and written by a process pool.
 
-    if raw_data_df is not None:
-        print("CSV file extracted successfully.")
-    else:
-        print("Extraction failed.")
+    The partitions written are the same files as process_dataset's (see parallel_etl.py).
+
+    Args:
+    aws_client: Boto3 client for AWS services.
+    bucket (str): Name of the S3 bucket.
+    name (str): Key of the dataset in DATASETS.
+    metrics (MetricsRecorder): Recorder of the run, every stage is labelled with the dataset.
+    output_format (str): 'csv' or 'parquet'.
+    workers (int): Processes in the pool.
+    content_encoding (str): Codec of the raw CSV and of the CSV partitions, as in process_dataset.
+    file_name (str): Key of the raw file, looked up with find_raw_file if not given.
+
+    Returns:
+    dict: The write_partitions report, None if the raw file is missing or could not be processed.
+    """
+    dataset = get_dataset(name)
+    content_encoding = resolve_content_encoding(content_encoding)
+    file_name = file_name or find_raw_file(aws_client, bucket, name, content_encoding)
+    if file_name is None:
+        print_missing_raw_file(bucket, name)
+        return None
+    key_name = dataset['processed_key']
+    is_crashes = name == 'crashes'
 
-    ############################### TRANSFORM DATAFRAME  ##########################################
+    ######################### EXTRACT, TRANSFORM AND UPLOAD IN A PROCESS POOL #####################
     ###############################################################################################
 
-    transform_data(raw_data_df, 'crash_date', 'crash_time')
+    with metrics.stage('parallel_etl', input_format=format_from_key(file_name), output_format=output_format,
+                       dataset=name, workers=workers) as stage:
+        try:
+            processed_data_df, run_report = parallel_etl(aws_client, bucket, file_name, key_name, fill_boroughs=is_crashes,
+                                                         grid_levels=GRID_LEVELS if is_crashes else (),
+                                                         output_format=output_format, sort_column=dataset['sort_column'],
+                                                         max_workers=workers, keep_frame=is_crashes,
+                                                         content_encoding=content_encoding)
+        except Exception as e:
+            print(f"Parallel processing of the {name} file failed: {e}")
+            stage.add(errors=1)
+            return None
+        add_partition_metrics(stage, run_report['write'])
+        stage.add(units=run_report['units'])
+
+    report = run_report['write']
+    print_transform_report(run_report['transform'])
+    print("ETL Completed.")
+    print(f"Total files uploaded to {key_name} bucket: {len(report['partitions'])}")
+    print_partition_report(report)
+    print(format_parallel_report(run_report))
+    update_manifest(aws_client, bucket, key_name, report['partitions'])
+
+    if is_crashes:
+        update_crash_tables(aws_client, bucket, key_name, processed_data_df, report, metrics,
+                            sort_column=dataset['sort_column'])
+    return report
+
+def print_missing_raw_file(bucket, name):
+    # Not an extraction failure: the mass upload that ran did not load this dataset
+    print(f"No raw {name} file in {bucket}/{RAW_DATA_KEY}, {name} skipped: run multiThread_mass_upload to load it.")
+
+def update_crash_tables(aws_client, bucket, key_name, processed_data_df, report, metrics, sort_column=FINEST_GRID_COLUMN):
+    """
+    Update the dashboard rollups and the collision_id index of the crash days just written.
 
-    processed_data_df = raw_data_df
+    Args:
+    aws_client: Boto3 client for AWS services.
+    bucket (str): Name of the S3 bucket.
+    key_name (str): Base key name of the crash partitions.
+    processed_data_df (pandas.DataFrame): The transformed crashes.
+    report (dict): The write_partitions report of the upload; only its days are updated.
+    metrics (MetricsRecorder): Recorder of the run.
+    sort_column (str): Column the days were sorted by when written.
+    """
+    written_days = [partition['date'] for partition in report['partitions']]
 
-    ############################## UPLOAD PROCESSED DATA  #########################################
+    ############################## UPDATE DASHBOARD ROLLUPS  ######################################
     ###############################################################################################
 
-    key_name = 'collisions_processed_data' 
-    
-    upload_dataframe_to_s3(aws_client, bucket, key_name, processed_data_df, 'date_time')
+    # Daily and hourly counts by borough and contributing factor, for the days just written
+    with metrics.stage('rollups') as stage:
+        rollup_report = update_rollups(aws_client, bucket, key_name, processed_data_df, days=written_days)
+        add_rollup_metrics(stage, rollup_report)
+    print(format_rollup_report(rollup_report))
+
+    ############################## UPDATE COLLISION_ID INDEX  #####################################
+    ###############################################################################################
+
+    # Row of every crash in its day partition, in collision_id order, for the merge joins
+    with metrics.stage('collision_index') as stage:
+        index_report = update_collision_index(aws_client, bucket, key_name, processed_data_df, days=written_days,
+                                              sort_column=sort_column)
+        stage.add(rows=index_report['rows'], bytes=index_report['bytes'], errors=len(index_report['errors']))
+    print(format_index_report(index_report))
+
+# PROFILE=1 (or main(profile=True)) writes cProfile and tracemalloc reports to PROFILE_DIR, PROFILE=cpu only cProfile
+@profiled_run('etl')
+def main(output_format='csv', datasets=tuple(DATASETS), workers=None, content_encoding=None):
+
+    start_time = time.time()
+
+    # Per-stage metrics as JSON lines (METRICS_SINK=off, stdout or a file path)
+    metrics = MetricsRecorder('etl')
+
+    # Set up AWS client and S3 resources
+    aws_client = boto3.client(service_name='s3', region_name='us-east-1')
+    bucket = 'nyc-application-collisions'
+
+    # ETL_WORKERS=N (or main(workers=N)) splits every raw file over N processes, 1 keeps the serial path
+    workers = workers or int(os.environ.get('ETL_WORKERS', '1'))
+
+    # S3_CONTENT_ENCODING=gzip or zstd (or main(content_encoding=...)) reads '.csv.gz' / '.csv.zst' raw files
+    # and writes the CSV partitions compressed the same way
+    content_encoding = resolve_content_encoding(content_encoding)
+
+    # Crashes, persons and vehicles, one after the other so only one dataset is in memory at a time.
+    # A dataset the mass upload did not load is skipped and listed at the end
+    skipped = []
+    for name in datasets:
+        file_name = find_raw_file(aws_client, bucket, name, content_encoding)
+        if file_name is None:
+            print_missing_raw_file(bucket, name)
+            skipped.append(name)
+        elif workers > 1:
+            process_dataset_in_parallel(aws_client, bucket, name, metrics, output_format=output_format, workers=workers,
+                                        content_encoding=content_encoding, file_name=file_name)
+        else:
+            process_dataset(aws_client, bucket, name, metrics, output_format=output_format,
+                            content_encoding=content_encoding, file_name=file_name)
 
     end_time = time.time()  # Record the end time
     execution_time = end_time - start_time  # Calculate the execution time
     print(f"Script execution time: {execution_time} seconds")
+    if skipped:
+        print(f"Skipped, no raw file in S3: {', '.join(skipped)}")
+    print(format_metrics_summary(metrics.summary()))
 
 if __name__ == "__main__":
     main()
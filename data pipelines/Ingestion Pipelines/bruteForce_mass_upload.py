@@ -1,97 +1,104 @@
+import os
+import sys
 import time
-import pandas as pd
 import boto3
-from botocore.exceptions import ClientError
 from sodapy import Socrata
 from secrets_1 import app_token, access_key, secret_access_key
 
-def get_api_records(client, dataset_name):
+# Shared pipeline modules live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.cache import CachedSocrataClient, format_cache_stats
+from nyc_collisions.compression import encoding_extension, resolve_content_encoding
+from nyc_collisions.metrics import MetricsRecorder, format_metrics_summary
+from nyc_collisions.profiling import profiled_run
+from nyc_collisions.paging import iter_keyset_pages
+from nyc_collisions.formats import file_extension
+from nyc_collisions.schema import CRASH_COLUMNS, CRASH_DTYPES
+from nyc_collisions.streaming import stream_records_to_s3
+
+def stream_api_records_to_s3(client, aws_client, bucket_name, key_name, dataset_name, max_in_flight_chunks=4,
+                             output_format='csv', compression='snappy', content_encoding=None):
     """
-    Fetches records from Socrata API endpoint in chunks and returns them as a DataFrame.
+    Streams records from Socrata API endpoint straight into a CSV or Parquet object on S3.
+
+    Each chunk is written to an S3 multipart upload as soon as it arrives, so memory stays
+    bounded by max_in_flight_chunks no matter how large the dataset is. A streaming run
+    cannot resume: the object only exists once the multipart upload completes, and a failed
+    run aborts it, so an interrupted run starts over from the first chunk.
 
     Args:
         client (sodapy.Socrata): The Socrata client for making API requests.
+        aws_client (boto3.client): An AWS S3 client object.
+        bucket_name (str): The name of the S3 bucket.
+        key_name (str): The key (object name) under which the data will be stored in the S3 bucket.
         dataset_name (str): The name of the dataset to retrieve.
+        max_in_flight_chunks (int): Chunks allowed to be fetched ahead of the upload.
+        output_format (str): 'csv' or 'parquet'.
+        compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+        content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the S3_CONTENT_ENCODING
+        environment variable. Ignored for Parquet.
 
     Returns:
-        pandas.DataFrame: A DataFrame containing the retrieved records.
+        dict: Run summary with rows, chunks, bytes, raw_bytes, parts, seconds and peak_rss_mb.
     """
-    start = 0 
     chunk_size = 5000
     client.timeout = 100
-    results =[]
-    number_of_requests_sent = 0 
-    
-    # Retrieve the total record count
-    record_count = client.get(dataset_name, select="COUNT(*)")
-    total_records = int(record_count[0]['COUNT'])
-
-
-    # Get the data in chunks of 5,000 records 
-    while True:
-        results.extend(client.get(dataset_name, offset=start, limit=chunk_size, order='collision_id'))
-        start += chunk_size
-        if (start > total_records):
-            break
-        number_of_requests_sent += 1
-    
-    print("BRUTE FORCE APPROACH")
-    print(f"Total number of records: {total_records}")
-    print(f'Number of requests sent {number_of_requests_sent}')
-    
-    return pd.DataFrame.from_records(results)
-    
-
-def upload_dataframe_to_s3(client, bucket_name, key_name, df, dataset_name):
-    """
-    Uploads a DataFrame to an S3 bucket using the provided AWS S3 client.
 
-    Args:
-        client (boto3.client): An AWS S3 client object.
-        bucket_name (str): The name of the S3 bucket.
-        key_name (str): The key (object name) under which the data will be stored in the S3 bucket.
-        df (pandas.DataFrame): The DataFrame to upload.
-        dataset_name (str): The name of the dataset being uploaded.
+    pages = iter_keyset_pages(client, dataset_name, chunk_size=chunk_size)
+    summary = stream_records_to_s3(pages, aws_client, bucket_name, key_name, CRASH_COLUMNS, dtypes=CRASH_DTYPES, max_in_flight_chunks=max_in_flight_chunks,
+                                   output_format=output_format, compression=compression, content_encoding=content_encoding)
 
-    Returns:
-        bool: True if the upload was successful, False otherwise.
-    """
-    
-    csv_buffer = df.to_csv(index=False)
+    print("BRUTE FORCE APPROACH (STREAMING)")
+    print(f"Total number of records: {summary['rows']}")
+    print(f"Number of requests sent {summary['chunks']}")
+    print(f"Uploaded {summary['bytes']} bytes in {summary['parts']} parts to '{bucket_name}/{key_name}'")
+    if summary['content_encoding'] != 'identity':
+        print(f"Compressed with {summary['content_encoding']}: {summary['raw_bytes']} bytes of CSV "
+              f"in {summary['compress_seconds']} seconds")
+    print(f"Peak memory (RSS): {summary['peak_rss_mb']} MiB")
 
-    try:
-        # Upload the CSV file to S3
-        client.put_object(Bucket=bucket_name, Key=key_name, Body=csv_buffer.encode('utf-8'))
-        print(f"Uploaded '{dataset_name}' to '{bucket_name}/{key_name}' successfully.")
-        return True
-    except ClientError as e:
-        print(f"Error uploading '{dataset_name}' to '{bucket_name}/{key_name}': {e}")
-        return False
+    return summary
 
 
 # TRYING THE BRUTE FORCE APPROACH FOR MASS UPLOAD
-def main():
+# PROFILE=1 (or main(profile=True)) writes cProfile and tracemalloc reports to PROFILE_DIR, PROFILE=cpu only cProfile
+@profiled_run('bruteForce_mass_upload')
+def main(output_format='csv', cache_dir=None, content_encoding=None):
     data_url = 'data.cityofnewyork.us'
     socrata_client = Socrata(data_url, app_token)
+    # SOCRATA_CACHE_DIR=path (or main(cache_dir=path), i.e. DEFAULT_CACHE_DIR) reads pages already downloaded
+    # by an earlier run from a local cache. Off by default, so a plain run never serves a stale page
+    cache_dir = cache_dir or os.environ.get('SOCRATA_CACHE_DIR')
+    if cache_dir:
+        socrata_client = CachedSocrataClient(socrata_client, cache_dir)
     crash_data_set = 'h9gi-nx95'
     bucket_name = 'nyc-application-collisions'
     key_name = 'collisions_raw_data'
 
-    # Measure execution time
-    start_time = time.time()
-
-    # Call on Brute Force Method for Mass Download
-    crash_df = get_api_records(socrata_client, crash_data_set)
-
     # Connect to AWS boto3 client - Make sure to check the security settings 
     aws_client = boto3.client('s3', aws_access_key_id = access_key, aws_secret_access_key = secret_access_key)
 
-    # Upload directly to S3 collisions_raw_data key
-    upload_dataframe_to_s3(aws_client, bucket_name, key_name+"/'crash_data_set_bfc.csv'", crash_df, 'crash_data_set_bfc.csv')
+    # Per-stage metrics as JSON lines (METRICS_SINK=off, stdout or a file path)
+    metrics = MetricsRecorder('bruteForce_mass_upload')
+
+    # Measure execution time
+    start_time = time.time()
+
+    # Call on Brute Force Method for Mass Download, streaming each chunk directly to S3 collisions_raw_data key
+    # S3_CONTENT_ENCODING=gzip or zstd (or content_encoding) compresses the CSV, i.e. 'crash_data_set_bfc.csv.gz'
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+    file_name = f"crash_data_set_bfc{file_extension(output_format)}{encoding_extension(content_encoding)}"
+    with metrics.stage('download_and_upload', output_format=output_format, content_encoding=content_encoding) as stage:
+        summary = stream_api_records_to_s3(socrata_client, aws_client, bucket_name, key_name+f"/'{file_name}'", crash_data_set,
+                                           output_format=output_format, content_encoding=content_encoding)
+        stage.add(rows=summary['rows'], bytes=summary['bytes'], raw_bytes=summary['raw_bytes'], requests=summary['chunks'])
 
     # Calculate and print execution time
+    if cache_dir:
+        print(format_cache_stats(socrata_client.stats))
     execution_time = time.time() - start_time
     print(f"Execution time: {execution_time} seconds\n")
+    print(format_metrics_summary(metrics.summary()))
 
 if __name__ == '__main__':
     main()
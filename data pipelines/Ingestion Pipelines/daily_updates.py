@@ -1,48 +1,31 @@
+import os
+import sys
 import time
-import pandas as pd
 import boto3
 import logging
-from io import StringIO
 from sodapy import Socrata
 from datetime import datetime
 from secrets_1 import app_token, access_key, secret_access_key
 
+# Shared pipeline modules live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.cache import CachedSocrataClient, format_cache_stats
+from nyc_collisions.incremental import print_incremental_report, run_incremental_update
+from nyc_collisions.metrics import MetricsRecorder, format_metrics_summary, measure
+from nyc_collisions.manifest import latest_date, load_or_rebuild_manifest, partition_exists, update_manifest
+from nyc_collisions.paging import iter_keyset_pages
+from nyc_collisions.partitions import DEFAULT_UPLOAD_WORKERS, add_partition_metrics, print_partition_report, write_partitions
+from nyc_collisions.rollups import add_rollup_metrics, format_rollup_report, update_rollups
+from nyc_collisions.schema import concat_frames, format_memory_report, memory_report, records_to_frame
+from nyc_collisions.transform import print_transform_report, transform_data
+
 # ------------------------------------------ TOOLS TO INTERACT WITH S3 ------------------------------------------
 def get_latest_date_in_S3(aws_client, bucket_name, key_name):
     """
     Get the latest date available in the specified dataset inside S3 bucket.
 
-    Args:
-    aws_client: Boto3 client for AWS services.
-    dataset_name (str): Name of the dataset.
-    bucket_name (str): Name of the S3 bucket.
-    key_name (str): Key prefix where the dataset is stored.
-
-    Returns:
-    str: The latest date available in the dataset.
-    """
-    all_dates = []
-
-    # List objects in the base prefix
-    response = aws_client.list_objects_v2(Bucket=bucket_name, Prefix=key_name)
-    
-    # Extract dates from object keys for all years and months
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        # Split the object key to extract year and month
-        parts = key.split('/')
-        if len(parts) >= 5: # Assuming a minimum key structure depth
-            # Extract date and add to all_dates list
-            day = parts[3]
-            date_string  = str(datetime.strptime(day, '%Y-%m-%d'))
-            all_dates.append(date_string)
-
-    sorted_dates = sorted(all_dates, reverse=True)
-    return sorted_dates[0]
-
-def get_date_list_in_S3(aws_client, bucket_name, key_name):
-    """
-    Get a list of unique dates available in the specified location inside S3 bucket.
+    The date comes from the partition manifest, which is rebuilt from a full listing
+    of key_name the first time it is needed.
 
     Args:
     aws_client: Boto3 client for AWS services.
@@ -50,24 +33,13 @@ def get_date_list_in_S3(aws_client, bucket_name, key_name):
     key_name (str): Key prefix where the dataset is stored.
 
     Returns:
-    list: A sorted list of unique dates available in the specified location.
+    str: The latest date available in the dataset, i.e. '2024-01-31 00:00:00'.
     """
-    all_dates =[]
-
-    # List objects in the base prefix
-    response = aws_client.list_objects_v2(Bucket=bucket_name, Prefix=key_name)
-    
-    # Extract dates from object keys for all years and months
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        # Split the object key to extract year and month
-        parts = key.split('/')
-        if len(parts) >= 5:
-            # Extract year, month and day from the day object and append to the corresponsding lists
-            all_dates.append(str(datetime.strptime(parts[3], '%Y-%m-%d')))
-           
-    sorted_dates = sorted(set(all_dates), reverse=True)
-    return sorted_dates
+    manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name)
+    date = latest_date(manifest)
+    if date is None:
+        raise ValueError(f"No partitions found under '{bucket_name}/{key_name}'")
+    return str(datetime.strptime(date, '%Y-%m-%d'))
 
 # ------------------------------------------ TOOLS TO EXTRACT DATA FROM SOCRATA API ------------------------------------------
 def fetch_data_worker(socrata_client, dataset_name, starting_date, current_date):
@@ -92,7 +64,7 @@ def fetch_data_worker(socrata_client, dataset_name, starting_date, current_date)
     else:
         return 0
 
-def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
+def fetch_data_from_socrata(socrata_client, dataset_name, start_date, metrics=None):
     """
     Fetches data from a Socrata dataset starting from a specified date.
 
@@ -100,14 +72,14 @@ def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
     socrata_client: Socrata client for interacting with the Socrata API.
     dataset_name (str): Name of the dataset to fetch data from.
     start_date (str): Start date for fetching data in 'YYYY-MM-DD HH:MM:SS' format.
+    metrics (MetricsRecorder): Records the 'fetch' stage (rows and requests) if given.
 
     Returns:
     pandas.DataFrame: DataFrame containing the fetched data.
     """
  
     chunk_size = 3000
-    results = []
-    start = 0
+    frames = []
     number_of_requests_sent = 0
     
     # Rewrite the date strings so we can call the Socrata API -> i.e. '2020-01-01T00:00:00'
@@ -116,33 +88,32 @@ def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
     starting_date = str(date_object).replace(" ", "T")
     current_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
-    # Get the total number of records between the start and current dates
-    total_records =  fetch_data_worker(socrata_client, dataset_name, starting_date, current_date)
+    with measure(metrics, 'fetch', start_date=starting_date) as stage:
+        # Get the total number of records between the start and current dates
+        total_records =  fetch_data_worker(socrata_client, dataset_name, starting_date, current_date)
 
-    # Calling the Socrata API. Extracting data in chunks of 3,000 records
-    while True:
-        data_chunk  = socrata_client.get(
+        # Calling the Socrata API. Extracting data in chunks of 3,000 records, paging on collision_id.
+        # Each chunk is cast to the compact crash schema as soon as it arrives.
+        for data_chunk in iter_keyset_pages(
+            socrata_client,
             dataset_name,
-            where=f"crash_date BETWEEN '{starting_date}' AND '{current_date}'",
-            offset=start, 
-            limit=chunk_size, 
-            order='collision_id'
-            )
-        if not data_chunk:
-            # If the current data chunk is empty, we have fetched all available records
-            break
-
-        results.extend(data_chunk)
-        start += chunk_size
-        number_of_requests_sent += 1
-
-    data = pd.DataFrame.from_records(results)
-    rec_tot = data.shape[0]
+            chunk_size=chunk_size,
+            where=f"crash_date BETWEEN '{starting_date}' AND '{current_date}'"
+            ):
+            frames.append(records_to_frame(data_chunk))
+            number_of_requests_sent += 1
+            stage.add(requests=1)
+
+        data = concat_frames(frames)
+        rec_tot = data.shape[0]
+        # The count query is a request too
+        stage.add(rows=rec_tot, requests=1)
 
     print()
-    print(f"Brute Force Approach for Daily Upload!")
+    print("Brute Force Approach for Daily Upload!")
     print(f"Socrata API is returning: {total_records} records")
     print(f'This dataset has {rec_tot} records')
+    print(f"Memory: {format_memory_report(memory_report(data))}")
     print(f"Latest record available in S3 is for date: {starting_date}")
     print(f"current date is {current_date}")
     print(f"Number of requests sent: {number_of_requests_sent}")
@@ -150,118 +121,121 @@ def fetch_data_from_socrata(socrata_client, dataset_name, start_date):
 
     return data
 
-# ------------------------------------------ TRANSFORMING DATA FOR S3 UPLOAD ------------------------------------------
-def transform_data(socrata_dataset, date_column_name, time_column_name):
-    """
-    Transforms the given Socrata dataset by converting date and time columns to datetime objects,
-    extracting year, month, day, hour, and minute, and dropping the original time column.
-
-    Args:
-    socrata_dataset (pandas.DataFrame): The Socrata dataset to transform.
-    date_column_name (str): The name of the column containing the date information.
-    time_column_name (str): The name of the column containing the time information.
-
-    Returns:
-    None. The transformation is applied directly to the input DataFrame.
-    """
-    # Convert  date and time columns to a pandas datetime object
-    socrata_dataset[date_column_name] = pd.to_datetime(socrata_dataset[date_column_name])
-    socrata_dataset[time_column_name] = pd.to_datetime(socrata_dataset[time_column_name])
-
-    # Extract year, month, day, hour, and minute from the date and time columns
-    socrata_dataset['crash_year'] = socrata_dataset[date_column_name].dt.year
-    socrata_dataset['crash_month'] = socrata_dataset[date_column_name].dt.month
-    socrata_dataset['crash_day'] = socrata_dataset[date_column_name].dt.day
-    socrata_dataset['crash_hour'] = socrata_dataset[time_column_name].dt.hour
-    socrata_dataset['crash_minute'] = socrata_dataset[time_column_name].dt.minute
-
-    # Drop the original time column
-    socrata_dataset.drop([time_column_name], axis=1, inplace=True)
-
 # ------------------------------------------ UPLOADING DATA TO S3 ------------------------------------------
-def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name):
+def upload_dataframe_to_s3(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format='csv', compression='snappy',
+                           max_workers=DEFAULT_UPLOAD_WORKERS, folder_markers=False, content_encoding=None):
     """
     Uploads a DataFrame to S3 bucket, partitioned by date.
 
+    The DataFrame is split into days in a single pass and the days are uploaded concurrently,
+    sharing aws_client.
+
     Args:
     aws_client: Boto3 client for AWS services.
     bucket_name (str): Name of the S3 bucket.
     key_name (str): Base key name under which data will be stored in S3.
     DataFrame (pandas.DataFrame): DataFrame to upload.
     date_column_name (str): Name of the column containing the date information.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Number of partitions uploaded at the same time.
+    folder_markers (bool): Also create the empty year/month/day '.../' objects for new days.
+    Off by default: S3 needs nothing but the data objects.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet.
 
     Returns:
-    None
+    dict: The write_partitions report, with the bytes and latency of every partition.
+    The partitions are also recorded in the manifest.
     """
-    date_list = list(set(DataFrame[date_column_name]))
-
-    for date in date_list:
-        try:
-            year = date.year 
-            month = date.month 
-            day = date.day 
-            date_string = f"{year}-{month:02d}-{day:02d}" # Construct date_string in the desired format
-            day_subfolder_key = f"{key_name}/{year}/{month:02d}/{date_string}/" # Construct the key path for the day subfolder
-            
-            year_exists = get_date_list_in_S3(aws_client, bucket_name, key_name) # Collect list of available dates in S3
-
-            # Create the year subfolder if it doesn't exist
-            if year not in year_exists:
-                aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/")
-
-                # Check if the month subfolder exists within the year subfolder
-                month_exists = get_date_list_in_S3(aws_client, bucket_name, f"{key_name}/{year}/")
-                if month not in month_exists:    
-                    aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/")
-
-                    # Check if the day subfolder exists within the month subfolder
-                    day_exists = get_date_list_in_S3(aws_client, bucket_name, f"{key_name}/{year}/{month:02d}/{date_string}/")
-                    if day not in day_exists:
-                        aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/{date_string}/")
-                    
-            # Log the upload process
-            logging.info(f"Uploading file to S3 for: {date_string}")
-
-            # Filter DataFrame for records corresponding to the current date
-            subset_df = DataFrame[DataFrame[date_column_name].dt.date == date.date()]
-
-            # Save the subset DataFrame as a CSV file in memory
-            csv_buffer = StringIO()
-            subset_df.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
-
-            # Upload the CSV file to S3 under the day subfolder
-            aws_client.put_object(Bucket=bucket_name, Key=f"{day_subfolder_key}{date_string}.csv", Body=csv_buffer.getvalue())
-            
-        except Exception as e:
-            print(f"Error occurred while processing date {date}: {e}")
-            
-def main():
+
+    # Existing days are looked up in the manifest instead of listing S3 for every date
+    manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name) if folder_markers else None
+
+    def create_day_subfolders(date):
+        year = date.year 
+        month = date.month 
+        day = date.day 
+        date_string = f"{year}-{month:02d}-{day:02d}" # Construct date_string in the desired format
+
+        # Create the year, month and day subfolders for a day we have not stored yet
+        if folder_markers and not partition_exists(manifest, date_string):
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/")
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/")
+            aws_client.put_object(Bucket=bucket_name, Key=f"{key_name}/{year}/{month:02d}/{date_string}/")
+                
+        # Log the upload process
+        logging.info(f"Uploading file to S3 for: {date_string}")
+
+    report = write_partitions(aws_client, bucket_name, key_name, DataFrame, date_column_name, output_format=output_format,
+                              compression=compression, max_workers=max_workers, before_upload=create_day_subfolders,
+                              content_encoding=content_encoding)
+    print_partition_report(report)
+
+    # Record the new partitions so the next run finds them without listing the bucket
+    update_manifest(aws_client, bucket_name, key_name, report['partitions'])
+    return report
+
+def main(output_format='csv', incremental=False, cache_dir=None):
     data_url = 'data.cityofnewyork.us'
     socrata_client = Socrata(data_url, app_token)
+    # SOCRATA_CACHE_DIR=path (or main(cache_dir=path), i.e. DEFAULT_CACHE_DIR) reads pages already downloaded
+    # by an earlier run from a local cache. Off by default, so a plain run never serves a stale page
+    cache_dir = cache_dir or os.environ.get('SOCRATA_CACHE_DIR')
+    if cache_dir:
+        socrata_client = CachedSocrataClient(socrata_client, cache_dir)
     crash_data_set = 'h9gi-nx95'
     aws_client = boto3.client('s3', aws_access_key_id = access_key, aws_secret_access_key = secret_access_key)
     bucket_name = 'nyc-application-collisions'
     key_name = 'collisions_processed_data'
-    
-    start_time = time.time()
 
-    # Get the latest date available from S3
-    start_date = get_latest_date_in_S3(aws_client, bucket_name, key_name)
-
-    # Make a call to Socrata API using the date range
-    api_data = fetch_data_from_socrata(socrata_client, crash_data_set, start_date)
+    # Per-stage metrics as JSON lines (METRICS_SINK=off, stdout or a file path)
+    metrics = MetricsRecorder('daily_updates')
     
-    # Transform api_data prior to uploading to S3
-    transform_data(api_data, 'crash_date', 'crash_time')
-
-    print(f"The Socrata data has been transformed and it's now ready for upload!.")
-
-    # Upload data to S3
-    upload_dataframe_to_s3(aws_client, bucket_name, key_name, api_data, 'crash_date')
+    start_time = time.time()
 
+    if incremental:
+        # Only the records created or edited since the last run, merged into their days by collision_id
+        with metrics.stage('incremental', output_format=output_format) as stage:
+            summary = run_incremental_update(socrata_client, aws_client, crash_data_set, bucket_name, key_name,
+                                             output_format=output_format)
+            stage.add(rows=summary['changed'], requests=summary['pages'], partitions=summary['partitions_written'],
+                      errors=len(summary['errors']))
+        print_incremental_report(summary)
+    else:
+        # Get the latest date available from S3
+        with metrics.stage('latest_date'):
+            start_date = get_latest_date_in_S3(aws_client, bucket_name, key_name)
+
+        # Make a call to Socrata API using the date range, recorded as the 'fetch' stage
+        api_data = fetch_data_from_socrata(socrata_client, crash_data_set, start_date, metrics=metrics)
+
+        # Transform api_data prior to uploading to S3
+        with metrics.stage('transform') as stage:
+            api_data, transform_report = transform_data(api_data, 'crash_date', 'crash_time')
+            stage.add(rows=transform_report['rows'],
+                      errors=int(transform_report['invalid_dates']) + int(transform_report['invalid_times']))
+        print_transform_report(transform_report)
+
+        print("The Socrata data has been transformed and it's now ready for upload!.")
+
+        # Upload data to S3
+        with metrics.stage('upload', output_format=output_format) as stage:
+            report = upload_dataframe_to_s3(aws_client, bucket_name, key_name, api_data, 'crash_date', output_format=output_format)
+            add_partition_metrics(stage, report)
+
+        # Recompute the dashboard rollups of the days just rewritten
+        with metrics.stage('rollups') as stage:
+            rollup_report = update_rollups(aws_client, bucket_name, key_name, api_data,
+                                           days=[partition['date'] for partition in report['partitions']])
+            add_rollup_metrics(stage, rollup_report)
+        print(format_rollup_report(rollup_report))
+
+    if cache_dir:
+        print(format_cache_stats(socrata_client.stats))
     execution_time = time.time() - start_time
     print(f"Execution time: {execution_time} seconds\n")
+    print(format_metrics_summary(metrics.summary()))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,27 +1,25 @@
+import io
+import os
+import sys
 import time
-import pandas as pd
 import boto3
 from botocore.exceptions import ClientError
-import concurrent.futures
 from sodapy import Socrata
 from secrets_1 import app_token, access_key, secret_access_key
 
-def fetch_data_chunk(offset, chunk_size, client, dataset_name):
-    """
-    Fetch a chunk of data from a dataset.
-    
-    Args:
-        offset (int): The offset from where to start fetching data.
-        chunk_size (int): The number of records to fetch in this chunk.
-        client: The client object responsible for interacting with the dataset.
-        dataset_name (str): The name of the dataset to fetch data from.
-
-    Returns:
-        list: A list of records retrieved from the dataset.
-    """
-    
-    results = client.get(dataset_name, limit=chunk_size, offset=offset, order='collision_id')
-    return results
+# Shared pipeline modules live in 'data pipelines/nyc_collisions'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.cache import CachedSocrataClient, format_cache_stats
+from nyc_collisions.async_fetch import fetch_records
+from nyc_collisions.compression import CompressingWriter, put_object_kwargs, resolve_content_encoding
+from nyc_collisions.datasets import DATASETS, fetch_datasets, get_dataset, raw_file_name
+from nyc_collisions.paging import KEY_COLUMN
+from nyc_collisions.parallel import AimdController, iter_records_in_parallel
+from nyc_collisions.metrics import MetricsRecorder, format_metrics_summary
+from nyc_collisions.profiling import profiled_run
+from nyc_collisions.formats import DEFAULT_ROW_GROUP_SIZE, content_type, write_dataframe
+from nyc_collisions.schema import CRASH_COLUMNS, CRASH_DTYPES, concat_frames, format_memory_report, memory_report, records_to_frame
+from nyc_collisions.streaming import stream_records_to_s3
 
 def get_total_record_count(client, dataset_name):
     """
@@ -39,13 +37,18 @@ def get_total_record_count(client, dataset_name):
     total_records = int(record_count[0]['COUNT'])
     return total_records
 
-def get_api_records(client, dataset_name):
+def get_api_records(client, dataset_name, max_workers=32):
     """
-    Fetch and aggregate records from an API in parallel using a ThreadPoolExecutor.
+    Fetch and aggregate records from an API in parallel.
+
+    The collision_id key space is split into disjoint ranges which are fetched by a thread
+    pool whose size adapts to the API's latency and throttling. Failed ranges are retried
+    on their own and the records come back in collision_id order.
 
     Args:
         client: The client object responsible for interacting with the API.
         dataset_name (str): The name or identifier of the dataset.
+        max_workers (int): The highest number of concurrent requests allowed.
 
     Returns:
         pd.DataFrame: A Pandas DataFrame containing the aggregated records from the API.
@@ -53,36 +56,72 @@ def get_api_records(client, dataset_name):
     
     chunk_size = 5000
     client.timeout = 100
+    start_time = time.time()
     
     # Get the total record count
     total_records = get_total_record_count(client, dataset_name)
     
-    # Create a ThreadPoolExecutor to fetch data in parallel
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        start = 0
-        number_of_requests_sent = 0 
-
-        # Fetch data in parallel
-        while start < total_records:
-            futures.append(executor.submit(fetch_data_chunk, start, chunk_size, client, dataset_name))
-            start += chunk_size
-            number_of_requests_sent += 1
-
-        # Collect the results from all futures
-        results = []
-        for future in concurrent.futures.as_completed(futures):
-            chunk = future.result()
-            if chunk:
-                results.extend(chunk)
+    # Fetch collision_id ranges in parallel, starting small and letting the controller find the right pace
+    controller = AimdController(initial=4, maximum=max_workers)
+    frames = []
+    stats = {'requests': 0, 'retries': 0, 'throttles': 0}
+    for records, stats in iter_records_in_parallel(client, dataset_name, chunk_size=chunk_size, controller=controller):
+        # Cast each range to the compact crash schema as it arrives
+        frames.append(records_to_frame(records))
+    crash_df = concat_frames(frames)
+
+    elapsed = time.time() - start_time
     
     print("PARALLEL APPROACH")
     print(f"Total number of records: {total_records}")
-    print(f'Number of requests sent {number_of_requests_sent}')
+    print(f'Number of requests sent {stats["requests"]}')
+    print(f'Retries: {stats["retries"]}, throttled responses: {stats["throttles"]}')
+    print(f"Throughput: {len(crash_df) / elapsed:.0f} rows/s")
+    print(f"Final concurrency: {controller.limit} (peak {controller.peak})")
+    print(f"Memory: {format_memory_report(memory_report(crash_df))}")
     
-    return pd.DataFrame.from_records(results)
+    return crash_df
+
+def get_api_records_async(client, dataset_name, max_in_flight=32, scheme='https'):
+    """
+    Drop-in alternative to get_api_records that fetches on one asyncio event loop.
+
+    The same collision_id ranges are requested through a pooled, keep-alive aiohttp session
+    with gzip transfer encoding, and max_in_flight caps the concurrent requests instead of a
+    thread count.
+
+    Args:
+        client (sodapy.Socrata): The Socrata client whose domain and app token are reused.
+        dataset_name (str): The name or identifier of the dataset.
+        max_in_flight (int): The highest number of concurrent requests allowed.
+        scheme (str): 'https', or 'http' for a local test server.
+
+    Returns:
+        pd.DataFrame: A Pandas DataFrame containing the aggregated records from the API.
+    """
+
+    chunk_size = 5000
+    client.timeout = 100
+
+    records, stats = fetch_records(client, dataset_name, max_in_flight=max_in_flight, scheme=scheme, chunk_size=chunk_size)
+
+    # Cast to the compact crash schema one range worth of records at a time
+    frames = [records_to_frame(records[start:start + chunk_size * 4]) for start in range(0, len(records), chunk_size * 4)]
+    crash_df = concat_frames(frames)
 
-def upload_dataframe_to_s3(client, bucket_name, key_name, df, dataset_name):
+    print("ASYNCIO APPROACH")
+    print(f"Total number of records: {len(crash_df)}")
+    print(f'Number of requests sent {stats["requests"]}')
+    print(f'Retries: {stats["retries"]}, throttled responses: {stats["throttles"]}')
+    if stats['seconds']:
+        print(f"Throughput: {len(crash_df) / stats['seconds']:.0f} rows/s")
+    print(f"Received {stats['bytes_received'] / 1e6:.1f} MB ({stats['bytes_decoded'] / 1e6:.1f} MB decoded)")
+    print(f"Memory: {format_memory_report(memory_report(crash_df))}")
+
+    return crash_df
+
+def upload_dataframe_to_s3(client, bucket_name, key_name, df, dataset_name, output_format='csv', compression='snappy',
+                           row_group_size=DEFAULT_ROW_GROUP_SIZE, content_encoding=None):
     """
     Uploads a DataFrame to S3 bucket using the provided AWS S3 client.
 
@@ -92,44 +131,149 @@ def upload_dataframe_to_s3(client, bucket_name, key_name, df, dataset_name):
         key_name (str): The key (object name) under which the data will be stored in the S3 bucket.
         df (pandas.DataFrame): The DataFrame to upload.
         dataset_name (str): The name of the dataset being uploaded.
+        output_format (str): 'csv' or 'parquet'.
+        compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+        row_group_size (int): Rows per Parquet row group. Ignored for CSV.
+        content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the S3_CONTENT_ENCODING
+        environment variable. Ignored for Parquet. key_name should end in the matching extension, i.e. '.csv.gz'.
 
     Returns:
         bool: True if the upload was successful, False otherwise.
     """
     
-    csv_buffer = df.to_csv(index=False)
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+    # Serialized straight into the codec, so the uncompressed file is never held next to the compressed one
+    body = io.BytesIO()
+    with CompressingWriter(body, content_encoding) as writer:
+        write_dataframe(df, writer, output_format, compression, row_group_size)
+    body.seek(0)
 
     try:
-        # Upload the CSV file to S3
-        client.put_object(Bucket=bucket_name, Key=key_name, Body=csv_buffer.encode('utf-8'))
+        # Upload the CSV or Parquet file to S3
+        client.put_object(Bucket=bucket_name, Key=key_name, Body=body, ContentType=content_type(output_format),
+                          **put_object_kwargs(content_encoding))
         print(f"Uploaded '{dataset_name}' to '{bucket_name}/{key_name}' successfully.")
         return True
     except ClientError as e:
         print(f"Error uploading '{dataset_name}' to '{bucket_name}/{key_name}': {e}")
         return False
 
-def main():
+def stream_api_records_to_s3(client, aws_client, bucket_name, key_name, dataset_name, max_in_flight_chunks=8, max_workers=32,
+                             output_format='csv', compression='snappy', columns=CRASH_COLUMNS, dtypes=CRASH_DTYPES,
+                             key_column=KEY_COLUMN, controller=None, content_encoding=None):
+    """
+    Fetch records from an API in parallel and stream them straight into a CSV or Parquet object on S3.
+
+    Every key range is a single chunk, and at most max_in_flight_chunks ranges are
+    fetched ahead of the upload, so memory stays bounded no matter how large the dataset is.
+
+    Args:
+        client: The client object responsible for interacting with the API.
+        aws_client (boto3.client): An AWS S3 client object.
+        bucket_name (str): The name of the S3 bucket.
+        key_name (str): The key (object name) under which the data will be stored in the S3 bucket.
+        dataset_name (str): The name or identifier of the dataset.
+        max_in_flight_chunks (int): Chunks allowed to be fetched ahead of the upload. This also caps concurrency.
+        max_workers (int): The highest number of concurrent requests allowed.
+        output_format (str): 'csv' or 'parquet'.
+        compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+        columns (list): Column names of the dataset, in output order (see datasets.py).
+        dtypes (dict): Column name to dtype of the dataset.
+        key_column (str): The dataset's unique, numeric key, i.e. 'unique_id' for persons.
+        controller (AimdController): Concurrency controller, shared by the datasets fetched at
+        the same time so they share one rate budget. A new one is created if None.
+        content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the S3_CONTENT_ENCODING
+        environment variable. Ignored for Parquet.
+
+    Returns:
+        dict: Run summary with rows, chunks, bytes, raw_bytes, parts, seconds, peak_rss_mb, requests, retries and throttles.
+    """
+    chunk_size = 5000
+    client.timeout = 100
+
+    controller = controller or AimdController(initial=4, maximum=max_workers)
+    stats = {'requests': 0, 'retries': 0, 'throttles': 0}
+
+    def pages():
+        nonlocal stats
+        for records, stats in iter_records_in_parallel(client, dataset_name, chunk_size=chunk_size, partition_size=chunk_size,
+                                                       controller=controller, reorder_window=max_in_flight_chunks,
+                                                       key_column=key_column):
+            yield records
+
+    summary = stream_records_to_s3(pages(), aws_client, bucket_name, key_name, columns, dtypes=dtypes, max_in_flight_chunks=max_in_flight_chunks,
+                                   output_format=output_format, compression=compression, content_encoding=content_encoding)
+
+    print(f"PARALLEL APPROACH (STREAMING) - {dataset_name}")
+    print(f"Total number of records: {summary['rows']}")
+    print(f'Number of requests sent {stats["requests"]}')
+    print(f'Retries: {stats["retries"]}, throttled responses: {stats["throttles"]}')
+    if summary['seconds']:
+        print(f"Throughput: {summary['rows'] / summary['seconds']:.0f} rows/s")
+    print(f"Final concurrency: {controller.limit} (peak {controller.peak})")
+    print(f"Uploaded {summary['bytes']} bytes in {summary['parts']} parts to '{bucket_name}/{key_name}'")
+    if summary['content_encoding'] != 'identity':
+        print(f"Compressed with {summary['content_encoding']}: {summary['raw_bytes']} bytes of CSV "
+              f"in {summary['compress_seconds']} seconds")
+    print(f"Peak memory (RSS): {summary['peak_rss_mb']} MiB")
+
+    summary.update(stats)
+    return summary
+
+# PROFILE=1 (or main(profile=True)) writes cProfile and tracemalloc reports to PROFILE_DIR, PROFILE=cpu only cProfile
+@profiled_run('multiThread_mass_upload')
+def main(output_format='csv', cache_dir=None, datasets=tuple(DATASETS), max_workers=32, content_encoding=None):
     data_url = 'data.cityofnewyork.us'
     socrata_client = Socrata(data_url, app_token)
-    crash_data_set = 'h9gi-nx95'
+    # SOCRATA_CACHE_DIR=path (or main(cache_dir=path), i.e. DEFAULT_CACHE_DIR) reads pages already downloaded
+    # by an earlier run from a local cache. Off by default, so a plain run never serves a stale page
+    cache_dir = cache_dir or os.environ.get('SOCRATA_CACHE_DIR')
+    if cache_dir:
+        socrata_client = CachedSocrataClient(socrata_client, cache_dir)
     bucket_name = 'nyc-application-collisions'
     key_name = 'collisions_raw_data'
 
+    # Connect to AWS boto3 client - Make sure to check the security settings 
+    aws_client = boto3.client('s3', aws_access_key_id = access_key, aws_secret_access_key = secret_access_key)
+
+    # Per-stage metrics as JSON lines (METRICS_SINK=off, stdout or a file path)
+    metrics = MetricsRecorder('multiThread_mass_upload')
+
     # Measure execution time
     start_time = time.time()
 
-    # Call on Threading Method for Mass Download
-    crash_df = get_api_records(socrata_client, crash_data_set)
+    # Crashes, persons and vehicles are fetched at the same time. They share one controller,
+    # so together they never send more than its limit of concurrent requests to the API.
+    controller = AimdController(initial=4, maximum=max_workers)
 
-    # Connect to AWS boto3 client - Make sure to check the security settings
-    aws_client = boto3.client('s3', aws_access_key_id = access_key, aws_secret_access_key = secret_access_key)
+    # S3_CONTENT_ENCODING=gzip or zstd (or content_encoding) compresses the CSV, i.e. 'person_data_set_par.csv.gz'
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+
+    # Call on Threading Method for Mass Download, streaming each chunk directly to S3 collisions_raw_data key
+    def download_and_upload(name):
+        dataset = get_dataset(name)
+        with metrics.stage('download_and_upload', output_format=output_format, content_encoding=content_encoding,
+                           dataset=name) as stage:
+            summary = stream_api_records_to_s3(socrata_client, aws_client, bucket_name,
+                                               key_name+f"/'{raw_file_name(name, output_format, content_encoding)}'",
+                                               dataset['dataset_id'], output_format=output_format, columns=dataset['columns'],
+                                               dtypes=dataset['dtypes'], key_column=dataset['key_column'],
+                                               controller=controller, content_encoding=content_encoding)
+            stage.add(rows=summary['rows'], bytes=summary['bytes'], raw_bytes=summary['raw_bytes'],
+                      requests=summary['requests'], retries=summary['retries'], throttles=summary['throttles'])
+        return summary
 
-    # Upload directly to S3 collisions_raw_data key
-    upload_dataframe_to_s3(aws_client, bucket_name, key_name+"/'crash_data_set_par.csv'", crash_df, 'crash_data_set_par.csv')
+    run = fetch_datasets(download_and_upload, datasets)
+    for name, summary in run['datasets'].items():
+        print(f"{name}: {summary['rows']} records, {summary['bytes']} bytes")
+    print(f"Shared concurrency: final {controller.limit}, peak {controller.peak}; {len(run['errors'])} datasets failed")
 
     # Calculate and print execution time
+    if cache_dir:
+        print(format_cache_stats(socrata_client.stats))
     execution_time = time.time() - start_time
     print(f"Execution time: {execution_time} seconds\n")
+    print(format_metrics_summary(metrics.summary()))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+"""
+Benchmark: filling the missing boroughs from the zip code, per-row apply and merge vs the
+array-backed index in nyc_collisions/boroughs.py.
+
+A synthetic crashes table of --rows rows is built with --missing-rate of the boroughs
+empty; zip codes are drawn from data/nycBorough.csv, except for --foreign-rate of them
+(zip codes outside the city) and a few missing ones. Three ways of filling the borough:
+
+- apply: a dict lookup per row with DataFrame.apply(axis=1), timed on --apply-rows rows
+  and scaled up, since it takes minutes on the full table;
+- merge: a left merge with the lookup table, then fillna; copies the whole table;
+- index: enrich_boroughs, with the zip code column as the ETL reads it (float64 from the
+  raw CSV), as the mass uploads type it (categorical) and as plain text.
+
+For each it reports the time, rows/s, memory allocated at the peak (tracemalloc), the fill
+rate and whether the result matches the merge.
+
+Usage:
+    python bench_boroughs.py --rows 3000000 --missing-rate 0.35
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.boroughs import BOROUGHS, DEFAULT_LOOKUP_PATH, enrich_boroughs, load_borough_index, normalize_borough
+
+def build_table(rows, missing_rate, foreign_rate, seed=3):
+    rng = np.random.default_rng(seed)
+    lookup = pd.read_csv(DEFAULT_LOOKUP_PATH, dtype=str).drop_duplicates('zip_code')
+    nyc_zips = lookup['zip_code'].astype(float).to_numpy()
+    zip_codes = rng.choice(nyc_zips, rows)
+    foreign = rng.random(rows) < foreign_rate
+    zip_codes[foreign] = rng.integers(7001, 8999, foreign.sum())
+    zip_codes[rng.random(rows) < 0.01] = np.nan
+    # Socrata spells the borough in capitals; the ones present agree with the zip code
+    boroughs = lookup.set_index(lookup['zip_code'].astype(float))['Boroughs'].map(normalize_borough)
+    borough = pd.Series(zip_codes).map(boroughs).to_numpy(dtype=object)
+    borough[rng.random(rows) < missing_rate] = None
+    return pd.DataFrame({'borough': borough, 'zip_code': zip_codes, 'collision_id': np.arange(rows)})
+
+def measure(function):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=3000000, help='rows in the synthetic table')
+    parser.add_argument('--missing-rate', type=float, default=0.35, help='fraction of rows without a borough')
+    parser.add_argument('--foreign-rate', type=float, default=0.02, help='fraction of zip codes outside the city')
+    parser.add_argument('--apply-rows', type=int, default=100000, help='rows the per-row apply is timed on')
+    args = parser.parse_args()
+
+    table = build_table(args.rows, args.missing_rate, args.foreign_rate)
+    lookup = pd.read_csv(DEFAULT_LOOKUP_PATH, dtype=str).drop_duplicates('zip_code')
+    lookup = pd.DataFrame({'zip_code': lookup['zip_code'].astype(float), 'zip_borough': lookup['Boroughs'].map(normalize_borough)})
+    mapping = dict(zip(lookup['zip_code'], lookup['zip_borough']))
+    print(f"Borough enrichment benchmark: {args.rows} rows, {table['borough'].isna().mean():.1%} without a borough")
+
+    def report(method, seconds, peak, filled, rows=args.rows, **extra):
+        print({'method': method, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds),
+               'peak_alloc_mb': round(peak / 1e6, 1), 'fill_rate': round(float(filled.notna().mean()), 4), **extra})
+
+    # Per-row apply on a sample, scaled up to the whole table
+    sample = table.head(args.apply_rows).copy()
+    filled, seconds, peak = measure(lambda: sample.apply(
+        lambda row: row['borough'] if isinstance(row['borough'], str) else mapping.get(row['zip_code']), axis=1))
+    report('apply (scaled)', seconds * args.rows / len(sample), peak, filled)
+
+    def merge():
+        merged = table.merge(lookup, on='zip_code', how='left')
+        merged['borough'] = merged['borough'].fillna(merged.pop('zip_borough'))
+        return merged
+    merged, seconds, peak = measure(merge)
+    expected = merged['borough'].to_numpy(dtype=object)
+    report('merge', seconds, peak, merged['borough'])
+    del merged
+
+    load_borough_index()
+    variants = [
+        ('index, float zip (raw CSV)', table['zip_code']),
+        ('index, categorical zip', table['zip_code'].map('{:.0f}'.format, na_action='ignore').astype('category')),
+        ('index, text zip', table['zip_code'].map('{:.0f}'.format, na_action='ignore').astype('string')),
+    ]
+    for name, zip_codes in variants:
+        enriched = pd.DataFrame({'borough': table['borough'], 'zip_code': zip_codes})
+        borough_report, seconds, peak = measure(lambda: enrich_boroughs(enriched))
+        matches = np.array_equal(enriched['borough'].to_numpy(dtype=object, na_value=None),
+                                 np.where(pd.isna(expected), None, expected))
+        report(name, seconds, peak, enriched['borough'], filled_rows=borough_report['filled'],
+               dtype=str(enriched['borough'].dtype), matches_merge=matches)
+
+    memory = {'object column': table['borough'].memory_usage(deep=True) / 1e6,
+              'categorical column': pd.Categorical(table['borough'], categories=BOROUGHS).memory_usage(deep=True) / 1e6}
+    print({name: f"{size:.1f} MB" for name, size in memory.items()})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark: re-running a download with and without the on-disk Socrata response cache.
+
+The fake Socrata server holds --rows synthetic crashes whose last --recent-days days are
+within the cache's recent window. The whole dataset is paged with iter_keyset_pages, the
+way the mass uploads do, several times through CachedSocrataClient:
+
+1. cold: empty cache, every page is downloaded and stored;
+2. warm: the re-run of a failed load, answered from disk;
+3. two hours later: the historical pages are still served, the recent ones have expired;
+4. capped: a fresh cache limited to --max-mb (half the cold cache by default), so the least
+   recently used pages are evicted and the warm re-run has to download them again.
+
+For each run it reports the time, server requests, hit rate, bytes not downloaded and the
+size of the cache on disk against the raw JSON it holds.
+
+Usage:
+    python bench_cache.py --rows 200000 --latency 0.05
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fake_socrata import CRASH_DATA_SET, FakeSocrataServer, generate_crash_rows
+from nyc_collisions.cache import CachedSocrataClient, format_cache_stats
+from nyc_collisions.paging import iter_keyset_pages
+
+CHUNK_SIZE = 5000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='rows in the fake dataset (about 600 per day)')
+    parser.add_argument('--recent-days', type=int, default=10, help='days at the end of the dataset that are recent')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake server waits per request')
+    parser.add_argument('--max-mb', type=float, help='size cap of the capped run, half the cold cache by default')
+    args = parser.parse_args()
+
+    days = max(1, args.rows // 600)
+    start_date = datetime.now() - timedelta(days=days - args.recent_days + 30)
+    rows = generate_crash_rows(args.rows, start_date=f"{start_date:%Y-%m-%d}")
+
+    with FakeSocrataServer(rows, latency=args.latency) as server, tempfile.TemporaryDirectory() as cache_dir:
+        print(f"Cache benchmark: {args.rows} rows in pages of {CHUNK_SIZE}, {args.latency}s per request, "
+              f"crashes up to {rows[-1]['crash_date'][:10]}")
+
+        def run(name, cache, clock_offset=0):
+            server.reset_stats()
+            start_time = time.perf_counter()
+            real_time = time.time
+            with mock.patch('nyc_collisions.cache.time.time', lambda: real_time() + clock_offset):
+                fetched = sum(len(page) for page in iter_keyset_pages(cache, CRASH_DATA_SET, chunk_size=CHUNK_SIZE))
+            stored_bytes = sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(cache.cache_dir)
+                               for name in names)
+            print({
+                'run': name,
+                'seconds': round(time.perf_counter() - start_time, 3),
+                'rows': fetched,
+                'server_requests': server.stats['requests'],
+                'cache_on_disk_mb': round(stored_bytes / 1e6, 2),
+                'raw_json_mb': round(cache.stats['bytes_downloaded'] / 1e6, 2),
+            })
+            print(f"    {format_cache_stats(cache.stats)}")
+            stats = dict(cache.stats, stored_bytes=stored_bytes)
+            cache.stats.update({name: 0 for name in cache.stats})
+            return stats
+
+        cache = CachedSocrataClient(server.client(), cache_dir)
+        cold = run('cold', cache)
+        run('warm', cache)
+        run('two hours later', cache, clock_offset=2 * 60 * 60)
+
+        # The cap has to be below what the cold run stored, or nothing is ever evicted
+        max_mb = args.max_mb or round(cold['stored_bytes'] / 2e6, 2)
+        capped = CachedSocrataClient(server.client(), os.path.join(cache_dir, 'capped'), max_bytes=int(max_mb * 1e6))
+        capped_cold = run(f'capped at {max_mb} MB, cold', capped)
+        capped_warm = run(f'capped at {max_mb} MB, warm', capped)
+        if not capped_cold['evictions'] or not capped_warm['misses']:
+            sys.exit(f"The {max_mb} MB cap did not evict anything, it has to be below the "
+                     f"{cold['stored_bytes'] / 1e6:.2f} MB the cold run stored")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark: catching up after the daily updates Lambda has fallen behind, in one go vs in
+checkpointed windows.
+
+The fake Socrata server holds crashes up to today; S3 (moto, in-process) already has every
+day except the last --behind days. The handler is invoked with a fake Lambda context that
+times out after --timeout seconds, again and again (the way SELF_REINVOKE or the next
+scheduled run would) until it reports the run complete or --max-invocations is reached:
+
+- one window: the whole backlog in a single window, like the handler used to fetch it;
+  when it does not fit, the fetched pages are dropped at the deadline and nothing is written;
+- checkpointed: windows of --window-days days, with the cursor saved to S3 after each.
+
+For each backlog it reports whether the run completed, the invocations it took, the total
+time and the rows in S3 against the rows served.
+
+Usage:
+    python bench_checkpoint.py --behind 30 60 120 --timeout 4 --latency 0.1
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from harness import load_pipeline_module, local_s3, BUCKET_NAME
+from fake_socrata import FakeSocrataServer, generate_crash_rows
+
+KEY_NAME = 'collisions_processed_data'
+SECRET_NAME = 'nyc-collisions/socrata'
+ROWS_PER_DAY = 600
+
+class FakeContext:
+    """The parts of the Lambda context the handler uses, with a deadline timeout seconds from now."""
+
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:000000000000:function:daily_updates'
+
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--behind', type=int, nargs='+', default=[30, 60, 120], help='days missing from S3')
+    parser.add_argument('--loaded', type=int, default=30, help='days already in S3 before the backlog')
+    parser.add_argument('--timeout', type=float, default=4.0, help='seconds per invocation')
+    parser.add_argument('--reserve', type=float, default=0.5, help='seconds kept back to save the checkpoint')
+    parser.add_argument('--window-days', type=int, default=7, help='days per checkpointed window')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the fake server waits per request')
+    parser.add_argument('--max-invocations', type=int, default=30, help='invocations before giving up')
+    args = parser.parse_args()
+
+    os.environ.update(SECRET_NAME=SECRET_NAME, TIME_RESERVE_SECONDS=str(args.reserve))
+    lambda_module = load_pipeline_module('daily_updates_lambda')
+    from nyc_collisions.manifest import load_manifest, update_manifest
+    from nyc_collisions.partitions import write_partitions
+    from nyc_collisions.schema import records_to_frame
+    from nyc_collisions.transform import transform_data
+
+    mock, aws_client = local_s3()
+    lambda_module.get_aws_client('secretsmanager').create_secret(Name=SECRET_NAME,
+                                                                 SecretString=json.dumps({'app_token': 'fake'}))
+
+    print(f"Catch-up benchmark: {args.timeout}s per invocation, {args.latency}s per Socrata request, "
+          f"windows of {args.window_days} days")
+    for behind in args.behind:
+        days = args.loaded + behind
+        start_date = datetime.now() - timedelta(days=days - 1)
+        rows = generate_crash_rows(days * ROWS_PER_DAY, start_date=f"{start_date:%Y-%m-%d}")
+        loaded_until = f"{start_date + timedelta(days=args.loaded - 1):%Y-%m-%d}"
+        loaded_df, _ = transform_data(records_to_frame([row for row in rows if row['crash_date'][:10] <= loaded_until]))
+
+        with FakeSocrataServer(rows, latency=args.latency) as server:
+            lambda_module.Socrata = lambda domain, app_token: server.client()
+            lambda_module._clients.pop('socrata_app_token', None)
+
+            for name, window_days in [('one window', days + 1), ('checkpointed', args.window_days)]:
+                # Start every run from the same S3 contents
+                for page in aws_client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET_NAME):
+                    for entry in page.get('Contents', []):
+                        aws_client.delete_object(Bucket=BUCKET_NAME, Key=entry['Key'])
+                report = write_partitions(aws_client, BUCKET_NAME, KEY_NAME, loaded_df, 'crash_date')
+                update_manifest(aws_client, BUCKET_NAME, KEY_NAME, report['partitions'])
+
+                start_time = time.perf_counter()
+                complete = False
+                invocations = 0
+                while not complete and invocations < args.max_invocations:
+                    invocations += 1
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        response = lambda_module.lambda_handler({'window_days': window_days}, FakeContext(args.timeout))
+                    complete = json.loads(response['body'])['complete']
+                seconds = time.perf_counter() - start_time
+
+                manifest, _ = load_manifest(aws_client, BUCKET_NAME, KEY_NAME)
+                print({
+                    'behind_days': behind,
+                    'run': name,
+                    'complete': complete,
+                    'invocations': invocations,
+                    'seconds': round(seconds, 2),
+                    'rows_in_s3': f"{sum(partition['rows'] for partition in manifest['partitions'].values())}/{len(rows)}",
+                })
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark: plain CSV vs gzip and zstd at several levels, for the raw extract and the day
+partitions.
+
+A synthetic raw crash CSV of --rows rows is built, transformed like the ETL does, and its
+day partitions serialized as CSV. For every codec and level, the raw file is compressed
+through CompressingWriter (the way stream_records_to_s3 writes it) and every partition
+with compress_bytes (the way write_partitions does). For each it reports the compression
+ratio, the CPU seconds to compress and to decompress (time.process_time) and the MB/s of
+uncompressed CSV that makes.
+
+Then, against a local S3 (moto, in-process), each codec at its default level runs the real
+writers and readers:
+
+- write_partitions of the transformed frame: seconds and MB stored;
+- read back every partition with read_dataframe: seconds, and the same rows as written;
+- the raw file streamed into S3 with stream_records_to_s3, then stream_transform_from_s3
+  on it: seconds of each, MB stored and fetched, and the same frame as the plain CSV run.
+
+The local S3 has no network in between: on a real link the smaller objects also save
+transfer time, which these numbers leave out.
+
+Usage:
+    python bench_compression.py --rows 1000000
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+from harness import BUCKET_NAME, local_s3
+from fake_socrata import generate_crash_frame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.compression import CompressingWriter, compress_bytes, decompress_bytes, encoding_extension
+from nyc_collisions.extract import stream_transform_from_s3
+from nyc_collisions.formats import read_dataframe, serialize_dataframe
+from nyc_collisions.partitions import iter_date_partitions, write_partitions
+from nyc_collisions.streaming import stream_records_to_s3
+from nyc_collisions.transform import transform_data
+
+LEVELS = [('identity', None), ('gzip', 1), ('gzip', 6), ('gzip', 9), ('zstd', 1), ('zstd', 3), ('zstd', 9), ('zstd', 19)]
+
+def cpu_seconds(function):
+    start = time.process_time()
+    result = function()
+    return result, time.process_time() - start
+
+def stream_compress(body, content_encoding, level, write_size=1024 * 1024):
+    sink = io.BytesIO()
+    with CompressingWriter(sink, content_encoding, level=level) as writer:
+        for start in range(0, len(body), write_size):
+            writer.write(body[start:start + write_size])
+    return sink.getvalue()
+
+def codec_row(name, raw_size, compress, decompress):
+    compressed, compress_cpu = cpu_seconds(compress)
+    stored = sum(len(part) for part in compressed)
+    _, decompress_cpu = cpu_seconds(lambda: [decompress(part) for part in compressed])
+    return {'data': name, 'raw_mb': round(raw_size / 1e6, 1), 'stored_mb': round(stored / 1e6, 2),
+            'ratio': round(raw_size / stored, 2),
+            'compress_cpu_s': round(compress_cpu, 3), 'compress_mb_s': round(raw_size / 1e6 / compress_cpu) if compress_cpu else None,
+            'decompress_cpu_s': round(decompress_cpu, 3),
+            'decompress_mb_s': round(raw_size / 1e6 / decompress_cpu) if decompress_cpu else None}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help='rows in the raw file (about 600 per day)')
+    parser.add_argument('--page-rows', type=int, default=50000, help='records per page streamed to S3')
+    args = parser.parse_args()
+
+    raw_df = generate_crash_frame(args.rows)
+    raw_body = raw_df.to_csv(index=False).encode('utf-8')
+    df, _ = transform_data(raw_df.copy())
+    partitions = [serialize_dataframe(day_df) for _, day_df in iter_date_partitions(df, 'crash_date')]
+    partition_size = sum(len(body) for body in partitions)
+    print(f"Compression benchmark: {args.rows} rows, {len(raw_body) / 1e6:.1f} MB raw CSV, "
+          f"{len(partitions)} partitions ({partition_size / 1e6:.1f} MB of CSV)")
+
+    print("\nCodecs, in memory:")
+    for content_encoding, level in LEVELS:
+        codec = content_encoding if level is None else f"{content_encoding} {level}"
+        # raw_body is bound now: it is deleted before the S3 runs below to free its memory
+        raw = codec_row('raw', len(raw_body), lambda body=raw_body: [stream_compress(body, content_encoding, level)],
+                        lambda part: decompress_bytes(part))
+        days = codec_row('partitions', partition_size,
+                         lambda: [compress_bytes(body, content_encoding, level) for body in partitions],
+                         lambda part: decompress_bytes(part))
+        print(dict({'codec': codec}, **raw))
+        print(dict({'codec': codec}, **days))
+
+    print("\nWriters and readers, local S3, default levels:")
+    columns = list(raw_df.columns)
+    records = raw_df.astype(object).where(raw_df.notna(), None).to_dict('records')
+    del raw_df, raw_body
+    mock, aws_client = local_s3()
+    reference = None
+    for content_encoding in ('identity', 'gzip', 'zstd'):
+        key_name = f"processed_{content_encoding}"
+        start_time = time.perf_counter()
+        report = write_partitions(aws_client, BUCKET_NAME, key_name, df, 'crash_date', content_encoding=content_encoding)
+        write_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        read_rows = 0
+        for partition in report['partitions']:
+            body = aws_client.get_object(Bucket=BUCKET_NAME, Key=partition['key'])['Body'].read()
+            read_rows += len(read_dataframe(body, 'csv'))
+        read_seconds = time.perf_counter() - start_time
+
+        raw_key = f"collisions_raw_data/'crash_data_set_par.csv{encoding_extension(content_encoding)}'"
+        pages = (records[start:start + args.page_rows] for start in range(0, len(records), args.page_rows))
+        start_time = time.perf_counter()
+        summary = stream_records_to_s3(pages, aws_client, BUCKET_NAME, raw_key, columns, content_encoding=content_encoding)
+        upload_seconds = time.perf_counter() - start_time
+        streamed_df, extract_report = stream_transform_from_s3(aws_client, BUCKET_NAME, raw_key)
+        reference = streamed_df if reference is None else reference
+
+        print({'codec': content_encoding,
+               'partitions_write_s': round(write_seconds, 3),
+               'partitions_mb': round(report['bytes'] / 1e6, 1),
+               'partitions_read_s': round(read_seconds, 3), 'same_rows': read_rows == len(df),
+               'raw_upload_s': round(upload_seconds, 3), 'raw_mb': round(summary['bytes'] / 1e6, 1),
+               'raw_compress_s': summary['compress_seconds'],
+               'extract_transform_s': extract_report['seconds'],
+               'mb_fetched': round(extract_report['bytes_fetched'] / 1e6, 1),
+               'same_frame': bool(streamed_df.equals(reference))})
+        del streamed_df
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
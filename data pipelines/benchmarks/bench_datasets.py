@@ -0,0 +1,204 @@
+"""
+Benchmark: fetching the crash, person and vehicle datasets under one shared rate budget,
+and joining them for a date range with merge joins vs hash joins.
+
+--crashes synthetic crashes are served with their persons (1 to 4 per crash) and vehicles
+(1 to 3 per crash) by a fake SODA server that answers HTTP 429 above --server-capacity
+requests in flight, counted over all three datasets. They are downloaded with
+iter_records_in_parallel three ways:
+
+- one dataset after the other, each with its own controller (what a loop over the
+  registry would do);
+- all three at the same time, each with its own controller: together they overshoot the
+  server's capacity;
+- all three at the same time sharing one controller, as multiThread_mass_upload.main does.
+
+For each it reports the time, requests, throttled responses and whether every record
+arrived.
+
+The datasets are then transformed and written as day partitions to a local S3 (moto,
+in-process), persons and vehicles sorted by collision_id, and the crashes' collision_id
+index is built. Persons and vehicles of the last --range-days days are joined to their
+crashes two ways:
+
+- hash join: read the range's partitions of both datasets, concatenate them and pd.merge
+  the whole range at once;
+- merge join: join_collisions, which reads the co-partitioned days and merges them on
+  (day, collision_id), the crash order coming from the collision_id index.
+
+For each it reports the time, peak traced memory (on a second run), rows and whether
+both give the same rows.
+Last, the join step alone is timed on the whole history already in memory: pd.merge vs
+merge_join.
+
+Usage:
+    python bench_datasets.py --crashes 60000 --latency 0.02 --server-capacity 12 --range-days 60
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from harness import local_s3, BUCKET_NAME
+from fake_socrata import FakeDataset, FakeSocrataServer, generate_crash_rows, generate_person_rows, generate_vehicle_rows
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.datasets import DATASETS, fetch_datasets
+from nyc_collisions.formats import read_dataframe
+from nyc_collisions.grid import GRID_LEVELS
+from nyc_collisions.joins import (_csv_dtypes, format_index_report, format_join_report,
+                                  join_collisions, merge_join, update_collision_index)
+from nyc_collisions.manifest import load_manifest, update_manifest
+from nyc_collisions.parallel import AimdController, iter_records_in_parallel
+from nyc_collisions.partitions import write_partitions
+from nyc_collisions.schema import records_to_frame
+from nyc_collisions.transform import transform_data
+
+def download(client, name, controller, chunk_size):
+    dataset = DATASETS[name]
+    rows = 0
+    for records, _ in iter_records_in_parallel(client, dataset['dataset_id'], chunk_size=chunk_size, controller=controller,
+                                               key_column=dataset['key_column']):
+        rows += len(records)
+    return rows
+
+def _day_keys_of(days, collision_ids):
+    # Day and collision_id packed like join_collisions does
+    day_numbers = pd.to_datetime(days).to_numpy().astype('datetime64[D]').astype(np.int64)
+    return (day_numbers << 40) | collision_ids.to_numpy(dtype='int64')
+
+def hash_join(aws_client, child, start_date, end_date):
+    """Read every partition of the range of both datasets, then one pd.merge of the whole range."""
+    def read_range(name):
+        manifest, _ = load_manifest(aws_client, BUCKET_NAME, DATASETS[name]['processed_key'])
+        keys = [entry['key'] for date, entry in manifest['partitions'].items() if start_date <= date <= end_date]
+
+        def read(key):
+            body = aws_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read()
+            return read_dataframe(body, 'csv', dtype=_csv_dtypes(DATASETS[name]['dtypes']))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return pd.concat(list(executor.map(read, keys)), ignore_index=True)
+
+    crash_df = read_range('crashes')
+    child_df = read_range(child)
+    crash_df = crash_df[[column for column in crash_df.columns if column not in child_df.columns or column == 'collision_id']]
+    return child_df.merge(crash_df, on='collision_id', how='inner')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--crashes', type=int, default=60000, help='synthetic crashes (about 600 per day)')
+    parser.add_argument('--chunk-size', type=int, default=2000, help='records per request')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to each response')
+    parser.add_argument('--server-capacity', type=int, default=12, help='requests in flight, over every dataset, before HTTP 429')
+    parser.add_argument('--max-workers', type=int, default=16, help='upper bound of each controller')
+    parser.add_argument('--range-days', type=int, default=60, help='days joined')
+    args = parser.parse_args()
+
+    crash_rows = generate_crash_rows(args.crashes)
+    rows = {'crashes': crash_rows, 'persons': generate_person_rows(crash_rows), 'vehicles': generate_vehicle_rows(crash_rows)}
+    print(f"Dataset benchmark: {', '.join(f'{len(records)} {name}' for name, records in rows.items())}, "
+          f"latency {args.latency}s, capacity {args.server_capacity}")
+
+    def new_controller():
+        return AimdController(initial=4, maximum=args.max_workers, target_latency=1.0)
+
+    def sequential(client):
+        return {name: download(client, name, new_controller(), args.chunk_size) for name in DATASETS}
+
+    def concurrent(client, shared):
+        controller = new_controller()
+        run = fetch_datasets(lambda name: download(client, name, controller if shared else new_controller(), args.chunk_size))
+        return run['datasets']
+
+    print("\nDownloads:")
+    for strategy, fetch in [('one after the other', sequential),
+                            ('concurrent, own controllers', lambda client: concurrent(client, False)),
+                            ('concurrent, shared controller', lambda client: concurrent(client, True))]:
+        datasets = {DATASETS[name]['dataset_id']: FakeDataset(records, key_column=DATASETS[name]['key_column'])
+                    for name, records in rows.items() if name != 'crashes'}
+        with FakeSocrataServer(crash_rows, latency=args.latency, max_concurrency=args.server_capacity,
+                               datasets=datasets) as server:
+            start_time = time.perf_counter()
+            try:
+                fetched = fetch(server.client())
+            except Exception as e:
+                print({'strategy': strategy, 'failed': repr(e)[:120], 'requests': server.stats['requests']})
+                continue
+            print({'strategy': strategy, 'seconds': round(time.perf_counter() - start_time, 3),
+                   'requests': server.stats['requests'], 'throttled': server.stats['throttled'],
+                   'complete': all(fetched.get(name) == len(records) for name, records in rows.items())})
+
+    # Transform and write every dataset the way etl.process_dataset does
+    mock, aws_client = local_s3()
+    frames = {}
+    for name, records in rows.items():
+        dataset = DATASETS[name]
+        frame, _ = transform_data(records_to_frame(records, dataset['columns'], dataset['dtypes']),
+                                  fill_boroughs=name == 'crashes', grid_levels=GRID_LEVELS if name == 'crashes' else ())
+        report = write_partitions(aws_client, BUCKET_NAME, dataset['processed_key'], frame, 'crash_date',
+                                  sort_column=dataset['sort_column'])
+        update_manifest(aws_client, BUCKET_NAME, dataset['processed_key'], report['partitions'])
+        frames[name] = frame
+        if name == 'crashes':
+            days = sorted(partition['date'] for partition in report['partitions'])
+            print(f"\n{format_index_report(update_collision_index(aws_client, BUCKET_NAME, dataset['processed_key'], frame))}")
+
+    start_date, end_date = days[-min(args.range_days, len(days))], days[-1]
+    print(f"\nJoins, {start_date} to {end_date}:")
+    for child in ('persons', 'vehicles'):
+        answers = {}
+        for method in ('hash join', 'merge join'):
+            def run():
+                if method == 'hash join':
+                    return hash_join(aws_client, child, start_date, end_date), None
+                return join_collisions(aws_client, BUCKET_NAME, child, start_date, end_date)
+            start_time = time.perf_counter()
+            answer, join_report = run()
+            seconds = time.perf_counter() - start_time
+            # Memory is traced on a second run, tracing slows the first one down too much to time it
+            tracemalloc.start()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            answers[method] = answer
+            if join_report is not None:
+                merge_report = join_report
+            print({'child': child, 'method': method, 'seconds': round(seconds, 3), 'peak_mb': round(peak / 1e6, 1),
+                   'rows': len(answer)})
+        print(f"  {format_join_report(merge_report)}")
+        columns = sorted(answers['hash join'].columns)
+        same = (sorted(answers['merge join'].columns) == columns and
+                answers['hash join'][columns].sort_values('unique_id', ignore_index=True).equals(
+                    answers['merge join'][columns].sort_values('unique_id', ignore_index=True)))
+        print({'child': child, 'same_rows': same})
+
+    # The join step alone, on the whole history already in memory, both sides sorted by day and collision_id
+    print("\nJoin step alone, whole history in memory:")
+    crash_df = frames['crashes'].sort_values(['crash_date', 'collision_id'], kind='stable', ignore_index=True)
+    left_keys = _day_keys_of(crash_df['crash_date'], crash_df['collision_id'])
+    for child in ('persons', 'vehicles'):
+        child_df = frames[child].sort_values(['crash_date', 'collision_id'], kind='stable', ignore_index=True)
+        right_keys = _day_keys_of(child_df['crash_date'], child_df['collision_id'])
+        pruned = crash_df[[column for column in crash_df.columns if column not in child_df.columns or column == 'collision_id']]
+        for method, join in [('hash join', lambda: child_df.merge(pruned, on='collision_id', how='inner')),
+                             ('merge join', lambda: merge_join(crash_df, child_df, left_keys=left_keys,
+                                                               right_keys=right_keys))]:
+            start_time = time.perf_counter()
+            answer = join()
+            seconds = time.perf_counter() - start_time
+            tracemalloc.start()
+            join()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print({'child': child, 'method': method, 'seconds': round(seconds, 4), 'peak_mb': round(peak / 1e6, 1),
+                   'rows': len(answer)})
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
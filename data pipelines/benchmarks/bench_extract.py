@@ -0,0 +1,119 @@
+"""
+Benchmark: extract_csv_from_s3 (whole body, BytesIO copy, one read_csv, see harness.py)
+vs the streaming range-GET extractor.
+
+A synthetic raw crash CSV of --rows rows is put in a local S3 stand-in running in its
+own process. Every mode then runs in a fresh child process, so its peak RSS is its own:
+
+- full read: extract_csv_from_s3, the whole file as one untyped frame;
+- stream read: iter_raw_batches, parsing the file in --batch-rows batches and dropping them;
+- full etl: extract_csv_from_s3 then transform_data, what process_dataset used to do;
+- stream etl: stream_transform_from_s3, each batch transformed as soon as it is parsed.
+
+For each it reports the time, rows, peak RSS above the child's baseline (after its
+imports), GET requests and MB fetched. A last child runs both ETL modes and checks
+they give the same frame.
+
+Usage:
+    python bench_extract.py --rows 2000000 --batch-rows 100000 --block-mb 8 --prefetch 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from harness import BUCKET_NAME, extract_csv_from_s3, moto_server_process
+from bench_suite import proc_status_mb, reset_peak_rss
+from fake_socrata import generate_crash_frame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.extract import iter_raw_batches, stream_transform_from_s3
+from nyc_collisions.transform import transform_data
+
+RAW_KEY = "collisions_raw_data/'crash_data_set_par.csv'"
+MODES = ['full read', 'stream read', 'full etl', 'stream etl']
+
+class CountingClient:
+    """Wrap a boto3 client to count the GET requests and the bytes they return."""
+
+    def __init__(self, aws_client):
+        self.aws_client = aws_client
+        self.requests = 0
+        self.bytes = 0
+
+    def get_object(self, **kwargs):
+        response = self.aws_client.get_object(**kwargs)
+        self.requests += 1
+        self.bytes += response['ContentLength']
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.aws_client, name)
+
+def child(args):
+    import boto3
+
+    aws_client = CountingClient(boto3.client('s3', region_name='us-east-1', endpoint_url=args.endpoint_url,
+                                             aws_access_key_id='testing', aws_secret_access_key='testing'))
+    options = {'batch_rows': args.batch_rows, 'block_size': int(args.block_mb * 1024 * 1024), 'max_workers': args.prefetch}
+
+    def full_etl():
+        return transform_data(extract_csv_from_s3(aws_client, BUCKET_NAME, RAW_KEY))[0]
+
+    def stream_etl():
+        return stream_transform_from_s3(aws_client, BUCKET_NAME, RAW_KEY, **options)[0]
+
+    if args.child == 'check':
+        print(json.dumps({'same_frame': bool(full_etl().equals(stream_etl()))}))
+        return
+
+    reset_peak_rss()
+    baseline = proc_status_mb('VmRSS')
+    start_time = time.perf_counter()
+    if args.child == 'full read':
+        rows = len(extract_csv_from_s3(aws_client, BUCKET_NAME, RAW_KEY))
+    elif args.child == 'stream read':
+        rows = sum(len(batch) for batch in iter_raw_batches(aws_client, BUCKET_NAME, RAW_KEY, **options))
+    elif args.child == 'full etl':
+        rows = len(full_etl())
+    else:
+        rows = len(stream_etl())
+    seconds = time.perf_counter() - start_time
+    peak = proc_status_mb('VmHWM')
+    print(json.dumps({'mode': args.child, 'seconds': round(seconds, 3), 'rows': rows,
+                      'peak_rss_mb': round(peak - baseline, 1) if peak and baseline else None,
+                      'get_requests': aws_client.requests, 'mb_fetched': round(aws_client.bytes / 1e6, 1)}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000, help='rows in the raw file (about 160 bytes each)')
+    parser.add_argument('--batch-rows', type=int, default=100000, help='rows parsed and transformed at a time')
+    parser.add_argument('--block-mb', type=float, default=8, help='MB per ranged GET')
+    parser.add_argument('--prefetch', type=int, default=4, help='ranged GETs in flight')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    with moto_server_process() as aws_client:
+        body = generate_crash_frame(args.rows).to_csv(index=False).encode('utf-8')
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=RAW_KEY, Body=body)
+        print(f"Extract benchmark: {args.rows} rows, {len(body) / 1e6:.1f} MB raw CSV, batches of {args.batch_rows} rows, "
+              f"{args.block_mb} MB blocks, {args.prefetch} in flight")
+        del body
+
+        options = ['--rows', str(args.rows), '--batch-rows', str(args.batch_rows), '--block-mb', str(args.block_mb),
+                   '--prefetch', str(args.prefetch), '--endpoint-url', aws_client.meta.endpoint_url]
+        for mode in MODES + ['check']:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode] + options,
+                                    capture_output=True, text=True)
+            if result.returncode:
+                print({'mode': mode, 'failed': result.stderr.strip().splitlines()[-1:]})
+                continue
+            print(json.loads(result.stdout.strip().splitlines()[-1]))
+
+if __name__ == '__main__':
+    main()
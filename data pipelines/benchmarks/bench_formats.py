@@ -0,0 +1,63 @@
+"""
+Benchmark: CSV vs Parquet (several codecs) for the collision table.
+
+For each format the synthetic table is serialized with nyc_collisions.formats, then read
+back three ways: the whole file, two pruned columns, and two pruned columns with a
+crash_date predicate pushed down to the reader. Parquet files are written sorted by
+collision_id, which keeps crash_date clustered so row-group statistics can skip data.
+
+Usage:
+    python bench_formats.py --rows 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.formats import read_dataframe, serialize_dataframe
+from fake_socrata import generate_crash_frame
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, round(time.perf_counter() - start_time, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help='rows in the synthetic table')
+    parser.add_argument('--row-group-size', type=int, default=128 * 1024, help='rows per Parquet row group')
+    args = parser.parse_args()
+
+    df = generate_crash_frame(args.rows)
+    columns = ['collision_id', 'number_of_persons_injured']
+    # Roughly the last tenth of the date range
+    cutoff = df['crash_date'].iloc[int(len(df) * 0.9)]
+    filters = [('crash_date', '>=', cutoff)]
+
+    print(f"Format benchmark: {args.rows} rows, row group size {args.row_group_size}")
+    for output_format, codec in [('csv', None), ('parquet', 'none'), ('parquet', 'snappy'),
+                                 ('parquet', 'zstd'), ('parquet', 'gzip')]:
+        body, write_seconds = timed(serialize_dataframe, df, output_format, codec or 'snappy', args.row_group_size)
+        _, read_seconds = timed(read_dataframe, body, output_format)
+        _, pruned_seconds = timed(read_dataframe, body, output_format, columns=columns)
+        if output_format == 'csv':
+            # CSV has no statistics: every row is parsed, then filtered in pandas
+            def read_filtered():
+                frame = read_dataframe(body, 'csv', columns=columns + ['crash_date'])
+                return frame[frame['crash_date'] >= cutoff]
+            filtered, filtered_seconds = timed(read_filtered)
+        else:
+            filtered, filtered_seconds = timed(read_dataframe, body, output_format, columns=columns, filters=filters)
+        print({
+            'format': output_format if codec is None else f"{output_format}/{codec}",
+            'bytes': len(body),
+            'write_seconds': write_seconds,
+            'read_seconds': read_seconds,
+            'read_2_columns_seconds': pruned_seconds,
+            'read_filtered_seconds': filtered_seconds,
+            'filtered_rows': len(filtered),
+        })
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Benchmark: bounding-box and nearest-cell queries on the precomputed grid cells of
+nyc_collisions/grid.py against a full scan of the coordinates.
+
+A synthetic crashes table of --rows rows is built, with --bad-rate of the coordinates
+missing, at zero or outside the city. add_grid_cells is timed on it, then --queries random
+boxes of --box-km on a side are run, in memory:
+
+- full scan: compares the latitude and longitude of every row;
+- grid, unsorted: query_bbox with a CellIndex of the table as it comes (sorted by crash):
+  a binary search per cell range, then the coordinates of those rows only, gathered from
+  all over the table;
+- grid, sorted: the same on the table sorted by cell (sort_by_cell), where the rows of a
+  range are next to each other (the indexes are built once, before the queries);
+
+and on a Parquet object in a local S3 (moto, in-process) with row groups of
+--row-group-size rows, read through ranged GETs: all of it then a full scan, and with the
+bbox_filters of the box, for the file sorted by crash (as it comes) and sorted by cell.
+
+For each it reports the median time per query, the rows (or bytes) it had to look at and
+whether it returned the same rows as the full scan. The nearest-cell lookup (query_near,
+one ring around a point) is timed the same way.
+
+Usage:
+    python bench_grid.py --rows 3000000 --queries 50 --box-km 1 5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from harness import local_s3, BUCKET_NAME
+from fake_socrata import generate_crash_frame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.formats import S3RangeReader, serialize_dataframe
+from nyc_collisions.grid import (NYC_BOUNDS, CellIndex, add_grid_cells, bbox_filters, cell_degrees, cell_ranges, in_bbox,
+                                 nearest_cells, query_bbox, query_near, sort_by_cell)
+
+# Degrees of latitude per km
+KM = 1 / 111.0
+
+def build_table(rows, bad_rate, seed=7):
+    table = generate_crash_frame(rows)[['collision_id', 'crash_date', 'borough', 'latitude', 'longitude',
+                                        'number_of_persons_injured']]
+    rng = np.random.default_rng(seed)
+    bad = np.flatnonzero(rng.random(rows) < bad_rate)
+    kind = rng.integers(0, 3, len(bad))
+    table.loc[bad[kind == 0], ['latitude', 'longitude']] = np.nan
+    table.loc[bad[kind == 1], ['latitude', 'longitude']] = 0.0
+    table.loc[bad[kind == 2], 'latitude'] = 41.5
+    return table
+
+def random_boxes(count, box_km, seed=11):
+    rng = np.random.default_rng(seed)
+    size = box_km * KM
+    min_lat = rng.uniform(NYC_BOUNDS['min_lat'], NYC_BOUNDS['max_lat'] - size, count)
+    # A degree of longitude is about 0.76 of a degree of latitude at this latitude
+    min_lon = rng.uniform(NYC_BOUNDS['min_lon'], NYC_BOUNDS['max_lon'] - size / 0.76, count)
+    return [(lat, lon, lat + size, lon + size / 0.76) for lat, lon in zip(min_lat, min_lon)]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def time_queries(boxes, query):
+    """Run query on every box; return the median milliseconds, the median rows examined and the ids found."""
+    seconds, examined, found = [], [], []
+    for box in boxes:
+        start_time = time.perf_counter()
+        rows, looked_at = query(box)
+        seconds.append(time.perf_counter() - start_time)
+        examined.append(looked_at)
+        found.append(np.sort(rows['collision_id'].to_numpy()))
+    return round(1000 * median(seconds), 3), median(examined), found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=3000000, help='rows in the synthetic table')
+    parser.add_argument('--bad-rate', type=float, default=0.05, help='fraction of rows with missing, zero or outside coordinates')
+    parser.add_argument('--queries', type=int, default=50, help='random boxes per size')
+    parser.add_argument('--box-km', type=float, nargs='+', default=[1.0, 5.0], help='sides of the boxes, in km')
+    parser.add_argument('--row-group-size', type=int, default=16384, help='rows per Parquet row group')
+    args = parser.parse_args()
+
+    table = build_table(args.rows, args.bad_rate)
+    start_time = time.perf_counter()
+    report = add_grid_cells(table)
+    print(f"Grid benchmark: {args.rows} rows; add_grid_cells in {time.perf_counter() - start_time:.3f} seconds "
+          f"({report['rows_per_second']} rows/s): {report['ok']} ok, {report['missing']} missing, {report['zero']} "
+          f"at zero, {report['out_of_bounds']} outside")
+    start_time = time.perf_counter()
+    by_cell = sort_by_cell(table).reset_index(drop=True)
+    print(f"sort_by_cell: {time.perf_counter() - start_time:.3f} seconds")
+    start_time = time.perf_counter()
+    indexes = {'by crash': CellIndex(table), 'by cell': CellIndex(by_cell)}
+    print(f"CellIndex, both tables: {time.perf_counter() - start_time:.3f} seconds")
+
+    mock, aws_client = local_s3()
+    files = {}
+    for name, frame in [('by crash', table), ('by cell', by_cell)]:
+        key = f"grid/{name.replace(' ', '_')}.parquet"
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=serialize_dataframe(frame, 'parquet', row_group_size=args.row_group_size))
+        files[name] = key
+
+    def read_parquet(key, filters=None):
+        with S3RangeReader(aws_client, BUCKET_NAME, key) as source:
+            frame = pq.read_table(source, filters=filters).to_pandas()
+        return frame, source.bytes_fetched
+
+    for box_km in args.box_km:
+        boxes = random_boxes(args.queries, box_km)
+        print(f"\n{box_km} km boxes, {median([len(cell_ranges(box, 4)) for box in boxes])} cell ranges each:")
+        methods = [
+            ('full scan', lambda box: (table[in_bbox(table, box)], len(table))),
+            ('grid, unsorted', lambda box: (query_bbox(table, box, indexes['by crash']),
+                                            len(indexes['by crash'].positions(cell_ranges(box, 4))))),
+            ('grid, sorted', lambda box: (query_bbox(by_cell, box, indexes['by cell']),
+                                          len(indexes['by cell'].positions(cell_ranges(box, 4))))),
+        ]
+        expected = None
+        for name, query in methods:
+            milliseconds, examined, found = time_queries(boxes, query)
+            expected = expected if expected is not None else found
+            print({'method': name, 'ms_per_query': milliseconds, 'rows_examined': examined,
+                   'matches_full_scan': all(np.array_equal(a, b) for a, b in zip(expected, found))})
+
+        parquet_boxes = boxes[:max(1, args.queries // 10)]
+        parquet_expected = expected[:len(parquet_boxes)]
+        methods = [('parquet, full read', files['by cell'], False),
+                   ('parquet filters, sorted by crash', files['by crash'], True),
+                   ('parquet filters, sorted by cell', files['by cell'], True)]
+        for name, key, filtered in methods:
+            fetched = []
+
+            def query(box):
+                frame, bytes_fetched = read_parquet(key, bbox_filters(box) if filtered else None)
+                fetched.append(bytes_fetched)
+                return frame[in_bbox(frame, box)], len(frame)
+            milliseconds, examined, found = time_queries(parquet_boxes, query)
+            print({'method': name, 'ms_per_query': milliseconds, 'rows_read': examined,
+                   'mb_fetched': round(median(fetched) / 1e6, 2),
+                   'matches_full_scan': all(np.array_equal(a, b) for a, b in zip(parquet_expected, found))})
+
+    # Nearest cells: the cell of a point and the ring around it, i.e. crashes within ~300-600 m
+    points = [((box[0] + box[2]) / 2, (box[1] + box[3]) / 2) for box in random_boxes(args.queries, 1)]
+    size = cell_degrees(4)
+    print(f"\nNearest cells (one ring at level 4, {len(nearest_cells(*points[0]))} grid rows per point):")
+    for name, frame, query in [
+        ('full scan', table, lambda point: table[in_bbox(table, (point[0] - size, point[1] - size, point[0] + size, point[1] + size))]),
+        ('query_near, sorted', by_cell, lambda point: query_near(by_cell, *point, index=indexes['by cell'])),
+    ]:
+        seconds = []
+        for point in points:
+            start_time = time.perf_counter()
+            query(point)
+            seconds.append(time.perf_counter() - start_time)
+        print({'method': name, 'ms_per_query': round(1000 * median(seconds), 3)})
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
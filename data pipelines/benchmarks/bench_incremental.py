@@ -0,0 +1,112 @@
+"""
+Benchmark: date-based daily update vs the incremental ':updated_at' update.
+
+Two copies of the same day partitions are loaded into a local S3 stand-in. The fake
+Socrata server then publishes --new records for the latest day and revises --edits
+records scattered over older days, the way NYPD does. Each copy is brought up to date
+once: the date-based run of daily_updates.py (everything since the latest day folder,
+boundary day overwritten) and run_incremental_update (records changed since the
+high-water mark, upserted by collision_id). For each run it reports the Socrata
+requests and records served, S3 requests, partitions rewritten and how many of the
+revised records actually reached S3.
+
+Usage:
+    python bench_incremental.py --rows 300000 --new 500 --edits 200
+"""
+import argparse
+import collections
+import contextlib
+import io
+import random
+import time
+
+from harness import load_pipeline_module, local_s3, BUCKET_NAME
+from fake_socrata import CRASH_DATA_SET, FakeSocrataServer, generate_crash_rows
+
+# ':updated_at' of every change made during the benchmark, later than any seeded record
+CHANGED_AT = '2030-01-01T06:00:00.000Z'
+EDITED_INJURIES = '9'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000, help='records already loaded (about 600 per day)')
+    parser.add_argument('--new', type=int, default=500, help='records published after the last load')
+    parser.add_argument('--edits', type=int, default=200, help='older records revised after the last load')
+    args = parser.parse_args()
+
+    daily = load_pipeline_module('daily_updates')
+    from nyc_collisions.formats import format_from_key, read_dataframe
+    from nyc_collisions.incremental import UPDATED_AT, run_incremental_update
+    from nyc_collisions.manifest import load_manifest, update_manifest
+    from nyc_collisions.partitions import write_partitions
+    from nyc_collisions.schema import records_to_frame
+    from nyc_collisions.transform import transform_data
+
+    rows = generate_crash_rows(args.rows)
+    loaded_df, _ = transform_data(records_to_frame(rows))
+    mock, aws_client = local_s3()
+    for key_name in ('date_based', 'incremental'):
+        report = write_partitions(aws_client, BUCKET_NAME, key_name, loaded_df, 'crash_date')
+        # A full load leaves the high-water mark at the newest record it fetched
+        update_manifest(aws_client, BUCKET_NAME, key_name, report['partitions'],
+                        high_water_mark=max(row[UPDATED_AT] for row in rows))
+
+    last_id = int(rows[-1]['collision_id'])
+    new_rows = generate_crash_rows(args.new, start_date=rows[-1]['crash_date'][:10], first_collision_id=last_id + 1, seed=7)
+    for row in new_rows:
+        row[UPDATED_AT] = CHANGED_AT
+    edited_ids = {int(row['collision_id']) for row in random.Random(0).sample(rows[:-5000], args.edits)}
+    edited_days = {row['crash_date'][:10] for row in rows if int(row['collision_id']) in edited_ids}
+
+    def edits_in_s3(key_name):
+        manifest, _ = load_manifest(aws_client, BUCKET_NAME, key_name)
+        applied = 0
+        for day in edited_days:
+            key = manifest['partitions'][day]['key']
+            stored = read_dataframe(aws_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read(), format_from_key(key))
+            edited = stored[stored['collision_id'].isin(edited_ids)]
+            applied += int((edited['number_of_persons_injured'].astype(str) == EDITED_INJURIES).sum())
+        return applied
+
+    s3_counts = collections.Counter()
+    aws_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: s3_counts.update([model.name]))
+
+    print(f"Incremental update benchmark: {args.rows} records loaded, {args.new} new, "
+          f"{args.edits} revised over {len(edited_days)} older days")
+    with FakeSocrataServer(rows) as server:
+        dataset = server.datasets[CRASH_DATA_SET]
+        dataset.append_rows(new_rows)
+        dataset.update_rows(edited_ids, CHANGED_AT, number_of_persons_injured=EDITED_INJURIES)
+        socrata_client = server.client()
+
+        def date_based():
+            start_date = daily.get_latest_date_in_S3(aws_client, BUCKET_NAME, 'date_based')
+            api_data = daily.fetch_data_from_socrata(socrata_client, CRASH_DATA_SET, start_date)
+            api_data, _ = transform_data(api_data)
+            return len(daily.upload_dataframe_to_s3(aws_client, BUCKET_NAME, 'date_based', api_data, 'crash_date')['partitions'])
+
+        def incremental():
+            summary = run_incremental_update(socrata_client, aws_client, CRASH_DATA_SET, BUCKET_NAME, 'incremental')
+            return summary['partitions_written']
+
+        for name, run in [('date-based', date_based), ('incremental', incremental)]:
+            server.reset_stats()
+            s3_counts.clear()
+            start_time = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                partitions_written = run()
+            seconds = round(time.perf_counter() - start_time, 3)
+            print({
+                'update': name,
+                'seconds': seconds,
+                'socrata_requests': server.stats['requests'],
+                'records_served': server.stats['rows_served'],
+                's3_requests': dict(s3_counts),
+                'partitions_rewritten': partitions_written,
+                'revised_records_in_s3': f"{edits_in_s3(name.replace('-', '_'))}/{args.edits}",
+            })
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark: cold vs warm invocations of the daily updates Lambda, with and without reuse.
+
+S3 and SecretsManager are a local moto server and Socrata is the fake server, both in
+this process; every execution environment is a fresh child process that imports
+daily_updates_lambda.py and invokes lambda_handler --invocations times, the way Lambda
+does. The crashes run up to today, so each invocation fetches the last --days days of
+crashes (not years of empty catch-up windows), transforms them and rewrites their
+partitions. Every AWS request is delayed by --aws-latency seconds to
+stand in for the network.
+
+- reuse: the handler as it is, clients and the app token kept between invocations,
+  pandas and pyarrow imported on first use;
+- no reuse: pandas and pyarrow imported with the module and every client and secret
+  created again on each invocation, as the handler used to.
+
+For each invocation it reports the wall time, the handler's own init/work split and the
+AWS requests made.
+
+Usage:
+    python bench_lambda.py --rows 100000 --days 2 --invocations 5 --aws-latency 0.02
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from harness import BUCKET_NAME, PIPELINES_DIR, moto_server_process
+from fake_socrata import FakeSocrataServer, generate_crash_rows
+
+SECRET_NAME = 'nyc-collisions/socrata'
+KEY_NAME = 'collisions_processed_data'
+
+def run_environment(args, endpoint_url, domain, reuse):
+    """Invoke the handler in a child process. Returns one dict per invocation."""
+    env = dict(os.environ, AWS_ENDPOINT_URL=endpoint_url, AWS_ACCESS_KEY_ID='testing',
+               AWS_SECRET_ACCESS_KEY='testing', AWS_REGION='us-east-1', SECRET_NAME=SECRET_NAME)
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--domain', domain,
+               '--invocations', str(args.invocations), '--aws-latency', str(args.aws_latency)]
+    if not reuse:
+        command.append('--no-reuse')
+    output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+    return [json.loads(line[len('RESULT '):]) for line in output.splitlines() if line.startswith('RESULT ')]
+
+def child(args):
+    import boto3
+
+    # Stand-in for the network round trip of every AWS request
+    aws_requests = []
+    def delay(**kwargs):
+        aws_requests.append(1)
+        time.sleep(args.aws_latency)
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send', delay)
+
+    start_time = time.perf_counter()
+    if args.no_reuse:
+        # The handler used to import them with the module, only the import time matters
+        for module_name in ('pandas', 'pyarrow'):
+            importlib.import_module(module_name)
+    from harness import load_pipeline_module
+    lambda_module = load_pipeline_module('daily_updates_lambda')
+    import_seconds = time.perf_counter() - start_time
+
+    from sodapy import Socrata
+    import requests
+    adapter = {'prefix': 'http://', 'adapter': requests.adapters.HTTPAdapter()}
+    lambda_module.Socrata = lambda domain, app_token: Socrata(args.domain, app_token, session_adapter=adapter)
+
+    for invocation in range(args.invocations):
+        if args.no_reuse:
+            lambda_module._clients.clear()
+            lambda_module._secret.update(app_token=None, expires=0.0)
+        del aws_requests[:]
+        invocation_start = time.perf_counter()
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            lambda_module.lambda_handler(None, None)
+        # The handler logs its init/work split as one JSON line
+        timing = [json.loads(line) for line in log.getvalue().splitlines() if line.startswith('{"cold_start"')][-1]
+        seconds = time.perf_counter() - invocation_start + (import_seconds if invocation == 0 else 0)
+        print('RESULT ' + json.dumps(dict(timing, seconds=round(seconds, 4), aws_requests=len(aws_requests))))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='records in the fake dataset (about 600 per day)')
+    parser.add_argument('--days', type=int, default=2, help='days at the end of the dataset fetched by every invocation')
+    parser.add_argument('--invocations', type=int, default=5, help='invocations per execution environment')
+    parser.add_argument('--aws-latency', type=float, default=0.02, help='seconds added to every AWS request')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--no-reuse', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--domain', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    import boto3
+    sys.path.append(PIPELINES_DIR)
+    from nyc_collisions.manifest import update_manifest
+    from nyc_collisions.partitions import write_partitions
+    from nyc_collisions.schema import records_to_frame
+    from nyc_collisions.transform import transform_data
+
+    # The handler catches up from the latest day in S3 to now, so the data has to end today
+    start_date = datetime.now() - timedelta(days=max(1, args.rows // 600) - 1)
+    rows = generate_crash_rows(args.rows, start_date=f"{start_date:%Y-%m-%d}")
+    last_day = rows[-1]['crash_date'][:10]
+    days = sorted({row['crash_date'][:10] for row in rows})
+    first_fetched = days[-args.days]
+
+    with moto_server_process() as aws_client, FakeSocrataServer(rows) as server:
+        endpoint_url = aws_client.meta.endpoint_url
+        boto3.client('secretsmanager', region_name='us-east-1', endpoint_url=endpoint_url, aws_access_key_id='testing',
+                     aws_secret_access_key='testing').create_secret(Name=SECRET_NAME,
+                                                                    SecretString=json.dumps({'app_token': 'fake-app-token'}))
+
+        # Everything up to the first fetched day is already loaded
+        loaded_df, _ = transform_data(records_to_frame([row for row in rows if row['crash_date'][:10] <= first_fetched]))
+        report = write_partitions(aws_client, BUCKET_NAME, KEY_NAME, loaded_df, 'crash_date')
+        update_manifest(aws_client, BUCKET_NAME, KEY_NAME, report['partitions'])
+
+        print(f"Lambda warm start benchmark: {args.rows} records, {first_fetched} to {last_day} fetched by every "
+              f"invocation, {args.aws_latency}s per AWS request")
+        for name, reuse in [('no reuse', False), ('reuse', True)]:
+            for invocation, result in enumerate(run_environment(args, endpoint_url, server.domain, reuse), 1):
+                print({'handler': name, 'invocation': invocation, **result})
+
+if __name__ == '__main__':
+    main()
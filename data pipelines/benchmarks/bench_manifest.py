@@ -0,0 +1,75 @@
+"""
+Benchmark: latest-date and existence checks from S3 listings vs from the partition manifest.
+
+A local S3 stand-in is seeded with --days day partitions (plus the year/month/day folder
+markers the scripts create). The old lookup reads a single list_objects_v2 page, which
+holds at most 1000 keys, so past that point it reports a stale latest date. The manifest
+answers both questions from one GET once it has been built; the rebuild is the only step
+that still lists the whole prefix.
+
+Usage:
+    python bench_manifest.py --days 1500
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from harness import local_s3, BUCKET_NAME
+from nyc_collisions.manifest import latest_date, load_manifest, partition_exists, rebuild_manifest
+from nyc_collisions.partitions import partition_key, partition_prefix
+
+KEY_NAME = 'collisions_processed_data'
+
+def legacy_latest_date(aws_client):
+    # get_latest_date_in_S3 as it was: one unpaginated listing
+    response = aws_client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=KEY_NAME)
+    dates = [key.split('/')[3] for key in (obj['Key'] for obj in response.get('Contents', [])) if len(key.split('/')) >= 5]
+    return max(dates)
+
+def count_requests(aws_client):
+    counts = collections.Counter()
+    aws_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: counts.update([model.name]))
+    return counts
+
+def timed(counts, function, *args):
+    counts.clear()
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, round(time.perf_counter() - start_time, 3), dict(counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=1500, help='day partitions to seed')
+    args = parser.parse_args()
+
+    mock, aws_client = local_s3()
+    days = pd.date_range('2012-07-01', periods=args.days, freq='D')
+    body = b'collision_id\n1\n'
+    for day in days:
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=partition_prefix(KEY_NAME, day), Body=b'')
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=partition_key(KEY_NAME, day), Body=body)
+
+    counts = count_requests(aws_client)
+    print(f"Manifest benchmark: {args.days} day partitions, true latest date {days[-1]:%Y-%m-%d}")
+
+    legacy, seconds, requests = timed(counts, legacy_latest_date, aws_client)
+    print({'lookup': 'single listing', 'latest_date': legacy, 'seconds': seconds, 'requests': requests})
+
+    _, seconds, requests = timed(counts, rebuild_manifest, aws_client, BUCKET_NAME, KEY_NAME)
+    print({'lookup': 'manifest rebuild (once)', 'seconds': seconds, 'requests': requests})
+
+    def manifest_lookups():
+        manifest, _ = load_manifest(aws_client, BUCKET_NAME, KEY_NAME)
+        return latest_date(manifest), sum(partition_exists(manifest, day) for day in days)
+    (latest, existing), seconds, requests = timed(counts, manifest_lookups)
+    print({'lookup': 'manifest', 'latest_date': latest, 'days_found': existing, 'seconds': seconds, 'requests': requests})
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark: S3 requests made by the partition writers with and without folder markers.
+
+The same days are loaded twice into a local S3 stand-in by etl.upload_dataframe_to_s3:
+once with folder_markers=True (the empty year/month/day '.../' objects the writers used to
+create) and once with the default, which only writes the data objects. Every S3 call is
+counted by operation. The markers left by the first load are then removed with
+delete_folder_markers, which batches up to 1000 keys per delete_objects request.
+
+Usage:
+    python bench_markers.py --rows 300000
+"""
+import argparse
+import collections
+import contextlib
+import io
+
+from harness import load_pipeline_module, local_s3, BUCKET_NAME
+from fake_socrata import generate_crash_frame
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000, help='rows in the synthetic table (about 600 per day)')
+    args = parser.parse_args()
+
+    etl = load_pipeline_module('etl')
+    from nyc_collisions.partitions import delete_folder_markers
+    from nyc_collisions.transform import transform_data
+
+    df, _ = transform_data(generate_crash_frame(args.rows))
+    days = df['crash_date'].nunique()
+    mock, aws_client = local_s3()
+    counts = collections.Counter()
+    aws_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: counts.update([model.name]))
+
+    print(f"Folder marker benchmark: {args.rows} rows over {days} days")
+    for name, key_name, folder_markers in [('with markers', 'with_markers', True), ('data objects only', 'data_only', False)]:
+        counts.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.upload_dataframe_to_s3(aws_client, BUCKET_NAME, key_name, df.copy(), 'crash_date', folder_markers=folder_markers)
+        print({'writer': name, 'requests': sum(counts.values()), 'by_operation': dict(counts),
+               'puts_per_partition': round(counts['PutObject'] / days, 2)})
+
+    counts.clear()
+    summary = delete_folder_markers(aws_client, BUCKET_NAME, 'with_markers/')
+    print({'cleanup': 'delete_folder_markers', 'markers_deleted': summary['deleted'], 'by_operation': dict(counts)})
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: offset paging vs keyset (collision_id cursor) paging.
+
+Both strategies download the whole synthetic crashes dataset from a local fake
+Socrata server. The report shows wall-clock time, requests sent, rows the server
+had to scan to answer them, and whether every record was fetched exactly once.
+
+Usage:
+    python bench_paging.py --rows 200000 --chunk-size 5000 --churn 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.paging import iter_keyset_pages
+from fake_socrata import FakeSocrataServer, generate_crash_rows, CRASH_DATA_SET
+
+def offset_pages(client, dataset_name, chunk_size):
+    """The paging loop the scripts used before: offset=start, order='collision_id'."""
+    start = 0
+    while True:
+        page = client.get(dataset_name, offset=start, limit=chunk_size, order='collision_id')
+        if not page:
+            return
+        yield page
+        start += chunk_size
+
+def run_strategy(server, name, pages, expected_ids, churn):
+    """
+    Drain a page generator and measure it.
+
+    Args:
+    server (FakeSocrataServer): The server the pages come from.
+    name (str): Label used in the report.
+    pages (generator): Yields lists of records.
+    expected_ids (set): collision_ids that should be fetched exactly once.
+    churn (int): Number of low keys deleted on the server after the first page.
+
+    Returns:
+    dict: Measurements for the report.
+    """
+    server.reset_stats()
+    fetched_ids = []
+    start_time = time.perf_counter()
+
+    for page_number, page in enumerate(pages):
+        fetched_ids.extend(row['collision_id'] for row in page)
+        if churn and page_number == 0:
+            # Rows already fetched disappear on the server, shifting every later offset
+            server.datasets[CRASH_DATA_SET].delete_first(churn)
+
+    elapsed = time.perf_counter() - start_time
+    unique_ids = set(fetched_ids)
+    return {
+        'strategy': name,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(len(fetched_ids) / elapsed) if elapsed else None,
+        'requests': server.stats['requests'],
+        'rows_scanned_by_server': server.stats['rows_scanned'],
+        'duplicates': len(fetched_ids) - len(unique_ids),
+        'missing': len(expected_ids - unique_ids),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='synthetic records to serve')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='records per request')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    parser.add_argument('--churn', type=int, default=0, help='low keys deleted mid-run to test consistency')
+    args = parser.parse_args()
+
+    rows = generate_crash_rows(args.rows)
+    expected_ids = {row['collision_id'] for row in rows}
+
+    results = []
+    for name, build_pages in [
+        ('offset', lambda client: offset_pages(client, CRASH_DATA_SET, args.chunk_size)),
+        ('keyset', lambda client: iter_keyset_pages(client, CRASH_DATA_SET, chunk_size=args.chunk_size)),
+    ]:
+        # A fresh server per strategy so churn from one run does not leak into the next
+        with FakeSocrataServer(rows, latency=args.latency) as server:
+            results.append(run_strategy(server, name, build_pages(server.client()), expected_ids, args.churn))
+
+    print(f"Paging benchmark: {args.rows} rows, chunk size {args.chunk_size}, churn {args.churn}")
+    for result in results:
+        print(result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: fixed thread pool with offset chunks vs range-partitioned adaptive downloads.
+
+The fixed strategy is what multiThread_mass_upload.py used to do: one offset chunk per
+task on a default-sized ThreadPoolExecutor, collected with as_completed and no retries.
+The adaptive strategy is nyc_collisions.parallel.iter_records_in_parallel. The fake
+server can throttle (HTTP 429 above --server-capacity concurrent requests) and fail a
+fraction of requests (HTTP 503) to show how each strategy copes.
+
+Usage:
+    python bench_parallel.py --rows 200000 --latency 0.05 --server-capacity 8 --error-rate 0.02
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.parallel import AimdController, iter_records_in_parallel
+from fake_socrata import FakeSocrataServer, generate_crash_rows, CRASH_DATA_SET
+
+def fixed_pool(client, chunk_size, total_records):
+    """The previous multiThread_mass_upload.get_api_records loop."""
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(client.get, CRASH_DATA_SET, limit=chunk_size, offset=start, order='collision_id')
+            for start in range(0, total_records, chunk_size)
+        ]
+        results = []
+        for future in concurrent.futures.as_completed(futures):
+            results.extend(future.result())
+    return results, {}
+
+def adaptive(client, chunk_size, total_records, max_workers):
+    controller = AimdController(initial=4, maximum=max_workers, target_latency=1.0)
+    results = []
+    stats = {}
+    for records, stats in iter_records_in_parallel(client, CRASH_DATA_SET, chunk_size=chunk_size, controller=controller):
+        results.extend(records)
+    return results, {'final_concurrency': controller.limit, 'peak_concurrency': controller.peak,
+                     'retries': stats.get('retries', 0)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='synthetic records to serve')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='records per request')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each response')
+    parser.add_argument('--server-capacity', type=int, default=None, help='concurrent requests before HTTP 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 503')
+    parser.add_argument('--max-workers', type=int, default=32, help='upper bound for the adaptive strategy')
+    args = parser.parse_args()
+
+    rows = generate_crash_rows(args.rows)
+    expected_ids = [row['collision_id'] for row in rows]
+
+    print(f"Parallel download benchmark: {args.rows} rows, latency {args.latency}s, "
+          f"capacity {args.server_capacity}, error rate {args.error_rate}")
+    for name, strategy in [
+        ('fixed_pool', lambda client: fixed_pool(client, args.chunk_size, args.rows)),
+        ('adaptive', lambda client: adaptive(client, args.chunk_size, args.rows, args.max_workers)),
+    ]:
+        with FakeSocrataServer(rows, latency=args.latency, max_concurrency=args.server_capacity,
+                               error_rate=args.error_rate) as server:
+            start_time = time.perf_counter()
+            try:
+                results, extra = strategy(server.client())
+            except Exception as e:
+                print({'strategy': name, 'failed': repr(e)[:120], 'requests': server.stats['requests']})
+                continue
+            elapsed = time.perf_counter() - start_time
+            fetched_ids = [row['collision_id'] for row in results]
+            print({
+                'strategy': name,
+                'seconds': round(elapsed, 3),
+                'rows_per_second': round(len(results) / elapsed),
+                'requests': server.stats['requests'],
+                'throttled': server.stats['throttled'],
+                'errors': server.stats['errors'],
+                'complete': sorted(fetched_ids, key=int) == expected_ids,
+                'in_key_order': fetched_ids == expected_ids,
+                **extra,
+            })
+
+if __name__ == '__main__':
+    main()
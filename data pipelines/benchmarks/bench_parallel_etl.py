@@ -0,0 +1,98 @@
+"""
+Benchmark: the serial ETL of a raw file vs parallel_etl on 1 to N processes.
+
+A synthetic raw crash CSV of --rows rows is put in a local S3 stand-in running in its
+own process. Zip codes are missing only in the second half of the file, so the first
+units parse them as int64 and the last ones as float64, the way a real extract mixes
+them; a few dates are malformed.
+
+The serial path is the one etl.process_dataset ran before it streamed: extract_csv_from_s3
+(see harness.py), transform_data and write_partitions. parallel_etl then processes the same file with every --workers
+count. For each run it reports the time, the speedup over the serial run and over one
+worker, the parallel efficiency, the time of each phase and the MB of Arrow buffers
+exchanged, and whether every partition has the same checksum as the serial one and the
+transformed frame gives the same rollups. The machine's CPU count is printed too: there
+is no speedup to expect beyond it.
+
+Usage:
+    python bench_parallel_etl.py --rows 1000000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from harness import BUCKET_NAME, extract_csv_from_s3, moto_server_process
+from fake_socrata import generate_crash_frame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.parallel_etl import format_parallel_report, parallel_etl
+from nyc_collisions.partitions import write_partitions
+from nyc_collisions.rollups import compute_rollup
+from nyc_collisions.transform import transform_data
+
+RAW_KEY = "collisions_raw_data/'crash_data_set_par.csv'"
+
+def raw_csv(rows):
+    df = generate_crash_frame(rows)
+    # Gaps in the second half only: early units infer int64 zip codes, late ones float64
+    second_half = np.arange(rows) >= rows // 2
+    df['zip_code'] = df['zip_code'].where(~(second_half & (np.arange(rows) % 7 == 0)))
+    df.loc[df.index[::5000], 'crash_date'] = 'not a date'
+    return df.to_csv(index=False).encode('utf-8')
+
+def checksums(report):
+    return {partition['date']: partition['checksum'] for partition in report['partitions']}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help='rows in the raw file (about 600 per day)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='process counts to run')
+    parser.add_argument('--unit-mb', type=float, default=16, help='target size of a CSV unit')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='output format')
+    args = parser.parse_args()
+
+    body = raw_csv(args.rows)
+    print(f"Parallel ETL benchmark: {args.rows} rows, {len(body) / 1e6:.1f} MB raw CSV, {args.format} output, "
+          f"{os.cpu_count()} CPUs")
+
+    with moto_server_process() as aws_client:
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=RAW_KEY, Body=body)
+        del body
+        client_kwargs = {'service_name': 's3', 'region_name': 'us-east-1', 'endpoint_url': aws_client.meta.endpoint_url,
+                         'aws_access_key_id': 'testing', 'aws_secret_access_key': 'testing'}
+
+        start_time = time.perf_counter()
+        raw_df = extract_csv_from_s3(aws_client, BUCKET_NAME, RAW_KEY)
+        serial_df, _ = transform_data(raw_df)
+        del raw_df
+        serial_report = write_partitions(aws_client, BUCKET_NAME, 'serial', serial_df, 'crash_date',
+                                         output_format=args.format)
+        serial_seconds = time.perf_counter() - start_time
+        serial_checksums = checksums(serial_report)
+        serial_rollup = compute_rollup(serial_df)
+        del serial_df
+        print({'run': 'serial', 'seconds': round(serial_seconds, 3), 'partitions': len(serial_checksums),
+               'rows': serial_report['rows']})
+
+        one_worker_seconds = None
+        for workers in args.workers:
+            df, report = parallel_etl(aws_client, BUCKET_NAME, RAW_KEY, f"parallel_{workers}", output_format=args.format,
+                                      max_workers=workers, unit_bytes=int(args.unit_mb * 1024 * 1024),
+                                      client_kwargs=client_kwargs)
+            seconds = report['seconds']
+            one_worker_seconds = one_worker_seconds or (seconds if workers == 1 else None)
+            print({'run': f"{workers} workers", 'seconds': seconds,
+                   'speedup_vs_serial': round(serial_seconds / seconds, 2),
+                   'speedup_vs_1_worker': round(one_worker_seconds / seconds, 2) if one_worker_seconds else None,
+                   'efficiency': round(one_worker_seconds / seconds / workers, 2) if one_worker_seconds else None,
+                   'same_files': checksums(report['write']) == serial_checksums,
+                   'same_rollups': compute_rollup(df).equals(serial_rollup),
+                   'errors': len(report['write']['errors'])})
+            print(f"  {format_parallel_report(report)}")
+            del df
+
+if __name__ == '__main__':
+    main()
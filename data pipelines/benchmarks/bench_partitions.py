@@ -0,0 +1,71 @@
+"""
+Benchmark: per-date rescans with serial uploads vs the single-pass concurrent partition writer.
+
+The old daily writer looped over set(DataFrame[date_column_name]) and, for every date,
+filtered the whole frame with .dt.date == date.date() before uploading that day on its
+own. write_partitions sorts once, cuts the frame at the day boundaries and uploads the
+days through a thread pool sharing one boto3 client. Both write to a local S3 stand-in
+running in its own process; --upload-latency adds a delay per PUT to mimic a real
+round trip to S3.
+
+Usage:
+    python bench_partitions.py --rows 300000 --upload-latency 0.02
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from harness import moto_server_process, BUCKET_NAME
+from fake_socrata import generate_crash_frame
+from nyc_collisions.formats import content_type, serialize_dataframe
+from nyc_collisions.partitions import partition_key, write_partitions
+from nyc_collisions.transform import transform_data
+
+class SlowClient:
+    """Wrap a boto3 client so every put_object takes at least `latency` seconds longer."""
+
+    def __init__(self, aws_client, latency):
+        self.aws_client = aws_client
+        self.latency = latency
+
+    def put_object(self, **kwargs):
+        time.sleep(self.latency)
+        return self.aws_client.put_object(**kwargs)
+
+def legacy_write(aws_client, key_name, df, date_column_name, output_format):
+    for date in set(df[date_column_name]):
+        subset_df = df[df[date_column_name].dt.date == date.date()]
+        body = serialize_dataframe(subset_df, output_format)
+        aws_client.put_object(Bucket=BUCKET_NAME, Key=partition_key(key_name, date, output_format), Body=body,
+                              ContentType=content_type(output_format))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000, help='rows in the synthetic table (about 600 per day)')
+    parser.add_argument('--upload-latency', type=float, default=0.02, help='extra seconds per PUT')
+    parser.add_argument('--max-workers', type=int, default=8, help='upload threads for write_partitions')
+    parser.add_argument('--format', default='parquet', choices=['csv', 'parquet'])
+    args = parser.parse_args()
+
+    df, _ = transform_data(generate_crash_frame(args.rows))
+    print(f"Partition benchmark: {args.rows} rows over {df['crash_date'].nunique()} days, {args.format}, "
+          f"{args.upload_latency}s per PUT")
+
+    with moto_server_process() as aws_client:
+        slow_client = SlowClient(aws_client, args.upload_latency)
+
+        start_time = time.perf_counter()
+        legacy_write(slow_client, 'legacy', df, 'crash_date', args.format)
+        print({'writer': 'per-date scan, serial', 'seconds': round(time.perf_counter() - start_time, 3)})
+
+        report = write_partitions(slow_client, BUCKET_NAME, 'single_pass', df, 'crash_date', output_format=args.format,
+                                  max_workers=args.max_workers)
+        latencies = sorted(partition['seconds'] for partition in report['partitions'])
+        print({'writer': f"single pass, {args.max_workers} threads", 'seconds': report['seconds'],
+               'partitions': len(report['partitions']), 'bytes': report['bytes'],
+               'p50_partition_seconds': latencies[len(latencies) // 2], 'max_partition_seconds': latencies[-1]})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark: what the opt-in profiling switch costs, off and on, and what it reports.
+
+A raw CSV extract of --rows synthetic crashes is put in a local S3 (moto, in-process) and
+etl.main is run four ways, --repeat times each:
+
+- undecorated: main.__wrapped__, the ETL exactly as it was before the switch;
+- switch off: main() as it runs in production, PROFILE unset;
+- cpu: main(profile='cpu'), under cProfile only;
+- all: main(profile=True), under cProfile and tracemalloc.
+
+A micro-benchmark then times an empty function behind the switch, off, against calling it
+directly. Last, the top of the hot-spot report of the cpu run (its timings are not inflated
+by tracemalloc) and of the peak-memory report of the full run are printed, with the largest
+call stack at the peak.
+
+Usage:
+    python bench_profiling.py --rows 100000 --repeat 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from harness import load_pipeline_module, local_s3, BUCKET_NAME
+from fake_socrata import generate_crash_frame
+
+RAW_KEY = "collisions_raw_data/'crash_data_set_par.csv'"
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='rows in the raw extract')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per mode')
+    parser.add_argument('--lines', type=int, default=12, help='report lines printed')
+    args = parser.parse_args()
+
+    os.environ.pop('PROFILE', None)
+    os.environ['METRICS_SINK'] = 'off'
+    etl = load_pipeline_module('etl')
+    from nyc_collisions.profiling import profiled_run
+
+    mock, aws_client = local_s3()
+    aws_client.put_object(Bucket=BUCKET_NAME, Key=RAW_KEY, Body=generate_crash_frame(args.rows).to_csv(index=False).encode('utf-8'))
+    print(f"Profiling benchmark: etl.main on {args.rows} rows")
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.environ['PROFILE_DIR'] = folder
+        modes = [
+            ('undecorated', lambda: etl.main.__wrapped__()),
+            ('switch off', lambda: etl.main()),
+            ('cpu', lambda: etl.main(profile='cpu')),
+            ('all', lambda: etl.main(profile=True)),
+        ]
+        for name, run in modes:
+            seconds = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run()
+                seconds.append(time.perf_counter() - start_time)
+            print({'mode': name, 'median_seconds': round(median(seconds), 3)})
+
+        def empty():
+            return None
+        switched = profiled_run('empty')(empty)
+        iterations = 200000
+        for name, function in [('direct call', empty), ('switch off', switched)]:
+            start_time = time.perf_counter()
+            for _ in range(iterations):
+                function()
+            print({'call': name, 'us_per_call': round(1e6 * (time.perf_counter() - start_time) / iterations, 3)})
+
+        # Report names sort by time: the first hot-spot report is from the cpu run
+        reports = sorted(os.listdir(folder))
+        for suffix in ('hotspots.txt', 'memory.txt'):
+            path = os.path.join(folder, [report for report in reports if report.endswith(suffix)][0])
+            with open(path) as report_file:
+                lines = [line for line in report_file.read().splitlines() if line.strip()]
+            print(f"\n{suffix}:")
+            print('\n'.join(lines[:args.lines]))
+            if suffix == 'memory.txt':
+                stacks = lines.index('---------------- top 5 call stacks ----------------')
+                print('\n'.join(lines[stacks:stacks + 2 + 2 * 8]))
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
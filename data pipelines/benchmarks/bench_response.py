@@ -0,0 +1,80 @@
+"""
+Benchmark: what the daily updates Lambda returns at the end of a run.
+
+A transformed frame of --rows crashes stands in for a catch-up run (about 600 crashes a
+day, so 200000 rows is roughly a year). It is returned three ways:
+
+1. rows: the whole frame serialized into the response body, as the handler used to;
+2. summary: the compact run summary the handler returns now;
+3. summary + ndjson / parquet: the summary, with the full result written to S3 first.
+
+For each it reports the response size (and whether it fits Lambda's 6 MB limit), the
+bytes stored in S3, the time and the peak memory allocated on top of the frame
+(tracemalloc, which also slows every allocation down, so compare the times with each other).
+
+Usage:
+    python bench_response.py --rows 200000
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+
+from harness import load_pipeline_module, local_s3, BUCKET_NAME
+from fake_socrata import generate_crash_rows
+
+LAMBDA_RESPONSE_LIMIT = 6 * 1024 ** 2
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='rows uploaded by the run')
+    args = parser.parse_args()
+
+    lambda_module = load_pipeline_module('daily_updates_lambda')
+    from nyc_collisions.schema import records_to_frame
+    from nyc_collisions.transform import transform_data
+
+    api_data, transform_report = transform_data(records_to_frame(generate_crash_rows(args.rows)))
+    mock, aws_client = local_s3()
+    with contextlib.redirect_stdout(io.StringIO()):
+        upload_report = lambda_module.upload_dataframe_to_s3(aws_client, BUCKET_NAME, 'collisions_processed_data',
+                                                             api_data, 'crash_date')
+    start_date = '2012-07-01 00:00:00'
+
+    def rows():
+        return api_data.to_json(orient='records', date_format='iso'), 0
+
+    def summary(result_format=None):
+        summary = lambda_module.build_run_summary(start_date, api_data, transform_report, upload_report)
+        stored = 0
+        if result_format:
+            result = lambda_module.write_result_to_s3(aws_client, BUCKET_NAME, api_data, result_format)
+            summary.update(result_key=result['key'], result_bytes=result['bytes'])
+            stored = result['bytes']
+        return json.dumps(summary), stored
+
+    print(f"Lambda response benchmark: {args.rows} rows, {len(upload_report['partitions'])} partitions")
+    for name, build in [('rows', rows), ('summary', summary), ('summary + ndjson', lambda: summary('ndjson')),
+                        ('summary + parquet', lambda: summary('parquet'))]:
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        body, stored = build()
+        seconds = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print({
+            'response': name,
+            'seconds': round(seconds, 3),
+            'response_mb': round(len(body) / 1e6, 3),
+            'fits_6mb_limit': len(body) <= LAMBDA_RESPONSE_LIMIT,
+            's3_mb': round(stored / 1e6, 2),
+            'peak_alloc_mb': round(peak / 1e6, 1),
+        })
+        del body
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Benchmark: dashboard queries on the pre-aggregated rollups vs scanning the day partitions,
+and what keeping the rollups up to date costs a daily run.
+
+--rows synthetic crashes (about 600 a day) are transformed and written as day partitions to
+a local S3 (moto, in-process), then update_rollups builds the daily and hourly rollups of
+the whole history. Two dashboard queries are run over the last --range-days days:
+
+- crashes, injuries and fatalities by day and borough;
+- crashes by hour of day and contributing factor;
+
+each answered by reading every day partition of the range (through the manifest, with
+--max-workers threads, then a groupby) and by read_rollups (the month slices of the range,
+then a groupby of the rollup rows). For each it reports the time, GET requests, bytes read
+and whether both give the same answer.
+
+Last, a daily run is simulated: the last --rewrite-days days are fetched again with a few
+more crashes and rewritten, and update_rollups recomputes only those days. Its time, the
+slices it touched and the bytes it wrote are compared with rebuilding the rollups of the
+whole history, and the updated rollups are checked against a rebuild.
+
+Usage:
+    python bench_rollups.py --rows 600000 --range-days 90 --rewrite-days 2
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from harness import local_s3, BUCKET_NAME
+from fake_socrata import generate_crash_rows
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.formats import read_dataframe
+from nyc_collisions.incremental import _CSV_DTYPES
+from nyc_collisions.manifest import load_manifest, update_manifest
+from nyc_collisions.partitions import write_partitions
+from nyc_collisions.rollups import compute_rollup, format_rollup_report, read_rollups, update_rollups
+from nyc_collisions.schema import records_to_frame
+from nyc_collisions.transform import transform_data
+
+KEY_NAME = 'collisions_processed_data'
+
+class S3Counter:
+    """Count the GET requests and the bytes they return on a boto3 client."""
+
+    def __init__(self, aws_client):
+        self.requests = collections.Counter()
+        self.bytes_read = 0
+        aws_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: self.requests.update([model.name]))
+        aws_client.meta.events.register('after-call.s3.GetObject', self._count_bytes)
+
+    def _count_bytes(self, parsed, **kwargs):
+        self.bytes_read += parsed.get('ContentLength', 0)
+
+    def reset(self):
+        self.requests.clear()
+        self.bytes_read = 0
+
+def by_day_and_borough(frame):
+    return frame.groupby(['crash_date', 'borough'], observed=True)[
+        ['crashes', 'number_of_persons_injured', 'number_of_persons_killed']].sum().sort_index()
+
+def by_hour_and_factor(frame):
+    return frame.groupby(['crash_hour', 'contributing_factor'], observed=True)['crashes'].sum().sort_index()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=600000, help='records in the history (about 600 per day)')
+    parser.add_argument('--range-days', type=int, default=90, help='days covered by the dashboard queries')
+    parser.add_argument('--rewrite-days', type=int, default=2, help='days rewritten by the simulated daily run')
+    parser.add_argument('--max-workers', type=int, default=8, help='threads reading partitions or slices')
+    args = parser.parse_args()
+
+    mock, aws_client = local_s3()
+    rows = generate_crash_rows(args.rows)
+    history, _ = transform_data(records_to_frame(rows))
+    report = write_partitions(aws_client, BUCKET_NAME, KEY_NAME, history, 'crash_date')
+    update_manifest(aws_client, BUCKET_NAME, KEY_NAME, report['partitions'])
+    days = sorted(partition['date'] for partition in report['partitions'])
+    print(f"Rollup benchmark: {len(history)} crashes over {len(days)} days, {report['bytes'] / 1e6:.1f} MB of partitions")
+
+    start_time = time.perf_counter()
+    rollup_report = update_rollups(aws_client, BUCKET_NAME, KEY_NAME, history)
+    print(f"Full build: {format_rollup_report(rollup_report)}")
+
+    counter = S3Counter(aws_client)
+    start_date, end_date = days[-args.range_days], days[-1]
+    manifest, _ = load_manifest(aws_client, BUCKET_NAME, KEY_NAME)
+
+    def scan_partitions():
+        keys = [entry['key'] for date, entry in manifest['partitions'].items() if start_date <= date <= end_date]
+
+        def read(key):
+            body = aws_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read()
+            return read_dataframe(body, 'csv', dtype=_CSV_DTYPES)
+        with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+            frames = list(executor.map(read, keys))
+        partitions = pd.concat(frames, ignore_index=True)
+        partitions['crash_date'] = pd.to_datetime(partitions['crash_date'])
+        return partitions
+
+    queries = [
+        ('by day and borough', 'daily', by_day_and_borough),
+        ('by hour and factor', 'hourly', by_hour_and_factor),
+    ]
+    print(f"\nDashboard queries, {start_date} to {end_date}:")
+    for name, grain, query in queries:
+        answers = {}
+        for method in ('scan partitions', 'rollups'):
+            counter.reset()
+            start_time = time.perf_counter()
+            if method == 'scan partitions':
+                answer = query(compute_rollup(scan_partitions(), grain))
+            else:
+                answer = query(read_rollups(aws_client, BUCKET_NAME, KEY_NAME, grain, start_date, end_date))
+            seconds = time.perf_counter() - start_time
+            answers[method] = answer
+            print({'query': name, 'method': method, 'seconds': round(seconds, 3),
+                   'get_requests': counter.requests['GetObject'], 'kb_read': round(counter.bytes_read / 1e3, 1)})
+        print({'query': name, 'same_answer': answers['scan partitions'].equals(answers['rollups'])})
+
+    # A daily run rewrites the last days with a few late crashes added
+    rewritten_days = days[-args.rewrite_days:]
+    late = generate_crash_rows(50 * args.rewrite_days, start_date=rewritten_days[0])
+    for offset, row in enumerate(late):
+        row['collision_id'] = str(10 ** 8 + offset)
+    late_df, _ = transform_data(records_to_frame(late))
+    day_labels = history['crash_date'].dt.strftime('%Y-%m-%d')
+    rewritten = pd.concat([history[day_labels.isin(rewritten_days).to_numpy()], late_df], ignore_index=True)
+    report = write_partitions(aws_client, BUCKET_NAME, KEY_NAME, rewritten, 'crash_date')
+
+    print(f"\nDaily run rewriting {len(report['partitions'])} days ({len(rewritten)} rows):")
+    for method, frame, written_days in [('recompute rewritten days', rewritten, [p['date'] for p in report['partitions']]),
+                                        ('rebuild whole history', None, None)]:
+        if frame is None:
+            frame = pd.concat([history[~day_labels.isin(rewritten_days).to_numpy()], rewritten], ignore_index=True)
+        counter.reset()
+        start_time = time.perf_counter()
+        rollup_report = update_rollups(aws_client, BUCKET_NAME, KEY_NAME, frame, days=written_days)
+        print({'method': method, 'seconds': round(time.perf_counter() - start_time, 3), 'slices': len(rollup_report['slices']),
+               'rollup_rows': rollup_report['rows'], 'kb_written': round(rollup_report['bytes'] / 1e3, 1),
+               's3_requests': sum(counter.requests.values())})
+        if written_days is not None:
+            after_update = read_rollups(aws_client, BUCKET_NAME, KEY_NAME, 'hourly')
+    after_rebuild = read_rollups(aws_client, BUCKET_NAME, KEY_NAME, 'hourly')
+    print({'incremental_matches_rebuild': after_update.equals(after_rebuild),
+           'crashes_in_rollups': int(after_rebuild['crashes'].sum()), 'crashes_stored': len(history) + len(late_df)})
+
+    mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark: untyped vs schema-typed crash frames.
+
+The untyped frame is what the fetchers used to build: every Socrata page appended to one
+list of dicts, then pd.DataFrame.from_records, which stores every value as a Python
+string. The typed frame casts each page to CRASH_DTYPES as it arrives and concatenates
+the pages at the end. Both are measured with memory_usage(deep=True).
+
+Usage:
+    python bench_schema.py --rows 500000
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.schema import concat_frames, memory_report, records_to_frame
+from fake_socrata import generate_crash_rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000, help='synthetic records to load')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='records per Socrata page')
+    parser.add_argument('--top-columns', type=int, default=5, help='columns listed in the per-column breakdown')
+    args = parser.parse_args()
+
+    rows = generate_crash_rows(args.rows)
+    pages = [rows[start:start + args.chunk_size] for start in range(0, len(rows), args.chunk_size)]
+
+    start_time = time.perf_counter()
+    untyped = pd.DataFrame.from_records([record for page in pages for record in page])
+    untyped_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    typed = concat_frames([records_to_frame(page) for page in pages])
+    typed_seconds = time.perf_counter() - start_time
+
+    print(f"Schema benchmark: {args.rows} rows in pages of {args.chunk_size}")
+    for name, frame, seconds in [('untyped', untyped, untyped_seconds), ('typed', typed, typed_seconds)]:
+        report = memory_report(frame)
+        largest = sorted(report['by_column'].items(), key=lambda item: item[1], reverse=True)[:args.top_columns]
+        print({
+            'frame': name,
+            'build_seconds': round(seconds, 3),
+            'total_mb': round(report['total_bytes'] / 1e6, 1),
+            'bytes_per_row': report['bytes_per_row'],
+            'largest_columns_mb': {column: round(size / 1e6, 1) for column, size in largest},
+        })
+
+if __name__ == '__main__':
+    main()
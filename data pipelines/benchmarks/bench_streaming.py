@@ -0,0 +1,91 @@
+"""
+Benchmark: buffered mass upload vs streaming extract-to-S3.
+
+The buffered strategy is what bruteForce_mass_upload.py used to do, keyset pages gathered
+by buffered_fetch + buffered_upload: every chunk is kept in one list, turned into
+one DataFrame, then serialized into one CSV string. The streaming
+strategy is stream_api_records_to_s3, which writes each chunk into an S3 multipart upload.
+Peak RSS is a per-process high-water mark, so every strategy runs in its own process, and
+the fake Socrata server and the S3 stand-in run in child processes of their own.
+
+Usage:
+    python bench_streaming.py --rows 300000
+"""
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import time
+
+from harness import load_pipeline_module, moto_server_process, BUCKET_NAME
+from fake_socrata import fake_socrata_process, socrata_client, CRASH_DATA_SET
+
+def buffered_fetch(client, dataset_name, chunk_size=5000):
+    """The previous bruteForce_mass_upload.get_api_records loop."""
+    from nyc_collisions.paging import iter_keyset_pages
+    from nyc_collisions.schema import concat_frames, records_to_frame
+
+    return concat_frames([records_to_frame(page)
+                          for page in iter_keyset_pages(client, dataset_name, chunk_size=chunk_size)])
+
+def buffered_upload(aws_client, bucket_name, key_name, df):
+    """The previous bruteForce_mass_upload.upload_dataframe_to_s3: one CSV string, one PUT."""
+    aws_client.put_object(Bucket=bucket_name, Key=key_name, Body=df.to_csv(index=False).encode('utf-8'))
+
+def run_one(strategy, script, rows):
+    """Run a single strategy in this process and print its measurements as JSON."""
+    module = load_pipeline_module(script)
+    from nyc_collisions.streaming import peak_rss_mb
+
+    baseline_rss = peak_rss_mb()
+    key_name = f"collisions_raw_data/{strategy}_{script}.csv"
+
+    with fake_socrata_process(rows) as domain, moto_server_process() as aws_client:
+        client = socrata_client(domain)
+        start_time = time.perf_counter()
+        # The scripts print a progress report, keep it out of the JSON result
+        with contextlib.redirect_stdout(io.StringIO()):
+            if strategy == 'buffered':
+                if script == 'bruteForce_mass_upload':
+                    buffered_upload(aws_client, BUCKET_NAME, key_name, buffered_fetch(client, CRASH_DATA_SET))
+                else:
+                    crash_df = module.get_api_records(client, CRASH_DATA_SET)
+                    module.upload_dataframe_to_s3(aws_client, BUCKET_NAME, key_name, crash_df, key_name)
+            else:
+                module.stream_api_records_to_s3(client, aws_client, BUCKET_NAME, key_name, CRASH_DATA_SET)
+        elapsed = time.perf_counter() - start_time
+        size = aws_client.head_object(Bucket=BUCKET_NAME, Key=key_name)['ContentLength']
+
+    print(json.dumps({
+        'strategy': strategy,
+        'script': script,
+        'seconds': round(elapsed, 3),
+        'object_bytes': size,
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'peak_rss_growth_mb': round(peak_rss_mb() - baseline_rss, 1),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000, help='synthetic records to serve')
+    parser.add_argument('--script', default='bruteForce_mass_upload',
+                        choices=['bruteForce_mass_upload', 'multiThread_mass_upload'])
+    parser.add_argument('--run-one', choices=['buffered', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        return run_one(args.run_one, args.script, args.rows)
+
+    print(f"Streaming benchmark: {args.rows} rows through {args.script}")
+    for strategy in ['buffered', 'streaming']:
+        output = subprocess.run(
+            [sys.executable, __file__, '--rows', str(args.rows), '--script', args.script, '--run-one', strategy],
+            capture_output=True, text=True, check=True
+            ).stdout
+        print(output.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Benchmark suite: the pipeline scripts end to end, with machine-readable results to track
+regressions.
+
+S3 is a local moto server and Socrata is the fake server, serving --rows synthetic
+h9gi-nx95 records, with their persons (f55k-p6yu) and vehicles (bm4k-52h4), with --latency
+seconds per request, HTTP 429 past --max-concurrency
+requests in flight and --error-rate of HTTP 503. Each pipeline runs its own main() in a
+fresh child process, with no app token, credentials or code changes, in this order:
+
+- bruteForce_mass_upload: the whole dataset, keyset paging, streamed to S3;
+- multiThread_mass_upload: the three datasets at the same time, parallel ranges, streamed to S3;
+- etl: reads the raw CSVs the multiThread upload wrote and writes the daily partitions;
+- daily_updates: S3 is reset to everything but the last --daily-days days, which it fetches.
+
+The response cache is off, so every run talks to the server. For every pipeline the suite
+records the wall time, rows and rows/s, peak RSS (and RSS before main), Socrata requests,
+throttled and failed responses, S3 requests by operation and the per-stage metrics the
+pipeline emitted.
+
+Results are written to --output as JSON, with the configuration, commit and Python version.
+With --baseline, every pipeline is compared with an earlier results file and the suite exits
+with status 1 if its time or peak memory grew by more than --tolerance.
+
+Usage:
+    python bench_suite.py --rows 100000 --latency 0.02 --output results.json
+    python bench_suite.py --rows 100000 --latency 0.02 --baseline results.json --tolerance 0.2
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from harness import BUCKET_NAME, PIPELINES_DIR, moto_server_process
+from fake_socrata import FakeDataset, FakeSocrataServer, generate_crash_rows, generate_person_rows, generate_vehicle_rows
+
+SUITE_VERSION = 1
+PIPELINES = ['bruteForce_mass_upload', 'multiThread_mass_upload', 'etl', 'daily_updates']
+RAW_KEY_NAME = 'collisions_raw_data'
+PROCESSED_KEY_NAME = 'collisions_processed_data'
+# Values compared with the baseline, all lower is better
+TRACKED = ['seconds', 'peak_rss_mb']
+
+def proc_status_mb(field):
+    """Read a memory field (VmRSS, VmHWM) of /proc/self/status in MiB, None where there is no /proc."""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    """Reset the peak RSS (VmHWM) to the current RSS, so the imports are not counted. Linux only."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def child(args):
+    import boto3
+
+    s3_requests = collections.Counter()
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call.s3.*', lambda model, **kwargs: s3_requests.update([model.name]))
+
+    from harness import load_pipeline_module
+    module = load_pipeline_module(args.child)
+    from nyc_collisions.streaming import peak_rss_mb
+
+    from sodapy import Socrata
+    import requests
+    adapter = {'prefix': 'http://', 'adapter': requests.adapters.HTTPAdapter()}
+    module.Socrata = lambda domain, app_token: Socrata(args.domain, app_token, session_adapter=adapter)
+
+    # The ETL has no Socrata client and so no cache to turn off
+    kwargs = {} if args.child == 'etl' else {'cache_dir': None}
+    # Importing pandas and pyarrow can peak higher than a small run, so the peak is reset before main
+    # where the platform allows it; elsewhere it is the peak of the whole process
+    if reset_peak_rss():
+        baseline_rss, read_peak = proc_status_mb('VmRSS'), lambda: proc_status_mb('VmHWM')
+    else:
+        baseline_rss, read_peak = peak_rss_mb(), peak_rss_mb
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.main(**kwargs)
+    seconds = time.perf_counter() - start_time
+
+    print('RESULT ' + json.dumps({
+        'seconds': round(seconds, 3),
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(read_peak(), 1),
+        's3_requests': sum(s3_requests.values()),
+        's3_requests_by_operation': dict(s3_requests),
+    }))
+
+def run_pipeline(pipeline, endpoint_url, domain):
+    """Run one pipeline's main() in a child process. Returns its result and the stages it emitted."""
+    with tempfile.TemporaryDirectory() as folder:
+        metrics_path = os.path.join(folder, 'metrics.jsonl')
+        env = dict(os.environ, AWS_ENDPOINT_URL=endpoint_url, AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                   AWS_DEFAULT_REGION='us-east-1', METRICS_SINK=metrics_path, PROFILE='')
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', pipeline, '--domain', domain],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        result = [json.loads(line[len('RESULT '):]) for line in output.splitlines() if line.startswith('RESULT ')][-1]
+
+        stages = {}
+        if os.path.exists(metrics_path):
+            with open(metrics_path) as metrics_file:
+                for record in map(json.loads, metrics_file):
+                    stage = stages.setdefault(record['Stage'], {})
+                    for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                        stage[metric['Name']] = round(stage.get(metric['Name'], 0) + record[metric['Name']], 3)
+    return result, stages
+
+def reset_prefix(aws_client, prefix):
+    for page in aws_client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for entry in page.get('Contents', []):
+            aws_client.delete_object(Bucket=BUCKET_NAME, Key=entry['Key'])
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PIPELINES_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Return one line per tracked value that grew by more than tolerance against the baseline."""
+    previous = {result['pipeline']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        if result['pipeline'] not in previous:
+            continue
+        for name in TRACKED:
+            before, after = previous[result['pipeline']][name], result[name]
+            if before and after > before * (1 + tolerance):
+                regressions.append(f"{result['pipeline']} {name}: {before} -> {after} (+{after / before - 1:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='records in the fake dataset (about 600 per day)')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake server waits per request')
+    parser.add_argument('--max-concurrency', type=int, default=16, help='requests in flight before the server answers HTTP 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 503')
+    parser.add_argument('--daily-days', type=int, default=7, help='days the daily update has to fetch')
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=PIPELINES, help='pipelines to run')
+    parser.add_argument('--output', default=f"suite-{datetime.now():%Y%m%dT%H%M%S}.json", help='results file')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='growth over the baseline reported as a regression')
+    parser.add_argument('--child', choices=PIPELINES, help=argparse.SUPPRESS)
+    parser.add_argument('--domain', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    sys.path.append(PIPELINES_DIR)
+    from nyc_collisions.compression import compress_bytes, resolve_content_encoding
+    from nyc_collisions.manifest import update_manifest
+    from nyc_collisions.partitions import write_partitions
+    from nyc_collisions.schema import records_to_frame
+    from nyc_collisions.transform import transform_data
+
+    from nyc_collisions.datasets import DATASETS, raw_file_name
+
+    rows = generate_crash_rows(args.rows)
+    child_rows = {'persons': generate_person_rows(rows), 'vehicles': generate_vehicle_rows(rows)}
+    days = sorted({row['crash_date'][:10] for row in rows})
+    loaded_until = days[-args.daily_days - 1]
+
+    print(f"Pipeline suite: {args.rows} records, {args.latency}s per Socrata request, "
+          f"HTTP 429 past {args.max_concurrency} in flight, {args.error_rate:.0%} HTTP 503")
+    results = []
+    datasets = {DATASETS[name]['dataset_id']: FakeDataset(records, key_column=DATASETS[name]['key_column'])
+                for name, records in child_rows.items()}
+    with moto_server_process() as aws_client, FakeSocrataServer(rows, latency=args.latency, max_concurrency=args.max_concurrency,
+                                                                error_rate=args.error_rate, datasets=datasets) as server:
+        for pipeline in args.pipelines:
+            if pipeline == 'etl' and 'multiThread_mass_upload' not in args.pipelines:
+                # The ETL reads what the multiThread upload writes, compressed if S3_CONTENT_ENCODING says so
+                content_encoding = resolve_content_encoding()
+                for name, records in [('crashes', rows), *child_rows.items()]:
+                    raw_df = records_to_frame(records, DATASETS[name]['columns'], DATASETS[name]['dtypes'])
+                    aws_client.put_object(Bucket=BUCKET_NAME, Key=f"{RAW_KEY_NAME}/'{raw_file_name(name, 'csv', content_encoding)}'",
+                                          Body=compress_bytes(raw_df.to_csv(index=False).encode('utf-8'), content_encoding))
+            if pipeline == 'daily_updates':
+                # Everything but the last days is already loaded
+                reset_prefix(aws_client, PROCESSED_KEY_NAME + '/')
+                loaded_df, _ = transform_data(records_to_frame([row for row in rows if row['crash_date'][:10] <= loaded_until]))
+                report = write_partitions(aws_client, BUCKET_NAME, PROCESSED_KEY_NAME, loaded_df, 'crash_date')
+                update_manifest(aws_client, BUCKET_NAME, PROCESSED_KEY_NAME, report['partitions'])
+
+            server.reset_stats()
+            result, stages = run_pipeline(pipeline, aws_client.meta.endpoint_url, server.domain)
+            stage_rows = max((stage.get('Rows', 0) for stage in stages.values()), default=0)
+            result = {
+                'pipeline': pipeline,
+                'seconds': result['seconds'],
+                'rows': stage_rows,
+                'rows_per_second': round(stage_rows / result['seconds']) if result['seconds'] else None,
+                'baseline_rss_mb': result['baseline_rss_mb'],
+                'peak_rss_mb': result['peak_rss_mb'],
+                'socrata_requests': server.stats['requests'],
+                'socrata_throttled': server.stats['throttled'],
+                'socrata_errors': server.stats['errors'],
+                'socrata_rows_served': server.stats['rows_served'],
+                's3_requests': result['s3_requests'],
+                's3_requests_by_operation': result['s3_requests_by_operation'],
+                'stages': stages,
+            }
+            results.append(result)
+            print({name: value for name, value in result.items() if name not in ('s3_requests_by_operation', 'stages')})
+
+    document = {
+        'suite_version': SUITE_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {name: getattr(args, name) for name in ('rows', 'latency', 'max_concurrency', 'error_rate', 'daily_days')},
+        'results': results,
+    }
+    with open(args.output, 'w') as results_file:
+        json.dump(document, results_file, indent=1)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['config'] != document['config']:
+            print(f"Warning: the baseline ran with {baseline['config']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression over {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark: the old per-script transform_data vs the shared vectorized transform.
+
+The old version is reproduced here as it was in etl.py: pd.to_datetime on crash_date and on
+crash_time with format='%H:%M', then date_time built from two .dt.strftime calls and the
+parts extracted with .dt accessors. It only works on clean data (a malformed time sent it
+into a per-row loop and then failed on .dt), so the shared transform is also timed on a
+copy with --invalid-rate of the times and dates corrupted.
+
+Usage:
+    python bench_transform.py --rows 3000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nyc_collisions.transform import transform_data
+from fake_socrata import generate_crash_frame
+
+def legacy_transform(dataset, date_column_name, time_column_name):
+    dataset[date_column_name] = pd.to_datetime(dataset[date_column_name])
+    dataset[time_column_name] = pd.to_datetime(dataset[time_column_name], format='%H:%M')
+    dataset['date_time'] = dataset[date_column_name].dt.strftime('%Y-%m-%dT') + dataset[time_column_name].dt.strftime('%H:%M')
+    dataset['crash_year'] = dataset[date_column_name].dt.year
+    dataset['crash_month'] = dataset[date_column_name].dt.month
+    dataset['crash_day'] = dataset[date_column_name].dt.day
+    dataset['crash_hour'] = dataset[time_column_name].dt.hour
+    dataset['crash_minute'] = dataset[time_column_name].dt.minute
+
+def corrupt(df, rate, seed=7):
+    # Socrata has the odd '24:00' or empty time, and a few dates that do not parse
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    bad_times = rng.random(len(df)) < rate
+    bad_dates = rng.random(len(df)) < rate / 10
+    df.loc[bad_times, 'crash_time'] = '24:61'
+    df.loc[bad_dates, 'crash_date'] = 'unknown'
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=3000000, help='rows in the synthetic table')
+    parser.add_argument('--invalid-rate', type=float, default=0.001, help='share of times corrupted in the last run')
+    args = parser.parse_args()
+
+    df = generate_crash_frame(args.rows)
+    print(f"Transform benchmark: {args.rows} rows")
+
+    frame = df.copy()
+    start_time = time.perf_counter()
+    legacy_transform(frame, 'crash_date', 'crash_time')
+    seconds = time.perf_counter() - start_time
+    print({'transform': 'legacy', 'seconds': round(seconds, 3), 'rows_per_second': round(args.rows / seconds),
+           'memory_mb': round(float(frame.memory_usage(deep=True).sum()) / 1e6, 1)})
+    del frame
+
+    for name, frame in [('vectorized', df.copy()), ('vectorized (malformed values)', corrupt(df, args.invalid_rate))]:
+        transformed, report = transform_data(frame, 'crash_date', 'crash_time')
+        print({'transform': name, 'seconds': report['seconds'], 'rows_per_second': report['rows_per_second'],
+               'invalid_dates': report['invalid_dates'], 'invalid_times': report['invalid_times'],
+               'memory_mb': round(float(transformed.memory_usage(deep=True).sum()) / 1e6, 1)})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,622 @@
+"""
+A local stand-in for the Socrata SODA API, serving synthetic crash records.
+
+It understands the small subset of SoQL the pipelines use ($select, $where, $order,
+$limit, $offset and $query) and behaves like a database would: a `collision_id > N`
+predicate seeks straight into the sorted table, while `$offset` has to walk past
+every skipped row. That makes the cost of deep offsets visible in a benchmark.
+
+Usage:
+    with FakeSocrataServer(generate_crash_rows(100000)) as server:
+        client = server.client()
+        client.get('h9gi-nx95', limit=10, order='collision_id')
+"""
+import argparse
+import bisect
+import contextlib
+import gzip
+import json
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+import requests
+from sodapy import Socrata
+
+CRASH_DATA_SET = 'h9gi-nx95'
+
+BOROUGHS = ['BROOKLYN', 'QUEENS', 'MANHATTAN', 'BRONX', 'STATEN ISLAND', '']
+FACTORS = ['Unspecified', 'Driver Inattention/Distraction', 'Failure to Yield Right-of-Way',
+           'Following Too Closely', 'Backing Unsafely', 'Passing or Lane Usage Improper', '']
+VEHICLE_TYPES = ['Sedan', 'Station Wagon/Sport Utility Vehicle', 'Taxi', 'Pick-up Truck',
+                 'Box Truck', 'Bike', 'Bus', '']
+PERSON_TYPES = ['Occupant', 'Occupant', 'Pedestrian', 'Bicyclist', 'Other Motorized']
+
+# ------------------------------------------ SYNTHETIC DATA ------------------------------------------
+def generate_crash_rows(number_of_rows, start_date='2012-07-01', first_collision_id=1, seed=42):
+    """
+    Generate synthetic records shaped like the h9gi-nx95 crashes dataset.
+
+    Args:
+    number_of_rows (int): Number of records to generate.
+    start_date (str): Date of the first crash in 'YYYY-MM-DD' format.
+    first_collision_id (int): collision_id of the first record.
+    seed (int): Seed for the random generator so runs are reproducible.
+
+    Returns:
+    list: A list of dicts, sorted by collision_id, with every value encoded as a string
+    the way the SODA API returns them, plus the ':updated_at' system field.
+    """
+    rng = random.Random(seed)
+    first_day = datetime.strptime(start_date, '%Y-%m-%d')
+    # Roughly 600 crashes a day, like the real dataset
+    days_span = max(1, number_of_rows // 600)
+
+    rows = []
+    collision_id = first_collision_id
+    for i in range(number_of_rows):
+        crash_day = first_day + timedelta(days=i * days_span // number_of_rows)
+        latitude = rng.uniform(40.50, 40.91)
+        longitude = rng.uniform(-74.25, -73.70)
+        row = {
+            'crash_date': crash_day.strftime('%Y-%m-%dT00:00:00.000'),
+            'crash_time': f"{rng.randint(0, 23)}:{rng.randint(0, 59):02d}",
+            'borough': rng.choice(BOROUGHS),
+            'zip_code': str(rng.randint(10001, 11697)),
+            'latitude': f"{latitude:.6f}",
+            'longitude': f"{longitude:.6f}",
+            'on_street_name': f"STREET {rng.randint(1, 500)}",
+            'number_of_persons_injured': str(rng.choice([0, 0, 0, 1, 1, 2])),
+            'number_of_persons_killed': str(rng.choice([0] * 99 + [1])),
+            'number_of_pedestrians_injured': str(rng.choice([0, 0, 0, 1])),
+            'number_of_pedestrians_killed': '0',
+            'number_of_cyclist_injured': str(rng.choice([0, 0, 0, 1])),
+            'number_of_cyclist_killed': '0',
+            'number_of_motorist_injured': str(rng.choice([0, 0, 1])),
+            'number_of_motorist_killed': '0',
+            'contributing_factor_vehicle_1': rng.choice(FACTORS),
+            'contributing_factor_vehicle_2': rng.choice(FACTORS),
+            'collision_id': str(collision_id),
+            'vehicle_type_code1': rng.choice(VEHICLE_TYPES),
+            'vehicle_type_code2': rng.choice(VEHICLE_TYPES),
+        }
+        # The SODA API leaves empty fields out of the record altogether
+        row = {column: value for column, value in row.items() if value != ''}
+        # System field, only returned when selected: records are published the day after the crash
+        row[':updated_at'] = (crash_day + timedelta(days=1, seconds=i % 86400)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        rows.append(row)
+        collision_id += rng.randint(1, 3)
+
+    return rows
+
+def _generate_child_rows(crash_rows, per_crash, make_row, seed):
+    # One or more records per crash, numbered by a unique_id of their own like the real datasets
+    rng = random.Random(seed)
+    rows = []
+    unique_id = 10 ** 7
+    for crash in crash_rows:
+        for number in range(rng.choice(per_crash)):
+            row = {
+                'unique_id': str(unique_id),
+                'collision_id': crash['collision_id'],
+                'crash_date': crash['crash_date'],
+                'crash_time': crash['crash_time'],
+                **make_row(rng, number),
+            }
+            rows.append({column: value for column, value in row.items() if value != ''})
+            unique_id += rng.randint(1, 2)
+    return rows
+
+def generate_person_rows(crash_rows, seed=43):
+    """
+    Generate synthetic records shaped like the f55k-p6yu persons dataset, 1 to 4 per crash.
+
+    Args:
+    crash_rows (list): Records from generate_crash_rows, the crashes the persons belong to.
+    seed (int): Seed for the random generator so runs are reproducible.
+
+    Returns:
+    list: A list of dicts, sorted by unique_id, with every value encoded as a string.
+    """
+    def person(rng, number):
+        return {
+            'person_id': f"{rng.getrandbits(64):016x}",
+            'person_type': rng.choice(PERSON_TYPES),
+            'person_injury': rng.choice(['Unspecified', 'Unspecified', 'Injured', 'Killed']),
+            'vehicle_id': str(rng.randint(10 ** 6, 10 ** 7)),
+            'person_age': str(rng.randint(1, 90)),
+            'ped_role': rng.choice(['Driver', 'Passenger', 'Pedestrian']),
+            'person_sex': rng.choice(['M', 'F', 'U']),
+        }
+    return _generate_child_rows(crash_rows, [1, 1, 2, 2, 3, 4], person, seed)
+
+def generate_vehicle_rows(crash_rows, seed=44):
+    """
+    Generate synthetic records shaped like the bm4k-52h4 vehicles dataset, 1 to 3 per crash.
+
+    Args:
+    crash_rows (list): Records from generate_crash_rows, the crashes the vehicles belong to.
+    seed (int): Seed for the random generator so runs are reproducible.
+
+    Returns:
+    list: A list of dicts, sorted by unique_id, with every value encoded as a string.
+    """
+    def vehicle(rng, number):
+        return {
+            'vehicle_id': str(rng.randint(10 ** 6, 10 ** 7)),
+            'state_registration': rng.choice(['NY', 'NY', 'NY', 'NJ', 'PA']),
+            'vehicle_type': rng.choice(VEHICLE_TYPES),
+            'vehicle_make': rng.choice(['TOYOTA', 'HONDA', 'FORD', 'NISSAN', '']),
+            'vehicle_year': str(rng.randint(1995, 2024)),
+            'vehicle_occupants': str(rng.randint(1, 4)),
+            'driver_sex': rng.choice(['M', 'F', '']),
+            'contributing_factor_1': rng.choice(FACTORS),
+        }
+    return _generate_child_rows(crash_rows, [1, 2, 2, 3], vehicle, seed)
+
+def generate_crash_frame(number_of_rows, start_date='2012-07-01', seed=42):
+    """
+    Generate a synthetic crashes table directly as a DataFrame, fast enough for millions of rows.
+
+    The columns match generate_crash_rows, with the dtypes pandas infers when it reads the
+    raw CSV extract back (numbers as numbers, everything else as text).
+
+    Args:
+    number_of_rows (int): Number of records to generate.
+    start_date (str): Date of the first crash in 'YYYY-MM-DD' format.
+    seed (int): Seed for the random generator so runs are reproducible.
+
+    Returns:
+    pandas.DataFrame: The synthetic table, sorted by collision_id.
+    """
+    rng = np.random.default_rng(seed)
+    days_span = max(1, number_of_rows // 600)
+    day_offsets = np.arange(number_of_rows) * days_span // number_of_rows
+    crash_dates = pd.Timestamp(start_date) + pd.to_timedelta(day_offsets, unit='D')
+
+    def pick(choices):
+        values = np.array(choices, dtype=object)[rng.integers(0, len(choices), number_of_rows)]
+        values[values == ''] = None
+        return values
+
+    hours = rng.integers(0, 24, number_of_rows).astype(str)
+    minutes = np.char.zfill(rng.integers(0, 60, number_of_rows).astype(str), 2)
+    return pd.DataFrame({
+        'crash_date': crash_dates.strftime('%Y-%m-%dT00:00:00.000'),
+        'crash_time': np.char.add(np.char.add(hours, ':'), minutes),
+        'borough': pick(BOROUGHS),
+        'zip_code': rng.integers(10001, 11697, number_of_rows),
+        'latitude': rng.uniform(40.50, 40.91, number_of_rows).round(6),
+        'longitude': rng.uniform(-74.25, -73.70, number_of_rows).round(6),
+        'on_street_name': np.char.add('STREET ', rng.integers(1, 500, number_of_rows).astype(str)),
+        'number_of_persons_injured': rng.choice([0, 0, 0, 1, 1, 2], number_of_rows),
+        'number_of_persons_killed': (rng.random(number_of_rows) < 0.01).astype(int),
+        'number_of_pedestrians_injured': rng.choice([0, 0, 0, 1], number_of_rows),
+        'number_of_pedestrians_killed': np.zeros(number_of_rows, dtype=int),
+        'number_of_cyclist_injured': rng.choice([0, 0, 0, 1], number_of_rows),
+        'number_of_cyclist_killed': np.zeros(number_of_rows, dtype=int),
+        'number_of_motorist_injured': rng.choice([0, 0, 1], number_of_rows),
+        'number_of_motorist_killed': np.zeros(number_of_rows, dtype=int),
+        'contributing_factor_vehicle_1': pick(FACTORS),
+        'contributing_factor_vehicle_2': pick(FACTORS),
+        'collision_id': 1 + np.cumsum(rng.integers(1, 4, number_of_rows)) - 1,
+        'vehicle_type_code1': pick(VEHICLE_TYPES),
+        'vehicle_type_code2': pick(VEHICLE_TYPES),
+    })
+
+# ------------------------------------------ SOQL SUBSET ------------------------------------------
+_BETWEEN = re.compile(r"^([:\w]+)\s+BETWEEN\s+'([^']*)'\s+AND\s+'([^']*)'$", re.IGNORECASE)
+_COMPARISON = re.compile(r"^([:\w]+)\s*(>=|<=|!=|>|<|=)\s*(.+)$")
+_OPERATORS = {
+    '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+    '=': lambda a, b: a == b, '!=': lambda a, b: a != b,
+}
+
+def _split_conjunction(where):
+    """Split a WHERE clause on top-level ANDs, leaving BETWEEN ... AND ... intact."""
+    clauses, depth, current, pending_between = [], 0, [], False
+    for token in re.split(r"(\(|\)|'[^']*'|\s+)", where):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0 and token.upper() == 'BETWEEN':
+            pending_between = True
+        elif depth == 0 and token.upper() == 'AND':
+            if pending_between:
+                pending_between = False
+            else:
+                clauses.append(''.join(current).strip())
+                current = []
+                continue
+        current.append(token)
+    clauses.append(''.join(current).strip())
+    return [clause for clause in clauses if clause]
+
+def _strip_parentheses(clause):
+    while clause.startswith('(') and clause.endswith(')'):
+        clause = clause[1:-1].strip()
+    return clause
+
+def _literal(text):
+    text = text.strip()
+    if text.startswith("'") and text.endswith("'"):
+        return text[1:-1]
+    return float(text)
+
+def parse_where(where):
+    """
+    Parse a conjunction of simple SoQL predicates.
+
+    Args:
+    where (str): SoQL WHERE clause.
+
+    Returns:
+    list: (column, operator, value) tuples. BETWEEN is expanded into a >= and a <= predicate.
+    """
+    predicates = []
+    for clause in _split_conjunction(where or ''):
+        clause = _strip_parentheses(clause)
+        if len(_split_conjunction(clause)) > 1:
+            predicates.extend(parse_where(clause))
+            continue
+        match = _BETWEEN.match(clause)
+        if match:
+            column, low, high = match.groups()
+            predicates.append((column, '>=', low))
+            predicates.append((column, '<=', high))
+            continue
+        match = _COMPARISON.match(clause)
+        if not match:
+            raise ValueError(f"Unsupported SoQL predicate: {clause}")
+        column, operator, value = match.groups()
+        predicates.append((column, operator, _literal(value)))
+    return predicates
+
+def _matches(row, predicates):
+    for column, operator, value in predicates:
+        field = row.get(column)
+        if field is None:
+            return False
+        if isinstance(value, float):
+            field = float(field)
+        if not _OPERATORS[operator](field, value):
+            return False
+    return True
+
+# ------------------------------------------ DATASET ------------------------------------------
+class FakeDataset:
+    """
+    An in-memory table, kept sorted by collision_id, that answers SoQL-style queries.
+    """
+
+    def __init__(self, rows, key_column='collision_id'):
+        self.key_column = key_column
+        self.lock = threading.Lock()
+        self.rows = sorted(rows, key=lambda row: int(row[key_column]))
+        self.keys = [int(row[key_column]) for row in self.rows]
+
+    def delete_first(self, number_of_rows):
+        """Remove the lowest keys, simulating records that disappear mid-run."""
+        with self.lock:
+            del self.rows[:number_of_rows]
+            del self.keys[:number_of_rows]
+
+    def update_rows(self, collision_ids, updated_at, **changes):
+        """
+        Edit existing records, the way NYPD revises crashes after they are published.
+
+        Args:
+        collision_ids (list): Keys of the records to edit.
+        updated_at (str): New ':updated_at' value, i.e. '2024-02-01T10:00:00.000Z'.
+        **changes: Fields to overwrite, i.e. number_of_persons_injured='3'.
+
+        Returns:
+        int: Number of records edited.
+        """
+        edited = 0
+        with self.lock:
+            for collision_id in collision_ids:
+                position = bisect.bisect_left(self.keys, int(collision_id))
+                if position < len(self.keys) and self.keys[position] == int(collision_id):
+                    self.rows[position] = {**self.rows[position], **changes, ':updated_at': updated_at}
+                    edited += 1
+        return edited
+
+    def append_rows(self, rows):
+        """Publish new records, which must have higher keys than the existing ones."""
+        with self.lock:
+            self.rows.extend(sorted(rows, key=lambda row: int(row[self.key_column])))
+            self.keys = [int(row[self.key_column]) for row in self.rows]
+
+    def query(self, select=None, where=None, order=None, limit=1000, offset=0):
+        """
+        Answer a query the way the SODA API would.
+
+        Args:
+        select (str): '$select' value. Supports '*' (optionally with system fields such as
+        ':updated_at, *' or ':*, *'), COUNT(*) and min/max aggregates of numeric or text columns.
+        where (str): '$where' value.
+        order (str): '$order' value. Only ordering by the key column is supported.
+        limit (int): '$limit' value.
+        offset (int): '$offset' value.
+
+        Returns:
+        tuple: The list of result rows and the number of rows the server had to scan.
+        """
+        predicates = parse_where(where)
+        if order and order.split()[0] != self.key_column:
+            raise ValueError(f"Unsupported $order: {order}")
+
+        with self.lock:
+            # Key predicates narrow the scan with a binary search, like an index seek
+            low, high = 0, len(self.keys)
+            remaining = []
+            for column, operator, value in predicates:
+                if column == self.key_column and isinstance(value, float):
+                    if operator == '>':
+                        low = max(low, bisect.bisect_right(self.keys, value))
+                    elif operator == '>=':
+                        low = max(low, bisect.bisect_left(self.keys, value))
+                    elif operator == '<':
+                        high = min(high, bisect.bisect_left(self.keys, value))
+                    elif operator == '<=':
+                        high = min(high, bisect.bisect_right(self.keys, value))
+                    else:
+                        remaining.append((column, operator, value))
+                else:
+                    remaining.append((column, operator, value))
+            candidates = self.rows[low:high]
+
+        if select and '(' in select:
+            matching = [row for row in candidates if _matches(row, remaining)]
+            return [self._aggregate(select, matching)], len(candidates)
+
+        # System fields (':updated_at', ...) are only returned when they are selected
+        system_fields = {field.strip() for field in (select or '').split(',') if field.strip().startswith(':')}
+
+        # Offsets have to be walked past row by row, there is no way to seek to them
+        results, skipped, scanned = [], 0, 0
+        for row in candidates:
+            scanned += 1
+            if not _matches(row, remaining):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            results.append({column: value for column, value in row.items()
+                            if not column.startswith(':') or column in system_fields or ':*' in system_fields})
+            if len(results) >= limit:
+                break
+
+        return results, scanned
+
+    def _aggregate(self, select, rows):
+        result = {}
+        for expression in select.split(','):
+            expression = expression.strip()
+            name = expression
+            match = re.match(r'^(.*?)\s+AS\s+(\w+)$', expression, re.IGNORECASE)
+            if match:
+                expression, name = match.groups()
+            function = expression.split('(')[0].strip().lower()
+            if function == 'count':
+                result[name if match else 'COUNT'] = str(len(rows))
+                continue
+            column = expression[expression.index('(') + 1:expression.rindex(')')].strip()
+            values = [row[column] for row in rows if column in row]
+            if values:
+                try:
+                    value = str(int((min if function == 'min' else max)(float(value) for value in values)))
+                except ValueError:
+                    # Text and floating timestamp columns, i.e. min(crash_date), compare as strings
+                    value = min(values) if function == 'min' else max(values)
+                result[name if match else f"{function}_{column}"] = value
+        return result
+
+# ------------------------------------------ HTTP SERVER ------------------------------------------
+def socrata_client(domain, timeout=100):
+    """
+    Build a sodapy client that talks to a fake server over plain HTTP.
+
+    Args:
+    domain (str): 'host:port' of the fake server.
+    timeout (int): Request timeout in seconds.
+
+    Returns:
+    sodapy.Socrata: The client.
+    """
+    adapter = {'prefix': 'http://', 'adapter': requests.adapters.HTTPAdapter(pool_maxsize=64)}
+    return Socrata(domain, 'fake-app-token', session_adapter=adapter, timeout=timeout)
+
+def _parse_query_param(query):
+    """Split a '$query' value (SELECT ... WHERE ...) into its select and where parts."""
+    match = re.match(r'^\s*SELECT\s+(.*?)(?:\s+WHERE\s+(.*))?$', query, re.IGNORECASE | re.DOTALL)
+    return match.group(1), match.group(2)
+
+class _SocrataHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.fake
+        parsed = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(parsed.query).items()}
+
+        with server.stats_lock:
+            server.stats['requests'] += 1
+            server.in_flight += 1
+            overloaded = server.max_concurrency is not None and server.in_flight > server.max_concurrency
+            failed = server.random.random() < server.error_rate
+        try:
+            if overloaded:
+                with server.stats_lock:
+                    server.stats['throttled'] += 1
+                return self._send(429, {'error': 'Too many requests'}, {'Retry-After': '0.1'})
+            if failed:
+                with server.stats_lock:
+                    server.stats['errors'] += 1
+                return self._send(503, {'error': 'Service unavailable'})
+            self._answer(server, parsed, params)
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def _answer(self, server, parsed, params):
+        dataset_name = parsed.path.rsplit('/', 1)[-1].split('.')[0]
+        if server.latency:
+            time.sleep(server.latency)
+
+        dataset = server.datasets.get(dataset_name)
+        if dataset is None:
+            return self._send(404, {'error': f"Unknown dataset {dataset_name}"})
+
+        select, where = params.get('$select'), params.get('$where')
+        if '$query' in params:
+            select, where = _parse_query_param(params['$query'])
+
+        try:
+            rows, scanned = dataset.query(
+                select=select,
+                where=where,
+                order=params.get('$order'),
+                limit=int(params.get('$limit', 1000)),
+                offset=int(params.get('$offset', 0)),
+                )
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+
+        with server.stats_lock:
+            server.stats['rows_served'] += len(rows)
+            server.stats['rows_scanned'] += scanned
+
+        self._send(200, rows)
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        # Like the real API, compress the response when the client accepts gzip
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeSocrataServer:
+    """
+    Run a fake SODA endpoint on localhost in a background thread.
+
+    Args:
+    rows (list): Records served for the crashes dataset (h9gi-nx95).
+    latency (float): Seconds added to every response, to mimic network round trips.
+    max_concurrency (int): Requests allowed in flight before the server answers HTTP 429.
+    error_rate (float): Fraction of requests answered with HTTP 503.
+    datasets (dict): Optional mapping of extra dataset names to their records, or to a
+    FakeDataset when they are keyed on another column (i.e. 'unique_id').
+    port (int): Port to listen on, 0 picks a free one.
+    """
+
+    def __init__(self, rows, latency=0.0, max_concurrency=None, error_rate=0.0, datasets=None, port=0):
+        self.datasets = {CRASH_DATA_SET: FakeDataset(rows)}
+        for dataset_name, dataset_rows in (datasets or {}).items():
+            self.datasets[dataset_name] = (dataset_rows if isinstance(dataset_rows, FakeDataset)
+                                           else FakeDataset(dataset_rows))
+        self.latency = latency
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'rows_served': 0, 'rows_scanned': 0, 'throttled': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _SocrataHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def domain(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def client(self, timeout=100):
+        """Build a sodapy client that talks to this server over plain HTTP."""
+        return socrata_client(self.domain, timeout=timeout)
+
+    def reset_stats(self):
+        with self.stats_lock:
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.stop()
+
+@contextlib.contextmanager
+def fake_socrata_process(number_of_rows, latency=0.0, max_concurrency=None, error_rate=0.0):
+    """
+    Run the fake server in a child process, so its memory and CPU are not charged to the benchmark.
+
+    Args:
+    number_of_rows (int): Synthetic crash records to serve.
+    latency (float): Seconds added to every response.
+    max_concurrency (int): Requests allowed in flight before the server answers HTTP 429.
+    error_rate (float): Fraction of requests answered with HTTP 503.
+
+    Yields:
+    str: 'host:port' of the running server.
+    """
+    command = [sys.executable, __file__, '--rows', str(number_of_rows), '--latency', str(latency),
+               '--error-rate', str(error_rate)]
+    if max_concurrency is not None:
+        command += ['--max-concurrency', str(max_concurrency)]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        # The child prints its address once it is ready to accept requests
+        yield process.stdout.readline().strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic crash records over a fake SODA API.')
+    parser.add_argument('--rows', type=int, default=100000, help='synthetic records to serve')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    parser.add_argument('--max-concurrency', type=int, default=None, help='concurrent requests before HTTP 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 503')
+    parser.add_argument('--port', type=int, default=0, help='port to listen on, 0 picks a free one')
+    args = parser.parse_args()
+
+    server = FakeSocrataServer(generate_crash_rows(args.rows), latency=args.latency,
+                               max_concurrency=args.max_concurrency, error_rate=args.error_rate, port=args.port)
+    print(server.domain, flush=True)
+    server.httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
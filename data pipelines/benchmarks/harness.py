@@ -0,0 +1,116 @@
+"""
+Helpers shared by the benchmarks: importing the pipeline scripts and standing up a local S3.
+
+The pipeline scripts read their credentials from a `secrets_1` module that is kept out of
+the repository. The benchmarks never talk to the real Socrata API or AWS, so they register
+a placeholder `secrets_1` before importing a script.
+"""
+import contextlib
+import importlib
+import os
+import socket
+import subprocess
+import sys
+import time
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINES_DIR = os.path.join(BENCHMARKS_DIR, '..')
+SCRIPT_DIRS = [
+    os.path.join(PIPELINES_DIR, 'Ingestion Pipelines'),
+    os.path.join(PIPELINES_DIR, 'ETL'),
+    os.path.join(PIPELINES_DIR, '..', 'AWS'),
+]
+
+BUCKET_NAME = 'nyc-application-collisions'
+
+def load_pipeline_module(module_name):
+    """
+    Import one of the pipeline scripts (i.e. 'bruteForce_mass_upload') by name.
+
+    Args:
+    module_name (str): File name of the script without the .py extension.
+
+    Returns:
+    module: The imported script.
+    """
+    if 'secrets_1' not in sys.modules:
+        secrets = types.ModuleType('secrets_1')
+        secrets.app_token = 'benchmark-app-token'
+        secrets.access_key = 'testing'
+        secrets.secret_access_key = 'testing'
+        sys.modules['secrets_1'] = secrets
+
+    for script_dir in SCRIPT_DIRS:
+        if script_dir not in sys.path:
+            sys.path.append(script_dir)
+    if PIPELINES_DIR not in sys.path:
+        sys.path.append(PIPELINES_DIR)
+
+    return importlib.import_module(module_name)
+
+def local_s3(bucket_name=BUCKET_NAME):
+    """
+    Start an in-process S3 stand-in (moto) with an empty bucket.
+
+    Returns:
+    tuple: The moto mock, already started (call .stop() when done), and a boto3 S3 client.
+    """
+    import boto3
+    from moto import mock_aws
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    mock = mock_aws()
+    mock.start()
+    aws_client = boto3.client('s3', region_name='us-east-1')
+    aws_client.create_bucket(Bucket=bucket_name)
+    return mock, aws_client
+
+@contextlib.contextmanager
+def moto_server_process(bucket_name=BUCKET_NAME):
+    """
+    Run the S3 stand-in in a child process, so stored objects are not charged to the benchmark's memory.
+
+    Yields:
+    boto3.client: An S3 client pointed at the stand-in, with an empty bucket created.
+    """
+    import boto3
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Wait until the server accepts connections
+        for _ in range(100):
+            with socket.socket() as probe:
+                if probe.connect_ex(('127.0.0.1', port)) == 0:
+                    break
+            time.sleep(0.1)
+
+        aws_client = boto3.client('s3', region_name='us-east-1', endpoint_url=f"http://127.0.0.1:{port}",
+                                  aws_access_key_id='testing', aws_secret_access_key='testing')
+        aws_client.create_bucket(Bucket=bucket_name)
+        yield aws_client
+    finally:
+        process.terminate()
+        process.wait()
+
+def extract_csv_from_s3(aws_client, bucket_name, file_name):
+    """
+    The extract etl.process_dataset ran before it streamed, the baseline of the extract benchmarks.
+
+    The whole raw object is read into bytes, copied into a BytesIO and parsed by a single
+    pd.read_csv into an untyped frame.
+    """
+    import io
+    import pandas as pd
+    from nyc_collisions.compression import decompress_bytes
+
+    body = aws_client.get_object(Bucket=bucket_name, Key=file_name)['Body'].read()
+    return pd.read_csv(io.BytesIO(decompress_bytes(body)))
@@ -0,0 +1,7 @@
+"""
+Shared building blocks for the NYC Collisions data pipelines.
+
+The ingestion scripts, the ETL script and the daily updates Lambda all import
+from this package so that paging, transformation and upload logic lives in
+one place instead of being copied between scripts.
+"""
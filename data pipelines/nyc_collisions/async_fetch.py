@@ -0,0 +1,189 @@
+"""
+asyncio download path for Socrata datasets, an alternative to the thread pool in parallel.py.
+
+The thread pool shares one sodapy client, and therefore one requests.Session, between all
+of its threads, and the only way to get more requests in flight is more threads. Here a
+single event loop drives every request through one aiohttp session:
+
+- a pooled set of keep-alive connections (max_connections), reused across pages;
+- an explicit limit on the requests in flight (max_in_flight), independent of the pool;
+- gzip transfer encoding, so the JSON pages travel compressed.
+
+The key space is split into the same collision_id ranges as iter_records_in_parallel and
+every range is paged with the same keyset WHERE clauses, so the records come back in the
+same order. Throttled or failed requests are retried with exponential backoff.
+"""
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from nyc_collisions.paging import KEY_COLUMN, build_keyset_where, split_key_range
+from nyc_collisions.parallel import RETRYABLE_STATUS_CODES, backoff_delay
+
+DEFAULT_MAX_IN_FLIGHT = 16
+
+class SocrataHTTPError(Exception):
+    """An HTTP error answered by the Socrata API, with the server's Retry-After in seconds if it sent one."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+class AsyncSocrataClient:
+    """
+    Minimal asyncio SODA client over a pooled, keep-alive aiohttp session.
+
+    Use it as an async context manager. get() takes the same keyword arguments as
+    sodapy.Socrata.get (select, where, order, limit, offset, query, ...).
+
+    Args:
+    domain (str): API domain, i.e. 'data.cityofnewyork.us'.
+    app_token (str): Socrata app token, sent with every request.
+    max_connections (int): Keep-alive connections in the pool.
+    timeout (int): Seconds allowed per request.
+    scheme (str): 'https', or 'http' for a local test server.
+    """
+
+    def __init__(self, domain, app_token=None, max_connections=DEFAULT_MAX_IN_FLIGHT, timeout=100, scheme='https'):
+        self.domain = domain
+        self.app_token = app_token
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.scheme = scheme
+        self.session = None
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_decoded': 0}
+
+    @classmethod
+    def from_socrata(cls, socrata_client, **kwargs):
+        """Build a client for the same domain and app token as a sodapy.Socrata client."""
+        return cls(socrata_client.domain, socrata_client.session.headers.get('X-App-Token'),
+                   timeout=socrata_client.timeout, **kwargs)
+
+    async def __aenter__(self):
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        if self.app_token:
+            headers['X-App-Token'] = self.app_token
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None):
+        await self.session.close()
+
+    async def get(self, dataset_identifier, **kwargs):
+        """
+        Run one SODA query.
+
+        Returns:
+        list: The records.
+
+        Raises:
+        SocrataHTTPError: If the server answers with an HTTP error.
+        """
+        url = f"{self.scheme}://{self.domain}/resource/{dataset_identifier}.json"
+        params = {f"${name}": str(value) for name, value in kwargs.items() if value is not None}
+        async with self.session.get(url, params=params) as response:
+            body = await response.read()
+            self.stats['requests'] += 1
+            self.stats['bytes_received'] += response.content_length or len(body)
+            self.stats['bytes_decoded'] += len(body)
+            if response.status >= 400:
+                retry_after = response.headers.get('Retry-After')
+                raise SocrataHTTPError(response.status, body[:200].decode('utf-8', 'replace'),
+                                       float(retry_after) if retry_after else None)
+            return json.loads(body)
+
+def _is_retryable(error):
+    if isinstance(error, SocrataHTTPError):
+        return error.status in RETRYABLE_STATUS_CODES
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+async def fetch_records_async(client, dataset_name, chunk_size=5000, partition_size=None, where=None,
+                              max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_retries=5, key_column=KEY_COLUMN):
+    """
+    Download a whole dataset with range partitions on one event loop, in key order.
+
+    Args:
+    client (AsyncSocrataClient): An open client.
+    dataset_name (str): Name of the dataset to fetch data from.
+    chunk_size (int): Number of records requested per page.
+    partition_size (int): Width of each key partition. Defaults to four pages worth of keys.
+    where (str): Optional SoQL filter applied to every page.
+    max_in_flight (int): Requests allowed in flight at the same time.
+    max_retries (int): Attempts allowed per request after the first failure.
+    key_column (str): Name of the unique, numeric key column.
+
+    Returns:
+    tuple: The list of records in key order and a stats dict with requests, retries,
+    throttles and seconds.
+    """
+    start_time = time.perf_counter()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    stats = {'requests': 0, 'retries': 0, 'throttles': 0}
+
+    async def request(**params):
+        for attempt in range(max_retries + 1):
+            try:
+                async with semaphore:
+                    stats['requests'] += 1
+                    return await client.get(dataset_name, **params)
+            except Exception as e:
+                if not _is_retryable(e) or attempt == max_retries:
+                    raise
+                stats['retries'] += 1
+                if isinstance(e, SocrataHTTPError) and e.status == 429:
+                    stats['throttles'] += 1
+                delay = backoff_delay(attempt + 1)
+                await asyncio.sleep(max(delay, getattr(e, 'retry_after', None) or 0))
+
+    bounds = await request(select=f"min({key_column}) AS min_key, max({key_column}) AS max_key", where=where)
+    if not bounds or bounds[0].get('min_key') is None:
+        return [], dict(stats, seconds=round(time.perf_counter() - start_time, 3))
+    min_key, max_key = int(float(bounds[0]['min_key'])), int(float(bounds[0]['max_key']))
+
+    partition_size = partition_size or chunk_size * 4
+    number_of_partitions = -(-(max_key - min_key + 1) // partition_size)
+
+    async def fetch_partition(partition):
+        last_key, upper_key = partition
+        records = []
+        while True:
+            page = await request(where=build_keyset_where(last_key, upper_key, where, key_column), order=key_column,
+                                 limit=chunk_size)
+            records.extend(page)
+            if len(page) < chunk_size:
+                return records
+            last_key = int(page[-1][key_column])
+
+    partitions = await asyncio.gather(*(fetch_partition(partition)
+                                        for partition in split_key_range(min_key, max_key, number_of_partitions)))
+    records = [record for partition in partitions for record in partition]
+    return records, dict(stats, seconds=round(time.perf_counter() - start_time, 3))
+
+def fetch_records(socrata_client, dataset_name, max_in_flight=DEFAULT_MAX_IN_FLIGHT, scheme='https', **kwargs):
+    """
+    Blocking wrapper around fetch_records_async for scripts that do not run an event loop.
+
+    Args:
+    socrata_client (sodapy.Socrata): Client whose domain and app token are reused.
+    dataset_name (str): Name of the dataset to fetch data from.
+    max_in_flight (int): Requests allowed in flight, also the size of the connection pool.
+    scheme (str): 'https', or 'http' for a local test server.
+    **kwargs: Forwarded to fetch_records_async (chunk_size, where, ...).
+
+    Returns:
+    tuple: The records in key order, and stats with the client's bytes received as well.
+    """
+    async def run():
+        async with AsyncSocrataClient.from_socrata(socrata_client, max_connections=max_in_flight, scheme=scheme) as client:
+            records, stats = await fetch_records_async(client, dataset_name, max_in_flight=max_in_flight, **kwargs)
+            stats.update(bytes_received=client.stats['bytes_received'], bytes_decoded=client.stats['bytes_decoded'])
+            return records, stats
+
+    return asyncio.run(run())
@@ -0,0 +1,167 @@
+"""
+Borough enrichment: fill and normalize the borough of a crash from its zip code.
+
+A large share of crashes come with a zip_code but no borough. data/nycBorough.csv maps the
+240 NYC zip codes to their borough (some twice, and Staten Island sometimes as 'Staten').
+It is loaded once per process into a BoroughIndex: a small int8 array indexed by
+zip code - 10001, holding the position of the borough in BOROUGHS (-1 for unknown zips).
+
+Looking a column up never goes row by row. The zip codes (or the existing borough names)
+are factorized first, so only the few hundred distinct values are parsed or normalized,
+and the result is put together from integer codes with pd.Categorical.from_codes.
+"""
+import functools
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Borough names as Socrata publishes them; the categories of the enriched column
+BOROUGHS = ['BRONX', 'BROOKLYN', 'MANHATTAN', 'QUEENS', 'STATEN ISLAND']
+
+# Other spellings found in the lookup file and in older records
+BOROUGH_ALIASES = {'STATEN': 'STATEN ISLAND', 'STATEN IS': 'STATEN ISLAND', 'THE BRONX': 'BRONX'}
+
+# The repository's data/nycBorough.csv; the Lambda image copies it elsewhere and sets
+# BOROUGH_LOOKUP_PATH to the copy (see Docker/Dockerfile)
+DEFAULT_LOOKUP_PATH = os.environ.get(
+    'BOROUGH_LOOKUP_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'nycBorough.csv'))
+
+logger = logging.getLogger(__name__)
+
+def normalize_borough(name):
+    """Return the BOROUGHS spelling of a borough name, None if it is not one."""
+    if not isinstance(name, str):
+        return None
+    name = ' '.join(name.upper().split())
+    name = BOROUGH_ALIASES.get(name, name)
+    return name if name in BOROUGHS else None
+
+def _borough_codes(names):
+    # Position of every normalized name in BOROUGHS, -1 for anything else
+    return np.array([BOROUGHS.index(borough) if borough else -1 for borough in map(normalize_borough, names)],
+                    dtype=np.int8)
+
+class BoroughIndex:
+    """
+    Zip code to borough, as an array indexed by zip code - first_zip.
+
+    Args:
+    zip_codes (array-like): Zip codes, as numbers or digit strings.
+    boroughs (array-like): Borough of each zip code, in any spelling normalize_borough accepts.
+    """
+
+    def __init__(self, zip_codes, boroughs):
+        zip_codes = np.asarray(pd.to_numeric(pd.Series(zip_codes), errors='coerce'), dtype='float64')
+        codes = _borough_codes(boroughs)
+        valid = ~np.isnan(zip_codes) & (codes >= 0)
+        zip_codes = zip_codes[valid].astype(np.int64)
+        self.first_zip = int(zip_codes.min())
+        self.codes = np.full(int(zip_codes.max()) - self.first_zip + 1, -1, dtype=np.int8)
+        self.codes[zip_codes - self.first_zip] = codes[valid]
+        self.zip_codes = len(np.unique(zip_codes))
+
+    def lookup_numbers(self, zip_codes):
+        """Return the borough codes (-1 if unknown) of a float or int array of zip codes."""
+        zip_codes = np.asarray(zip_codes, dtype='float64')
+        positions = zip_codes - self.first_zip
+        known = (positions >= 0) & (positions < len(self.codes)) & (positions == np.floor(positions))
+        result = np.full(len(zip_codes), -1, dtype=np.int8)
+        result[known] = self.codes[positions[known].astype(np.int64)]
+        return result
+
+    def lookup(self, zip_codes):
+        """
+        Return the borough code of every zip code, -1 where it is missing or not a NYC zip.
+
+        Args:
+        zip_codes (pandas.Series): Numbers, digit strings ('11201', '11201.0') or a categorical of either.
+
+        Returns:
+        numpy.ndarray: int8 positions in BOROUGHS.
+        """
+        if pd.api.types.is_numeric_dtype(zip_codes.dtype) and not isinstance(zip_codes.dtype, pd.CategoricalDtype):
+            return self.lookup_numbers(zip_codes.to_numpy(dtype='float64', na_value=np.nan))
+        # Text or categorical: look up the distinct values only
+        codes, uniques = pd.factorize(zip_codes)
+        unique_numbers = pd.to_numeric(pd.Series(np.asarray(uniques, dtype=object)), errors='coerce')
+        unique_codes = np.append(self.lookup_numbers(unique_numbers.to_numpy(dtype='float64', na_value=np.nan)), np.int8(-1))
+        # factorize marks missing values with -1, which picks the trailing -1
+        return unique_codes[codes]
+
+@functools.lru_cache(maxsize=None)
+def load_borough_index(path=DEFAULT_LOOKUP_PATH):
+    """
+    Read the zip code lookup once per process.
+
+    Returns:
+    BoroughIndex: The index, None if the file is not there.
+    """
+    if not os.path.exists(path):
+        logger.warning(f"Borough lookup {path} not found, missing boroughs are not filled from the zip code")
+        return None
+    lookup = pd.read_csv(path, dtype=str)
+    return BoroughIndex(lookup['zip_code'], lookup['Boroughs'])
+
+def normalize_borough_codes(boroughs):
+    """Return the BOROUGHS position of every value of a borough column, -1 where it is missing or unknown."""
+    codes, uniques = pd.factorize(boroughs)
+    return np.append(_borough_codes(np.asarray(uniques, dtype=object)), np.int8(-1))[codes]
+
+def enrich_boroughs(dataset, borough_column_name='borough', zip_column_name='zip_code', index=None):
+    """
+    Normalize the borough column and fill the missing boroughs from the zip code.
+
+    A borough that is already there is kept, even where the zip code says otherwise (a few
+    zip codes straddle two boroughs); those rows are only counted as conflicts. The column
+    becomes a categorical with the BOROUGHS categories.
+
+    Args:
+    dataset (pandas.DataFrame): The dataset to enrich, changed in place.
+    borough_column_name (str): The name of the borough column.
+    zip_column_name (str): The name of the zip code column.
+    index (BoroughIndex): The lookup. Defaults to load_borough_index().
+
+    Returns:
+    dict: Report with rows, present (boroughs there before), filled, missing (after),
+    conflicts, fill_rate, seconds and rows_per_second.
+    """
+    start_time = time.perf_counter()
+    index = index if index is not None else load_borough_index()
+    if index is None or zip_column_name not in dataset.columns:
+        return None
+
+    if borough_column_name in dataset.columns:
+        codes = normalize_borough_codes(dataset[borough_column_name])
+    else:
+        codes = np.full(len(dataset), -1, dtype=np.int8)
+    from_zip = index.lookup(dataset[zip_column_name])
+
+    present = codes >= 0
+    fill = ~present & (from_zip >= 0)
+    conflicts = int((present & (from_zip >= 0) & (codes != from_zip)).sum())
+    codes = np.where(fill, from_zip, codes)
+    dataset[borough_column_name] = pd.Categorical.from_codes(codes, categories=BOROUGHS)
+
+    seconds = time.perf_counter() - start_time
+    missing = int((codes < 0).sum())
+    return {
+        'rows': len(dataset),
+        'present': int(present.sum()),
+        'filled': int(fill.sum()),
+        'missing': missing,
+        'conflicts': conflicts,
+        'fill_rate': round(1 - missing / len(dataset), 4) if len(dataset) else None,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(len(dataset) / seconds) if seconds else None,
+    }
+
+def format_borough_report(report):
+    """Render the report of enrich_boroughs as one line."""
+    fill_rate = f"{report['fill_rate']:.1%}" if report['fill_rate'] is not None else 'n/a'
+    return (f"Boroughs: {report['present']} present, {report['filled']} filled from the zip code, {report['missing']} "
+            f"still missing (fill rate {fill_rate}), {report['conflicts']} disagreeing with the zip code, "
+            f"{report['seconds']} seconds")
@@ -0,0 +1,253 @@
+"""
+On-disk cache of Socrata API responses.
+
+CachedSocrataClient wraps a Socrata client and answers repeated get() calls from local
+disk, so re-running a failed mass upload or iterating on the ETL does not download the
+same historical pages (and spend the same API quota) again.
+
+- Entries are keyed on the domain, the dataset and every query parameter (a SHA-256 of
+  their canonical JSON), so different queries never share an entry.
+- Each response is stored as gzip-compressed JSON, '<cache_dir>/<2 hex>/<key>.json.gz',
+  written to a temporary file and renamed into place.
+- How long an entry lives depends on the data it holds (see response_ttl): a closed range
+  of crashes older than a few weeks does not change and is kept until evicted, anything
+  touching recent days, open-ended pages, counts and ':updated_at' queries expire quickly.
+- The total size is capped; the least recently used entries are evicted first. Use is
+  tracked with the file modification time, so it survives between runs.
+- Hits, misses, expired entries, evictions and the response bytes that did not have to be
+  downloaded are counted in CachedSocrataClient.stats.
+
+The scripts only use the cache when asked to, with SOCRATA_CACHE_DIR or cache_dir: a page
+cached by an earlier run can be older than what Socrata serves now.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nyc_collisions', 'socrata')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Crashes are still being reported and revised for a few weeks after they happen
+RECENT_DAYS = 30
+RECENT_TTL = 60 * 60
+# None means the entry never expires, it can only be evicted
+HISTORICAL_TTL = None
+
+_ENTRY_SUFFIX = '.json.gz'
+
+# Upper bound of a crash_date filter: "crash_date BETWEEN 'a' AND 'b'", "crash_date <= 'b'" or "crash_date < 'b'"
+_DATE_UPPER_BOUND = re.compile(r"crash_date\s*(?:<=?|BETWEEN\s*'[^']*'\s*AND)\s*'(\d{4}-\d{2}-\d{2})", re.IGNORECASE)
+
+# ------------------------------------------ TTL POLICY ------------------------------------------
+def response_ttl(params, records, now=None, recent_days=RECENT_DAYS, recent_ttl=RECENT_TTL,
+                 historical_ttl=HISTORICAL_TTL):
+    """
+    Decide how long a response may be served from the cache.
+
+    A response is historical, and kept for historical_ttl, when its range is closed and
+    older than the recent window: either the query has a crash_date upper bound before the
+    window, or the page is full (so later records cannot be added to it) and its newest
+    crash_date is before the window. Everything else gets recent_ttl.
+
+    Args:
+    params (dict): Query parameters passed to get() (where, limit, query, ...).
+    records (list): The response.
+    now (datetime): Current time, for testing.
+    recent_days (int): Days before now that still count as recent.
+    recent_ttl (int): Seconds a recent response lives.
+    historical_ttl (int): Seconds a historical response lives, None for ever.
+
+    Returns:
+    int: Seconds to keep the response, None for no expiry.
+    """
+    text = ' '.join(str(params.get(name) or '') for name in ('where', 'query'))
+    if ':updated_at' in text:
+        # Change tracking is only useful when it is fresh
+        return recent_ttl
+
+    cutoff = f"{(now or datetime.now()) - timedelta(days=recent_days):%Y-%m-%d}"
+    upper_bounds = _DATE_UPPER_BOUND.findall(text)
+    if upper_bounds and max(upper_bounds) < cutoff:
+        return historical_ttl
+
+    limit = params.get('limit')
+    dates = [record['crash_date'][:10] for record in records if isinstance(record, dict) and 'crash_date' in record]
+    if limit and len(records) >= int(limit) and dates and max(dates) < cutoff:
+        return historical_ttl
+    return recent_ttl
+
+# ------------------------------------------ CACHE ------------------------------------------
+class CachedSocrataClient:
+    """
+    Socrata client wrapper that serves get() responses from a compressed on-disk cache.
+
+    Every other attribute is read from the wrapped client, so the wrapper can be passed
+    anywhere a sodapy.Socrata client is expected.
+
+    Args:
+    socrata_client: The Socrata client to wrap.
+    cache_dir (str): Directory of the cache, created if missing.
+    max_bytes (int): Size cap of the compressed entries; least recently used ones are evicted.
+    ttl (callable): Function (params, records) -> seconds or None, response_ttl by default.
+    compresslevel (int): gzip level of the stored entries.
+    """
+
+    def __init__(self, socrata_client, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttl=response_ttl,
+                 compresslevel=6):
+        self.socrata_client = socrata_client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compresslevel = compresslevel
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0, 'evictions': 0,
+                      'bytes_saved': 0, 'bytes_downloaded': 0}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> [size on disk, last use], rebuilt from the files left by earlier runs
+        self.index = {}
+        for folder, _, file_names in os.walk(cache_dir):
+            for file_name in file_names:
+                if file_name.endswith(_ENTRY_SUFFIX):
+                    status = os.stat(os.path.join(folder, file_name))
+                    self.index[file_name[:-len(_ENTRY_SUFFIX)]] = [status.st_size, status.st_mtime]
+        self.total_bytes = sum(size for size, _ in self.index.values())
+
+    def __getattr__(self, name):
+        # Only called for attributes the wrapper does not have (domain, timeout, close, ...)
+        return getattr(self.socrata_client, name)
+
+    @property
+    def timeout(self):
+        return self.socrata_client.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.socrata_client.timeout = value
+
+    def cache_key(self, dataset_identifier, params):
+        """Return the content key of a request: a SHA-256 of the domain, dataset and parameters."""
+        request = {
+            'domain': getattr(self.socrata_client, 'domain', None),
+            'dataset': dataset_identifier,
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}{_ENTRY_SUFFIX}")
+
+    def get(self, dataset_identifier, content_type='json', **kwargs):
+        """
+        Same as Socrata.get, answered from the cache when a live entry exists.
+
+        Returns:
+        list: The records.
+        """
+        if content_type != 'json':
+            return self.socrata_client.get(dataset_identifier, content_type=content_type, **kwargs)
+
+        key = self.cache_key(dataset_identifier, kwargs)
+        records = self._load(key)
+        if records is not None:
+            return records
+
+        records = self.socrata_client.get(dataset_identifier, **kwargs)
+        self._store(key, records, self.ttl(kwargs, records))
+        return records
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                entry = json.loads(gzip.decompress(entry_file.read()))
+        except (OSError, EOFError, ValueError):
+            # A missing or damaged entry is a miss; a damaged one is replaced by _store
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+
+        now = time.time()
+        if entry['expires'] is not None and entry['expires'] < now:
+            self._remove(key)
+            with self.lock:
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+            return None
+
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            # Evicted by another process since it was read: still a hit, just not touched
+            pass
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += entry['bytes']
+            if key in self.index:
+                self.index[key][1] = now
+        return entry['records']
+
+    def _store(self, key, records, ttl):
+        body = json.dumps(records, separators=(',', ':'))
+        now = time.time()
+        entry = {'expires': None if ttl is None else now + ttl, 'bytes': len(body), 'records': records}
+        data = gzip.compress(json.dumps(entry, separators=(',', ':')).encode('utf-8'), compresslevel=self.compresslevel)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as entry_file:
+            entry_file.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            previous = self.index.get(key)
+            self.total_bytes += len(data) - (previous[0] if previous else 0)
+            self.index[key] = [len(data), now]
+            self.stats['stores'] += 1
+            self.stats['bytes_downloaded'] += len(body)
+            victims = self._pick_victims(key)
+        for victim in victims:
+            self._remove(victim)
+
+    def _pick_victims(self, keep):
+        # Least recently used first, never the entry just stored. Called with the lock held.
+        victims = []
+        if self.total_bytes <= self.max_bytes:
+            return victims
+        for key, (size, _) in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            victims.append(key)
+            self.total_bytes -= size
+            del self.index[key]
+            self.stats['evictions'] += 1
+        return victims
+
+    def _remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            size, _ = self.index.pop(key, (0, None))
+            self.total_bytes -= size
+
+    def clear(self):
+        """Delete every entry."""
+        for key in list(self.index):
+            self._remove(key)
+
+def format_cache_stats(stats):
+    """Render CachedSocrataClient.stats as one line, i.e. 'cache: 40 hits, 2 misses, ...'."""
+    requests = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / requests if requests else 0
+    return (f"cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%} hit rate), "
+            f"{stats['expired']} expired, {stats['evictions']} evicted, {stats['bytes_saved'] / 1e6:.1f} MB not downloaded")
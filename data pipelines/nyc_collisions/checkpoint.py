@@ -0,0 +1,143 @@
+"""
+Time budget and S3 checkpoint for catch-up runs that do not fit in one Lambda invocation.
+
+A daily run that has fallen weeks behind used to fetch everything since the latest day in
+one go; when the invocation timed out, every fetched page was lost and the next run started
+over. Instead, the run now works through windows of whole days:
+
+- before a window starts, the TimeBudget (built from the Lambda context) is asked whether
+  the slowest window so far still fits in the remaining time;
+- a window is fetched, transformed and written, then the checkpoint is saved to
+  '<key_name>/_checkpoint.json' with the cursor (first day not written yet) and the days
+  already written;
+- a window cut short by the deadline is dropped, so the checkpoint only ever points past
+  complete days;
+- days without any crashes are skipped: every window starts on the first day that has
+  data, so a feed that stalled for months costs one lookup instead of an empty window
+  (count, page and checkpoint write) per week.
+
+The next invocation, scheduled or re-invoked, resumes at the cursor. The checkpoint is
+deleted once the run reaches the present.
+"""
+import json
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+CHECKPOINT_NAME = '_checkpoint.json'
+CHECKPOINT_VERSION = 1
+
+# Seconds kept back from the Lambda deadline to save the checkpoint and answer
+DEFAULT_RESERVE_SECONDS = 20
+
+class TimeBudgetExceeded(Exception):
+    """Raised when a slice of work runs into the reserved end of the invocation."""
+
+class TimeBudget:
+    """
+    Time left in the current invocation, from the Lambda context.
+
+    Without a context (a local run) the budget never runs out.
+
+    Args:
+    context: Lambda context object, or anything with get_remaining_time_in_millis().
+    reserve_seconds (float): Seconds kept back for saving the checkpoint.
+    """
+
+    def __init__(self, context=None, reserve_seconds=DEFAULT_RESERVE_SECONDS):
+        self.context = context
+        self.reserve_seconds = reserve_seconds
+
+    def remaining(self):
+        """Return the seconds that can still be spent, inf without a context."""
+        if self.context is None:
+            return float('inf')
+        return self.context.get_remaining_time_in_millis() / 1000 - self.reserve_seconds
+
+    def allows(self, seconds):
+        """Return True if work expected to take `seconds` fits in the remaining time."""
+        return self.remaining() > seconds
+
+    def check(self):
+        """
+        Raises:
+        TimeBudgetExceeded: If the budget has run out.
+        """
+        if self.remaining() <= 0:
+            raise TimeBudgetExceeded(f"Less than {self.reserve_seconds} seconds left in the invocation")
+
+def checkpoint_key(key_name):
+    """Return the key of the checkpoint, i.e. 'collisions_processed_data/_checkpoint.json'."""
+    return f"{key_name}/{CHECKPOINT_NAME}"
+
+def new_checkpoint(cursor):
+    """Start a catch-up run at cursor ('YYYY-MM-DD', the first day to fetch)."""
+    return {
+        'version': CHECKPOINT_VERSION,
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'cursor': cursor,
+        'invocations': 0,
+        'windows': 0,
+        'rows_written': 0,
+        'days_written': [],
+    }
+
+def load_checkpoint(aws_client, bucket_name, key_name):
+    """
+    Read the checkpoint of an unfinished catch-up run.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+
+    Returns:
+    dict: The checkpoint, None if no run is in progress.
+    """
+    try:
+        response = aws_client.get_object(Bucket=bucket_name, Key=checkpoint_key(key_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+def save_checkpoint(aws_client, bucket_name, key_name, checkpoint):
+    """Store the checkpoint, replacing the previous one."""
+    checkpoint['updated_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    aws_client.put_object(
+        Bucket=bucket_name,
+        Key=checkpoint_key(key_name),
+        Body=json.dumps(checkpoint, indent=1, sort_keys=True).encode('utf-8'),
+        ContentType='application/json',
+        )
+
+def clear_checkpoint(aws_client, bucket_name, key_name):
+    """Delete the checkpoint once the run has caught up."""
+    aws_client.delete_object(Bucket=bucket_name, Key=checkpoint_key(key_name))
+
+def iter_date_windows(start_date, end_date, window_days, first_day=None):
+    """
+    Split [start_date, end_date) into windows of whole days.
+
+    Args:
+    start_date (str): First day, 'YYYY-MM-DD'.
+    end_date (datetime): End of the range (excluded), i.e. now.
+    window_days (int): Days per window; the last window ends at end_date.
+    first_day (callable): Called with the start of every window and end_date, returns the
+    first day with data in that range as a datetime, or None if there is none. Windows then
+    start on that day, and stop once there is nothing left. None keeps every window.
+
+    Yields:
+    tuple: (window start, window end) as datetimes.
+    """
+    window_start = datetime.strptime(start_date, '%Y-%m-%d')
+    while window_start < end_date:
+        if first_day is not None:
+            next_day = first_day(window_start, end_date)
+            if next_day is None:
+                return
+            window_start = max(window_start, next_day)
+        window_end = min(window_start + timedelta(days=window_days), end_date)
+        yield window_start, window_end
+        window_start = window_end
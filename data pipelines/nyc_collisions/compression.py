@@ -0,0 +1,252 @@
+"""
+Compression of the CSV objects written to S3: gzip or zstd, streamed, read back transparently.
+
+The raw extracts and the day partitions were uploaded as plain UTF-8 CSV. Collision CSV is
+repetitive text (boroughs, vehicle types, contributing factors, empty fields) and shrinks
+to a fraction with any codec, which cuts the bytes stored, the PUT and GET transfer and
+the time of every read by the ETL, at the cost of some CPU on both sides.
+
+The codec is picked per write with content_encoding ('identity', 'gzip' or 'zstd'), or
+for every writer at once with the S3_CONTENT_ENCODING environment variable; it defaults
+to 'identity', i.e. nothing changes. A compressed object:
+
+- has the codec's extension after the format's, i.e. '2024-01-31.csv.gz';
+- is stored with Content-Type text/csv and Content-Encoding gzip or zstd;
+- is a standard gzip or zstd file: gunzip, zstd -d, pandas and Athena read it as is.
+
+Parquet is never compressed a second time: its pages are already compressed with the
+codec given to the writer, so content_encoding is ignored for it.
+
+CompressingWriter compresses in chunks of chunk_size bytes, each one an independent gzip
+member or zstd frame, so a streaming writer never holds more than one chunk of
+uncompressed and one of compressed bytes on top of its own buffer. Both formats allow a
+file made of several members or frames, and every reader handles it. On the way back,
+readers tell the codec from the key or from the first bytes, so a mix of plain and
+compressed objects under one prefix reads the same.
+"""
+import gzip
+import io
+import os
+import time
+
+import pyarrow as pa
+
+CONTENT_ENCODINGS = ('identity', 'gzip', 'zstd')
+CONTENT_ENCODING_ENV = 'S3_CONTENT_ENCODING'
+
+# Levels picked with benchmarks/bench_compression.py: most of the ratio of the highest ones for a fraction of the CPU
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# Uncompressed bytes per gzip member or zstd frame of a streamed object
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+_EXTENSIONS = {'identity': '', 'gzip': '.gz', 'zstd': '.zst'}
+_MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+def _check_encoding(content_encoding):
+    if content_encoding not in CONTENT_ENCODINGS:
+        raise ValueError(f"Unknown content encoding '{content_encoding}', expected one of {CONTENT_ENCODINGS}")
+
+def resolve_content_encoding(requested=None, output_format='csv'):
+    """
+    Resolve the codec of one write.
+
+    Args:
+    requested (str): 'identity', 'gzip' or 'zstd', None to follow the S3_CONTENT_ENCODING
+    environment variable.
+    output_format (str): 'csv' or 'parquet'. Parquet is always written as it is.
+
+    Returns:
+    str: One of CONTENT_ENCODINGS.
+    """
+    if requested is None:
+        requested = os.environ.get(CONTENT_ENCODING_ENV) or 'identity'
+    _check_encoding(requested)
+    return 'identity' if output_format == 'parquet' else requested
+
+def encoding_extension(content_encoding):
+    """Return the extension added to the key of a compressed object, i.e. '.gz'."""
+    _check_encoding(content_encoding)
+    return _EXTENSIONS[content_encoding]
+
+def encoding_from_key(key_name):
+    """
+    Guess the codec of an S3 object from its key.
+
+    Args:
+    key_name (str): Key of the object, i.e. "collisions_raw_data/'crash_data_set_par.csv.gz'".
+
+    Returns:
+    str: 'gzip' for keys ending in .gz, 'zstd' for .zst, 'identity' otherwise.
+    """
+    key_name = key_name.rstrip("'")
+    for content_encoding in ('gzip', 'zstd'):
+        if key_name.endswith(_EXTENSIONS[content_encoding]):
+            return content_encoding
+    return 'identity'
+
+def strip_encoding_extension(key_name):
+    """Return a key without its codec extension, i.e. '2024-01-31.csv' for '2024-01-31.csv.gz'."""
+    quoted = key_name.endswith("'")
+    key_name = key_name.rstrip("'")
+    extension = _EXTENSIONS[encoding_from_key(key_name)]
+    if extension:
+        key_name = key_name[:-len(extension)]
+    return key_name + ("'" if quoted else '')
+
+def sniff_encoding(data):
+    """Tell the codec of some bytes from their first ones: 'gzip', 'zstd' or 'identity'."""
+    for content_encoding, magic in _MAGIC.items():
+        if bytes(data[:len(magic)]) == magic:
+            return content_encoding
+    return 'identity'
+
+def put_object_kwargs(content_encoding):
+    """Return the extra put_object/create_multipart_upload arguments of a codec, i.e. {'ContentEncoding': 'gzip'}."""
+    _check_encoding(content_encoding)
+    return {} if content_encoding == 'identity' else {'ContentEncoding': content_encoding}
+
+def _codec(content_encoding, level=None):
+    return pa.Codec(content_encoding, compression_level=level or DEFAULT_LEVELS[content_encoding])
+
+# ------------------------------------------ WRITING ------------------------------------------
+def compress_bytes(data, content_encoding, level=None):
+    """
+    Compress bytes into a gzip or zstd file.
+
+    Args:
+    data (bytes): The uncompressed content.
+    content_encoding (str): One of CONTENT_ENCODINGS. 'identity' returns data as it is.
+    level (int): Compression level, None for DEFAULT_LEVELS.
+
+    Returns:
+    bytes: The compressed content.
+    """
+    _check_encoding(content_encoding)
+    if content_encoding == 'identity':
+        return data
+    return _codec(content_encoding, level).compress(data, asbytes=True)
+
+class CompressingWriter:
+    """
+    File-like writer that compresses whatever is written to it into another writer.
+
+    Bytes are gathered until chunk_size of them are there, then compressed as one gzip
+    member or zstd frame and written to the sink. close() compresses what is left but does
+    not close the sink. With 'identity', bytes go to the sink as they come.
+
+    Args:
+    sink: Writer of the compressed bytes, i.e. a MultipartUploadWriter.
+    content_encoding (str): One of CONTENT_ENCODINGS.
+    level (int): Compression level, None for DEFAULT_LEVELS.
+    chunk_size (int): Uncompressed bytes per member or frame.
+    """
+
+    def __init__(self, sink, content_encoding, level=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        _check_encoding(content_encoding)
+        self.sink = sink
+        self.content_encoding = content_encoding
+        self.codec = None if content_encoding == 'identity' else _codec(content_encoding, level)
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.close()
+        return False
+
+    def tell(self):
+        return self.bytes_in
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        """Add bytes to the object, compressing a chunk whenever enough of them are buffered."""
+        self.bytes_in += len(data)
+        if self.codec is None:
+            self._emit(data)
+            return len(data)
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.chunk_size:
+            self._compress_buffer()
+        return len(data)
+
+    def _emit(self, data):
+        self.sink.write(data)
+        self.bytes_out += len(data)
+
+    def _compress_buffer(self):
+        start_time = time.perf_counter()
+        body = self.codec.compress(bytes(self.buffer), asbytes=True)
+        self.compress_seconds += time.perf_counter() - start_time
+        self.buffer = bytearray()
+        self._emit(body)
+
+    def close(self):
+        # An empty object is still a valid (empty) gzip or zstd file
+        if not self.closed and self.codec is not None and (self.buffer or not self.bytes_out):
+            self._compress_buffer()
+        self.closed = True
+
+# ------------------------------------------ READING ------------------------------------------
+def decompress_bytes(data, content_encoding=None):
+    """
+    Decompress the content of an object, if it is compressed.
+
+    Args:
+    data (bytes): The object's content.
+    content_encoding (str): Its codec, None to tell it from the first bytes.
+
+    Returns:
+    bytes: The uncompressed content; data itself when it was not compressed.
+    """
+    content_encoding = content_encoding or sniff_encoding(data)
+    _check_encoding(content_encoding)
+    if content_encoding == 'identity':
+        return data
+    if content_encoding == 'gzip':
+        return gzip.decompress(data)
+    with pa.CompressedInputStream(pa.BufferReader(data), content_encoding) as stream:
+        return stream.read()
+
+class _DecompressingReader(io.RawIOBase):
+    # Sequential file object over a compressed one, for readers (pd.read_csv) that want Python files
+    def __init__(self, raw, content_encoding):
+        super().__init__()
+        self.stream = pa.CompressedInputStream(pa.PythonFile(raw, mode='r'), content_encoding)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super().close()
+
+def open_decompressed(raw, content_encoding):
+    """
+    Wrap a sequential, readable file object so reads return the uncompressed bytes.
+
+    Args:
+    raw: File object over the compressed content, i.e. an S3PrefetchReader.
+    content_encoding (str): One of CONTENT_ENCODINGS. 'identity' returns raw as it is.
+
+    Returns:
+    A readable file object. Closing it closes raw as well.
+    """
+    _check_encoding(content_encoding)
+    if content_encoding == 'identity':
+        return raw
+    return io.BufferedReader(_DecompressingReader(raw, content_encoding))
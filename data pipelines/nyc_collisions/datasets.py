@@ -0,0 +1,137 @@
+"""
+Registry of the Socrata datasets the pipelines load: crashes, persons and vehicles.
+
+NYC publishes every crash in three datasets: the crash itself (h9gi-nx95), one record per
+person involved (f55k-p6yu) and one per vehicle (bm4k-52h4), the last two several times
+larger than the first. Each entry of DATASETS holds what a script needs to load one of
+them: the Socrata id, the unique numeric key to page on, the schema, the raw file it is
+mass uploaded to and the prefix of its processed day partitions.
+
+Person and vehicle records carry the collision_id and crash_date of their crash, so the
+three datasets are partitioned the same way, '<processed_key>/YYYY/MM/YYYY-MM-DD/...', and
+one day of persons only ever joins the same day of crashes. Crashes are stored sorted by
+grid cell within a day (see grid.py); persons and vehicles are stored sorted by
+collision_id, which is what the merge joins of joins.py need.
+
+fetch_datasets runs one download per dataset at the same time. Give every download the
+same AimdController (see parallel.py) and they share one rate budget: together they
+never have more requests in flight than the controller allows.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from nyc_collisions.compression import encoding_extension, resolve_content_encoding
+from nyc_collisions.formats import file_extension
+from nyc_collisions.grid import FINEST_GRID_COLUMN
+from nyc_collisions.schema import (CRASH_COLUMNS, CRASH_DTYPES, PERSON_COLUMNS, PERSON_DTYPES, VEHICLE_COLUMNS,
+                                   VEHICLE_DTYPES)
+
+DATASETS = {
+    'crashes': {
+        'dataset_id': 'h9gi-nx95',
+        'key_column': 'collision_id',
+        'columns': CRASH_COLUMNS,
+        'dtypes': CRASH_DTYPES,
+        'raw_file': 'crash_data_set_par',
+        'processed_key': 'collisions_processed_data',
+        'sort_column': FINEST_GRID_COLUMN,
+    },
+    'persons': {
+        'dataset_id': 'f55k-p6yu',
+        'key_column': 'unique_id',
+        'columns': PERSON_COLUMNS,
+        'dtypes': PERSON_DTYPES,
+        'raw_file': 'person_data_set_par',
+        'processed_key': 'persons_processed_data',
+        'sort_column': 'collision_id',
+    },
+    'vehicles': {
+        'dataset_id': 'bm4k-52h4',
+        'key_column': 'unique_id',
+        'columns': VEHICLE_COLUMNS,
+        'dtypes': VEHICLE_DTYPES,
+        'raw_file': 'vehicle_data_set_par',
+        'processed_key': 'vehicles_processed_data',
+        'sort_column': 'collision_id',
+    },
+}
+
+# The datasets with one or more records per crash, joined to crashes on collision_id
+CHILD_DATASETS = ('persons', 'vehicles')
+
+# Folder of the mass uploads in the bucket, and the formats they can be written in
+RAW_DATA_KEY = 'collisions_raw_data'
+RAW_FORMATS = ('csv', 'parquet')
+
+def get_dataset(name):
+    """Return the registry entry of a dataset, i.e. get_dataset('persons')."""
+    if name not in DATASETS:
+        raise ValueError(f"Unknown dataset '{name}', expected one of {sorted(DATASETS)}")
+    return DATASETS[name]
+
+def raw_file_name(name, output_format='csv', content_encoding='identity'):
+    """Return the file name of a dataset's mass upload, i.e. 'person_data_set_par.csv' or 'person_data_set_par.csv.gz'."""
+    return f"{get_dataset(name)['raw_file']}{file_extension(output_format)}{encoding_extension(content_encoding)}"
+
+def find_raw_file(aws_client, bucket_name, name, content_encoding='identity'):
+    """
+    Return the key of a dataset's mass upload in S3, None if it was never uploaded.
+
+    The mass upload may have written CSV (compressed with content_encoding) or Parquet, so
+    both keys are looked for; if both are there the most recently written one is returned.
+    The keys are the ones multiThread_mass_upload writes; a run that did not load a dataset
+    leaves it without a raw file.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    name (str): Key of the dataset in DATASETS.
+    content_encoding (str): Codec the mass upload ran with, for a CSV upload.
+
+    Returns:
+    str: The key, i.e. "collisions_raw_data/'person_data_set_par.parquet'", or None.
+    """
+    found = []
+    for output_format in RAW_FORMATS:
+        encoding = resolve_content_encoding(content_encoding, output_format)
+        key_name = f"{RAW_DATA_KEY}/'{raw_file_name(name, output_format, encoding)}'"
+        try:
+            head = aws_client.head_object(Bucket=bucket_name, Key=key_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                continue
+            raise
+        found.append((head['LastModified'], key_name))
+    return max(found)[1] if found else None
+
+def fetch_datasets(fetch, names=tuple(DATASETS)):
+    """
+    Run one download per dataset, all of them at the same time.
+
+    Args:
+    fetch (callable): Called with a dataset name on its own thread, returns that
+    dataset's summary. Share one AimdController between the calls to share a rate budget.
+    names (tuple): Names of the datasets to fetch, keys of DATASETS.
+
+    Returns:
+    dict: Run summary with datasets (name to the summary fetch returned), errors (dataset
+    and message) and seconds. A failed dataset does not stop the others.
+    """
+    start_time = time.perf_counter()
+    for name in names:
+        get_dataset(name)
+
+    summaries = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(names) or 1) as executor:
+        futures = {executor.submit(fetch, name): name for name in names}
+        for future, name in futures.items():
+            try:
+                summaries[name] = future.result()
+            except Exception as e:
+                print(f"Error occurred while fetching the {name} dataset: {e}")
+                errors.append({'dataset': name, 'error': str(e)})
+
+    return {'datasets': summaries, 'errors': errors, 'seconds': round(time.perf_counter() - start_time, 3)}
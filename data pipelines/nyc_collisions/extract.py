@@ -0,0 +1,241 @@
+"""
+Streaming extract of the raw files from S3, batch by batch into the transform.
+
+extract_csv_from_s3 reads the whole raw object into bytes, wraps it in a BytesIO (a second
+copy) and lets pd.read_csv build an object-typed frame of every row (a third), before
+transform_data makes the compact typed frame that is actually kept. For the multi-GB
+crash extract the peak is several times the size of the file.
+
+Here the object is read through S3PrefetchReader: a sequential file object backed by
+ranged GETs of block_size bytes, max_workers of them in flight ahead of the reader, so
+the download runs while the previous blocks are parsed. pd.read_csv reads it in batches of
+batch_rows rows, every batch is transformed as soon as it is parsed, and only the
+transformed batches are kept. The raw bytes in memory never exceed (max_workers + 1)
+blocks, and the untyped frame never exceeds one batch. Parquet files are read one
+batch of row groups at a time through ranged reads as well.
+
+A raw CSV compressed with gzip or zstd (a '.csv.gz' or '.csv.zst' key, or a
+Content-Encoding stored with the object, see compression.py) is decompressed on the fly
+between the download and the parser, so only compressed bytes are fetched and buffered.
+
+The transformed batches are concatenated one column at a time, emptying the batches as
+it goes, with the dtype pandas would infer for the whole file (see
+parallel_etl.common_dtypes). The result is the frame the serial extract and transform
+give, row for row and dtype for dtype, and the peak stays close to the size of that
+frame plus one batch.
+"""
+import io
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from nyc_collisions.compression import CONTENT_ENCODINGS, encoding_from_key, open_decompressed
+from nyc_collisions.formats import S3RangeReader, format_from_key
+from nyc_collisions.grid import GRID_LEVELS
+from nyc_collisions.parallel_etl import common_dtypes, merge_transform_reports
+from nyc_collisions.schema import concat_frames
+from nyc_collisions.transform import transform_data
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_PREFETCH_WORKERS = 4
+
+# Rows parsed and transformed at a time
+DEFAULT_BATCH_ROWS = 100000
+
+class S3PrefetchReader(io.RawIOBase):
+    """
+    Read-only, sequential file object over an S3 object, fetched with parallel ranged GETs.
+
+    The object is read in blocks of block_size bytes; up to max_workers blocks are
+    downloaded ahead of the reader and handed out in order. Unlike S3RangeReader it cannot
+    seek, but a reader that goes through the file once never waits for more than one block.
+    The bytes are those stored: a compressed object is not decompressed.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by the download threads.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the object.
+    block_size (int): Bytes per ranged GET.
+    max_workers (int): Blocks downloaded at the same time.
+    """
+
+    def __init__(self, aws_client, bucket_name, key_name, block_size=DEFAULT_BLOCK_SIZE,
+                 max_workers=DEFAULT_PREFETCH_WORKERS):
+        super().__init__()
+        self.aws_client = aws_client
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.block_size = block_size
+        self.max_workers = max_workers
+        head = aws_client.head_object(Bucket=bucket_name, Key=key_name)
+        self.size = head['ContentLength']
+        self.content_encoding = head.get('ContentEncoding')
+        self.bytes_fetched = 0
+        self.requests = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = deque()
+        self.next_start = 0
+        self.block = b''
+        self.offset = 0
+        self._prefetch()
+
+    def _fetch(self, start, end):
+        response = self.aws_client.get_object(Bucket=self.bucket_name, Key=self.key_name, Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    def _prefetch(self):
+        while len(self.pending) < self.max_workers and self.next_start < self.size:
+            end = min(self.size, self.next_start + self.block_size)
+            self.pending.append(self.executor.submit(self._fetch, self.next_start, end))
+            self.next_start = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.offset >= len(self.block):
+            if not self.pending:
+                return 0
+            self.block = self.pending.popleft().result()
+            self.offset = 0
+            self.bytes_fetched += len(self.block)
+            self.requests += 1
+            self._prefetch()
+        size = min(len(buffer), len(self.block) - self.offset)
+        buffer[:size] = self.block[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.pending.clear()
+            self.block = b''
+        super().close()
+
+def iter_raw_batches(aws_client, bucket_name, key_name, batch_rows=DEFAULT_BATCH_ROWS, block_size=DEFAULT_BLOCK_SIZE,
+                     max_workers=DEFAULT_PREFETCH_WORKERS, counters=None):
+    """
+    Yield the raw file in DataFrames of batch_rows rows, without reading the whole object.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the raw CSV or Parquet object. A CSV compressed with gzip or zstd
+    is decompressed as it is read.
+    batch_rows (int): Rows per batch (for Parquet, rows per batch within a row group).
+    block_size (int): Bytes per ranged GET of a CSV object.
+    max_workers (int): Ranged GETs of a CSV object in flight at the same time.
+    counters (dict): Optional dict that gets bytes_fetched (as stored, i.e. compressed) and
+    requests added once the object has been read.
+
+    Yields:
+    pandas.DataFrame: The next rows, parsed like pd.read_csv (CSV) or with the stored types (Parquet).
+    """
+    if format_from_key(key_name) == 'parquet':
+        reader = S3RangeReader(aws_client, bucket_name, key_name)
+        with reader:
+            for batch in pq.ParquetFile(reader).iter_batches(batch_size=batch_rows):
+                yield batch.to_pandas()
+    else:
+        reader = S3PrefetchReader(aws_client, bucket_name, key_name, block_size=block_size, max_workers=max_workers)
+        content_encoding = encoding_from_key(key_name)
+        if content_encoding == 'identity' and reader.content_encoding in CONTENT_ENCODINGS:
+            content_encoding = reader.content_encoding
+        source = open_decompressed(io.BufferedReader(reader), content_encoding)
+        with reader, pd.read_csv(source, chunksize=batch_rows) as batches:
+            yield from batches
+
+    if counters is not None:
+        counters['bytes_fetched'] = counters.get('bytes_fetched', 0) + reader.bytes_fetched
+        counters['requests'] = counters.get('requests', 0) + reader.requests
+
+def concat_batches(frames, target_dtypes):
+    """
+    Concatenate transformed batches one column at a time, emptying the batches as it goes.
+
+    pd.concat holds every batch and the whole result at the same time, twice the memory of
+    the data. Taking the columns out of the batches one by one, only one column is ever
+    held twice.
+
+    Args:
+    frames (list): DataFrames with the same columns, emptied in place.
+    target_dtypes (dict): Column name to dtype, as returned by common_dtypes.
+
+    Returns:
+    pandas.DataFrame: The rows of every batch, in order, with a fresh RangeIndex.
+    """
+    columns = {}
+    for column in list(frames[0].columns):
+        parts = [frame.pop(column) for frame in frames]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            # concat_frames unifies the categories, pd.concat would fall back to object
+            columns[column] = concat_frames([part.to_frame() for part in parts])[column]
+        else:
+            dtype = target_dtypes[column]
+            columns[column] = pd.concat([part if part.dtype == dtype else part.astype(dtype) for part in parts],
+                                        ignore_index=True)
+        del parts
+    return pd.DataFrame(columns, copy=False)
+
+def stream_transform_from_s3(aws_client, bucket_name, key_name, date_column_name='crash_date',
+                             time_column_name='crash_time', fill_boroughs=True, grid_levels=GRID_LEVELS,
+                             batch_rows=DEFAULT_BATCH_ROWS, block_size=DEFAULT_BLOCK_SIZE,
+                             max_workers=DEFAULT_PREFETCH_WORKERS):
+    """
+    Extract a raw file and transform it batch by batch, keeping only the transformed rows.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the raw CSV or Parquet object.
+    date_column_name (str): Name of the column containing the date information.
+    time_column_name (str): Name of the column containing the 'H:MM' time information.
+    fill_boroughs (bool): Passed to transform_data.
+    grid_levels (tuple): Passed to transform_data.
+    batch_rows (int): Rows parsed and transformed at a time.
+    block_size (int): Bytes per ranged GET of a CSV object.
+    max_workers (int): Ranged GETs of a CSV object in flight at the same time.
+
+    Returns:
+    tuple: The transformed DataFrame, as transform_data would return it for the whole file,
+    and a report with batches, rows, bytes_fetched, requests, seconds and transform (as
+    print_transform_report expects).
+    """
+    start_time = time.perf_counter()
+    counters = {}
+    frames = []
+    reports = []
+    dtypes = []
+    for batch in iter_raw_batches(aws_client, bucket_name, key_name, batch_rows=batch_rows, block_size=block_size,
+                                  max_workers=max_workers, counters=counters):
+        frame, report = transform_data(batch, date_column_name, time_column_name, fill_boroughs=fill_boroughs,
+                                       grid_levels=grid_levels)
+        del batch
+        dtypes.append({column: (frame[column].dtype, bool(frame[column].isna().all())) for column in frame.columns})
+        frames.append(frame)
+        reports.append(report)
+
+    if not frames:
+        raise ValueError(f"{key_name} has no rows")
+    df = concat_batches(frames, common_dtypes(dtypes))
+
+    seconds = time.perf_counter() - start_time
+    return df, {
+        'batches': len(reports),
+        'rows': len(df),
+        'bytes_fetched': counters.get('bytes_fetched', 0),
+        'requests': counters.get('requests', 0),
+        'seconds': round(seconds, 3),
+        'transform': merge_transform_reports(reports, seconds),
+    }
+
+def format_extract_report(report):
+    """Render the report of stream_transform_from_s3 as one line."""
+    return (f"Streamed {report['rows']} rows in {report['batches']} batches from {report['bytes_fetched'] / 1e6:.1f} MB "
+            f"({report['requests']} ranged GETs) in {report['seconds']} seconds")
@@ -0,0 +1,230 @@
+"""
+Output formats for the collision data stored in S3: CSV or Parquet.
+
+CSV keeps the files readable by anything, but every reader has to re-parse text and
+re-infer dtypes. Parquet stores typed, compressed columns in row groups with min/max
+statistics, so a reader can fetch only the columns it needs and skip row groups that
+cannot match a filter.
+"""
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from nyc_collisions.compression import decompress_bytes, strip_encoding_extension
+from nyc_collisions.schema import _as_text
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+PARQUET_CODECS = ('snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none')
+
+# Rows per Parquet row group: small enough for predicate pushdown to skip data, large enough to compress well
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+
+# Rows rendered per to_csv call when a DataFrame is written into a stream
+CSV_WRITE_ROWS = 50_000
+
+_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+_CONTENT_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+def _check_format(output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}")
+
+def file_extension(output_format):
+    """Return the file extension used for an output format, i.e. '.parquet'."""
+    _check_format(output_format)
+    return _EXTENSIONS[output_format]
+
+def content_type(output_format):
+    """Return the Content-Type stored with objects of an output format."""
+    _check_format(output_format)
+    return _CONTENT_TYPES[output_format]
+
+def format_from_key(key_name):
+    """
+    Guess the format of an S3 object from its key.
+
+    Args:
+    key_name (str): Key of the object, i.e. 'collisions_raw_data/crash_data_set_par.parquet'.
+    A compression extension is ignored: '...csv.gz' is CSV.
+
+    Returns:
+    str: 'parquet' for keys ending in .parquet, 'csv' otherwise.
+    """
+    return 'parquet' if strip_encoding_extension(key_name).rstrip("'").endswith('.parquet') else 'csv'
+
+# ------------------------------------------ WRITING ------------------------------------------
+def parquet_codec(compression):
+    """Translate a codec name from PARQUET_CODECS into the value pyarrow expects."""
+    if compression not in PARQUET_CODECS:
+        raise ValueError(f"Unknown Parquet codec '{compression}', expected one of {PARQUET_CODECS}")
+    return None if compression == 'none' else compression
+
+def write_dataframe(df, sink, output_format='csv', compression='snappy', row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Serialize a DataFrame as a CSV or Parquet file into a binary writer.
+
+    CSV is rendered CSV_WRITE_ROWS rows at a time and Parquet one row group at a time, so
+    writing through a compression.CompressingWriter never holds the whole uncompressed file
+    next to its compressed copy. The bytes are the same as serialize_dataframe's.
+
+    Args:
+    df (pandas.DataFrame): The DataFrame to serialize.
+    sink: Writer of the file content, i.e. a CompressingWriter or an io.BytesIO.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec, one of PARQUET_CODECS. Ignored for CSV.
+    row_group_size (int): Rows per Parquet row group. Ignored for CSV.
+    """
+    _check_format(output_format)
+    if output_format == 'csv':
+        # One pass even for an empty frame, which still gets its header
+        for start in range(0, max(len(df), 1), CSV_WRITE_ROWS):
+            chunk = df.iloc[start:start + CSV_WRITE_ROWS]
+            sink.write(chunk.to_csv(index=False, header=start == 0).encode('utf-8'))
+        return
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, sink, compression=parquet_codec(compression), row_group_size=row_group_size)
+
+def serialize_dataframe(df, output_format='csv', compression='snappy', row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Serialize a DataFrame into the bytes of a CSV or Parquet file.
+
+    Args:
+    df (pandas.DataFrame): The DataFrame to serialize.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec, one of PARQUET_CODECS. Ignored for CSV.
+    row_group_size (int): Rows per Parquet row group. Ignored for CSV.
+
+    Returns:
+    bytes: The file content.
+    """
+    buffer = io.BytesIO()
+    write_dataframe(df, buffer, output_format, compression, row_group_size)
+    return buffer.getvalue()
+
+def records_to_table(records, columns):
+    """
+    Turn a page of raw Socrata records into an Arrow table with one string column per name.
+
+    Every page gets the exact same schema, which is what a streaming Parquet writer needs
+    even when a page happens to be missing a column altogether.
+
+    Args:
+    records (list): Records as returned by the Socrata API.
+    columns (list): Column names, in output order.
+
+    Returns:
+    pyarrow.Table: The page as a table of strings.
+    """
+    return pa.table({column: pa.array([_as_text(record.get(column)) for record in records], pa.string())
+                     for column in columns})
+
+def raw_arrow_schema(columns):
+    """Return the all-string Arrow schema produced by records_to_table."""
+    return pa.schema([(column, pa.string()) for column in columns])
+
+# ------------------------------------------ READING ------------------------------------------
+class S3RangeReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object, backed by ranged GET requests.
+
+    Parquet readers only need the footer plus the column chunks they are asked for, so
+    reading through this class downloads a fraction of the object when columns are pruned
+    or row groups are skipped.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the object.
+    """
+
+    def __init__(self, aws_client, bucket_name, key_name):
+        super().__init__()
+        self.aws_client = aws_client
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.size = aws_client.head_object(Bucket=bucket_name, Key=key_name)['ContentLength']
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size=-1):
+        if self.position >= self.size:
+            return b''
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        response = self.aws_client.get_object(Bucket=self.bucket_name, Key=self.key_name,
+                                              Range=f"bytes={self.position}-{end - 1}")
+        data = response['Body'].read()
+        self.position += len(data)
+        self.bytes_fetched += len(data)
+        self.requests += 1
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def read_parquet_from_s3(aws_client, bucket_name, key_name, columns=None, filters=None):
+    """
+    Read a Parquet object from S3, fetching only the columns and row groups that are needed.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the Parquet object.
+    columns (list): Columns to read, None for all of them.
+    filters (list): Predicates pushed down to the reader in pyarrow's DNF form,
+    i.e. [('crash_date', '>=', '2024-01-01')]. Row groups whose statistics rule the
+    predicate out are never downloaded.
+
+    Returns:
+    pandas.DataFrame: The matching rows.
+    """
+    with S3RangeReader(aws_client, bucket_name, key_name) as source:
+        table = pq.read_table(source, columns=columns, filters=filters)
+    return table.to_pandas()
+
+def read_dataframe(data, input_format='csv', columns=None, filters=None, dtype=None):
+    """
+    Read CSV or Parquet bytes into a DataFrame.
+
+    Bytes compressed with gzip or zstd (see compression.py) are decompressed first, whatever
+    the key they came from.
+
+    Args:
+    data (bytes or file-like): The file content. File objects are read as they are.
+    input_format (str): 'csv' or 'parquet'.
+    columns (list): Columns to read, None for all of them.
+    filters (list): Parquet predicates in pyarrow's DNF form. Ignored for CSV.
+    dtype (dict): Column name to dtype for CSV, i.e. to keep zip codes as text. Ignored for
+    Parquet, which stores its own types.
+
+    Returns:
+    pandas.DataFrame: The data.
+    """
+    _check_format(input_format)
+    source = io.BytesIO(decompress_bytes(data)) if isinstance(data, (bytes, bytearray)) else data
+    if input_format == 'csv':
+        return pd.read_csv(source, usecols=columns, dtype=dtype)
+    return pq.read_table(source, columns=columns, filters=filters).to_pandas()
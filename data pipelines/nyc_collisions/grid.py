@@ -0,0 +1,233 @@
+"""
+Spatial grid over New York City: a precomputed cell id for every crash.
+
+The city's bounding box is cut into square cells of BASE_CELL_DEGREES, halved at every
+level, so a cell at level n + 1 lies in exactly one cell at level n (row // 2, col // 2).
+The cell id is row * columns + col, numbered from the south-west corner:
+
+    level 0: 0.04 degrees, ~4.4 km north-south
+    level 2: 0.01 degrees, ~1.1 km
+    level 4: 0.0025 degrees, ~280 m
+
+transform_data adds one grid_cell_<level> column per level in GRID_LEVELS and a
+geo_status column. Crashes without coordinates, at (0, 0) or outside the box are flagged
+there and get no cell. write_partitions sorts every day by the finest cell.
+
+Cells of one grid row have consecutive ids, so a bounding box is a handful of id ranges,
+one per grid row. A CellIndex holds the cell ids of a frame in sorted order; query_bbox
+finds each range in it with a binary search and only looks at the coordinates of the rows
+in it. For Parquet, bbox_filters turns the ranges into row-group filters for
+read_parquet_from_s3, which pay off on files sorted by cell.
+"""
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+# Slightly larger than the five boroughs
+NYC_BOUNDS = {'min_lat': 40.47, 'max_lat': 40.93, 'min_lon': -74.27, 'max_lon': -73.68}
+BASE_CELL_DEGREES = 0.04
+GRID_LEVELS = (0, 2, 4)
+
+GEO_STATUS_COLUMN = 'geo_status'
+# Categories of geo_status, in code order
+GEO_STATUSES = ['ok', 'missing', 'zero', 'out_of_bounds']
+
+def grid_column(level):
+    """Return the name of the cell id column of a level, i.e. 'grid_cell_4'."""
+    return f"grid_cell_{level}"
+
+# Partitions are sorted by this column
+FINEST_GRID_COLUMN = grid_column(max(GRID_LEVELS))
+
+def cell_degrees(level):
+    return BASE_CELL_DEGREES / 2 ** level
+
+def grid_shape(level):
+    """Return (rows, columns) of the grid at a level."""
+    size = cell_degrees(level)
+    return (math.ceil(round((NYC_BOUNDS['max_lat'] - NYC_BOUNDS['min_lat']) / size, 9)),
+            math.ceil(round((NYC_BOUNDS['max_lon'] - NYC_BOUNDS['min_lon']) / size, 9)))
+
+def _row_col(latitude, longitude, level):
+    size = cell_degrees(level)
+    rows, columns = grid_shape(level)
+    row = np.clip(np.floor((np.asarray(latitude, dtype='float64') - NYC_BOUNDS['min_lat']) / size), 0, rows - 1)
+    col = np.clip(np.floor((np.asarray(longitude, dtype='float64') - NYC_BOUNDS['min_lon']) / size), 0, columns - 1)
+    return row.astype(np.int32), col.astype(np.int32)
+
+def cell_ids(latitude, longitude, level):
+    """
+    Return the cell id of every point. The points are assumed to be inside NYC_BOUNDS.
+
+    Args:
+    latitude (array-like): Latitudes.
+    longitude (array-like): Longitudes.
+    level (int): Grid level.
+
+    Returns:
+    numpy.ndarray: int32 cell ids.
+    """
+    row, col = _row_col(latitude, longitude, level)
+    return row * np.int32(grid_shape(level)[1]) + col
+
+def geo_status_codes(latitude, longitude):
+    """Return the GEO_STATUSES position of every point: ok, missing, zero or out_of_bounds."""
+    latitude = np.asarray(latitude, dtype='float64')
+    longitude = np.asarray(longitude, dtype='float64')
+    missing = np.isnan(latitude) | np.isnan(longitude)
+    # Socrata has many crashes geocoded to (0, 0), or with only one of the two set to 0
+    with np.errstate(invalid='ignore'):
+        zero = ~missing & ((latitude == 0) | (longitude == 0))
+        inside = ((latitude >= NYC_BOUNDS['min_lat']) & (latitude <= NYC_BOUNDS['max_lat'])
+                  & (longitude >= NYC_BOUNDS['min_lon']) & (longitude <= NYC_BOUNDS['max_lon']))
+    codes = np.zeros(len(latitude), dtype=np.int8)
+    codes[~inside] = 3
+    codes[zero] = 2
+    codes[missing] = 1
+    return codes
+
+def add_grid_cells(dataset, levels=GRID_LEVELS, latitude_column_name='latitude', longitude_column_name='longitude'):
+    """
+    Add the geo_status column and one nullable Int32 grid_cell_<level> column per level.
+
+    Args:
+    dataset (pandas.DataFrame): The dataset, changed in place.
+    levels (tuple): Grid levels to add.
+    latitude_column_name (str): The name of the latitude column.
+    longitude_column_name (str): The name of the longitude column.
+
+    Returns:
+    dict: Report with rows, one count per geo status, seconds and rows_per_second. None if the
+    dataset has no coordinates.
+    """
+    if latitude_column_name not in dataset.columns or longitude_column_name not in dataset.columns:
+        return None
+    start_time = time.perf_counter()
+    latitude = pd.to_numeric(dataset[latitude_column_name], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    longitude = pd.to_numeric(dataset[longitude_column_name], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+    status = geo_status_codes(latitude, longitude)
+    ok = status == 0
+    dataset[GEO_STATUS_COLUMN] = pd.Categorical.from_codes(status, categories=GEO_STATUSES)
+    for level in levels:
+        ids = np.zeros(len(dataset), dtype=np.int32)
+        ids[ok] = cell_ids(latitude[ok], longitude[ok], level)
+        dataset[grid_column(level)] = pd.arrays.IntegerArray(ids, mask=~ok)
+
+    seconds = time.perf_counter() - start_time
+    counts = np.bincount(status, minlength=len(GEO_STATUSES))
+    return {
+        'rows': len(dataset),
+        **{name: int(count) for name, count in zip(GEO_STATUSES, counts)},
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(len(dataset) / seconds) if seconds else None,
+    }
+
+def format_grid_report(report):
+    """Render the report of add_grid_cells as one line."""
+    return (f"Coordinates: {report['ok']} in a grid cell, {report['missing']} missing, {report['zero']} at zero, "
+            f"{report['out_of_bounds']} outside New York City, {report['seconds']} seconds")
+
+# ------------------------------------------ QUERIES ------------------------------------------
+def cell_ranges(bbox, level):
+    """
+    Return the cell ids covering a bounding box, as one (first, last) range per grid row.
+
+    Args:
+    bbox (tuple): (min_lat, min_lon, max_lat, max_lon).
+    level (int): Grid level.
+
+    Returns:
+    list: (first id, last id) pairs, both included. Empty if the box misses the city.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if (max_lat < NYC_BOUNDS['min_lat'] or min_lat > NYC_BOUNDS['max_lat']
+            or max_lon < NYC_BOUNDS['min_lon'] or min_lon > NYC_BOUNDS['max_lon']):
+        return []
+    (first_row, last_row), (first_col, last_col) = _row_col([min_lat, max_lat], [min_lon, max_lon], level)
+    columns = grid_shape(level)[1]
+    return [(int(row * columns + first_col), int(row * columns + last_col)) for row in range(first_row, last_row + 1)]
+
+def bbox_filters(bbox, level=max(GRID_LEVELS)):
+    """
+    Return pyarrow DNF filters selecting the cells of a bounding box, for read_parquet_from_s3.
+
+    Row groups of a file sorted by the cell column whose statistics miss every range are not
+    downloaded. The cells on the edge of the box also hold rows just outside it, so the
+    result still needs in_bbox.
+    """
+    column = grid_column(level)
+    return [[(column, '>=', first), (column, '<=', last)] for first, last in cell_ranges(bbox, level)]
+
+def in_bbox(dataset, bbox, latitude_column_name='latitude', longitude_column_name='longitude'):
+    """Return the boolean mask of the rows whose coordinates are inside the bounding box."""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    latitude = dataset[latitude_column_name].to_numpy(dtype='float64', na_value=np.nan)
+    longitude = dataset[longitude_column_name].to_numpy(dtype='float64', na_value=np.nan)
+    with np.errstate(invalid='ignore'):
+        return (latitude >= min_lat) & (latitude <= max_lat) & (longitude >= min_lon) & (longitude <= max_lon)
+
+def sort_by_cell(dataset, level=max(GRID_LEVELS)):
+    """Return the dataset sorted by its cell id at a level (rows without a cell last), stable."""
+    return dataset.sort_values(grid_column(level), kind='stable', na_position='last')
+
+class CellIndex:
+    """
+    Row positions of a dataset ordered by grid cell, built once and shared by every query.
+
+    On a dataset sorted by the cell column (sort_by_cell, or a partition as written) the
+    rows of a range are next to each other; otherwise they are gathered from all over it.
+
+    Args:
+    dataset (pandas.DataFrame): Crashes with their grid_cell_<level> column.
+    level (int): Grid level whose column is indexed.
+    """
+
+    def __init__(self, dataset, level=max(GRID_LEVELS)):
+        # Rows without a cell sort past every real id
+        cells = dataset[grid_column(level)].to_numpy(dtype='int64', na_value=np.iinfo(np.int64).max)
+        self.level = level
+        self.order = np.argsort(cells, kind='stable')
+        self.cells = cells[self.order]
+
+    def positions(self, ranges):
+        """Return the positions, in dataset order, of the rows whose cell id falls in any of the (first, last) ranges."""
+        if not ranges:
+            return np.array([], dtype=np.int64)
+        starts = np.searchsorted(self.cells, [first for first, _ in ranges], side='left')
+        ends = np.searchsorted(self.cells, [last for _, last in ranges], side='right')
+        return np.sort(np.concatenate([self.order[start:end] for start, end in zip(starts, ends)]))
+
+def query_bbox(dataset, bbox, index=None):
+    """
+    Return the rows of a dataset inside a bounding box, looking only at the rows of its cells.
+
+    Args:
+    dataset (pandas.DataFrame): Crashes with grid cells.
+    bbox (tuple): (min_lat, min_lon, max_lat, max_lon).
+    index (CellIndex): Index of the dataset. Building it sorts the cell ids, so build it once
+    and pass it to every query on the same dataset; None builds one at the finest level.
+
+    Returns:
+    pandas.DataFrame: The matching rows, in the dataset's order.
+    """
+    index = index if index is not None else CellIndex(dataset)
+    candidates = dataset.iloc[index.positions(cell_ranges(bbox, index.level))]
+    return candidates[in_bbox(candidates, bbox)]
+
+def nearest_cells(latitude, longitude, level=max(GRID_LEVELS), rings=1):
+    """
+    Return the cell holding a point and the cells within `rings` cells of it.
+
+    Returns:
+    list: (first id, last id) ranges, one per grid row, as cell_ranges returns them.
+    """
+    size = cell_degrees(level) * rings
+    return cell_ranges((latitude - size, longitude - size, latitude + size, longitude + size), level)
+
+def query_near(dataset, latitude, longitude, rings=1, index=None):
+    """Return the rows of a dataset in the cell of a point and the `rings` cells around it (see query_bbox for index)."""
+    index = index if index is not None else CellIndex(dataset)
+    return dataset.iloc[index.positions(nearest_cells(latitude, longitude, index.level, rings))]
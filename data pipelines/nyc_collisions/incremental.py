@@ -0,0 +1,244 @@
+"""
+Incremental, idempotent daily updates driven by Socrata's ':updated_at' system field.
+
+The date-based daily run re-downloads every record since the latest day folder and
+overwrites that day wholesale, and it never sees late-arriving or edited records for
+older days (NYPD revises crashes long after they are published). Here every run asks
+only for the records whose ':updated_at' is past the high-water mark kept in the
+partition manifest:
+
+    WHERE :updated_at > '<high-water mark>' ORDER BY collision_id LIMIT n
+
+The changed records are transformed, grouped by crash day and merged into just those
+day partitions by collision_id (the newer version of a record wins), so a run costs
+O(changes) instead of O(days since the last folder). The high-water mark only moves
+forward once every partition has been written, and merging the same records twice
+gives the same files, so a failed or repeated run is safe to run again.
+
+Pages come in collision_id order, not ':updated_at' order, so a record revised while a
+run is paging may be revised behind the cursor and never seen by that run. The new
+high-water mark is therefore capped at the time the run started, minus a small overlap
+for clock skew: anything revised during the run is fetched again by the next one.
+
+A record whose crash_date was edited lands in its new day; the copy in the old day is
+left where it is, since finding it would mean reading every partition.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from nyc_collisions.formats import format_from_key, read_dataframe
+from nyc_collisions.grid import FINEST_GRID_COLUMN, GEO_STATUS_COLUMN, GRID_LEVELS, add_grid_cells, grid_column
+from nyc_collisions.manifest import get_high_water_mark, latest_date, load_or_rebuild_manifest, update_manifest
+from nyc_collisions.paging import KEY_COLUMN, iter_keyset_pages
+from nyc_collisions.partitions import DEFAULT_UPLOAD_WORKERS, iter_date_partitions, write_day_partitions
+from nyc_collisions.rollups import format_rollup_report, update_rollups
+from nyc_collisions.schema import CRASH_DTYPES, apply_schema, concat_frames, records_to_frame
+from nyc_collisions.transform import print_transform_report, transform_data
+
+UPDATED_AT = ':updated_at'
+
+# Format of the ':updated_at' values served by Socrata, i.e. '2024-02-01T10:00:00.000Z'
+UPDATED_AT_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+# How far behind the start of a run its high-water mark is kept, to cover clock skew
+# between us and Socrata and records committed while the run was paging
+HIGH_WATER_MARK_OVERLAP = timedelta(minutes=5)
+
+# Dtypes of a stored partition: the crash schema plus the columns added by transform_data
+PARTITION_DTYPES = {
+    **CRASH_DTYPES,
+    'date_time': 'datetime64[ns]',
+    'crash_year': 'Int16',
+    'crash_month': 'Int8',
+    'crash_day': 'Int8',
+    'crash_hour': 'Int8',
+    'crash_minute': 'Int8',
+    GEO_STATUS_COLUMN: 'category',
+    **{grid_column(level): 'Int32' for level in GRID_LEVELS},
+}
+
+# Text columns are read back from CSV as text, so zip codes do not turn into numbers
+_CSV_DTYPES = {column: str for column, dtype in PARTITION_DTYPES.items() if dtype in ('category', 'string')}
+
+# ------------------------------------------ FETCHING CHANGES ------------------------------------------
+def fetch_changed_records(socrata_client, dataset_name, since, chunk_size=3000, overlap=HIGH_WATER_MARK_OVERLAP):
+    """
+    Fetch the records created or edited after a high-water mark.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to query.
+    since (str): High-water mark, an ':updated_at' value or a 'YYYY-MM-DD' date.
+    chunk_size (int): Records per request.
+    overlap (timedelta): How far before the start of the run the new high-water mark is capped.
+
+    Returns:
+    tuple: The typed records as a DataFrame (without the ':updated_at' column), the new
+    high-water mark and the number of pages fetched. The mark is the newest ':updated_at'
+    seen, capped at the start of the run minus overlap, and never earlier than since.
+    """
+    ceiling = (datetime.now(timezone.utc) - overlap).strftime(UPDATED_AT_FORMAT)
+    frames = []
+    high_water_mark = since
+    pages = 0
+    for page in iter_keyset_pages(
+        socrata_client,
+        dataset_name,
+        chunk_size=chunk_size,
+        where=f"{UPDATED_AT} > '{since}'",
+        select=f"{UPDATED_AT}, *"
+        ):
+        pages += 1
+        high_water_mark = max([high_water_mark] + [record[UPDATED_AT] for record in page if UPDATED_AT in record])
+        frames.append(records_to_frame(page))
+
+    # Records revised behind the collision_id cursor while we were paging are newer than the
+    # ceiling, so the next run asks for them again instead of skipping them for good
+    high_water_mark = max(since, min(high_water_mark, ceiling))
+    return concat_frames(frames), high_water_mark, pages
+
+# ------------------------------------------ MERGING ------------------------------------------
+def merge_partition(existing_df, changes_df, key_column=KEY_COLUMN):
+    """
+    Upsert changed records into the rows of one partition.
+
+    Args:
+    existing_df (pandas.DataFrame): The partition as stored (CSV or Parquet).
+    changes_df (pandas.DataFrame): Transformed records for the same day.
+    key_column (str): Unique key of a record.
+
+    Returns:
+    pandas.DataFrame: One row per key, the changed version replacing the stored one,
+    sorted by key.
+    """
+    columns = list(changes_df.columns) + [column for column in existing_df.columns if column not in changes_df.columns]
+    frames = [apply_schema(df.reindex(columns=columns), PARTITION_DTYPES) for df in (existing_df, changes_df)]
+    merged = concat_frames(frames, columns, PARTITION_DTYPES)
+    merged = merged.drop_duplicates(subset=key_column, keep='last')
+    if FINEST_GRID_COLUMN not in existing_df.columns:
+        # Partition written before the grid: its old rows get their cells too
+        add_grid_cells(merged)
+    return merged.sort_values(key_column, kind='stable', ignore_index=True)
+
+def upsert_partitions(aws_client, bucket_name, key_name, changes_df, date_column_name='crash_date', manifest=None,
+                      output_format='csv', compression='snappy', max_workers=DEFAULT_UPLOAD_WORKERS,
+                      high_water_mark=None, rollups=True):
+    """
+    Merge transformed records into the day partitions they belong to, rewriting only those days.
+
+    Existing partitions are located through the manifest and read concurrently; days the
+    manifest does not know yet are written from the changes alone. An existing day is
+    rewritten under the key it is stored under, in its format and codec; new days are
+    written in output_format and the S3_CONTENT_ENCODING codec.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+    changes_df (pandas.DataFrame): Records as returned by transform_data.
+    date_column_name (str): Name of the column containing the date information.
+    manifest (dict): The current manifest, loaded if not given.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Partitions read and written at the same time.
+    high_water_mark (str): Stored in the manifest, but only if every partition was written.
+    rollups (bool): Recompute the dashboard rollups of the days written (see rollups.py).
+
+    Returns:
+    dict: The write_partitions report, plus inserted and updated record counts, the
+    number of existing partitions read and the update_rollups report (None if skipped).
+    """
+    if manifest is None:
+        manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name)
+
+    def merge_day(day):
+        date, day_changes = day
+        entry = manifest['partitions'].get(f"{date:%Y-%m-%d}")
+        if entry is None:
+            return date, day_changes, 0, False
+        body = aws_client.get_object(Bucket=bucket_name, Key=entry['key'])['Body'].read()
+        existing_df = read_dataframe(body, format_from_key(entry['key']), dtype=_CSV_DTYPES)
+        updated = int(day_changes[KEY_COLUMN].isin(existing_df[KEY_COLUMN]).sum())
+        return date, merge_partition(existing_df, day_changes), updated, True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        merged_days = list(executor.map(merge_day, iter_date_partitions(changes_df, date_column_name)))
+
+    report = write_day_partitions(aws_client, bucket_name, key_name, [(date, day_df) for date, day_df, _, _ in merged_days],
+                                  output_format=output_format, compression=compression, max_workers=max_workers,
+                                  keys={date: entry['key'] for date, entry in manifest['partitions'].items() if entry.get('key')})
+
+    # A failed day keeps the old high-water mark, so its records are fetched again next time
+    update_manifest(aws_client, bucket_name, key_name, report['partitions'],
+                    high_water_mark=None if report['errors'] else high_water_mark)
+
+    # The merged frames hold every row of their day, so their rollups replace the stored ones
+    report['rollups'] = None
+    if rollups and report['partitions']:
+        report['rollups'] = update_rollups(aws_client, bucket_name, key_name,
+                                           concat_frames([day_df for _, day_df, _, _ in merged_days]),
+                                           date_column_name, days=[partition['date'] for partition in report['partitions']],
+                                           output_format=output_format, max_workers=max_workers)
+
+    report['updated'] = sum(updated for _, _, updated, _ in merged_days)
+    report['inserted'] = len(changes_df) - report['updated']
+    report['partitions_read'] = sum(read for _, _, _, read in merged_days)
+    return report
+
+# ------------------------------------------ RUNNING AN UPDATE ------------------------------------------
+def run_incremental_update(socrata_client, aws_client, dataset_name, bucket_name, key_name, output_format='csv',
+                           compression='snappy', chunk_size=3000, max_workers=DEFAULT_UPLOAD_WORKERS):
+    """
+    Fetch the records changed since the last run and upsert them into their day partitions.
+
+    The first run has no high-water mark yet and starts from the latest partition date.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    aws_client: Boto3 client for AWS S3.
+    dataset_name (str): Name of the dataset to query.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    chunk_size (int): Records per Socrata request.
+    max_workers (int): Partitions read and written at the same time.
+
+    Returns:
+    dict: since, high_water_mark, pages fetched, changed records, inserted, updated,
+    partitions_read, partitions_written, rollup_slices, errors and seconds.
+    """
+    start_time = time.perf_counter()
+    manifest = load_or_rebuild_manifest(aws_client, bucket_name, key_name)
+    since = get_high_water_mark(manifest) or latest_date(manifest)
+    if since is None:
+        raise ValueError(f"No partitions found under '{bucket_name}/{key_name}': run a full load first")
+
+    changes_df, high_water_mark, pages = fetch_changed_records(socrata_client, dataset_name, since, chunk_size)
+    summary = {'since': since, 'high_water_mark': high_water_mark, 'pages': pages, 'changed': len(changes_df),
+               'inserted': 0, 'updated': 0, 'partitions_read': 0, 'partitions_written': 0, 'rollup_slices': 0, 'errors': []}
+
+    if len(changes_df):
+        changes_df, transform_report = transform_data(changes_df, 'crash_date', 'crash_time')
+        print_transform_report(transform_report)
+        report = upsert_partitions(aws_client, bucket_name, key_name, changes_df, 'crash_date', manifest=manifest,
+                                   output_format=output_format, compression=compression, max_workers=max_workers,
+                                   high_water_mark=high_water_mark)
+        summary.update(inserted=report['inserted'], updated=report['updated'], partitions_read=report['partitions_read'],
+                       partitions_written=len(report['partitions']), errors=report['errors'])
+        if report['rollups']:
+            print(format_rollup_report(report['rollups']))
+            summary['rollup_slices'] = len(report['rollups']['slices'])
+        if report['errors']:
+            summary['high_water_mark'] = since
+
+    summary['seconds'] = round(time.perf_counter() - start_time, 3)
+    return summary
+
+def print_incremental_report(summary):
+    """Print the outcome of run_incremental_update."""
+    print(f"Incremental update since {summary['since']}: {summary['changed']} changed records in {summary['pages']} pages")
+    print(f"Inserted {summary['inserted']}, updated {summary['updated']}; rewrote {summary['partitions_written']} partitions "
+          f"({summary['partitions_read']} read back), {len(summary['errors'])} failed, in {summary['seconds']} seconds")
+    print(f"High-water mark: {summary['high_water_mark']}")
@@ -0,0 +1,347 @@
+"""
+Sorted collision_id index of the crash partitions, and merge joins of crashes with the
+person and vehicle records of a date range.
+
+Persons and vehicles are partitioned by crash_date like the crashes (see datasets.py), so
+a join never has to look outside a day: the persons of 2024-01-31 only belong to crashes
+of 2024-01-31. Within a day they are stored sorted by collision_id. Crashes are stored
+sorted by grid cell instead, so the ETL also keeps an index of them, one small file per
+month next to the partitions:
+
+    '<key_name>/_collision_index/2024/2024-01.csv'    crash_date, collision_id, row
+
+sorted by crash_date then collision_id, where row is the position of the crash in its
+stored day partition. The index gives the crashes of a range in day then collision_id
+order without sorting or moving them, the persons are stored in that order, so joining
+the range is a single merge pass over two sorted key arrays (a vectorized binary search
+per person) instead of a hash table of every crash in the range.
+
+A day rewritten since the index was built (i.e. by an incremental update) no longer
+matches its index rows; join_collisions notices the mismatch and sorts that day itself,
+so a stale index costs time but never a wrong answer.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from nyc_collisions.datasets import get_dataset
+from nyc_collisions.formats import format_from_key, read_dataframe
+from nyc_collisions.grid import FINEST_GRID_COLUMN
+from nyc_collisions.manifest import load_manifest
+
+INDEX_NAME = '_collision_index'
+JOIN_COLUMN = 'collision_id'
+
+DEFAULT_JOIN_WORKERS = 8
+
+def collision_index_key(key_name, month):
+    """Return the key of a month of the index, i.e. 'collisions_processed_data/_collision_index/2024/2024-01.csv'."""
+    return f"{key_name}/{INDEX_NAME}/{month[:4]}/{month}.csv"
+
+def _csv_dtypes(dtypes):
+    # Text columns are read back as text, i.e. zip codes keep their leading zeros
+    return {column: str for column, dtype in dtypes.items() if dtype in ('category', 'string')}
+
+# ------------------------------------------ BUILDING THE INDEX ------------------------------------------
+def build_collision_index(df, date_column_name='crash_date', sort_column=FINEST_GRID_COLUMN):
+    """
+    Index the crashes of a frame by day and collision_id, with their row in the stored partition.
+
+    The rows are numbered in the order write_partitions stores them: split by day keeping
+    their order, then stable sorted by sort_column with missing values last.
+
+    Args:
+    df (pandas.DataFrame): Crashes as written by write_partitions.
+    date_column_name (str): Name of the column containing the date information.
+    sort_column (str): The sort_column given to write_partitions (numeric), None if the
+    rows were written in their order.
+
+    Returns:
+    pandas.DataFrame: crash_date ('YYYY-MM-DD'), collision_id and row, sorted by
+    crash_date then collision_id. Rows without a date are left out.
+    """
+    days = pd.to_datetime(df[date_column_name]).to_numpy().astype('datetime64[D]')
+    valid = np.flatnonzero(~np.isnat(days))
+    days = days[valid]
+    if sort_column is not None and sort_column in df.columns:
+        sort_values = df[sort_column].to_numpy(dtype='float64', na_value=np.inf)[valid]
+    else:
+        sort_values = np.zeros(len(valid))
+
+    # Stored order: day, then sort_column, then the original order (np.lexsort is stable)
+    stored = np.lexsort((sort_values, days))
+    day_starts = np.searchsorted(days[stored], days[stored], side='left')
+    rows = np.empty(len(valid), dtype=np.int64)
+    rows[stored] = np.arange(len(valid)) - day_starts
+
+    collision_ids = df[JOIN_COLUMN].to_numpy(dtype='int64')[valid]
+    order = np.lexsort((collision_ids, days))
+    codes, labels = pd.factorize(days[order])
+    return pd.DataFrame({
+        'crash_date': pd.Index(labels).strftime('%Y-%m-%d').to_numpy(dtype=object)[codes],
+        'collision_id': collision_ids[order],
+        'row': rows[order],
+    })
+
+def _load_month(aws_client, bucket_name, key):
+    # The stored month and its ETag, (None, None) if the month has no index yet
+    try:
+        response = aws_client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return read_dataframe(response['Body'].read(), 'csv', dtype={'crash_date': str}), response['ETag']
+
+def update_collision_index(aws_client, bucket_name, key_name, df, date_column_name='crash_date', days=None,
+                           sort_column=FINEST_GRID_COLUMN, max_workers=DEFAULT_JOIN_WORKERS, max_attempts=5):
+    """
+    Index the days in df and write them into their month files, replacing those days only.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by every thread.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the crash partitions; the index goes under '<key_name>/_collision_index/'.
+    df (pandas.DataFrame): Every row of the days to index, i.e. the frame just written.
+    date_column_name (str): Name of the column containing the date information.
+    days (list): Only index these 'YYYY-MM-DD' days, i.e. the partitions that were written
+    successfully. None for every day in df.
+    sort_column (str): The sort_column the partitions were written with.
+    max_workers (int): Months read and written at the same time.
+    max_attempts (int): Times to reload and retry a month when another writer got there first.
+
+    Returns:
+    dict: Report with months (month, key, days, rows, bytes), errors (month and message),
+    rows (crashes indexed), bytes and seconds.
+    """
+    start_time = time.perf_counter()
+    index = build_collision_index(df, date_column_name, sort_column)
+    if days is not None:
+        index = index[index['crash_date'].isin(set(days)).to_numpy()]
+
+    def write_month(task):
+        month, month_index = task
+        key = collision_index_key(key_name, month)
+        for attempt in range(max_attempts):
+            existing_df, etag = _load_month(aws_client, bucket_name, key)
+            if existing_df is not None:
+                kept = existing_df[~existing_df['crash_date'].isin(month_index['crash_date'].unique())]
+                merged = pd.concat([kept, month_index], ignore_index=True)
+                merged = merged.sort_values(['crash_date', 'collision_id'], kind='stable', ignore_index=True)
+            else:
+                merged = month_index
+            body = merged.to_csv(index=False).encode('utf-8')
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                aws_client.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType='text/csv', **condition)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict') or attempt == max_attempts - 1:
+                    raise
+        return {'month': month, 'key': key, 'days': int(month_index['crash_date'].nunique()),
+                'rows': len(month_index), 'bytes': len(body)}
+
+    months = index['crash_date'].str.slice(0, 7).to_numpy()
+    tasks = [(month, month_index.reset_index(drop=True)) for month, month_index in index.groupby(months, sort=True)]
+    written = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(write_month, task): task[0] for task in tasks}
+        for future, month in futures.items():
+            try:
+                written.append(future.result())
+            except Exception as e:
+                print(f"Error occurred while updating the collision_id index of {month}: {e}")
+                errors.append({'month': month, 'error': str(e)})
+
+    return {
+        'months': written,
+        'errors': errors,
+        'rows': sum(entry['rows'] for entry in written),
+        'bytes': sum(entry['bytes'] for entry in written),
+        'seconds': round(time.perf_counter() - start_time, 3),
+    }
+
+def format_index_report(report):
+    """Render the report of update_collision_index as one line."""
+    days = sum(entry['days'] for entry in report['months'])
+    return (f"Collision index: {report['rows']} crashes over {days} days, {len(report['months'])} months written "
+            f"({report['bytes'] / 1e3:.1f} KB) in {report['seconds']} seconds, {len(report['errors'])} failed")
+
+def read_collision_index(aws_client, bucket_name, key_name, start_date, end_date):
+    """
+    Read the index rows of a date range, fetching only the months it covers.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the crash partitions.
+    start_date (str): First day, 'YYYY-MM-DD'.
+    end_date (str): Last day (included), 'YYYY-MM-DD'.
+
+    Returns:
+    pandas.DataFrame: crash_date, collision_id and row, sorted by crash_date then collision_id.
+    """
+    first_month = datetime.strptime(start_date[:7], '%Y-%m')
+    last_month = datetime.strptime(end_date[:7], '%Y-%m')
+    months = [f"{month:%Y-%m}" for month in pd.date_range(first_month, last_month, freq='MS')]
+
+    def read_month(month):
+        return _load_month(aws_client, bucket_name, collision_index_key(key_name, month))[0]
+
+    with ThreadPoolExecutor(max_workers=DEFAULT_JOIN_WORKERS) as executor:
+        frames = [frame for frame in executor.map(read_month, months) if frame is not None]
+    if not frames:
+        return pd.DataFrame({'crash_date': pd.Series(dtype=object), 'collision_id': pd.Series(dtype='int64'),
+                             'row': pd.Series(dtype='int64')})
+    index = pd.concat(frames, ignore_index=True)
+    in_range = (index['crash_date'] >= start_date[:10]) & (index['crash_date'] <= end_date[:10])
+    return index[in_range.to_numpy()].reset_index(drop=True)
+
+# ------------------------------------------ MERGE JOINS ------------------------------------------
+def merge_join(left, right, on=JOIN_COLUMN, left_order=None, left_keys=None, right_keys=None):
+    """
+    Inner join on a key that is unique on the left (i.e. crashes to persons), by merging sorted keys.
+
+    Each right key is found in the sorted left keys with a binary search, in one vectorized
+    pass, so no hash table is built. The left frame itself does not have to be sorted:
+    left_order gives its rows in key order, which is what the collision_id index stores.
+
+    Args:
+    left (pandas.DataFrame): Every key at most once.
+    right (pandas.DataFrame): Any order.
+    on (str): Name of the join column.
+    left_order (numpy.ndarray): Positions of the left rows in key order. None if left is
+    already sorted by the key.
+    left_keys (numpy.ndarray): Sorted int64 keys of the left rows (in left_order), instead
+    of the on column, i.e. day and collision_id packed together by join_collisions.
+    right_keys (numpy.ndarray): int64 keys of the right rows, to go with left_keys.
+
+    Returns:
+    pandas.DataFrame: The right rows that have a match, in their order, followed by the
+    left columns the right frame does not have.
+    """
+    if left_order is None:
+        left_order = np.arange(len(left))
+    if left_keys is None:
+        left_keys = left[on].to_numpy(dtype='int64')[left_order]
+        right_keys = right[on].to_numpy(dtype='int64')
+
+    positions = np.searchsorted(left_keys, right_keys)
+    positions[positions == len(left_keys)] = 0
+    matched = np.flatnonzero(left_keys[positions] == right_keys) if len(left_keys) else np.array([], dtype=np.int64)
+
+    extra_columns = [column for column in left.columns if column not in right.columns]
+    joined = right if len(matched) == len(right) else right.iloc[matched]
+    joined = joined.reset_index(drop=True)
+    extra = left[extra_columns].iloc[left_order[positions[matched]]].reset_index(drop=True)
+    return pd.concat([joined, extra], axis=1)
+
+def _day_keys(date, collision_ids):
+    # The day in the high bits and the collision_id (below 2 ** 40) in the low bits, so
+    # sorting the packed keys sorts by day, then collision_id
+    return (np.datetime64(date, 'D').astype(np.int64) << 40) | collision_ids
+
+def join_collisions(aws_client, bucket_name, child, start_date, end_date, crash_key_name=None,
+                    max_workers=DEFAULT_JOIN_WORKERS):
+    """
+    Join the person or vehicle records of a date range to their crashes with one merge join.
+
+    The crash and child partitions of every day are located through their manifests and
+    read concurrently. The crashes of a day are put in collision_id order by the index
+    (the rows are not moved, only their positions are), the child records are stored in
+    that order already, so the whole range is sorted by day then collision_id on both
+    sides and merge_join matches them in one pass.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by every thread.
+    bucket_name (str): Name of the S3 bucket.
+    child (str): 'persons' or 'vehicles', a key of DATASETS.
+    start_date (str): First day, 'YYYY-MM-DD'.
+    end_date (str): Last day (included), 'YYYY-MM-DD'.
+    crash_key_name (str): Base key name of the crash partitions, the registry's by default.
+    max_workers (int): Days read at the same time.
+
+    Returns:
+    tuple: The joined DataFrame (child rows with the crash columns they lack, in day then
+    collision_id order) and a report with days joined, rows, child rows without a crash,
+    days sorted without the index (stale or missing index rows), partitions read and seconds.
+    """
+    start_time = time.perf_counter()
+    crashes = get_dataset('crashes')
+    children = get_dataset(child)
+    crash_key_name = crash_key_name or crashes['processed_key']
+
+    crash_manifest, _ = load_manifest(aws_client, bucket_name, crash_key_name)
+    child_manifest, _ = load_manifest(aws_client, bucket_name, children['processed_key'])
+    days = sorted(date for date in child_manifest['partitions']
+                  if start_date <= date <= end_date and date in crash_manifest['partitions'])
+    index = read_collision_index(aws_client, bucket_name, crash_key_name, start_date, end_date)
+    index_by_day = dict(tuple(index.groupby('crash_date', sort=False))) if len(index) else {}
+
+    crash_dtypes = _csv_dtypes(crashes['dtypes'])
+    child_dtypes = _csv_dtypes(children['dtypes'])
+
+    def read(entry, dtypes):
+        body = aws_client.get_object(Bucket=bucket_name, Key=entry['key'])['Body'].read()
+        return read_dataframe(body, format_from_key(entry['key']), dtype=dtypes)
+
+    def read_crashes(date):
+        crash_df = read(crash_manifest['partitions'][date], crash_dtypes)
+        # Trust the index only if it still describes the stored partition
+        collision_ids = crash_df[JOIN_COLUMN].to_numpy(dtype='int64')
+        day_index = index_by_day.get(date)
+        indexed = (day_index is not None and len(day_index) == len(crash_df) and day_index['row'].max() < len(crash_df)
+                   and np.array_equal(collision_ids[day_index['row'].to_numpy()], day_index['collision_id'].to_numpy()))
+        order = day_index['row'].to_numpy() if indexed else np.argsort(collision_ids, kind='stable')
+        return crash_df, order, _day_keys(date, collision_ids[order]), indexed
+
+    def read_children(date):
+        child_df = read(child_manifest['partitions'][date], child_dtypes)
+        if not child_df[JOIN_COLUMN].is_monotonic_increasing:
+            child_df = child_df.sort_values(JOIN_COLUMN, kind='stable', ignore_index=True)
+        return child_df, _day_keys(date, child_df[JOIN_COLUMN].to_numpy(dtype='int64'))
+
+    def concat(frames):
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame({JOIN_COLUMN: pd.Series(dtype='int64')})
+
+    def concat_arrays(arrays):
+        # The packed keys do not fit a float64, so an empty range must not make them one
+        return np.concatenate(arrays) if arrays else np.array([], dtype=np.int64)
+
+    # One dataset after the other, so only the days of one of them are held next to its
+    # concatenation. Children first: the crash columns they already have are not kept.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        child_days = list(executor.map(read_children, days))
+        right_keys = concat_arrays([keys for _, keys in child_days])
+        child_df = concat([child_df for child_df, _ in child_days])
+        del child_days
+
+        shared_columns = [column for column in child_df.columns if column != JOIN_COLUMN]
+        crash_days = list(executor.map(read_crashes, days))
+        offsets = np.cumsum([0] + [len(crash_df) for crash_df, _, _, _ in crash_days])
+        left_order = concat_arrays([order + offset for (_, order, _, _), offset in zip(crash_days, offsets)])
+        left_keys = concat_arrays([keys for _, _, keys, _ in crash_days])
+        indexed_days = sum(indexed for _, _, _, indexed in crash_days)
+        crash_df = concat([crash_df.drop(columns=shared_columns, errors='ignore') for crash_df, _, _, _ in crash_days])
+        del crash_days
+
+    joined_df = merge_join(crash_df, child_df, left_order=left_order, left_keys=left_keys, right_keys=right_keys)
+    report = {
+        'days': len(days),
+        'rows': len(joined_df),
+        'unmatched': len(child_df) - len(joined_df),
+        'sorted_without_index': len(days) - indexed_days,
+        'partitions_read': 2 * len(days),
+        'seconds': round(time.perf_counter() - start_time, 3),
+    }
+    return joined_df, report
+
+def format_join_report(report):
+    """Render the report of join_collisions as one line."""
+    return (f"Joined {report['rows']} rows over {report['days']} days ({report['unmatched']} without a crash, "
+            f"{report['sorted_without_index']} days sorted without the index) in {report['seconds']} seconds")
@@ -0,0 +1,235 @@
+"""
+Manifest of the day partitions stored under 'collisions_processed_data/'.
+
+One JSON object, '<key_name>/_manifest.json', records every partition that has been
+written: its key, row count, size, checksum and highest collision_id. Looking up the
+latest date or whether a day already exists then costs one GET instead of a
+list_objects_v2 call per day, and does not stop at the first 1000 keys the way a single
+unpaginated listing does.
+
+The manifest is replaced with a conditional PUT (If-Match on the ETag it was read with,
+or If-None-Match when it is created), so two loads finishing at the same time cannot
+silently drop each other's partitions: the loser reloads, merges and tries again.
+
+Incremental updates also keep their high-water mark here: the highest Socrata
+':updated_at' already merged into the partitions.
+
+The key of a partition carries its format and codec ('.csv', '.csv.gz', '.parquet'), so
+a day rewritten after S3_CONTENT_ENCODING or the output format changed gets a new key.
+update_manifest deletes the key the day was stored under before, once the manifest points
+at the new one, so a day is never stored twice.
+"""
+import json
+import re
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+from nyc_collisions.formats import format_from_key, read_dataframe
+
+MANIFEST_NAME = '_manifest.json'
+MANIFEST_VERSION = 1
+
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+# '<key_name>/YYYY/MM/YYYY-MM-DD/YYYY-MM-DD.<ext>', plus '.gz' or '.zst' for compressed CSV
+_PARTITION_KEY = re.compile(r'/(\d{4})/(\d{2})/(\d{4}-\d{2}-\d{2})/\3\.(csv|parquet)(\.gz|\.zst)?$')
+
+def manifest_key(key_name):
+    """Return the key of the manifest, i.e. 'collisions_processed_data/_manifest.json'."""
+    return f"{key_name}/{MANIFEST_NAME}"
+
+def empty_manifest():
+    return {'version': MANIFEST_VERSION, 'updated_at': None, 'partitions': {}}
+
+def load_manifest(aws_client, bucket_name, key_name):
+    """
+    Read the manifest.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+
+    Returns:
+    tuple: The manifest dict (empty if it does not exist yet) and its ETag (None if it
+    does not exist), to pass back to save_manifest.
+    """
+    try:
+        response = aws_client.get_object(Bucket=bucket_name, Key=manifest_key(key_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return empty_manifest(), None
+        raise
+    return json.loads(response['Body'].read()), response['ETag']
+
+def save_manifest(aws_client, bucket_name, key_name, manifest, etag=None):
+    """
+    Replace the manifest, but only if nobody else replaced it since it was read.
+
+    The conditional put (IfMatch / IfNoneMatch) needs boto3 1.35.69 or later, which is
+    why Docker/requirements.txt pins it: older releases reject both parameters.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+    manifest (dict): The manifest to store.
+    etag (str): ETag returned by load_manifest, None if the manifest did not exist.
+
+    Returns:
+    str: The ETag of the stored manifest.
+
+    Raises:
+    botocore.exceptions.ClientError: 'PreconditionFailed' if the manifest changed in between.
+    """
+    manifest['updated_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    response = aws_client.put_object(
+        Bucket=bucket_name,
+        Key=manifest_key(key_name),
+        Body=json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'),
+        ContentType='application/json',
+        **condition
+        )
+    return response['ETag']
+
+def delete_replaced_keys(aws_client, bucket_name, keys):
+    """
+    Delete the objects a day was stored under before it was rewritten under another key.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    keys (list): Keys to delete.
+
+    Returns:
+    int: Number of keys deleted. Keys that could not be deleted are printed.
+    """
+    deleted = 0
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        response = aws_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+        errors = response.get('Errors', [])
+        for error in errors:
+            print(f"Error deleting replaced partition {error['Key']}: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+    return deleted
+
+def update_manifest(aws_client, bucket_name, key_name, partitions, high_water_mark=None, max_attempts=5,
+                    delete_replaced=True):
+    """
+    Record newly written partitions in the manifest.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+    partitions (list): Partition dicts as in the write_partitions report (date, key, rows,
+    bytes, checksum, max_collision_id). A date already in the manifest is replaced.
+    high_water_mark (str): New ':updated_at' high-water mark, None to leave it as it is.
+    It never moves backwards.
+    max_attempts (int): Times to reload and retry when another writer got there first.
+    delete_replaced (bool): Delete the previous key of a day now stored under another key
+    (another codec or format), after the manifest has been saved.
+
+    Returns:
+    dict: The manifest as stored.
+    """
+    for attempt in range(max_attempts):
+        manifest, etag = load_manifest(aws_client, bucket_name, key_name)
+        replaced = []
+        for partition in partitions:
+            previous = manifest['partitions'].get(partition['date'])
+            if previous and previous.get('key') and previous['key'] != partition.get('key'):
+                replaced.append(previous['key'])
+            manifest['partitions'][partition['date']] = {
+                field: partition.get(field) for field in ('key', 'rows', 'bytes', 'checksum', 'max_collision_id')
+            }
+        if high_water_mark is not None:
+            manifest['high_water_mark'] = max(high_water_mark, manifest.get('high_water_mark') or '')
+        try:
+            save_manifest(aws_client, bucket_name, key_name, manifest, etag)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict') or attempt == max_attempts - 1:
+                raise
+            continue
+        # Only once nothing points at them any more
+        if delete_replaced and replaced:
+            delete_replaced_keys(aws_client, bucket_name, replaced)
+        return manifest
+    return manifest
+
+def latest_date(manifest):
+    """Return the latest partition date in the manifest ('YYYY-MM-DD'), or None if it is empty."""
+    return max(manifest['partitions'], default=None)
+
+def get_high_water_mark(manifest):
+    """Return the ':updated_at' high-water mark of the incremental updates, or None before the first one."""
+    return manifest.get('high_water_mark')
+
+def partition_exists(manifest, date):
+    """Return True if the manifest has a partition for a date (datetime or 'YYYY-MM-DD')."""
+    return (date if isinstance(date, str) else f"{date:%Y-%m-%d}") in manifest['partitions']
+
+def rebuild_manifest(aws_client, bucket_name, key_name):
+    """
+    Rebuild the manifest from a full, paginated listing of the partitioned data.
+
+    Every partition file is read once to count its rows and find its highest collision_id,
+    so this is meant for the first run or for repairs, not for every load. The checksum of
+    a rebuilt entry is the S3 ETag, which is the MD5 that write_partitions records for
+    files uploaded in a single PUT. A day stored under more than one key (i.e. '.csv' and
+    '.csv.gz' left by a codec change) is recorded with the most recently written one; the
+    others are printed, not deleted.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+
+    Returns:
+    dict: The manifest as stored.
+    """
+    manifest, etag = load_manifest(aws_client, bucket_name, key_name)
+    manifest['partitions'] = {}
+
+    # Newest object of every day: listing order says nothing about which one is current
+    newest = {}
+    paginator = aws_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{key_name}/"):
+        for obj in page.get('Contents', []):
+            match = _PARTITION_KEY.search(obj['Key'])
+            if not match:
+                continue
+            date = match.group(3)
+            if date in newest:
+                stale, obj = sorted([newest[date], obj], key=lambda candidate: candidate['LastModified'])
+                print(f"Partition {date} is stored twice, keeping {obj['Key']} over the older {stale['Key']}")
+            newest[date] = obj
+
+    for date, obj in newest.items():
+        body = aws_client.get_object(Bucket=bucket_name, Key=obj['Key'])['Body'].read()
+        partition_df = read_dataframe(body, format_from_key(obj['Key']))
+        has_ids = 'collision_id' in partition_df.columns and len(partition_df)
+        manifest['partitions'][date] = {
+            'key': obj['Key'],
+            'rows': len(partition_df),
+            'bytes': obj['Size'],
+            'checksum': obj['ETag'].strip('"'),
+            'max_collision_id': int(partition_df['collision_id'].max()) if has_ids else None,
+        }
+
+    save_manifest(aws_client, bucket_name, key_name, manifest, etag)
+    return manifest
+
+def load_or_rebuild_manifest(aws_client, bucket_name, key_name):
+    """Read the manifest, rebuilding it from a listing the first time it is needed."""
+    manifest, _ = load_manifest(aws_client, bucket_name, key_name)
+    if not manifest['partitions']:
+        manifest = rebuild_manifest(aws_client, bucket_name, key_name)
+    return manifest
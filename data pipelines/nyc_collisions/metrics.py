@@ -0,0 +1,196 @@
+"""
+Per-stage metrics for the pipelines, written as structured JSON lines.
+
+Each pipeline creates one MetricsRecorder and wraps its stages (fetch, transform, upload,
+...) in recorder.stage(name). When a stage ends, one JSON line is emitted with its duration
+and whatever the stage added: rows, bytes, requests, retries, throttles, errors, ...
+
+The lines follow the CloudWatch Embedded Metric Format (EMF): printed to stdout inside
+Lambda, CloudWatch Logs turns them into metrics in the NYCCollisions namespace, with the
+pipeline and stage as dimensions, without any API call. Where the lines go is up to the
+sink: stdout, a JSON lines file, memory (to inspect them in a test) or nowhere.
+
+    metrics = MetricsRecorder('daily_updates')
+    with metrics.stage('fetch') as stage:
+        data = fetch(...)
+        stage.add(rows=len(data), requests=pages)
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_NAMESPACE = 'NYCCollisions'
+
+# Values a stage can add, with the name and CloudWatch unit they are published under.
+# serialize_ms and put_ms are summed over the upload threads, so they can exceed the stage duration.
+METRICS = {
+    'duration_ms': ('Duration', 'Milliseconds'),
+    'rows': ('Rows', 'Count'),
+    'bytes': ('Bytes', 'Bytes'),
+    'requests': ('Requests', 'Count'),
+    'retries': ('Retries', 'Count'),
+    'throttles': ('Throttles', 'Count'),
+    'errors': ('Errors', 'Count'),
+    'partitions': ('Partitions', 'Count'),
+    'serialize_ms': ('SerializeDuration', 'Milliseconds'),
+    'put_ms': ('PutDuration', 'Milliseconds'),
+}
+
+# ------------------------------------------ SINKS ------------------------------------------
+class StdoutSink:
+    """Print every record as one JSON line; inside Lambda, CloudWatch Logs extracts the metrics."""
+
+    def emit(self, record):
+        print(json.dumps(record, separators=(',', ':'), default=str), flush=True)
+
+class JsonLinesSink:
+    """Append every record to a JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, separators=(',', ':'), default=str)
+        with self.lock, open(self.path, 'a', encoding='utf-8') as metrics_file:
+            metrics_file.write(line + '\n')
+
+class MemorySink:
+    """Keep the records in a list, for tests and benchmarks."""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class NullSink:
+    """Drop every record."""
+
+    def emit(self, record):
+        pass
+
+def sink_from_env(default='stdout'):
+    """
+    Pick the sink named by the METRICS_SINK environment variable.
+
+    'stdout', 'off', or the path of a JSON lines file.
+    """
+    name = os.environ.get('METRICS_SINK', default)
+    if name == 'stdout':
+        return StdoutSink()
+    if name in ('off', ''):
+        return NullSink()
+    return JsonLinesSink(name)
+
+# ------------------------------------------ RECORDER ------------------------------------------
+class Stage:
+    """A running stage: add() accumulates values, set() attaches properties (searchable, not metrics)."""
+
+    def __init__(self, name, properties):
+        self.name = name
+        self.values = {}
+        self.properties = dict(properties)
+
+    def add(self, **values):
+        for name, value in values.items():
+            if value is not None:
+                self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, **properties):
+        self.properties.update(properties)
+
+class MetricsRecorder:
+    """
+    Time the stages of a pipeline run and emit one metrics record per stage.
+
+    Args:
+    pipeline (str): Name of the pipeline, i.e. 'daily_updates_lambda'. Published as a dimension.
+    sink: Object with an emit(record) method. Defaults to sink_from_env().
+    namespace (str): CloudWatch namespace of the metrics.
+    dimensions (dict): Extra dimensions added to every record, i.e. {'OutputFormat': 'parquet'}.
+    """
+
+    def __init__(self, pipeline, sink=None, namespace=DEFAULT_NAMESPACE, dimensions=None):
+        self.pipeline = pipeline
+        self.sink = sink if sink is not None else sink_from_env()
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, **properties):
+        """
+        Time a stage. The record is emitted when the block ends, also when it raises (with errors=1).
+
+        Yields:
+        Stage: Call .add(rows=..., bytes=..., ...) on it.
+        """
+        stage = Stage(name, properties)
+        start_time = time.perf_counter()
+        try:
+            yield stage
+        except Exception:
+            stage.add(errors=1)
+            raise
+        finally:
+            stage.add(duration_ms=round((time.perf_counter() - start_time) * 1000, 3))
+            self.emit(stage)
+
+    def emit(self, stage):
+        """Send the record of a finished stage to the sink and add it to the totals."""
+        dimensions = {'Pipeline': self.pipeline, 'Stage': stage.name, **self.dimensions}
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': METRICS[name][0], 'Unit': METRICS[name][1]}
+                                for name in stage.values if name in METRICS],
+                }],
+            },
+            **dimensions,
+            **stage.properties,
+            **{METRICS.get(name, (name, None))[0]: value for name, value in stage.values.items()},
+        }
+        with self.lock:
+            totals = self.totals.setdefault(stage.name, {'count': 0})
+            totals['count'] += 1
+            for name, value in stage.values.items():
+                totals[name] = totals.get(name, 0) + value
+        self.sink.emit(record)
+
+    def summary(self):
+        """
+        Returns:
+        dict: stage name -> summed values (and the number of times it ran, count).
+        """
+        with self.lock:
+            return {name: {field: round(value, 3) if isinstance(value, float) else value for field, value in totals.items()}
+                    for name, totals in self.totals.items()}
+
+@contextlib.contextmanager
+def measure(metrics, name, **properties):
+    """
+    recorder.stage(name) when a recorder is given, otherwise a stage that is never emitted.
+
+    Lets functions take an optional metrics=None argument.
+    """
+    if metrics is None:
+        yield Stage(name, properties)
+    else:
+        with metrics.stage(name, **properties) as stage:
+            yield stage
+
+def format_metrics_summary(summary):
+    """Render MetricsRecorder.summary() as one line per stage, slowest first."""
+    lines = []
+    for name, totals in sorted(summary.items(), key=lambda item: -item[1].get('duration_ms', 0)):
+        values = ', '.join(f"{field} {value}" for field, value in totals.items() if field not in ('duration_ms', 'count'))
+        lines.append(f"{name}: {totals.get('duration_ms', 0) / 1000:.3f}s over {totals['count']} run(s)"
+                     + (f", {values}" if values else ''))
+    return '\n'.join(lines)
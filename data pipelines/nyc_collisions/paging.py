@@ -0,0 +1,172 @@
+"""
+Keyset (cursor) pagination over Socrata datasets.
+
+Instead of paging with `$offset`, every request asks for the rows whose key is
+strictly greater than the last key already seen:
+
+    WHERE collision_id > :last ORDER BY collision_id LIMIT n
+
+The server can seek straight to the cursor no matter how deep into the dataset
+we are, and rows that are added or removed mid-run can no longer shift the
+pages and cause skipped or duplicated records.
+"""
+import json
+import os
+
+KEY_COLUMN = 'collision_id'
+
+# ------------------------------------------ CURSOR PERSISTENCE ------------------------------------------
+def load_cursor(cursor_path):
+    """
+    Load the last key saved by a previous run.
+
+    Args:
+    cursor_path (str): Path of the JSON file holding the cursor.
+
+    Returns:
+    int: The last key fetched, or None if there is no saved cursor.
+    """
+    if not os.path.exists(cursor_path):
+        return None
+
+    with open(cursor_path) as cursor_file:
+        return json.load(cursor_file).get('last_key')
+
+def save_cursor(cursor_path, last_key):
+    """
+    Atomically save the last key fetched so a later run can resume from it.
+
+    Args:
+    cursor_path (str): Path of the JSON file holding the cursor.
+    last_key (int): The last key fetched.
+
+    Returns:
+    None
+    """
+    tmp_path = f"{cursor_path}.tmp"
+    with open(tmp_path, 'w') as cursor_file:
+        json.dump({'last_key': last_key}, cursor_file)
+    os.replace(tmp_path, cursor_path)
+
+# ------------------------------------------ QUERY BUILDING ------------------------------------------
+def build_keyset_where(last_key=None, upper_key=None, where=None, key_column=KEY_COLUMN):
+    """
+    Combine an optional filter with the keyset bounds into a single SoQL WHERE clause.
+
+    Args:
+    last_key (int): Exclusive lower bound on the key, None to start from the beginning.
+    upper_key (int): Inclusive upper bound on the key, None for no upper bound.
+    where (str): Additional SoQL filter, i.e. a crash_date range.
+    key_column (str): Name of the unique, numeric key column.
+
+    Returns:
+    str: The WHERE clause, or None if there is nothing to filter on.
+    """
+    clauses = []
+    if where:
+        clauses.append(f"({where})")
+    if last_key is not None:
+        clauses.append(f"{key_column} > {int(last_key)}")
+    if upper_key is not None:
+        clauses.append(f"{key_column} <= {int(upper_key)}")
+
+    return ' AND '.join(clauses) or None
+
+# ------------------------------------------ PAGING ------------------------------------------
+def iter_keyset_pages(socrata_client, dataset_name, chunk_size=5000, where=None, last_key=None,
+                      upper_key=None, key_column=KEY_COLUMN, cursor_path=None, **query):
+    """
+    Walk a Socrata dataset in key order, one page at a time.
+
+    When a cursor_path is given the walk resumes from the saved cursor, and the cursor is
+    saved again once the caller has finished with each page, so an interrupted run can
+    pick up where it left off.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to fetch data from.
+    chunk_size (int): Number of records requested per page.
+    where (str): Additional SoQL filter applied to every page.
+    last_key (int): Exclusive lower bound on the key to start after.
+    upper_key (int): Inclusive upper bound on the key to stop at.
+    key_column (str): Name of the unique, numeric key column used as the cursor.
+    cursor_path (str): Optional path of a JSON file used to resume and record progress.
+    **query: Extra keyword arguments forwarded to socrata_client.get (i.e. select).
+
+    Yields:
+    list: A page of records, ordered by key_column.
+    """
+    if cursor_path is not None and last_key is None:
+        last_key = load_cursor(cursor_path)
+
+    while True:
+        page = socrata_client.get(
+            dataset_name,
+            where=build_keyset_where(last_key, upper_key, where, key_column),
+            order=key_column,
+            limit=chunk_size,
+            **query
+            )
+        if not page:
+            # An empty page means there is nothing left past the cursor
+            return
+
+        yield page
+
+        # Advance the cursor only after the caller is done with the page
+        last_key = int(page[-1][key_column])
+        if cursor_path is not None:
+            save_cursor(cursor_path, last_key)
+
+        if len(page) < chunk_size:
+            # A short page is the last one, no need for an extra empty request
+            return
+
+def fetch_key_bounds(socrata_client, dataset_name, where=None, key_column=KEY_COLUMN):
+    """
+    Get the smallest and largest key in a Socrata dataset.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to query.
+    where (str): Optional SoQL filter.
+    key_column (str): Name of the unique, numeric key column.
+
+    Returns:
+    tuple: (min_key, max_key) as ints, or (None, None) if the dataset is empty.
+    """
+    response = socrata_client.get(
+        dataset_name,
+        select=f"min({key_column}) AS min_key, max({key_column}) AS max_key",
+        where=where
+        )
+    if not response or response[0].get('min_key') is None:
+        return None, None
+
+    return int(float(response[0]['min_key'])), int(float(response[0]['max_key']))
+
+def split_key_range(min_key, max_key, number_of_partitions):
+    """
+    Split the key space [min_key, max_key] into disjoint, contiguous partitions.
+
+    Args:
+    min_key (int): Smallest key in the dataset.
+    max_key (int): Largest key in the dataset.
+    number_of_partitions (int): Number of partitions to create.
+
+    Returns:
+    list: (last_key, upper_key) tuples, usable as the exclusive lower and inclusive upper
+    bounds of iter_keyset_pages. The partitions are returned in key order.
+    """
+    span = max_key - min_key + 1
+    number_of_partitions = max(1, min(number_of_partitions, span))
+    step = -(-span // number_of_partitions)  # ceiling division
+
+    partitions = []
+    lower = min_key - 1
+    while lower < max_key:
+        upper = min(lower + step, max_key)
+        partitions.append((lower, upper))
+        lower = upper
+
+    return partitions
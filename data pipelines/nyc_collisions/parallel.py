@@ -0,0 +1,338 @@
+"""
+Range-partitioned parallel downloads with adaptive concurrency.
+
+The collision_id key space is split into many small, disjoint partitions which are
+fetched by a thread pool. The number of partitions in flight is tuned with an AIMD
+(additive increase, multiplicative decrease) controller: it grows by one while
+requests come back quickly and halves as soon as the server throttles us or slows
+down. Failed partitions are retried on their own with exponential backoff, and
+results are handed back in key order through a bounded reorder window, so nothing
+has to buffer the whole dataset.
+
+The controller also counts the requests in flight, so one controller can be shared by
+the downloads of several datasets running at the same time: together they never have
+more than controller.limit partitions in flight, which is the rate budget the API
+sees, and a throttle on any of them slows all of them down.
+"""
+import concurrent.futures
+import random
+import threading
+import time
+
+import requests
+
+from nyc_collisions.paging import iter_keyset_pages, fetch_key_bounds, split_key_range, KEY_COLUMN
+
+# HTTP status codes that mean "slow down" or "try again later"
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# HTTP status code of a request the server rejected because we are sending too many
+THROTTLE_STATUS_CODE = 429
+
+# ------------------------------------------ CONCURRENCY CONTROL ------------------------------------------
+class AimdController:
+    """
+    Additive increase / multiplicative decrease limit on the number of requests in flight.
+
+    Args:
+    initial (int): Starting concurrency.
+    minimum (int): Lowest concurrency the controller will back off to.
+    maximum (int): Highest concurrency the controller will grow to.
+    target_latency (float): Seconds per request above which we treat the server as overloaded.
+    increase_every (int): Number of fast, successful requests needed before adding one worker.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, target_latency=2.0, increase_every=4):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.increase_every = increase_every
+        self.successes = 0
+        self.peak = initial
+        self.decreases = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+
+    def acquire(self, blocking=True):
+        """
+        Take one of the limit slots for a partition about to be fetched.
+
+        Args:
+        blocking (bool): Wait for a slot when all of them are taken, i.e. by the other
+        downloads sharing the controller.
+
+        Returns:
+        bool: True if a slot was taken, False if none was free and blocking is False.
+        """
+        with self.lock:
+            while self.in_flight >= self.limit:
+                if not blocking:
+                    return False
+                self.released.wait()
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """Give back the slot of a partition that finished, successfully or not."""
+        with self.lock:
+            self.in_flight -= 1
+            self.released.notify_all()
+
+    def record_success(self, latency):
+        """Record a successful request and its latency in seconds."""
+        with self.lock:
+            if latency > self.target_latency:
+                self._decrease()
+                return
+            self.successes += 1
+            if self.successes >= self.increase_every:
+                self.successes = 0
+                self.limit = min(self.maximum, self.limit + 1)
+                self.peak = max(self.peak, self.limit)
+                self.released.notify_all()
+
+    def record_throttle(self):
+        """Record a request the server throttled."""
+        with self.lock:
+            self._decrease()
+
+    def _decrease(self):
+        self.successes = 0
+        self.limit = max(self.minimum, self.limit // 2)
+        self.decreases += 1
+
+def is_retryable(error):
+    """
+    Decide whether a failed request is worth retrying.
+
+    Args:
+    error (Exception): The exception raised by the request.
+
+    Returns:
+    bool: True for throttling, server errors, timeouts and dropped connections.
+    """
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def is_throttle(error):
+    """
+    Decide whether a failed request was the server telling us to slow down.
+
+    Server errors, timeouts and dropped connections are retried but do not shrink the
+    concurrency limit, only an explicit 429 does.
+
+    Args:
+    error (Exception): The exception raised by the request.
+
+    Returns:
+    bool: True if the request was rejected with a 429.
+    """
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == THROTTLE_STATUS_CODE
+
+def backoff_delay(attempt, error=None, base=0.5, cap=30.0):
+    """
+    Seconds to wait before retrying, honouring the server's Retry-After header when present.
+
+    Args:
+    attempt (int): Number of attempts already made (1 for the first retry).
+    error (Exception): The exception raised by the last attempt.
+    base (float): Delay before the first retry.
+    cap (float): Longest delay allowed.
+
+    Returns:
+    float: Seconds to sleep.
+    """
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+
+    # Exponential backoff with jitter so retries from different threads spread out
+    return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+# ------------------------------------------ PARTITION FETCHING ------------------------------------------
+class _TimedClient:
+    """Wraps a Socrata client to count requests sent, failed ones included, and report their latency to the controller."""
+
+    def __init__(self, socrata_client, controller):
+        self.socrata_client = socrata_client
+        self.controller = controller
+        self.requests = 0
+
+    def get(self, *args, **kwargs):
+        request_start = time.perf_counter()
+        self.requests += 1
+        response = self.socrata_client.get(*args, **kwargs)
+        self.controller.record_success(time.perf_counter() - request_start)
+        return response
+
+def fetch_partition(socrata_client, dataset_name, partition, chunk_size, controller, where=None, key_column=KEY_COLUMN):
+    """
+    Fetch every record of one key partition, reporting each request to the controller.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to fetch data from.
+    partition (tuple): (last_key, upper_key) bounds of the partition.
+    chunk_size (int): Number of records requested per page.
+    controller (AimdController): Controller notified of each request's latency.
+    where (str): Optional SoQL filter applied to every page.
+    key_column (str): Name of the unique, numeric key column.
+
+    Returns:
+    tuple: The list of records in key order and the number of requests sent.
+
+    Raises:
+    Exception: Whatever the failing request raised, with the number of requests the
+    attempt sent attached as requests_sent.
+    """
+    last_key, upper_key = partition
+    timed_client = _TimedClient(socrata_client, controller)
+    records = []
+    try:
+        for page in iter_keyset_pages(timed_client, dataset_name, chunk_size=chunk_size, where=where,
+                                      last_key=last_key, upper_key=upper_key, key_column=key_column):
+            records.extend(page)
+    except Exception as e:
+        e.requests_sent = timed_client.requests
+        raise
+
+    return records, timed_client.requests
+
+def fetch_partitions_in_order(fetch, partitions, controller, max_retries=5, reorder_window=None):
+    """
+    Fetch partitions in parallel and yield their results in partition order.
+
+    At most controller.limit partitions are in flight at once, counting those of any other
+    download sharing the controller, and at most reorder_window partitions are held ahead
+    of the next one to be yielded, which bounds memory even when an early partition is
+    slow or being retried. A failed partition waits out its backoff before it takes a slot
+    again, so the slot stays free for other partitions in the meantime.
+
+    Args:
+    fetch (callable): Called with a partition, returns (records, number_of_requests_sent).
+    An exception it raises may carry the requests the failed attempt sent as requests_sent.
+    partitions (list): Partitions in the order their results should be yielded.
+    controller (AimdController): Concurrency controller shared by all workers.
+    max_retries (int): Attempts allowed per partition after the first failure.
+    reorder_window (int): Partitions allowed to be fetched ahead of the next one to yield.
+    Defaults to twice the controller's maximum concurrency.
+
+    Yields:
+    tuple: (partition, records, stats) where stats holds 'requests', 'retries' and 'throttles'.
+    """
+    if reorder_window is None:
+        reorder_window = controller.maximum * 2
+
+    attempts = {}
+    retry_at = {}
+    ready = {}
+    in_flight = {}
+    next_to_submit = 0
+    next_to_yield = 0
+    retry_queue = []
+    stats = {'requests': 0, 'retries': 0, 'throttles': 0}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        try:
+            while next_to_yield < len(partitions):
+                # Top up the pool, retries first, without running too far ahead of the consumer.
+                # With nothing of ours in flight, wait for a slot another download gives back.
+                while True:
+                    due_retries = [index for index in retry_queue if retry_at[index] <= time.monotonic()]
+                    if due_retries:
+                        index = due_retries[0]
+                    elif next_to_submit < len(partitions) and next_to_submit - next_to_yield < reorder_window:
+                        index = next_to_submit
+                    else:
+                        break
+                    if not controller.acquire(blocking=not in_flight):
+                        break
+                    if due_retries:
+                        retry_queue.remove(index)
+                    else:
+                        next_to_submit += 1
+                    in_flight[executor.submit(fetch, partitions[index])] = index
+
+                # Sleep out retry backoffs here, without holding a slot, and wake up for
+                # whichever comes first: a finished partition or a retry falling due
+                retry_wait = None
+                if retry_queue:
+                    retry_wait = max(0.0, min(retry_at[index] for index in retry_queue) - time.monotonic())
+                if not in_flight and retry_wait is not None:
+                    time.sleep(retry_wait)
+                if in_flight:
+                    done, _ = concurrent.futures.wait(in_flight, timeout=retry_wait,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index = in_flight.pop(future)
+                        controller.release()
+                        try:
+                            records, number_of_requests_sent = future.result()
+                        except Exception as e:
+                            stats['requests'] += getattr(e, 'requests_sent', 1)
+                            attempts[index] = attempts.get(index, 0) + 1
+                            if not is_retryable(e) or attempts[index] > max_retries:
+                                raise
+                            if is_throttle(e):
+                                controller.record_throttle()
+                                stats['throttles'] += 1
+                            stats['retries'] += 1
+                            retry_at[index] = time.monotonic() + backoff_delay(attempts[index], e)
+                            retry_queue.append(index)
+                            continue
+                        stats['requests'] += number_of_requests_sent
+                        ready[index] = records
+
+                # Hand back every partition that is complete and next in line
+                while next_to_yield in ready:
+                    yield partitions[next_to_yield], ready.pop(next_to_yield), stats
+                    next_to_yield += 1
+        finally:
+            # Partitions still in flight after an error or an early stop give their slots back
+            for _ in in_flight:
+                controller.release()
+
+def iter_records_in_parallel(socrata_client, dataset_name, chunk_size=5000, partition_size=None, where=None,
+                             controller=None, max_retries=5, reorder_window=None, key_column=KEY_COLUMN):
+    """
+    Download a whole dataset with range partitions and adaptive concurrency, in key order.
+
+    Args:
+    socrata_client: Socrata client for interacting with the Socrata API.
+    dataset_name (str): Name of the dataset to fetch data from.
+    chunk_size (int): Number of records requested per page.
+    partition_size (int): Width of each key partition. Defaults to four pages worth of keys.
+    where (str): Optional SoQL filter applied to every page.
+    controller (AimdController): Concurrency controller, a default one is created if None.
+    max_retries (int): Attempts allowed per partition after the first failure.
+    reorder_window (int): Partitions allowed to be fetched ahead of the consumer, which caps
+    both memory and the effective concurrency. See fetch_partitions_in_order.
+    key_column (str): Name of the unique, numeric key column.
+
+    Yields:
+    tuple: (records, stats) for each partition, in key order.
+    """
+    controller = controller or AimdController()
+    min_key, max_key = fetch_key_bounds(socrata_client, dataset_name, where=where, key_column=key_column)
+    if min_key is None:
+        return
+
+    partition_size = partition_size or chunk_size * 4
+    number_of_partitions = -(-(max_key - min_key + 1) // partition_size)
+    partitions = split_key_range(min_key, max_key, number_of_partitions)
+
+    def fetch(partition):
+        return fetch_partition(socrata_client, dataset_name, partition, chunk_size, controller,
+                               where=where, key_column=key_column)
+
+    for _, records, stats in fetch_partitions_in_order(fetch, partitions, controller, max_retries=max_retries,
+                                                       reorder_window=reorder_window):
+        yield records, stats
@@ -0,0 +1,416 @@
+"""
+Parallel ETL of a raw file over a pool of processes.
+
+etl.process_dataset reads the whole raw file, transforms it and serializes every day on
+one core; parsing CSV, the date/time transform and to_csv are pure CPU and hold the GIL,
+so threads do not help. parallel_etl splits the raw file into independent work units
+and runs them in a ProcessPoolExecutor, in two phases:
+
+1. Transform. Each unit is a byte range of a CSV file, cut on line boundaries (the header
+   is sent along with every range), or a group of row groups of a Parquet file. A worker
+   fetches its unit with a ranged GET, parses and transforms it, orders its rows by day
+   (stable, rows without a date last) and sends the result back as an Arrow IPC stream,
+   with the row range of every day in it.
+
+2. Write. The days are split into contiguous ranges of about the same number of rows.
+   For each range the parent slices the rows of those days out of every unit and sends
+   them, unit by unit in file order, to a worker, which writes the day partitions with
+   write_partitions.
+
+Frames cross process boundaries only as Arrow IPC buffers, never as pickled DataFrames.
+Every worker opens its own boto3 client: clients cannot be sent to another process.
+
+The files written are byte for byte those of the serial path. Rows of a day keep their
+file order (units are concatenated in file order before write_partitions sorts a day), and
+the dtype pandas infers for a column of one unit is widened to the dtype it infers for the
+whole file: a unit whose zip codes happen to have no gaps is parsed as int64, but written
+as float64 like in the serial run. A unit where a column is entirely empty does not take
+part, as read_csv makes such a column float64 whatever the other units hold.
+
+Byte ranges assume that no quoted field spans lines, as in the raw files written by the
+mass uploads. A compressed raw CSV ('.csv.gz' or '.csv.zst', see compression.py) cannot
+be cut into byte ranges: it is transformed as a single unit, and only the writes run in
+parallel.
+"""
+import io
+import math
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from nyc_collisions.compression import decompress_bytes, encoding_from_key, resolve_content_encoding
+from nyc_collisions.formats import S3RangeReader, format_from_key
+from nyc_collisions.grid import FINEST_GRID_COLUMN, GRID_LEVELS
+from nyc_collisions.partitions import write_partitions
+from nyc_collisions.schema import concat_frames
+from nyc_collisions.transform import transform_data
+
+DEFAULT_ETL_WORKERS = 4
+
+# Target size of a CSV unit; a file is always split into at least one unit per worker
+DEFAULT_UNIT_BYTES = 64 * 1024 * 1024
+MIN_UNIT_BYTES = 1024 * 1024
+
+# Bytes fetched at a time when looking for the end of a line
+BOUNDARY_PROBE_BYTES = 64 * 1024
+
+# Upload threads inside every write worker
+DEFAULT_UPLOAD_THREADS = 4
+
+DEFAULT_CLIENT_KWARGS = {'service_name': 's3', 'region_name': 'us-east-1'}
+
+# ------------------------------------------ PLANNING ------------------------------------------
+def _next_line_start(aws_client, bucket_name, file_name, position, size):
+    # Offset of the first line starting at or after position
+    while position < size:
+        end = min(size, position + BOUNDARY_PROBE_BYTES)
+        chunk = aws_client.get_object(Bucket=bucket_name, Key=file_name, Range=f"bytes={position}-{end - 1}")['Body'].read()
+        newline = chunk.find(b'\n')
+        if newline >= 0:
+            return position + newline + 1
+        position = end
+    return size
+
+def plan_csv_units(aws_client, bucket_name, file_name, units):
+    """
+    Cut a CSV object into byte ranges that start and end on line boundaries.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    file_name (str): Key of the CSV object.
+    units (int): Number of ranges wanted; small files get fewer.
+
+    Returns:
+    tuple: The header line (bytes) and a list of (start, end) byte ranges covering every
+    line after it, end excluded.
+    """
+    size = aws_client.head_object(Bucket=bucket_name, Key=file_name)['ContentLength']
+    header_end = _next_line_start(aws_client, bucket_name, file_name, 0, size)
+    header = b''
+    if header_end:
+        header = aws_client.get_object(Bucket=bucket_name, Key=file_name, Range=f"bytes=0-{header_end - 1}")['Body'].read()
+
+    data_size = size - header_end
+    units = max(1, min(units, data_size // MIN_UNIT_BYTES))
+    boundaries = [header_end]
+    for unit in range(1, units):
+        start = _next_line_start(aws_client, bucket_name, file_name, header_end + unit * data_size // units - 1, size)
+        if start > boundaries[-1]:
+            boundaries.append(start)
+    boundaries.append(size)
+    return header, [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+def plan_parquet_units(aws_client, bucket_name, file_name, units):
+    """
+    Split the row groups of a Parquet object into consecutive groups.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    file_name (str): Key of the Parquet object.
+    units (int): Number of groups wanted; a file with fewer row groups gets fewer.
+
+    Returns:
+    list: Lists of row group indices, in file order.
+    """
+    with S3RangeReader(aws_client, bucket_name, file_name) as source:
+        row_groups = pq.ParquetFile(source).metadata.num_row_groups
+    return [chunk.tolist() for chunk in np.array_split(np.arange(row_groups), min(units, row_groups)) if len(chunk)]
+
+# ------------------------------------------ WORKERS ------------------------------------------
+_worker_client = None
+
+def _init_worker(client_kwargs):
+    global _worker_client
+    _worker_client = boto3.client(**client_kwargs)
+
+def _to_ipc(table):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def _from_ipc(buffer):
+    return pa.ipc.open_stream(buffer).read_all()
+
+def _to_table(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # read_csv can leave numbers and text in one object column; they are written as the same text
+        df = df.copy()
+        for column in df.columns[(df.dtypes == object).to_numpy()]:
+            df[column] = df[column].map(lambda value: value if isinstance(value, str) or pd.isna(value) else str(value))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+def _transform_unit(task):
+    # Phase 1: fetch, parse and transform one unit, ordered by day
+    start_time = time.perf_counter()
+    if task['input_format'] == 'parquet':
+        with S3RangeReader(_worker_client, task['bucket_name'], task['file_name']) as source:
+            raw_df = pq.ParquetFile(source).read_row_groups(task['row_groups']).to_pandas()
+    elif task['byte_range'] is None:
+        # A compressed file, read whole
+        body = _worker_client.get_object(Bucket=task['bucket_name'], Key=task['file_name'])['Body'].read()
+        raw_df = pd.read_csv(io.BytesIO(decompress_bytes(body, encoding_from_key(task['file_name']))))
+        del body
+    else:
+        start, end = task['byte_range']
+        body = _worker_client.get_object(Bucket=task['bucket_name'], Key=task['file_name'],
+                                         Range=f"bytes={start}-{end - 1}")['Body'].read()
+        raw_df = pd.read_csv(io.BytesIO(task['header'] + body))
+        del body
+    fetched = time.perf_counter()
+
+    df, report = transform_data(raw_df, task['date_column_name'], task['time_column_name'],
+                                fill_boroughs=task['fill_boroughs'], grid_levels=task['grid_levels'])
+    del raw_df
+    dtypes = {column: (df[column].dtype, bool(df[column].isna().all())) for column in df.columns}
+
+    # Same day order as iter_date_partitions, so the day ranges below are contiguous
+    days = pd.to_datetime(df[task['date_column_name']]).to_numpy().astype('datetime64[D]')
+    has_day = ~np.isnat(days)
+    valid = np.flatnonzero(has_day)
+    order = np.concatenate((valid[np.argsort(days[valid], kind='stable')], np.flatnonzero(~has_day)))
+    sorted_days = days[order[:len(valid)]]
+    starts = np.concatenate(([0], np.flatnonzero(sorted_days[1:] != sorted_days[:-1]) + 1)) if len(valid) else []
+    day_ranges = {str(sorted_days[start]): (int(start), int(end)) for start, end in zip(starts, np.append(starts[1:], len(valid)))}
+
+    table = _to_table(df).take(pa.array(order))
+    return {
+        'buffer': _to_ipc(table),
+        'days': day_ranges,
+        'dtypes': dtypes,
+        'transform': report,
+        'fetch_seconds': fetched - start_time,
+        'seconds': time.perf_counter() - start_time,
+    }
+
+def _write_days(task):
+    # Phase 2: write the partitions of a range of days from the unit slices holding them
+    frames = [_from_ipc(buffer).to_pandas() for buffer in task['buffers']]
+    df = cast_to_common_dtypes(concat_frames(frames), task['target_dtypes'])
+    del frames
+    return write_partitions(_worker_client, task['bucket_name'], task['key_name'], df, task['date_column_name'],
+                            output_format=task['output_format'], compression=task['compression'],
+                            max_workers=task['upload_threads'], sort_column=task['sort_column'],
+                            content_encoding=task['content_encoding'])
+
+# ------------------------------------------ DTYPES ------------------------------------------
+def common_dtypes(unit_dtypes):
+    """
+    Return the dtype every column gets when all the units are read as one file.
+
+    Args:
+    unit_dtypes (list): One dict per unit, column name to (dtype, all values missing).
+
+    Returns:
+    dict: Column name to dtype, the way pd.concat widens them (int64 and float64 give
+    float64, numbers and text give object). Units where a column is entirely missing are
+    left out, unless every unit is.
+    """
+    targets = {}
+    for column in unit_dtypes[0]:
+        candidates = [dtypes[column] for dtypes in unit_dtypes if column in dtypes]
+        seen = [dtype for dtype, all_missing in candidates if not all_missing] or [dtype for dtype, _ in candidates]
+        if len({str(dtype) for dtype in seen}) == 1:
+            targets[column] = seen[0]
+        else:
+            targets[column] = pd.concat([pd.Series([], dtype=dtype) for dtype in seen]).dtype
+    return targets
+
+def cast_to_common_dtypes(df, target_dtypes):
+    """Cast the columns of df whose dtype differs from common_dtypes, in place; categoricals are left alone."""
+    for column, dtype in target_dtypes.items():
+        if column in df.columns and df[column].dtype != dtype and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(dtype)
+    return df
+
+# ------------------------------------------ REPORTS ------------------------------------------
+def _merge_counts(reports, rate_key=None):
+    reports = [report for report in reports if report]
+    if not reports:
+        return None
+    merged = {key: sum(report[key] for report in reports) for key, value in reports[0].items()
+              if isinstance(value, int) and not isinstance(value, bool) and key != 'rows_per_second'}
+    merged['seconds'] = round(sum(report['seconds'] for report in reports), 3)
+    merged['rows_per_second'] = round(merged['rows'] / merged['seconds']) if merged['seconds'] else None
+    if rate_key:
+        merged[rate_key] = round(1 - merged['missing'] / merged['rows'], 4) if merged['rows'] else None
+    return merged
+
+def merge_transform_reports(reports, seconds):
+    """
+    Combine the transform_data reports of the units into one, as print_transform_report expects.
+
+    Args:
+    reports (list): transform_data reports, in unit order.
+    seconds (float): Wall-clock time of the transform phase.
+
+    Returns:
+    dict: The counts summed over the units, the first invalid examples and the phase's
+    seconds and rows_per_second. The borough and grid seconds are summed over the workers.
+    """
+    rows = sum(report['rows'] for report in reports)
+    return {
+        'rows': rows,
+        'invalid_dates': sum(report['invalid_dates'] for report in reports),
+        'invalid_times': sum(report['invalid_times'] for report in reports),
+        'invalid_date_examples': [value for report in reports for value in report['invalid_date_examples']][:5],
+        'invalid_time_examples': [value for report in reports for value in report['invalid_time_examples']][:5],
+        'boroughs': _merge_counts([report['boroughs'] for report in reports], rate_key='fill_rate'),
+        'grid': _merge_counts([report['grid'] for report in reports]),
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds) if seconds else None,
+    }
+
+def format_parallel_report(report):
+    """Render the run summary of parallel_etl as one line."""
+    return (f"Parallel ETL: {report['units']} units on {report['workers']} processes, {report['rows']} rows in "
+            f"{report['seconds']} seconds (plan {report['plan_seconds']}s, transform {report['transform_seconds']}s, "
+            f"write {report['write_seconds']}s), {report['buffer_bytes'] / 1e6:.1f} MB of Arrow buffers exchanged")
+
+# ------------------------------------------ RUNNING ------------------------------------------
+def _split_days(day_rows, parts):
+    # Contiguous ranges of days with about the same number of rows each
+    days = sorted(day_rows)
+    if not days:
+        return []
+    cumulative = np.cumsum([day_rows[day] for day in days])
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, parts) / parts, side='right')
+    bounds = [0] + sorted(set(int(cut) for cut in cuts if 0 < cut < len(days))) + [len(days)]
+    return [days[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def parallel_etl(aws_client, bucket_name, file_name, key_name, date_column_name='crash_date', time_column_name='crash_time',
+                 fill_boroughs=True, grid_levels=GRID_LEVELS, output_format='csv', compression='snappy',
+                 sort_column=FINEST_GRID_COLUMN, max_workers=DEFAULT_ETL_WORKERS, unit_bytes=DEFAULT_UNIT_BYTES,
+                 upload_threads=DEFAULT_UPLOAD_THREADS, client_kwargs=None, keep_frame=True, content_encoding=None):
+    """
+    Transform a raw file and write its day partitions over a pool of processes.
+
+    Same result as extracting the whole file, transform_data and write_partitions, with
+    the manifest left to the caller like write_partitions does.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, used by this process to plan the units.
+    bucket_name (str): Name of the S3 bucket.
+    file_name (str): Key of the raw CSV or Parquet file.
+    key_name (str): Base key name under which the partitions are stored.
+    date_column_name (str): Name of the column containing the date information.
+    time_column_name (str): Name of the column containing the 'H:MM' time information.
+    fill_boroughs (bool): Passed to transform_data.
+    grid_levels (tuple): Passed to transform_data.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    sort_column (str): Column every day is sorted by, as in write_partitions.
+    max_workers (int): Processes in the pool.
+    unit_bytes (int): Target size of a CSV unit. Ignored for Parquet (one group of row
+    groups per worker).
+    upload_threads (int): Partitions uploaded at the same time by each write worker.
+    client_kwargs (dict): Keyword arguments of boto3.client in every worker. Defaults to
+    DEFAULT_CLIENT_KWARGS (with AWS_ENDPOINT_URL, if set, honoured by boto3).
+    keep_frame (bool): Also return the transformed frame, i.e. for the rollups. False
+    saves the memory of converting it back to pandas.
+    content_encoding (str): Codec of the CSV partitions, as in write_partitions.
+
+    Returns:
+    tuple: The transformed DataFrame (rows ordered by day, file order within a day; None
+    when keep_frame is False) and a report with units, workers, rows, buffer_bytes, the
+    seconds of each phase and of the run, transform (as print_transform_report expects)
+    and write (as print_partition_report expects).
+    """
+    start_time = time.perf_counter()
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+    input_format = format_from_key(file_name)
+    base_task = {'bucket_name': bucket_name, 'file_name': file_name, 'input_format': input_format,
+                 'date_column_name': date_column_name, 'time_column_name': time_column_name,
+                 'fill_boroughs': fill_boroughs, 'grid_levels': tuple(grid_levels)}
+    if input_format == 'parquet':
+        tasks = [dict(base_task, row_groups=row_groups)
+                 for row_groups in plan_parquet_units(aws_client, bucket_name, file_name, max_workers)]
+    elif encoding_from_key(file_name) != 'identity':
+        tasks = [dict(base_task, header=b'', byte_range=None)]
+    else:
+        size = aws_client.head_object(Bucket=bucket_name, Key=file_name)['ContentLength']
+        header, byte_ranges = plan_csv_units(aws_client, bucket_name, file_name,
+                                             max(max_workers, math.ceil(size / unit_bytes)))
+        tasks = [dict(base_task, header=header, byte_range=byte_range) for byte_range in byte_ranges]
+    plan_end = time.perf_counter()
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(client_kwargs or DEFAULT_CLIENT_KWARGS,)) as executor:
+        units = list(executor.map(_transform_unit, tasks))
+        transform_end = time.perf_counter()
+        if not units:
+            raise ValueError(f"{file_name} has no rows")
+
+        tables = [_from_ipc(unit['buffer']) for unit in units]
+        target_dtypes = common_dtypes([unit['dtypes'] for unit in units])
+        day_rows = {}
+        for unit in units:
+            for day, (start, end) in unit['days'].items():
+                day_rows[day] = day_rows.get(day, 0) + end - start
+
+        write_tasks = []
+        for days in _split_days(day_rows, 2 * max_workers):
+            buffers = []
+            for unit, table in zip(units, tables):
+                ranges = [unit['days'][day] for day in days if day in unit['days']]
+                if ranges:
+                    buffers.append(_to_ipc(table.slice(ranges[0][0], ranges[-1][1] - ranges[0][0])))
+            write_tasks.append({'buffers': buffers, 'target_dtypes': target_dtypes, 'days': days,
+                                'bucket_name': bucket_name, 'key_name': key_name, 'date_column_name': date_column_name,
+                                'output_format': output_format, 'compression': compression,
+                                'content_encoding': content_encoding, 'upload_threads': upload_threads,
+                                'sort_column': sort_column})
+
+        partitions = []
+        errors = []
+        futures = [(executor.submit(_write_days, task), task) for task in write_tasks]
+        for future, task in futures:
+            try:
+                result = future.result()
+                partitions += result['partitions']
+                errors += result['errors']
+            except Exception as e:
+                print(f"Error occurred while writing {task['days'][0]} to {task['days'][-1]}: {e}")
+                errors += [{'date': day, 'error': str(e)} for day in task['days']]
+        write_end = time.perf_counter()
+
+    partitions.sort(key=lambda partition: partition['date'])
+    write_report = {
+        'partitions': partitions,
+        'errors': errors,
+        'content_encoding': content_encoding,
+        'rows': sum(partition['rows'] for partition in partitions),
+        'bytes': sum(partition['bytes'] for partition in partitions),
+        'raw_bytes': sum(partition['raw_bytes'] for partition in partitions),
+        'seconds': round(write_end - transform_end, 3),
+    }
+
+    df = None
+    if keep_frame:
+        df = cast_to_common_dtypes(concat_frames([table.to_pandas() for table in tables]), target_dtypes)
+
+    report = {
+        'units': len(units),
+        'workers': max_workers,
+        'rows': sum(unit['transform']['rows'] for unit in units),
+        'buffer_bytes': sum(unit['buffer'].size for unit in units) + sum(buffer.size for task in write_tasks
+                                                                        for buffer in task['buffers']),
+        'plan_seconds': round(plan_end - start_time, 3),
+        'transform_seconds': round(transform_end - plan_end, 3),
+        'write_seconds': round(write_end - transform_end, 3),
+        'seconds': round(time.perf_counter() - start_time, 3),
+        'transform': merge_transform_reports([unit['transform'] for unit in units], transform_end - plan_end),
+        'write': write_report,
+    }
+    return df, report
@@ -0,0 +1,314 @@
+"""
+Day-partitioned writes of processed collision data to S3.
+
+S3 has no directories: a key like '2024/01/2024-01-31/2024-01-31.csv' is all it takes for
+the console and for prefix listings to show the folders. The writers used to create
+zero-byte '.../' placeholder objects for the year, month and day as well, which tripled
+the PUTs per partition; delete_folder_markers removes the ones already in the bucket.
+
+The processed data lives under '<key_name>/YYYY/MM/YYYY-MM-DD/YYYY-MM-DD.<ext>'. The
+frame is split into days in a single pass (one stable sort, then the boundaries between
+runs of equal days), so the cost no longer grows with days x rows. Days with no rows are
+never produced. Each partition is serialized and uploaded by a bounded thread pool; the
+threads share the caller's boto3 client, which is thread-safe and keeps one connection
+pool (10 connections by default, so keep max_workers at or below that unless the client
+was created with a larger max_pool_connections).
+
+Within a day, rows are written sorted by their finest grid cell (see grid.py), so the
+rows of a neighbourhood are stored together and a Parquet reader can skip the row
+groups of the cells a bounding-box query does not cover.
+
+CSV partitions can be compressed with gzip or zstd (content_encoding, or the
+S3_CONTENT_ENCODING environment variable, see compression.py); the key then ends in
+'.csv.gz' or '.csv.zst'. A day rewritten in another format or codec gets a new key, and
+update_manifest deletes the old one (see manifest.py); a caller that knows the key a day
+is stored under can pass it to write_day_partitions to rewrite it in place instead.
+"""
+import hashlib
+import io
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from nyc_collisions.compression import (
+    CompressingWriter, encoding_extension, encoding_from_key, put_object_kwargs, resolve_content_encoding
+)
+from nyc_collisions.formats import content_type, file_extension, format_from_key, write_dataframe
+from nyc_collisions.grid import FINEST_GRID_COLUMN
+
+DEFAULT_UPLOAD_WORKERS = 8
+
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+def partition_prefix(key_name, date):
+    """Return the day folder of a partition, i.e. 'collisions_processed_data/2024/01/2024-01-31/'."""
+    return f"{key_name}/{date.year}/{date.month:02d}/{date:%Y-%m-%d}/"
+
+def partition_key(key_name, date, output_format='csv', content_encoding='identity'):
+    """Return the key of a partition file, i.e. 'collisions_processed_data/2024/01/2024-01-31/2024-01-31.csv.gz'."""
+    return (f"{partition_prefix(key_name, date)}{date:%Y-%m-%d}{file_extension(output_format)}"
+            f"{encoding_extension(content_encoding)}")
+
+def iter_date_partitions(df, date_column_name):
+    """
+    Split a DataFrame into one frame per calendar day, in a single pass.
+
+    Rows keep their original order within a day. Rows without a date are left out; count
+    them with df[date_column_name].isna().sum() if they matter.
+
+    Args:
+    df (pandas.DataFrame): The data to split.
+    date_column_name (str): Name of the column containing the date information.
+
+    Yields:
+    tuple: (pandas.Timestamp of the day, pandas.DataFrame with the rows of that day).
+    """
+    days = pd.to_datetime(df[date_column_name]).to_numpy().astype('datetime64[D]')
+    valid = np.flatnonzero(~np.isnat(days))
+    if len(valid) == 0:
+        return
+
+    order = valid[np.argsort(days[valid], kind='stable')]
+    sorted_days = days[order]
+    starts = np.concatenate(([0], np.flatnonzero(sorted_days[1:] != sorted_days[:-1]) + 1))
+    ends = np.append(starts[1:], len(order))
+
+    for start, end in zip(starts, ends):
+        yield pd.Timestamp(sorted_days[start]), df.iloc[order[start:end]]
+
+def write_partitions(aws_client, bucket_name, key_name, df, date_column_name, output_format='csv', compression='snappy',
+                     max_workers=DEFAULT_UPLOAD_WORKERS, before_upload=None, sort_column=FINEST_GRID_COLUMN,
+                     content_encoding=None):
+    """
+    Serialize and upload one file per day through a bounded thread pool.
+
+    At most 2 x max_workers partitions are queued at a time, so a large frame is not
+    copied into every partition up front. A failed partition is reported and does not stop
+    the others.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by every upload thread.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name under which data will be stored in S3.
+    df (pandas.DataFrame): DataFrame to upload.
+    date_column_name (str): Name of the column containing the date information.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Partitions serialized and uploaded at the same time.
+    before_upload (callable): Optional function called with the partition date before its
+    upload, on the upload thread.
+    sort_column (str): Column each day is sorted by before it is written, if the frame has
+    it (stable, missing values last). None keeps the rows in their order.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet.
+
+    Returns:
+    dict: Run summary with partitions (date, key, rows, bytes, checksum, max_collision_id
+    and seconds for each uploaded day), errors (date and message), rows, bytes and seconds.
+    """
+    return write_day_partitions(aws_client, bucket_name, key_name, iter_date_partitions(df, date_column_name),
+                                output_format=output_format, compression=compression, max_workers=max_workers,
+                                before_upload=before_upload, sort_column=sort_column, content_encoding=content_encoding)
+
+def write_day_partitions(aws_client, bucket_name, key_name, days, output_format='csv', compression='snappy',
+                         max_workers=DEFAULT_UPLOAD_WORKERS, before_upload=None, sort_column=FINEST_GRID_COLUMN,
+                         content_encoding=None, keys=None):
+    """
+    Upload frames that are already split by day, i.e. partitions merged one at a time.
+
+    Same as write_partitions, which calls it with iter_date_partitions.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by every upload thread.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name under which data will be stored in S3.
+    days (iterable): (date, pandas.DataFrame) pairs, one per day.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec (i.e. 'snappy', 'zstd'). Ignored for CSV.
+    max_workers (int): Partitions serialized and uploaded at the same time.
+    before_upload (callable): Optional function called with the partition date before its
+    upload, on the upload thread.
+    sort_column (str): Column each day is sorted by before it is written, if the frame has
+    it (stable, missing values last). None keeps the rows in their order.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet.
+    keys (dict): 'YYYY-MM-DD' to the key a day is already stored under, i.e. from the
+    manifest. Those days are rewritten under the same key, in its format and codec, rather
+    than in output_format and content_encoding.
+
+    Returns:
+    dict: Run summary with partitions (date, key, rows, bytes, raw_bytes, checksum,
+    max_collision_id, seconds, serialize_seconds, compress_seconds and put_seconds for each
+    uploaded day), errors (date and message), content_encoding, rows, bytes (as stored),
+    raw_bytes (before compression) and seconds.
+    """
+    start_time = time.perf_counter()
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+    keys = keys or {}
+
+    def upload(date, subset_df):
+        partition_start = time.perf_counter()
+        if before_upload is not None:
+            before_upload(date)
+        key = keys.get(f"{date:%Y-%m-%d}")
+        if key is None:
+            day_format, day_encoding = output_format, content_encoding
+            key = partition_key(key_name, date, day_format, day_encoding)
+        else:
+            day_format, day_encoding = format_from_key(key), encoding_from_key(key)
+        if sort_column is not None and sort_column in subset_df.columns:
+            subset_df = subset_df.sort_values(sort_column, kind='stable', na_position='last')
+        # Serialized straight into the codec: only the compressed body is ever held in full
+        serialize_start = time.perf_counter()
+        body = io.BytesIO()
+        with CompressingWriter(body, day_encoding) as writer:
+            write_dataframe(subset_df, writer, day_format, compression)
+        put_start = time.perf_counter()
+        with body.getbuffer() as view:
+            checksum = hashlib.md5(view).hexdigest()
+        body.seek(0)
+        aws_client.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType=content_type(day_format),
+                              **put_object_kwargs(day_encoding))
+        has_ids = 'collision_id' in subset_df.columns
+        return {
+            'date': f"{date:%Y-%m-%d}",
+            'key': key,
+            'rows': len(subset_df),
+            'bytes': writer.bytes_out,
+            'raw_bytes': writer.bytes_in,
+            'checksum': checksum,
+            'max_collision_id': int(subset_df['collision_id'].max()) if has_ids else None,
+            'seconds': round(time.perf_counter() - partition_start, 3),
+            'serialize_seconds': round(put_start - serialize_start - writer.compress_seconds, 4),
+            'compress_seconds': round(writer.compress_seconds, 4),
+            'put_seconds': round(time.perf_counter() - put_start, 4),
+        }
+
+    partitions = []
+    errors = []
+
+    def collect(done):
+        for future in done:
+            date = in_flight.pop(future)
+            try:
+                partitions.append(future.result())
+            except Exception as e:
+                print(f"Error occurred while processing date {date:%Y-%m-%d}: {e}")
+                errors.append({'date': f"{date:%Y-%m-%d}", 'error': str(e)})
+
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for date, subset_df in days:
+            if len(in_flight) >= 2 * max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(upload, date, subset_df)] = date
+        collect(list(in_flight))
+
+    partitions.sort(key=lambda partition: partition['date'])
+    return {
+        'partitions': partitions,
+        'errors': errors,
+        'content_encoding': content_encoding,
+        'rows': sum(partition['rows'] for partition in partitions),
+        'bytes': sum(partition['bytes'] for partition in partitions),
+        'raw_bytes': sum(partition['raw_bytes'] for partition in partitions),
+        'seconds': round(time.perf_counter() - start_time, 3),
+    }
+
+def add_partition_metrics(stage, report):
+    """Add the rows, bytes, partitions, errors and serialize/compress/PUT time of a write_partitions report to a metrics stage."""
+    partitions = report['partitions']
+    stage.add(rows=report['rows'], bytes=report['bytes'], raw_bytes=report['raw_bytes'], partitions=len(partitions),
+              errors=len(report['errors']), requests=len(partitions) + len(report['errors']),
+              serialize_ms=round(1000 * sum(partition['serialize_seconds'] for partition in partitions), 3),
+              compress_ms=round(1000 * sum(partition['compress_seconds'] for partition in partitions), 3),
+              put_ms=round(1000 * sum(partition['put_seconds'] for partition in partitions), 3))
+
+def print_partition_report(report, per_partition=False):
+    """
+    Print a write_partitions summary: totals, latency percentiles and the largest partition.
+
+    Args:
+    report (dict): As returned by write_partitions.
+    per_partition (bool): Also print one line per partition.
+    """
+    partitions = report['partitions']
+    if per_partition:
+        for partition in partitions:
+            print(f"{partition['date']}: {partition['rows']} rows, {partition['bytes']} bytes in {partition['seconds']} seconds")
+
+    print(f"Uploaded {len(partitions)} partitions ({report['rows']} rows, {report['bytes'] / 1e6:.1f} MB) "
+          f"in {report['seconds']} seconds, {len(report['errors'])} failed")
+    if report.get('content_encoding', 'identity') != 'identity' and report['bytes']:
+        print(f"Compressed with {report['content_encoding']}: {report['raw_bytes'] / 1e6:.1f} MB of CSV stored in "
+              f"{report['bytes'] / 1e6:.1f} MB ({report['raw_bytes'] / report['bytes']:.1f}x)")
+    if partitions:
+        latencies = np.array([partition['seconds'] for partition in partitions])
+        largest = max(partitions, key=lambda partition: partition['bytes'])
+        print(f"Partition latency p50 {np.percentile(latencies, 50):.3f}s, p95 {np.percentile(latencies, 95):.3f}s, "
+              f"max {latencies.max():.3f}s; largest {largest['date']} ({largest['bytes']} bytes)")
+
+# ------------------------------------------ FOLDER MARKERS ------------------------------------------
+def iter_folder_markers(aws_client, bucket_name, prefix):
+    """
+    Yield the keys of the zero-byte folder placeholders under a prefix, using a paginated listing.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    prefix (str): Key prefix to scan, i.e. 'collisions_processed_data/'.
+
+    Yields:
+    str: Keys ending in '/' whose object is empty.
+    """
+    paginator = aws_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/') and obj['Size'] == 0:
+                yield obj['Key']
+
+def delete_folder_markers(aws_client, bucket_name, prefix, dry_run=False, batch_size=DELETE_BATCH_SIZE):
+    """
+    Remove the folder placeholders under a prefix with batched delete_objects calls.
+
+    Data objects are never touched: only empty objects whose key ends in '/' are deleted.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    prefix (str): Key prefix to clean up, i.e. 'collisions_processed_data/'.
+    dry_run (bool): Only count the markers.
+    batch_size (int): Keys per delete_objects request, at most 1000.
+
+    Returns:
+    dict: markers found, deleted, delete_requests sent and errors (key and message).
+    """
+    batch_size = min(batch_size, DELETE_BATCH_SIZE)
+    summary = {'markers': 0, 'deleted': 0, 'delete_requests': 0, 'errors': []}
+    batch = []
+
+    def delete(keys):
+        response = aws_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        errors = response.get('Errors', [])
+        summary['delete_requests'] += 1
+        summary['deleted'] += len(keys) - len(errors)
+        summary['errors'].extend({'key': error['Key'], 'error': error.get('Message')} for error in errors)
+
+    for key in iter_folder_markers(aws_client, bucket_name, prefix):
+        summary['markers'] += 1
+        if dry_run:
+            continue
+        batch.append(key)
+        if len(batch) == batch_size:
+            delete(batch)
+            batch = []
+    if batch:
+        delete(batch)
+    return summary
@@ -0,0 +1,223 @@
+"""
+Opt-in profiling of a whole pipeline run: cProfile hot spots and tracemalloc allocations.
+
+Entry points are wrapped with @profiled_run(name). The switch is off unless the PROFILE
+environment variable is set or the call asks for it (profile=True, or {"profile": true} in a
+Lambda event). When it is off the wrapper only reads that flag: cProfile, pstats and
+tracemalloc are not even imported, so the decorator can stay in production images.
+
+- PROFILE=1 (profile=True): cProfile and tracemalloc. tracemalloc records a stack for every
+  allocation, which slows pandas-heavy code down many times over, so the timings in the
+  hot-spot report are inflated; use it to find where the memory goes.
+- PROFILE=cpu (profile='cpu'): cProfile only, a few percent slower than a normal run.
+
+The run writes its reports to PROFILE_DIR (default './profiles', '/tmp/profiles' inside
+Lambda) and prints the top of them:
+
+- <name>-<time>.pstats: the raw cProfile data, for snakeviz or pstats;
+- <name>-<time>.hotspots.txt: functions by cumulative and by own time;
+- <name>-<time>.memory.txt: the peak traced memory, and the lines and call stacks that held
+  the most memory at that peak (i.e. DataFrame.from_records, to_csv, StringIO.getvalue).
+
+A snapshot taken at the end would only show what is still alive, so a background thread
+watches the traced memory and takes a snapshot whenever it reaches a new high.
+"""
+import contextlib
+import functools
+import os
+import threading
+import time
+from datetime import datetime
+
+PROFILE_ENV = 'PROFILE'
+PROFILE_DIR_ENV = 'PROFILE_DIR'
+PROFILE_FRAMES_ENV = 'PROFILE_FRAMES'
+DEFAULT_TOP = 25
+# Frames kept per allocation, enough to reach the pipeline code from inside pandas.
+# Every frame makes each allocation more expensive to trace.
+DEFAULT_FRAMES = 10
+# Frames printed per call stack in the memory report
+STACK_FRAMES_SHOWN = 8
+
+def profiling_mode(requested=None):
+    """
+    Resolve the switch of one run.
+
+    Args:
+    requested: True/'1'/'all' for cProfile and tracemalloc, 'cpu' for cProfile only, False
+    to turn it off, None to follow the PROFILE environment variable.
+
+    Returns:
+    str: 'all', 'cpu', or None when profiling is off.
+    """
+    if requested is None:
+        requested = os.environ.get(PROFILE_ENV)
+    if requested == 'cpu':
+        return 'cpu'
+    if requested in (True, 1, '1', 'all', 'true'):
+        return 'all'
+    return None
+
+def default_profile_dir():
+    if PROFILE_DIR_ENV in os.environ:
+        return os.environ[PROFILE_DIR_ENV]
+    # Only /tmp is writable inside Lambda
+    return '/tmp/profiles' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'profiles'
+
+class _PeakSnapshots:
+    """
+    Take a tracemalloc snapshot every time the traced memory grows past the last one by `growth`.
+
+    A snapshot copies every live trace while holding the GIL, so they are kept few: one per
+    50% of growth, about twenty on the way from 1 MB to a 1 GB peak. The early ones are
+    small and cheap, and even a run that stays at a few MB gets a snapshot of its own peak.
+    """
+
+    def __init__(self, interval=0.05, growth=1.5):
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self.snapshot_bytes = 0
+        self.snapshots = 0
+        self.snapshot_seconds = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        import tracemalloc
+
+        while not self.stopped.wait(self.interval):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > self.snapshot_bytes * self.growth:
+                start_time = time.perf_counter()
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_bytes = current
+                self.snapshots += 1
+                self.snapshot_seconds += time.perf_counter() - start_time
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        self.stopped.set()
+        self.thread.join()
+
+def _hotspot_report(profiler, top):
+    import io
+    import pstats
+
+    buffer = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buffer).strip_dirs()
+    for sort in ('cumulative', 'tottime'):
+        buffer.write(f"---------------- top {top} functions by {sort} time ----------------\n")
+        stats.sort_stats(sort).print_stats(top)
+    return buffer.getvalue()
+
+def _memory_report(peaks, peak_bytes, top):
+    import tracemalloc
+
+    lines = [f"Peak traced memory: {peak_bytes / 1e6:.1f} MB"]
+    snapshot = peaks.snapshot
+    if snapshot is None:
+        # The run ended before the first poll: the end state is as good as any
+        snapshot = tracemalloc.take_snapshot()
+        lines.append('No snapshot taken during the run, showing the memory held at the end of it')
+    else:
+        lines.append(f"{peaks.snapshots} snapshot(s) taken in {peaks.snapshot_seconds:.2f} seconds, "
+                     f"showing the one nearest to the peak ({peaks.snapshot_bytes / 1e6:.1f} MB)")
+    # Leave out the profiler's own allocations
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '*/cProfile.py'),
+        tracemalloc.Filter(False, '*/pstats.py'),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ])
+    lines.append(f"---------------- top {top} lines ----------------")
+    for stat in snapshot.statistics('lineno')[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1e6:9.1f} MB {stat.count:9d} blocks  {frame.filename}:{frame.lineno}")
+    lines.append('---------------- top 5 call stacks ----------------')
+    for stat in snapshot.statistics('traceback')[:5]:
+        lines.append(f"{stat.size / 1e6:.1f} MB in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format(limit=STACK_FRAMES_SHOWN, most_recent_first=True))
+    return '\n'.join(lines)
+
+def run_profiled(name, function, *args, memory=True, output_dir=None, top=DEFAULT_TOP, frames=None, **kwargs):
+    """
+    Call function(*args, **kwargs) under cProfile (and tracemalloc), then write and print the reports.
+
+    Args:
+    name (str): Name of the run, the prefix of the report files.
+    function (callable): The run.
+    memory (bool): Also trace allocations with tracemalloc.
+    output_dir (str): Folder of the reports. Defaults to PROFILE_DIR or './profiles'.
+    top (int): Functions and lines listed in the reports.
+    frames (int): Stack frames kept per allocation. Defaults to PROFILE_FRAMES or 10.
+
+    Returns:
+    The result of the function.
+    """
+    import cProfile
+    import tracemalloc
+
+    output_dir = output_dir or default_profile_dir()
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.join(output_dir, f"{name}-{datetime.now():%Y%m%dT%H%M%S%f}"[:-3])
+    frames = frames or int(os.environ.get(PROFILE_FRAMES_ENV, DEFAULT_FRAMES))
+
+    profiler = cProfile.Profile()
+    peaks = _PeakSnapshots() if memory else contextlib.nullcontext()
+    if memory:
+        tracemalloc.start(frames)
+    start_time = time.perf_counter()
+    try:
+        with peaks:
+            profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+    finally:
+        seconds = time.perf_counter() - start_time
+        profiler.dump_stats(f"{prefix}.pstats")
+        hotspots = _hotspot_report(profiler, top)
+        with open(f"{prefix}.hotspots.txt", 'w') as report_file:
+            report_file.write(hotspots)
+        print(f"Profiled {name} in {seconds:.1f} seconds, reports in {prefix}.*")
+        print('\n'.join(hotspots.splitlines()[:top // 2 + 5]))
+
+        if memory:
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            report = _memory_report(peaks, peak_bytes, top)
+            tracemalloc.stop()
+            with open(f"{prefix}.memory.txt", 'w') as report_file:
+                report_file.write(report + '\n')
+            print('\n'.join(report.splitlines()[:top // 2 + 3]))
+
+def profiled_run(name, enabled_by=None):
+    """
+    Decorator adding the opt-in profiling switch to a pipeline entry point.
+
+    The wrapped function takes an extra keyword argument, profile (see profiling_mode; None
+    follows the PROFILE environment variable). enabled_by, if given, reads the switch from the
+    call arguments instead, i.e. lambda event, context: (event or {}).get('profile') for a
+    Lambda handler.
+
+    Args:
+    name (str): Name of the run in the report files.
+    enabled_by (callable): Optional function of the call arguments returning the switch or None.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, profile=None, **kwargs):
+            if profile is None and enabled_by is not None:
+                profile = enabled_by(*args, **kwargs)
+            mode = profiling_mode(profile)
+            if mode is None:
+                return function(*args, **kwargs)
+            return run_profiled(name, function, *args, memory=mode == 'all', **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,246 @@
+"""
+Pre-aggregated rollups of the processed data for the dashboards.
+
+The dashboards only need counts of crashes, injuries and fatalities by day (or hour),
+borough and contributing factor, and used to read every day partition to get them. The
+loads now keep rollup tables next to the partitions, one small file per grain and month:
+
+    '<key_name>/_rollups/daily/2024/2024-01.csv'    crash_date x borough x factor
+    '<key_name>/_rollups/hourly/2024/2024-01.csv'   crash_date x crash_hour x borough x factor
+
+with a crashes column and the sum of every number_of_* column. The factor is
+contributing_factor_vehicle_1, the primary cause of the crash, so each crash is counted
+once; crashes without a borough or factor are counted under UNKNOWN_BOROUGH and
+UNKNOWN_FACTOR.
+
+Whenever days are (re)written, update_rollups recomputes only those days, with one
+vectorized groupby over their rows, and replaces their rows in the month slices they
+fall in; the other days of a slice are kept as they are. Every load rewrites whole days
+(the date-based runs fetch complete days, the incremental runs merge into the stored
+partition), so the rows of the days written are all a day has. A slice is replaced with a
+conditional PUT on the ETag it was read with, like the manifest, so two runs updating the
+same month cannot drop each other's days.
+
+read_rollups reads the slices of a date range back for a dashboard query.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from nyc_collisions.formats import content_type, file_extension, read_dataframe, serialize_dataframe
+from nyc_collisions.schema import COUNT_COLUMNS
+
+ROLLUPS_NAME = '_rollups'
+
+# Grouping columns of each grain, after the date
+ROLLUP_GRAINS = {
+    'daily': ['crash_date', 'borough', 'contributing_factor'],
+    'hourly': ['crash_date', 'crash_hour', 'borough', 'contributing_factor'],
+}
+FACTOR_COLUMN_NAME = 'contributing_factor_vehicle_1'
+UNKNOWN_BOROUGH = 'UNKNOWN'
+UNKNOWN_FACTOR = 'Unspecified'
+MEASURE_COLUMNS = ['crashes'] + COUNT_COLUMNS
+
+# Slices are read back from CSV with these types, so they concatenate with fresh rollups
+_CSV_DTYPES = {'crash_date': str, 'crash_hour': 'Int8', 'borough': str, 'contributing_factor': str}
+
+DEFAULT_ROLLUP_WORKERS = 8
+
+def rollup_slice_key(key_name, grain, month, output_format='csv'):
+    """Return the key of a month slice, i.e. 'collisions_processed_data/_rollups/daily/2024/2024-01.csv'."""
+    return f"{key_name}/{ROLLUPS_NAME}/{grain}/{month[:4]}/{month}{file_extension(output_format)}"
+
+def _day_labels(dates):
+    # 'YYYY-MM-DD' of every date, formatting each distinct day once
+    codes, days = pd.factorize(dates.dt.normalize())
+    return pd.Index(days).strftime('%Y-%m-%d').to_numpy(dtype=object)[codes]
+
+def compute_rollup(df, grain='daily', date_column_name='crash_date'):
+    """
+    Aggregate crash rows into one rollup row per group of a grain.
+
+    Args:
+    df (pandas.DataFrame): Crashes as written by transform_data (crash_hour is needed for
+    the hourly grain).
+    grain (str): A key of ROLLUP_GRAINS.
+    date_column_name (str): Name of the column containing the date information.
+
+    Returns:
+    pandas.DataFrame: The grouping columns (crash_date as 'YYYY-MM-DD'), crashes and the
+    number_of_* sums, sorted by the grouping columns. Rows without a date are left out.
+    """
+    dates = pd.to_datetime(df[date_column_name])
+    has_date = dates.notna().to_numpy()
+    df, dates = df[has_date], dates[has_date]
+
+    def labels(column_name, unknown):
+        # Categorical codes group much faster than strings
+        if column_name not in df.columns:
+            return pd.Categorical.from_codes([0] * len(df), categories=[unknown])
+        values = df[column_name].astype('category')
+        if unknown not in values.cat.categories:
+            values = values.cat.add_categories(unknown)
+        return values.fillna(unknown).array
+
+    columns = ROLLUP_GRAINS[grain]
+    frame = pd.DataFrame({'crash_date': _day_labels(dates)})
+    if 'crash_hour' in columns:
+        frame['crash_hour'] = df['crash_hour'].astype('Int8').array
+    frame['borough'] = labels('borough', UNKNOWN_BOROUGH)
+    frame['contributing_factor'] = labels(FACTOR_COLUMN_NAME, UNKNOWN_FACTOR)
+    frame['crashes'] = 1
+    for column in COUNT_COLUMNS:
+        frame[column] = df[column].fillna(0).to_numpy(dtype='int64') if column in df.columns else 0
+
+    rollup = frame.groupby(columns, observed=True, dropna=False, sort=True)[MEASURE_COLUMNS].sum().reset_index()
+    for column in ('borough', 'contributing_factor'):
+        rollup[column] = rollup[column].astype(str)
+    return rollup
+
+def empty_rollup(grain='daily'):
+    """Return a rollup without rows, with the columns of a grain."""
+    return compute_rollup(pd.DataFrame({'crash_date': pd.to_datetime([]), 'crash_hour': pd.array([], dtype='Int8')}), grain)
+
+def _load_slice(aws_client, bucket_name, key, output_format):
+    # The stored slice and its ETag, (None, None) if the month has no slice yet
+    try:
+        response = aws_client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return read_dataframe(response['Body'].read(), output_format, dtype=_CSV_DTYPES), response['ETag']
+
+def _replace_days(existing_df, rollup_df, grain):
+    # The slice with the rows of the recomputed days swapped for their new rollup
+    if existing_df is None:
+        return rollup_df
+    kept = existing_df[~existing_df['crash_date'].isin(rollup_df['crash_date'].unique())]
+    merged = pd.concat([kept, rollup_df], ignore_index=True)
+    return merged.sort_values(ROLLUP_GRAINS[grain], kind='stable', ignore_index=True)
+
+def update_rollups(aws_client, bucket_name, key_name, df, date_column_name='crash_date', days=None,
+                   grains=tuple(ROLLUP_GRAINS), output_format='csv', max_workers=DEFAULT_ROLLUP_WORKERS,
+                   max_attempts=5):
+    """
+    Recompute the rollups of the days in df and write them into their month slices.
+
+    Args:
+    aws_client: Boto3 client for AWS S3, shared by every thread.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data; the rollups go under '<key_name>/_rollups/'.
+    df (pandas.DataFrame): Every row of the days to recompute, i.e. the frame just written.
+    date_column_name (str): Name of the column containing the date information.
+    days (list): Only recompute these 'YYYY-MM-DD' days, i.e. the partitions that were
+    written successfully. None for every day in df.
+    grains (tuple): Keys of ROLLUP_GRAINS to maintain.
+    output_format (str): 'csv' or 'parquet'.
+    max_workers (int): Slices read and written at the same time.
+    max_attempts (int): Times to reload and retry a slice when another writer got there first.
+
+    Returns:
+    dict: Report with slices (grain, month, key, days recomputed, rows, bytes), errors
+    (grain, month and message), rows (rollup rows recomputed), bytes and seconds.
+    """
+    start_time = time.perf_counter()
+    if days is not None:
+        df = df[pd.Series(_day_labels(pd.to_datetime(df[date_column_name]))).isin(set(days)).to_numpy()]
+
+    tasks = []
+    for grain in grains:
+        rollup = compute_rollup(df, grain, date_column_name)
+        months = rollup['crash_date'].str.slice(0, 7)
+        for month, month_rollup in rollup.groupby(months.to_numpy(), sort=True):
+            tasks.append((grain, month, month_rollup.reset_index(drop=True)))
+
+    def write_slice(task):
+        grain, month, rollup_df = task
+        key = rollup_slice_key(key_name, grain, month, output_format)
+        for attempt in range(max_attempts):
+            existing_df, etag = _load_slice(aws_client, bucket_name, key, output_format)
+            body = serialize_dataframe(_replace_days(existing_df, rollup_df, grain), output_format)
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                aws_client.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType=content_type(output_format),
+                                      **condition)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict') or attempt == max_attempts - 1:
+                    raise
+        return {'grain': grain, 'month': month, 'key': key, 'days': int(rollup_df['crash_date'].nunique()),
+                'rows': len(rollup_df), 'bytes': len(body)}
+
+    slices = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(write_slice, task): task for task in tasks}
+        for future, (grain, month, _) in futures.items():
+            try:
+                slices.append(future.result())
+            except Exception as e:
+                print(f"Error occurred while updating the {grain} rollup of {month}: {e}")
+                errors.append({'grain': grain, 'month': month, 'error': str(e)})
+
+    return {
+        'slices': slices,
+        'errors': errors,
+        'rows': sum(rollup_slice['rows'] for rollup_slice in slices),
+        'bytes': sum(rollup_slice['bytes'] for rollup_slice in slices),
+        'seconds': round(time.perf_counter() - start_time, 3),
+    }
+
+def add_rollup_metrics(stage, report):
+    """Add the rows, bytes, slices and errors of an update_rollups report to a metrics stage."""
+    stage.add(rows=report['rows'], bytes=report['bytes'], slices=len(report['slices']), errors=len(report['errors']),
+              requests=2 * (len(report['slices']) + len(report['errors'])))
+
+def format_rollup_report(report):
+    """Render the report of update_rollups as one line."""
+    days = sum(rollup_slice['days'] for rollup_slice in report['slices'] if rollup_slice['grain'] == 'daily')
+    return (f"Rollups: {days} days recomputed, {len(report['slices'])} slices written ({report['rows']} rows, "
+            f"{report['bytes'] / 1e3:.1f} KB) in {report['seconds']} seconds, {len(report['errors'])} failed")
+
+def read_rollups(aws_client, bucket_name, key_name, grain='daily', start_date=None, end_date=None, output_format='csv'):
+    """
+    Read the rollup rows of a date range, fetching only the month slices it covers.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Base key name of the partitioned data.
+    grain (str): A key of ROLLUP_GRAINS.
+    start_date (str): First day, 'YYYY-MM-DD'. None to start at the first slice.
+    end_date (str): Last day (included), 'YYYY-MM-DD'. None to end at the last slice.
+    output_format (str): 'csv' or 'parquet', as the slices were written.
+
+    Returns:
+    pandas.DataFrame: The rollup rows of the range, sorted by the grouping columns.
+    """
+    if start_date is None or end_date is None:
+        months = []
+        paginator = aws_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{key_name}/{ROLLUPS_NAME}/{grain}/"):
+            months += [entry['Key'].rsplit('/', 1)[1][:7] for entry in page.get('Contents', [])]
+        if not months:
+            return empty_rollup(grain)
+        start_date = start_date or f"{min(months)}-01"
+        end_date = end_date or f"{max(months)}-31"
+
+    first_month = datetime.strptime(start_date[:7], '%Y-%m')
+    last_month = datetime.strptime(end_date[:7], '%Y-%m')
+    months = [f"{month:%Y-%m}" for month in pd.date_range(first_month, last_month, freq='MS')]
+
+    def read_month(month):
+        return _load_slice(aws_client, bucket_name, rollup_slice_key(key_name, grain, month, output_format), output_format)[0]
+
+    with ThreadPoolExecutor(max_workers=DEFAULT_ROLLUP_WORKERS) as executor:
+        frames = [frame for frame in executor.map(read_month, months) if frame is not None]
+    if not frames:
+        return empty_rollup(grain)
+    rollup = pd.concat(frames, ignore_index=True)
+    in_range = (rollup['crash_date'] >= start_date[:10]) & (rollup['crash_date'] <= end_date[:10])
+    return rollup[in_range.to_numpy()].reset_index(drop=True)
@@ -0,0 +1,245 @@
+"""
+Column layout and dtypes of the Socrata collision datasets: crashes, persons and vehicles.
+
+The SODA API leaves empty fields out of a record altogether, so a single page does not
+tell us every column the dataset has. Writers that stream page by page use these lists
+to keep the same header and column order from the first chunk to the last.
+
+The API also returns every value as a string. Left alone, pandas stores each of them as
+a Python object; casting the counts to small nullable ints, the coordinates to float32
+and the repeated text to categoricals cuts the memory of a crash frame several times.
+"""
+import json
+
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+# Motor Vehicle Collisions - Crashes (h9gi-nx95), in the order the dataset publishes them
+CRASH_COLUMNS = [
+    'crash_date', 'crash_time', 'borough', 'zip_code', 'latitude', 'longitude', 'location',
+    'on_street_name', 'cross_street_name', 'off_street_name',
+    'number_of_persons_injured', 'number_of_persons_killed',
+    'number_of_pedestrians_injured', 'number_of_pedestrians_killed',
+    'number_of_cyclist_injured', 'number_of_cyclist_killed',
+    'number_of_motorist_injured', 'number_of_motorist_killed',
+    'contributing_factor_vehicle_1', 'contributing_factor_vehicle_2', 'contributing_factor_vehicle_3',
+    'contributing_factor_vehicle_4', 'contributing_factor_vehicle_5',
+    'collision_id',
+    'vehicle_type_code1', 'vehicle_type_code2', 'vehicle_type_code_3', 'vehicle_type_code_4',
+    'vehicle_type_code_5',
+]
+
+COUNT_COLUMNS = [
+    'number_of_persons_injured', 'number_of_persons_killed',
+    'number_of_pedestrians_injured', 'number_of_pedestrians_killed',
+    'number_of_cyclist_injured', 'number_of_cyclist_killed',
+    'number_of_motorist_injured', 'number_of_motorist_killed',
+]
+
+# Low-cardinality text columns: a few dozen distinct values repeated millions of times
+CATEGORY_COLUMNS = [
+    'borough', 'zip_code',
+    'contributing_factor_vehicle_1', 'contributing_factor_vehicle_2', 'contributing_factor_vehicle_3',
+    'contributing_factor_vehicle_4', 'contributing_factor_vehicle_5',
+    'vehicle_type_code1', 'vehicle_type_code2', 'vehicle_type_code_3', 'vehicle_type_code_4',
+    'vehicle_type_code_5',
+]
+
+# Compact dtypes for the crashes dataset. Counts are nullable because older records leave them empty.
+CRASH_DTYPES = {
+    'crash_date': 'datetime64[ns]',
+    'crash_time': 'string',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'location': 'string',
+    'on_street_name': 'string',
+    'cross_street_name': 'string',
+    'off_street_name': 'string',
+    'collision_id': 'int64',
+    **{column: 'Int16' for column in COUNT_COLUMNS},
+    **{column: 'category' for column in CATEGORY_COLUMNS},
+}
+
+# Motor Vehicle Collisions - Person (f55k-p6yu): one record per person involved in a crash
+PERSON_COLUMNS = [
+    'unique_id', 'collision_id', 'crash_date', 'crash_time', 'person_id', 'person_type', 'person_injury',
+    'vehicle_id', 'person_age', 'ejection', 'emotional_status', 'bodily_injury', 'position_in_vehicle',
+    'safety_equipment', 'ped_location', 'ped_action', 'complaint', 'ped_role',
+    'contributing_factor_1', 'contributing_factor_2', 'person_sex',
+]
+
+PERSON_CATEGORY_COLUMNS = [
+    'person_type', 'person_injury', 'ejection', 'emotional_status', 'bodily_injury', 'position_in_vehicle',
+    'safety_equipment', 'ped_location', 'ped_action', 'complaint', 'ped_role',
+    'contributing_factor_1', 'contributing_factor_2', 'person_sex',
+]
+
+PERSON_DTYPES = {
+    'unique_id': 'int64',
+    'collision_id': 'int64',
+    'crash_date': 'datetime64[ns]',
+    'crash_time': 'string',
+    'person_id': 'string',
+    'vehicle_id': 'Int64',
+    'person_age': 'Int16',
+    **{column: 'category' for column in PERSON_CATEGORY_COLUMNS},
+}
+
+# Motor Vehicle Collisions - Vehicles (bm4k-52h4): one record per vehicle involved in a crash
+VEHICLE_COLUMNS = [
+    'unique_id', 'collision_id', 'crash_date', 'crash_time', 'vehicle_id', 'state_registration', 'vehicle_type',
+    'vehicle_make', 'vehicle_model', 'vehicle_year', 'travel_direction', 'vehicle_occupants', 'driver_sex',
+    'driver_license_status', 'driver_license_jurisdiction', 'pre_crash', 'point_of_impact', 'vehicle_damage',
+    'vehicle_damage_1', 'vehicle_damage_2', 'vehicle_damage_3', 'public_property_damage',
+    'public_property_damage_type', 'contributing_factor_1', 'contributing_factor_2',
+]
+
+VEHICLE_CATEGORY_COLUMNS = [
+    'state_registration', 'vehicle_type', 'vehicle_make', 'travel_direction', 'driver_sex',
+    'driver_license_status', 'driver_license_jurisdiction', 'pre_crash', 'point_of_impact', 'vehicle_damage',
+    'vehicle_damage_1', 'vehicle_damage_2', 'vehicle_damage_3', 'public_property_damage',
+    'contributing_factor_1', 'contributing_factor_2',
+]
+
+VEHICLE_DTYPES = {
+    'unique_id': 'int64',
+    'collision_id': 'int64',
+    'crash_date': 'datetime64[ns]',
+    'crash_time': 'string',
+    'vehicle_id': 'Int64',
+    'vehicle_model': 'string',
+    'vehicle_year': 'Int16',
+    'vehicle_occupants': 'Int16',
+    'public_property_damage_type': 'string',
+    **{column: 'category' for column in VEHICLE_CATEGORY_COLUMNS},
+}
+
+# ------------------------------------------ APPLYING THE SCHEMA ------------------------------------------
+def _as_text(value):
+    # Nested values such as the 'location' point are kept as JSON text
+    if value is None or isinstance(value, str) or pd.isna(value):
+        return value
+    return json.dumps(value)
+
+def apply_schema(df, dtypes):
+    """
+    Cast the columns of a freshly fetched DataFrame to their declared dtypes.
+
+    Socrata returns every value as a string, so numbers are parsed (anything unparseable
+    becomes missing) and text columns become categoricals or pandas strings.
+
+    Args:
+    df (pandas.DataFrame): Records as built by pd.DataFrame.from_records.
+    dtypes (dict): Column name to dtype, i.e. CRASH_DTYPES. Columns not listed are left alone.
+
+    Returns:
+    pandas.DataFrame: The same DataFrame, with its columns cast in place.
+    """
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        if dtype.startswith('datetime64'):
+            df[column] = pd.to_datetime(df[column], format='ISO8601')
+        elif dtype in ('category', 'string'):
+            values = df[column]
+            if dtype == 'string' and isinstance(values.dtype, pd.StringDtype):
+                # Recent pandas already builds string columns from the records
+                continue
+            if values.dtype == object:
+                values = values.map(_as_text)
+            df[column] = values.astype(dtype)
+        else:
+            # Integer and float columns. A straight cast is several times faster than
+            # pd.to_numeric, which is only needed when a page holds an unparseable value.
+            try:
+                df[column] = df[column].astype(dtype)
+            except (TypeError, ValueError):
+                df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+    return df
+
+def records_to_frame(records, columns=CRASH_COLUMNS, dtypes=CRASH_DTYPES):
+    """
+    Build a typed DataFrame from a page of Socrata records.
+
+    Args:
+    records (list): Records as returned by the Socrata API.
+    columns (list): Column names, in output order.
+    dtypes (dict): Column name to dtype.
+
+    Returns:
+    pandas.DataFrame: The page with every declared column cast.
+    """
+    return apply_schema(pd.DataFrame.from_records(records, columns=columns), dtypes)
+
+def concat_frames(frames, columns=CRASH_COLUMNS, dtypes=CRASH_DTYPES):
+    """
+    Concatenate typed pages without losing their categorical dtypes.
+
+    pd.concat turns categoricals back into objects when the pages have different
+    categories, so the categories are unified first.
+
+    Args:
+    frames (list): DataFrames built by records_to_frame.
+    columns (list): Column names of an empty result, when there are no frames.
+    dtypes (dict): Column name to dtype of an empty result.
+
+    Returns:
+    pandas.DataFrame: One DataFrame with a fresh RangeIndex.
+    """
+    if not frames:
+        return records_to_frame([], columns, dtypes)
+
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            # A page where the column is always missing has no categories (of dtype float64) to unify
+            with_values = [frame[column] for frame in frames if len(frame[column].cat.categories)]
+            if not with_values:
+                continue
+            categories = union_categoricals(with_values).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
+
+def arrow_schema(columns, dtypes):
+    """
+    Arrow schema matching the declared dtypes, used to stream typed Parquet files.
+
+    Args:
+    columns (list): Column names, in output order.
+    dtypes (dict): Column name to dtype. Columns not listed are stored as strings.
+
+    Returns:
+    pyarrow.Schema: The schema.
+    """
+    arrow_types = {
+        'int64': pa.int64(), 'Int64': pa.int64(), 'Int16': pa.int16(), 'float32': pa.float32(),
+        'string': pa.string(), 'category': pa.dictionary(pa.int32(), pa.string()),
+        'datetime64[ns]': pa.timestamp('ns'),
+    }
+    return pa.schema([(column, arrow_types[dtypes.get(column, 'string')]) for column in columns])
+
+# ------------------------------------------ MEMORY REPORTING ------------------------------------------
+def memory_report(df):
+    """
+    Measure how much memory a DataFrame really uses, strings included.
+
+    Args:
+    df (pandas.DataFrame): The DataFrame to measure.
+
+    Returns:
+    dict: total_bytes, bytes_per_row and the bytes used by each column.
+    """
+    by_column = df.memory_usage(deep=True, index=False)
+    total_bytes = int(by_column.sum())
+    return {
+        'rows': len(df),
+        'total_bytes': total_bytes,
+        'bytes_per_row': round(total_bytes / len(df), 1) if len(df) else 0,
+        'by_column': {column: int(size) for column, size in by_column.items()},
+    }
+
+def format_memory_report(report):
+    """Render a memory_report as one line, i.e. '12.3 MB, 118.4 bytes/row over 100000 rows'."""
+    return f"{report['total_bytes'] / 1e6:.1f} MB, {report['bytes_per_row']} bytes/row over {report['rows']} rows"
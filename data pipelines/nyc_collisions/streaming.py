@@ -0,0 +1,297 @@
+"""
+Streaming extract-to-S3 with bounded memory.
+
+Pages coming out of the Socrata fetchers are handed to a writer through a bounded queue,
+turned into a columnar batch, serialized as CSV or Parquet, and appended to an S3
+multipart upload. At no
+point is the whole dataset held in a Python list or a single DataFrame: memory is bounded
+by the number of chunks allowed in flight plus one multipart part buffer.
+
+CSV can be compressed with gzip or zstd on the way (see compression.py): the serialized
+chunks go through a CompressingWriter in front of the multipart upload, which adds one
+compression chunk to the bound.
+"""
+import queue
+import sys
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from nyc_collisions.compression import CompressingWriter, put_object_kwargs, resolve_content_encoding
+from nyc_collisions.formats import (
+    DEFAULT_ROW_GROUP_SIZE, content_type, parquet_codec, raw_arrow_schema, records_to_table
+)
+from nyc_collisions.schema import apply_schema, arrow_schema
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, see peak_rss_mb
+    resource = None
+
+# S3 requires every part except the last one to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+_END_OF_STREAM = object()
+
+# ------------------------------------------ MEMORY REPORTING ------------------------------------------
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process.
+
+    Returns:
+    float: Peak RSS in MiB, or None if it cannot be measured on this platform.
+    """
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+# ------------------------------------------ S3 MULTIPART UPLOAD ------------------------------------------
+class MultipartUploadWriter:
+    """
+    File-like writer that streams bytes into an S3 multipart upload.
+
+    Bytes are buffered until a part is large enough, then uploaded and released. Use it as a
+    context manager: the upload is completed on a clean exit and aborted on an exception, so
+    a failed run never leaves a half-written object behind.
+
+    Args:
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the object to create.
+    part_size (int): Bytes buffered before a part is uploaded. At least 5 MiB.
+    **create_kwargs: Extra arguments for create_multipart_upload (i.e. ContentType).
+    """
+
+    def __init__(self, aws_client, bucket_name, key_name, part_size=8 * 1024 * 1024, **create_kwargs):
+        self.aws_client = aws_client
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.create_kwargs = create_kwargs
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        self.upload_id = None
+
+    def __enter__(self):
+        response = self.aws_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key_name, **self.create_kwargs)
+        self.upload_id = response['UploadId']
+        return self
+
+    @property
+    def closed(self):
+        return False
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        """Append bytes to the object, uploading a part whenever the buffer is full."""
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.aws_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key_name,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+            )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        if exc_type is not None:
+            self.aws_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key_name, UploadId=self.upload_id)
+            return False
+
+        # The last part is allowed to be smaller than 5 MiB (and an empty object still needs one part)
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        self.aws_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key_name,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+            )
+        return False
+
+# ------------------------------------------ PIPELINE ------------------------------------------
+def prefetch(pages, max_in_flight_chunks=4):
+    """
+    Pull pages from a generator on a background thread, holding at most max_in_flight_chunks.
+
+    This lets the next Socrata request run while the current chunk is being serialized and
+    uploaded, without letting the fetcher race ahead and fill memory.
+
+    Args:
+    pages (iterable): Yields lists of records.
+    max_in_flight_chunks (int): Pages allowed to wait in the queue.
+
+    Yields:
+    list: The pages, in the order they were produced.
+    """
+    page_queue = queue.Queue(maxsize=max_in_flight_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        # Block while the queue is full, but give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(_END_OF_STREAM)
+        except Exception as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = page_queue.get()
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop the producer on an early exit and drain the queue so a put it is blocked on
+        # returns at once. The thread ends after the request it may still have in flight.
+        stop.set()
+        while True:
+            try:
+                page_queue.get_nowait()
+            except queue.Empty:
+                break
+
+def records_to_batch(records, columns, dtypes=None):
+    """
+    Turn a page of records into a columnar batch with a fixed set of columns.
+
+    Args:
+    records (list): Records as returned by the Socrata API.
+    columns (list): Column names, in output order. Columns missing from the page are left empty.
+    dtypes (dict): Column name to dtype, i.e. CRASH_DTYPES. None keeps the raw strings.
+
+    Returns:
+    pandas.DataFrame: The batch.
+    """
+    batch = pd.DataFrame.from_records(records, columns=columns)
+    return apply_schema(batch, dtypes) if dtypes else batch
+
+def records_to_arrow(records, columns, dtypes=None):
+    """Turn a page of records into an Arrow table, typed by dtypes or made of raw strings."""
+    if not dtypes:
+        return records_to_table(records, columns)
+    return pa.Table.from_pandas(records_to_batch(records, columns, dtypes), schema=arrow_schema(columns, dtypes),
+                                preserve_index=False)
+
+def stream_records_to_s3(pages, aws_client, bucket_name, key_name, columns, max_in_flight_chunks=4,
+                         part_size=8 * 1024 * 1024, output_format='csv', compression='snappy',
+                         row_group_size=DEFAULT_ROW_GROUP_SIZE, dtypes=None, content_encoding=None):
+    """
+    Stream pages of records into a single CSV or Parquet object on S3.
+
+    Args:
+    pages (iterable): Yields lists of records, i.e. iter_keyset_pages(...).
+    aws_client: Boto3 client for AWS S3.
+    bucket_name (str): Name of the S3 bucket.
+    key_name (str): Key of the object to create.
+    columns (list): Column names, in output order.
+    max_in_flight_chunks (int): Pages allowed to be fetched ahead of the writer.
+    part_size (int): Bytes per multipart part.
+    output_format (str): 'csv' or 'parquet'.
+    compression (str): Parquet codec. Ignored for CSV.
+    row_group_size (int): Rows per Parquet row group. Pages are gathered until a row group
+    is full, so this also adds to the memory bound. Ignored for CSV.
+    dtypes (dict): Column name to dtype, applied to every page as it arrives. None writes
+    the raw strings.
+    content_encoding (str): 'identity', 'gzip' or 'zstd' for CSV, None to follow the
+    S3_CONTENT_ENCODING environment variable. Ignored for Parquet. The key is used as it
+    is: give it the matching extension (see compression.encoding_extension).
+
+    Returns:
+    dict: Run summary with rows, chunks, bytes (as stored), raw_bytes (before
+    compression), content_encoding, compress_seconds, parts, seconds and peak_rss_mb.
+    """
+    start_time = time.time()
+    rows = 0
+    chunks = 0
+    content_encoding = resolve_content_encoding(content_encoding, output_format)
+    compressor = None
+
+    with MultipartUploadWriter(aws_client, bucket_name, key_name, part_size=part_size,
+                               ContentType=content_type(output_format), **put_object_kwargs(content_encoding)) as writer:
+        if output_format == 'parquet':
+            schema = arrow_schema(columns, dtypes) if dtypes else raw_arrow_schema(columns)
+            with pq.ParquetWriter(writer, schema, compression=parquet_codec(compression)) as parquet_writer:
+                pending = []
+                pending_rows = 0
+                for page in prefetch(pages, max_in_flight_chunks):
+                    pending.append(records_to_arrow(page, columns, dtypes))
+                    pending_rows += len(page)
+                    rows += len(page)
+                    chunks += 1
+                    # Gather pages into full row groups so the statistics stay useful for pushdown
+                    if pending_rows >= row_group_size:
+                        parquet_writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+                        pending, pending_rows = [], 0
+                if pending:
+                    parquet_writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+        else:
+            with CompressingWriter(writer, content_encoding) as compressor:
+                for page in prefetch(pages, max_in_flight_chunks):
+                    batch = records_to_batch(page, columns, dtypes)
+                    # Only the first chunk carries the header
+                    compressor.write(batch.to_csv(index=False, header=chunks == 0).encode('utf-8'))
+                    rows += len(batch)
+                    chunks += 1
+
+                if chunks == 0:
+                    # Keep the header so readers still see the columns of an empty extract
+                    compressor.write(records_to_batch([], columns).to_csv(index=False).encode('utf-8'))
+
+    peak_rss = peak_rss_mb()
+    return {
+        'rows': rows,
+        'chunks': chunks,
+        'bytes': writer.bytes_written,
+        'raw_bytes': compressor.bytes_in if compressor is not None else writer.bytes_written,
+        'content_encoding': content_encoding,
+        'compress_seconds': round(compressor.compress_seconds, 3) if compressor is not None else 0.0,
+        'parts': len(writer.parts),
+        'seconds': round(time.time() - start_time, 3),
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+    }
@@ -0,0 +1,127 @@
+"""
+Date/time transform shared by the ETL, the daily updates script and the Lambda.
+
+Socrata publishes crash_date as an ISO timestamp at midnight and crash_time as an 'H:MM'
+string. Both columns are parsed in one vectorized pass with pyarrow's strptime: parsing
+'H:MM' through pd.to_datetime goes value by value and is the slowest step of the ETL.
+Values that cannot be parsed become NaT and are counted in a report instead of failing
+the whole run.
+
+The borough is then filled from the zip code where it is missing (see boroughs.py), and
+every crash gets its spatial grid cells (see grid.py).
+
+Partitions written through this transform have date_time as a real timestamp (written to
+CSV as 'YYYY-MM-DD HH:MM:SS', not the ETL's old 'YYYY-MM-DDTHH:MM' string) and no
+crash_time column: the time of day lives in date_time, crash_hour and crash_minute. The
+daily updates never kept crash_time; the ETL used to keep it as a 1900-01-01 timestamp.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from nyc_collisions.boroughs import enrich_boroughs, format_borough_report
+from nyc_collisions.grid import GRID_LEVELS, add_grid_cells, format_grid_report
+
+DERIVED_COLUMNS = ['date_time', 'crash_year', 'crash_month', 'crash_day', 'crash_hour', 'crash_minute']
+
+# Malformed values quoted in the report
+MAX_INVALID_EXAMPLES = 5
+
+def _parse(values, format):
+    # Returns the parsed timestamps and the positions that were present but unparseable
+    source = pa.array(values, type=pa.string(), from_pandas=True)
+    parsed = pc.strptime(source, format=format, unit='s', error_is_null=True)
+    invalid = pc.and_(pc.is_valid(source), pc.is_null(parsed)).to_numpy(zero_copy_only=False)
+    return parsed, invalid
+
+def _to_series(array, index, dtype=None):
+    # Nullable pandas ints are built straight from Arrow, without a float64 round trip
+    if dtype is None:
+        return array.to_pandas().set_axis(index)
+    return array.to_pandas(types_mapper={array.type: dtype}.get).set_axis(index)
+
+def transform_data(dataset, date_column_name='crash_date', time_column_name='crash_time', fill_boroughs=True,
+                   grid_levels=GRID_LEVELS):
+    """
+    Parse the date and time columns and derive the columns the processed data is partitioned by.
+
+    Adds date_time (date plus time of day) and compact integer crash_year, crash_month,
+    crash_day, crash_hour and crash_minute columns in front of the others, and drops the
+    time column. Malformed dates or times become NaT / <NA> instead of raising. The borough
+    becomes a categorical, filled from the zip code where it is missing. The coordinates are
+    checked (geo_status) and mapped to a grid_cell_<level> column per grid level.
+
+    Args:
+    dataset (pandas.DataFrame): The dataset to transform.
+    date_column_name (str): The name of the column containing the date information.
+    time_column_name (str): The name of the column containing the 'H:MM' time information.
+    fill_boroughs (bool): Normalize and fill the borough column from zip_code.
+    grid_levels (tuple): Grid levels to add cell columns for. Empty to skip the grid.
+
+    Returns:
+    tuple: The transformed DataFrame and a report dict with rows, invalid_dates,
+    invalid_times, a few invalid examples, boroughs (the enrich_boroughs report, None when
+    skipped), grid (the add_grid_cells report, None when skipped), seconds and rows_per_second.
+    """
+    start_time = time.perf_counter()
+    dates_column = dataset[date_column_name]
+    times_column = dataset[time_column_name]
+
+    if pd.api.types.is_datetime64_any_dtype(dates_column):
+        dates = pa.array(dates_column, from_pandas=True)
+        invalid_dates = np.zeros(len(dataset), dtype=bool)
+    else:
+        # Only the 'YYYY-MM-DD' prefix matters: it covers both '2024-01-31' and '2024-01-31T00:00:00.000'
+        prefixes = pc.utf8_slice_codeunits(pa.array(dates_column, type=pa.string(), from_pandas=True), 0, 10)
+        dates, invalid_dates = _parse(prefixes, '%Y-%m-%d')
+    times, invalid_times = _parse(times_column, '%H:%M')
+
+    index = dataset.index
+    crash_date = _to_series(dates, index)
+    hours = _to_series(pc.cast(pc.hour(times), pa.int8()), index, pd.Int8Dtype())
+    minutes = _to_series(pc.cast(pc.minute(times), pa.int8()), index, pd.Int8Dtype())
+
+    derived = pd.DataFrame({
+        'date_time': crash_date + pd.to_timedelta(hours.astype('float64'), unit='h')
+                     + pd.to_timedelta(minutes.astype('float64'), unit='m'),
+        'crash_year': _to_series(pc.cast(pc.year(dates), pa.int16()), index, pd.Int16Dtype()),
+        'crash_month': _to_series(pc.cast(pc.month(dates), pa.int8()), index, pd.Int8Dtype()),
+        'crash_day': _to_series(pc.cast(pc.day(dates), pa.int8()), index, pd.Int8Dtype()),
+        'crash_hour': hours,
+        'crash_minute': minutes,
+    }, index=index)
+
+    remaining = dataset.drop(columns=[time_column_name] + [column for column in DERIVED_COLUMNS if column in dataset.columns])
+    remaining[date_column_name] = crash_date
+    transformed = pd.concat([derived, remaining], axis=1)
+    borough_report = enrich_boroughs(transformed) if fill_boroughs else None
+    grid_report = add_grid_cells(transformed, grid_levels) if grid_levels else None
+
+    seconds = time.perf_counter() - start_time
+    report = {
+        'rows': len(transformed),
+        'invalid_dates': int(invalid_dates.sum()),
+        'invalid_times': int(invalid_times.sum()),
+        'invalid_date_examples': dates_column[invalid_dates].head(MAX_INVALID_EXAMPLES).tolist(),
+        'invalid_time_examples': times_column[invalid_times].head(MAX_INVALID_EXAMPLES).tolist(),
+        'boroughs': borough_report,
+        'grid': grid_report,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(len(transformed) / seconds) if seconds else None,
+    }
+    return transformed, report
+
+def print_transform_report(report):
+    """Print the outcome of transform_data, including any malformed dates or times."""
+    print(f"Data has been transformed! {report['rows']} rows in {report['seconds']} seconds")
+    if report['invalid_dates']:
+        print(f"Invalid dates set to NaT: {report['invalid_dates']} (i.e. {report['invalid_date_examples']})")
+    if report['invalid_times']:
+        print(f"Invalid times set to NaT: {report['invalid_times']} (i.e. {report['invalid_time_examples']})")
+    if report.get('boroughs'):
+        print(format_borough_report(report['boroughs']))
+    if report.get('grid'):
+        print(format_grid_report(report['grid']))